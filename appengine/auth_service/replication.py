@@ -5,6 +5,7 @@
 """Primary side of Primary <-> Replica protocol."""
 
 import base64
+import collections
 import datetime
 import hashlib
 import logging
@@ -39,6 +40,15 @@ PUSH_STATUS_FATAL_ERROR = 2
 MAX_SHARD_SIZE = 900*1024
 
 
+# Serialized AuthDBDelta along with its signature, see pack_auth_db_delta.
+_SignedDelta = collections.namedtuple('_SignedDelta', [
+  'base_auth_db_rev',  # revision the delta should be applied to
+  'blob',              # serialized AuthDBDelta
+  'key_name',          # name of a RSA key used to generate the signature
+  'sig',               # base64 encoded signature of the blob
+])
+
+
 class ReplicationTriggerError(Exception):
   """Failed to trigger a replication task."""
 
@@ -336,11 +346,29 @@ def update_replicas_task(auth_db_rev):
     logging.info('All replicas are up-to-date.')
     return True
 
-  # Push the blob to all out-of-date replicas, in parallel.
+  # Replicas at the previous revision get only the difference with it, which is
+  # usually much smaller than the entire AuthDB.
+  delta = None
+  base_rev = replication_state.auth_db_rev - 1
+  if any(replica.auth_db_rev == base_rev for replica in stale_replicas):
+    # The delta is only an optimization, full pushes must happen regardless.
+    try:
+      delta_blob = pack_auth_db_delta(base_rev, auth_db_blob)
+      if delta_blob:
+        delta_key_name, delta_sig = signature.sign_blob(
+            hashlib.sha512(delta_blob).digest())
+        delta = _SignedDelta(
+            base_rev, delta_blob, delta_key_name, base64.b64encode(delta_sig))
+    except Exception:
+      logging.exception('Failed to make AuthDB delta from rev %d', base_rev)
+      delta = None
+
+  # Push the update to all out-of-date replicas, in parallel.
   push_started_ts = utils.utcnow()
   futures = {
-    push_to_replica(
-        replica.replica_url, auth_db_blob, key_name, sig_b64): replica
+    push_update_to_replica(
+        replica, replication_state.auth_db_rev, auth_db_blob, key_name,
+        sig_b64, delta): replica
     for replica in stale_replicas
   }
 
@@ -432,6 +460,39 @@ def pack_auth_db():
   return state, auth_db_blob
 
 
+def pack_auth_db_delta(base_auth_db_rev, auth_db_blob):
+  """Packs the difference between a stored AuthDB snapshot and a new AuthDB.
+
+  Args:
+    base_auth_db_rev: revision of the stored AuthDBSnapshot to diff against.
+    auth_db_blob: serialized ReplicationPushRequest with the new AuthDB.
+
+  Returns:
+    Blob with serialized AuthDBDelta or None if there's no base snapshot.
+  """
+  base = get_auth_db_snapshot(base_auth_db_rev, skip_body=False)
+  if not base:
+    logging.warning(
+        'No AuthDB snapshot at rev %d to diff with', base_auth_db_rev)
+    return None
+  base_req = replication_pb2.ReplicationPushRequest.FromString(
+      zlib.decompress(base.auth_db_deflated))
+  del base
+  req = replication_pb2.ReplicationPushRequest.FromString(auth_db_blob)
+
+  delta = replication.make_auth_db_delta(base_req.auth_db, req.auth_db)
+  delta.revision.CopyFrom(req.revision)
+  delta.base_auth_db_rev = base_auth_db_rev
+  delta.auth_code_version = req.auth_code_version
+  delta_blob = delta.SerializeToString()
+
+  logging.info(
+      'AuthDB delta %d->%d is %d bytes (full AuthDB blob is %d bytes)',
+      base_auth_db_rev, req.revision.auth_db_rev, len(delta_blob),
+      len(auth_db_blob))
+  return delta_blob
+
+
 def store_auth_db_snapshot(replication_state, auth_db_blob):
   """Puts AuthDB blob (serialized proto) into datastore.
 
@@ -508,7 +569,51 @@ def upload_to_gs(replication_state, auth_db_blob, key_name, sig):
 
 
 @ndb.tasklet
-def push_to_replica(replica_url, auth_db_blob, key_name, sig):
+def push_update_to_replica(
+    replica, auth_db_rev, auth_db_blob, key_name, sig, delta=None):
+  """Pushes AuthDB to a replica, as a delta if possible.
+
+  The delta is pushed only if the replica is known to be at its base revision.
+  If the replica doesn't apply it (e.g. it doesn't have AuthDB at the base
+  revision or doesn't support deltas), falls back to pushing |auth_db_blob|.
+
+  Args:
+    replica: AuthReplicaState of the replica to push to.
+    auth_db_rev: revision of AuthDB being pushed.
+    auth_db_blob: binary blob with serialized ReplicationPushRequest.
+    key_name: name of a RSA key used to generate a signature.
+    sig: base64 encoded signature of |auth_db_blob|.
+    delta: _SignedDelta with changes since the previous revision or None.
+
+  Returns:
+    Same as push_to_replica.
+
+  Raises:
+    Same as push_to_replica.
+  """
+  if delta and replica.auth_db_rev == delta.base_auth_db_rev:
+    try:
+      current_revision, auth_code_version = yield push_to_replica(
+          replica.replica_url, delta.blob, delta.key_name, delta.sig,
+          delta=True)
+    except Exception as exc:  # pylint: disable=broad-except
+      logging.warning(
+          'Failed to push AuthDB delta to replica %s, pushing full AuthDB: '
+          '%s (%s)', replica.key.id(), exc.__class__.__name__, exc)
+    else:
+      if current_revision.auth_db_rev >= auth_db_rev:
+        raise ndb.Return((current_revision, auth_code_version))
+      logging.warning(
+          'Replica %s skipped AuthDB delta (its rev is %d), pushing full '
+          'AuthDB',
+          replica.key.id(), current_revision.auth_db_rev)
+  result = yield push_to_replica(
+      replica.replica_url, auth_db_blob, key_name, sig)
+  raise ndb.Return(result)
+
+
+@ndb.tasklet
+def push_to_replica(replica_url, auth_db_blob, key_name, sig, delta=False):
   """Pushes |auth_db_blob| to a replica via URLFetch POST.
 
   Args:
@@ -516,6 +621,7 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
     auth_db_blob: binary blob with serialized Auth DB.
     key_name: name of a RSA key used to generate a signature.
     sig: base64 encoded signature of |auth_db_blob|.
+    delta: True if |auth_db_blob| is serialized AuthDBDelta.
 
   Returns:
     Tuple:
@@ -546,9 +652,12 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
   # 'follow_redirects' set to False is required for 'X-Appengine-Inbound-Appid'
   # to work. 70 sec deadline correspond to 60 sec GAE foreground requests
   # deadline plus 10 seconds to account for URL fetch own lags.
+  url = replica_url + '/auth/api/v1/internal/replication'
+  if delta:
+    url += '/delta'
   ctx = ndb.get_context()
   result = yield ctx.urlfetch(
-      url=replica_url + '/auth/api/v1/internal/replication',
+      url=url,
       payload=auth_db_blob,
       method='POST',
       headers=headers,
@@ -3,15 +3,32 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import datetime
 import unittest
 
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.ext import ndb
+
+from components.auth import model
+from components.auth import replication as auth_replication
+from components.auth.proto import delta_pb2
+from components.auth.proto import replication_pb2
 from test_support import test_case
 import replication
 
 
+def make_auth_db_blob(rev, groups):
+  """Returns serialized ReplicationPushRequest with given group names."""
+  req = replication_pb2.ReplicationPushRequest()
+  req.revision.primary_id = 'primary'
+  req.revision.auth_db_rev = rev
+  req.auth_db.groups.extend(
+      replication_pb2.AuthGroup(name=name) for name in groups)
+  return req.SerializeToString()
+
+
 class ReplicationTest(test_case.TestCase):
   def test_sharding(self):
     shard_ids = replication.shard_authdb(123, '0123456789', max_size=3)
@@ -20,6 +37,62 @@ class ReplicationTest(test_case.TestCase):
     blob = replication.unshard_authdb(shard_ids)
     self.assertEqual(blob, '0123456789')
 
+  def test_pack_auth_db_delta(self):
+    self.assertIsNone(
+        replication.pack_auth_db_delta(1, make_auth_db_blob(2, ['a'])))
+
+    replication.store_auth_db_snapshot(
+        model.AuthReplicationState(
+            auth_db_rev=1, modified_ts=datetime.datetime(2020, 1, 1)),
+        make_auth_db_blob(1, ['a', 'b']))
+    blob = make_auth_db_blob(2, ['a', 'c'])
+    delta = delta_pb2.AuthDBDelta.FromString(
+        replication.pack_auth_db_delta(1, blob))
+    self.assertEqual(1, delta.base_auth_db_rev)
+    self.assertEqual(2, delta.revision.auth_db_rev)
+    self.assertEqual(['c'], [g.name for g in delta.auth_db.groups])
+    self.assertEqual(['b'], list(delta.removed_groups))
+
+    base = replication_pb2.ReplicationPushRequest.FromString(
+        make_auth_db_blob(1, ['a', 'b'])).auth_db
+    self.assertEqual(
+        replication_pb2.ReplicationPushRequest.FromString(blob).auth_db,
+        auth_replication.apply_auth_db_delta(base, delta))
+
+  def test_push_update_to_replica(self):
+    def push(replica_rev, delta_outcome):
+      calls = []
+      def push_to_replica(_url, blob, _key_name, _sig, delta=False):
+        calls.append(blob)
+        f = ndb.Future()
+        if delta and isinstance(delta_outcome, Exception):
+          f.set_exception(delta_outcome)
+        else:
+          rev = delta_outcome if delta else 2
+          f.set_result((replication_pb2.AuthDBRevision(auth_db_rev=rev), 'v'))
+        return f
+      self.mock(replication, 'push_to_replica', push_to_replica)
+      replica = replication.AuthReplicaState(
+          key=replication.replica_state_key('replica'),
+          replica_url='https://replica',
+          auth_db_rev=replica_rev)
+      current_revision, _ = replication.push_update_to_replica(
+          replica, 2, 'full', 'key', 'sig',
+          replication._SignedDelta(1, 'delta', 'key', 'sig')).get_result()
+      self.assertEqual(2, current_revision.auth_db_rev)
+      return calls
+
+    # Delta is applied.
+    self.assertEqual(['delta'], push(1, 2))
+    # Replica doesn't have the base revision.
+    self.assertEqual(['delta', 'full'], push(1, 1))
+    # Replica failed to apply the delta.
+    self.assertEqual(
+        ['delta', 'full'],
+        push(1, replication.TransientReplicaUpdateError('boom')))
+    # Replica is not at the base revision.
+    self.assertEqual(['full'], push(0, 2))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -22,6 +22,11 @@ import time
 
 from six.moves import urllib
 
+try:
+  import resource
+except ImportError:
+  resource = None
+
 from google.appengine.api import app_identity
 from google.appengine.api import oauth
 from google.appengine.api import urlfetch
@@ -32,12 +37,14 @@ from components.datastore_utils import config as ds_config
 from components import utils
 
 from . import config
+from . import globmatch
 from . import ipaddr
 from . import model
 from . import realms
 from . import replication
 from .proto import delegation_pb2
 from .proto import realms_pb2
+from .proto import replication_pb2
 from .proto import security_config_pb2
 
 # Part of public API of 'auth' component, exposed by this module.
@@ -51,6 +58,7 @@ __all__ = [
     'SecretKey',
     'autologin',
     'disable_process_cache',
+    'enable_membership_index',
     'get_auth_details',
     'get_current_identity',
     'get_delegation_token',
@@ -99,6 +107,12 @@ _auth_db_expiration = None
 # Holds id of a thread that is currently fetching AuthDB (or None).
 _auth_db_fetching_thread = None
 
+# True if AuthDB resolves group memberships through an index and memoizes them
+# per identity, see enable_membership_index.
+_membership_index_enabled = False
+# Maximum number of identities with memoized group memberships per AuthDB.
+_MEMBERSHIP_MEMO_SIZE = 10000
+
 # Limits concurrent fetches of AuthDB.
 #
 # We don't want multiple threads fetching heavy AuthDB objects concurrently,
@@ -197,6 +211,70 @@ ConditionalPrincipalsSet = collections.namedtuple('ConditionalPrincipalsSet', [
 ])
 
 
+class _LazyGroups(object):
+  """Read only {group name => CachedGroup} built from AuthGroup protos.
+
+  Groups are kept serialized until the first access to them, so a freshly
+  loaded AuthDB can be used right away and doesn't keep the parsed AuthDB proto
+  alive. Lookups through indexes (see AuthDB._indexes) convert all groups.
+  """
+
+  def __init__(self, groups_pb):
+    # {group name => serialized replication_pb2.AuthGroup or CachedGroup}.
+    self._groups = {}
+    # {group name => tuple of IdentityGlob}, only for groups that have globs.
+    self._globs = {}
+    for gr in groups_pb:
+      self._groups[gr.name] = gr.SerializeToString()
+      if gr.globs:
+        self._globs[gr.name] = tuple(
+            model.IdentityGlob.from_bytes(x) for x in gr.globs)
+
+  def iter_globs(self):
+    """Yields (group name, tuple of IdentityGlob) for groups that have globs."""
+    return self._globs.iteritems()
+
+  def get(self, name, default=None):
+    gr = self._groups.get(name)
+    if gr is None:
+      return default
+    if not isinstance(gr, CachedGroup):
+      gr = replication_pb2.AuthGroup.FromString(gr)
+      gr = CachedGroup(
+          members=frozenset(gr.members),
+          globs=self._globs.get(name, ()),
+          nested=tuple(gr.nested),
+          description=gr.description,
+          owners=gr.owners or model.ADMIN_GROUP,
+          created_ts=utils.timestamp_to_datetime(gr.created_ts),
+          created_by=model.Identity.from_bytes(gr.created_by),
+          modified_ts=utils.timestamp_to_datetime(gr.modified_ts),
+          modified_by=model.Identity.from_bytes(gr.modified_by))
+      self._groups[name] = gr
+    return gr
+
+  def __getitem__(self, name):
+    gr = self.get(name)
+    if gr is None:
+      raise KeyError(name)
+    return gr
+
+  def __contains__(self, name):
+    return name in self._groups
+
+  def __len__(self):
+    return len(self._groups)
+
+  def __iter__(self):
+    return iter(self._groups)
+
+  def keys(self):
+    return self._groups.keys()
+
+  def items(self):
+    return [(name, self.get(name)) for name in self._groups]
+
+
 class AuthDB(object):
   """A read only in-memory database of auth configuration of a service.
 
@@ -286,19 +364,6 @@ class AuthDB(object):
     Returns:
       New AuthDB instance.
     """
-    cached_groups = {}
-    for gr in auth_db.groups:
-      cached_groups[gr.name] = CachedGroup(
-          members=frozenset(gr.members),
-          globs=tuple(model.IdentityGlob.from_bytes(x) for x in gr.globs),
-          nested=tuple(gr.nested),
-          description=gr.description,
-          owners=gr.owners or model.ADMIN_GROUP,
-          created_ts=utils.timestamp_to_datetime(gr.created_ts),
-          created_by=model.Identity.from_bytes(gr.created_by),
-          modified_ts=utils.timestamp_to_datetime(gr.modified_ts),
-          modified_by=model.Identity.from_bytes(gr.modified_by))
-
     return AuthDB(
         from_what='from_proto',
         replication_state=replication_state,
@@ -308,7 +373,7 @@ class AuthDB(object):
             oauth_additional_client_ids=list(
                 auth_db.oauth_additional_client_ids)),
         token_server_url=auth_db.token_server_url,
-        groups=cached_groups,
+        groups=_LazyGroups(auth_db.groups),
         ip_whitelist_assignments={
             model.Identity.from_bytes(e.identity): e.ip_whitelist
             for e in auth_db.ip_whitelist_assignments
@@ -328,7 +393,7 @@ class AuthDB(object):
         replication_state,         # AuthReplicationState
         oauth_config,              # OAuthConfig
         token_server_url,          # str
-        groups,                    # {str -> CachedGroup}
+        groups,                    # {str -> CachedGroup} or _LazyGroups
         ip_whitelist_assignments,  # {Identity -> str}
         ip_whitelists,             # {str -> [str]}
         realms_pb,                 # realms_pb2.Realms or None
@@ -340,7 +405,9 @@ class AuthDB(object):
     self._oauth_config = oauth_config
     self._token_server_url = token_server_url
     self._groups = groups
+    self._globs = self._compile_globs(groups)
     self._ip_whitelists = ip_whitelists
+    self._ip_whitelist_subnets = self._parse_ip_whitelists(ip_whitelists)
     self._ip_whitelist_assignments = ip_whitelist_assignments
 
     # Secrets are loaded lazily in get_secret.
@@ -358,10 +425,12 @@ class AuthDB(object):
       client_ids.extend(additional_client_ids)
     self._allowed_client_ids = set(c for c in client_ids if c)
 
-    # These are populated from realms_pb2.Realms.
+    # These are populated from realms_pb2.Realms. Realms are built lazily in
+    # _get_realms from _realms_pb.
     self._use_realms = realms_pb is not None
     self._permissions = {}  # {str name -> int index}
     self._realms = {}       # {str name -> CachedRealm}
+    self._realms_pb = None  # realms_pb2.Realms not yet converted to _realms
     if realms_pb:
       with _all_perms_lock:
         registered_perms = list(_all_perms)
@@ -380,10 +449,73 @@ class AuthDB(object):
     self._nested_idx = None
     self._owned_idx = None
 
+    # Lazy-initialized memo of group memberships. See _groups_of().
+    self._memo_lock = threading.Lock()
+    self._memo = collections.OrderedDict()
+
+    # Time it took to load and construct this AuthDB (in sec), if known. Set by
+    # fetch_auth_db, reported by _roll_auth_db_cache.
+    self._load_time = None
+    # time.time() when loading of this AuthDB started, until the first check
+    # (is_group_member or has_permission) is done. See _report_first_check.
+    self._load_started = None
+
+  @staticmethod
+  def _parse_ip_whitelists(ip_whitelists):
+    """Parses subnets of all IP whitelists into a single ipaddr.SubnetSet.
+
+    Values attached to subnets are names of whitelists they belong to. Invalid
+    subnets are skipped.
+    """
+    out = ipaddr.SubnetSet()
+    for name, subnets in sorted(ip_whitelists.items()):
+      for net in subnets:
+        try:
+          out.add(ipaddr.subnet_from_string(net), name)
+        except ValueError as exc:
+          logging.error('Bad subnet %r in IP whitelist %s: %s', net, name, exc)
+    return out
+
+  @staticmethod
+  def _compile_globs(groups):
+    """Compiles globs of all groups into a matcher per identity kind.
+
+    Returns:
+      {identity kind => (GlobSet, [(IdentityGlob, [group names])])}, where
+      GlobSet patterns are in the same order as the list, sorted by glob.
+    """
+    if isinstance(groups, _LazyGroups):
+      pairs = groups.iter_globs()
+    else:
+      pairs = ((name, group.globs) for name, group in groups.items())
+    globs = collections.defaultdict(list)
+    for name, group_globs in sorted(pairs):
+      for glob in group_globs:
+        globs[glob].append(name)
+    by_kind = collections.defaultdict(list)
+    for glob, names in sorted(globs.items()):
+      by_kind[glob.kind].append((glob, names))
+    return {
+        kind: (globmatch.GlobSet([glob.pattern for glob, _ in items]), items)
+        for kind, items in by_kind.items()
+    }
+
+  def _matching_globs(self, identity):
+    """Returns [(IdentityGlob, [group names])] for globs matching |identity|.
+
+    The list is sorted by glob, group names are sorted too.
+    """
+    compiled = self._globs.get(identity.kind)
+    if not compiled:
+      return []
+    glob_set, items = compiled
+    return [items[i] for i in glob_set.match(identity.name)]
+
   def _init_realms(self, realms_pb, registered_perms):
-    """Preprocesses realms_pb2.Realms into a slightly more efficient form.
+    """Validates realms_pb2.Realms and builds the map of permissions.
 
-    Populates `_permissions` and `_realms`.
+    Populates `_permissions` and `_realms_pb`. Realms themselves are
+    preprocessed later, on the first access, by _get_realms.
 
     Args:
       realms_pb: a realms_pb2.Realms message.
@@ -396,8 +528,6 @@ class AuthDB(object):
     assert not self._permissions
     assert not self._realms
 
-    logging.info('Loading realms...')
-
     # Do not use realm_pb2.Realms we don't understand. Better to go offline
     # completely than mistakenly allow access to something private by
     # misinterpreting realm rules (e.g. if a new hypothetical DENY rule is
@@ -427,6 +557,29 @@ class AuthDB(object):
         logging.warning(
             'Permission %r is not in the AuthDB rev %d', p, self.auth_db_rev)
 
+    self._realms = None
+    self._realms_pb = realms_pb
+
+  def _get_realms(self):
+    """Lazily preprocesses realms_pb2.Realms into a more efficient form.
+
+    Returns:
+      {str name -> CachedRealm}.
+    """
+    realms_map = self._realms
+    if realms_map is not None:
+      return realms_map
+    with self._lock:
+      if self._realms is None:
+        self._realms = self._build_realms(self._realms_pb)
+        self._realms_pb = None
+      return self._realms
+
+  @staticmethod
+  def _build_realms(realms_pb):
+    """Returns {str name -> CachedRealm} given realms_pb2.Realms."""
+    logging.info('Loading %d realms...', len(realms_pb.realms))
+
     # Lazily convert conditions into predicate lambdas.
     conds = {}
     def condition(idx):
@@ -445,6 +598,7 @@ class AuthDB(object):
     # message) without trying to merge them in any way. That way multiple
     # per_permission_sets entries may share the same ConditionalPrincipalsSet
     # object. The expense is more computations during has_permission(...).
+    out = {}
     for realm in realms_pb.realms:
       per_permission_sets = {}  # permission index => [ConditionalPrincipalsSet]
       for b in realm.bindings:
@@ -460,9 +614,10 @@ class AuthDB(object):
             tuple(condition(idx) for idx in b.conditions))
         for perm_idx in b.permissions:
           per_permission_sets.setdefault(perm_idx, []).append(principals_set)
-      self._realms[realm.name] = CachedRealm(per_permission_sets, realm.data)
+      out[realm.name] = CachedRealm(per_permission_sets, realm.data)
 
-    logging.info('Loaded %d realms', len(self._realms))
+    logging.info('Loaded %d realms', len(out))
+    return out
 
   def _init_security_config(self, blob):
     """Parses and interprets security_config_pb2.SecurityConfig."""
@@ -478,9 +633,7 @@ class AuthDB(object):
     that directly include it (i.e. NOT via glob or a nested subgroup).
 
     The globs index is a map from IdentityGlob to a list of groups that directly
-    include it. We store it as an OrderedDict to make 'get_relevant_subgraph'
-    output deterministic (it linearly traverses through globs index keys at some
-    point).
+    include it, as an OrderedDict sorted by glob.
 
     THe nested groups index is a map from a group name to a list of groups that
     directly include it.
@@ -558,9 +711,31 @@ class AuthDB(object):
 
     Unknown groups are considered empty.
     """
+    started = self._load_started
+    if started is not None:
+      self._load_started = None
+      try:
+        return self._is_group_member(group_name, identity)
+      finally:
+        _report_first_check(self, started)
+    return self._is_group_member(group_name, identity)
+
+  def _is_group_member(self, group_name, identity):
+    """Implementation of is_group_member."""
+    if _membership_index_enabled:
+      if group_name == model.GROUP_ALL:
+        return True
+      if group_name not in self._groups:
+        logging.warning('Querying unknown group: %s', group_name)
+        return False
+      return group_name in self._groups_of(identity)
+
     # Will be used when checking self._groups[...].members sets.
     ident_as_bytes = identity.to_bytes()
 
+    # Groups that include |identity| via a glob, found on first use.
+    with_glob = []
+
     # While the code to add groups refuses to add cycle, this code ensures that
     # it doesn't go in a cycle by keeping track of the groups currently being
     # visited via |current| stack.
@@ -602,8 +777,13 @@ class AuthDB(object):
         if ident_as_bytes in group_obj.members:
           return True
 
-        if any(glob.match(identity) for glob in group_obj.globs):
-          return True
+        if group_obj.globs:
+          if not with_glob:
+            with_glob.append(set(
+                name for _, names in self._matching_globs(identity)
+                for name in names))
+          if group_name in with_glob[0]:
+            return True
 
         return any(is_member(nested) for nested in group_obj.nested)
       finally:
@@ -612,6 +792,43 @@ class AuthDB(object):
 
     return is_member(group_name)
 
+  def _groups_of(self, identity):
+    """Returns a frozenset with names of all groups |identity| belongs to.
+
+    Walks the group graph upwards, starting from groups that include |identity|
+    directly or via a glob, using indexes built once per AuthDB. This never
+    expands members of nested groups, so memory usage doesn't depend on the
+    size of groups. Results are memoized for _MEMBERSHIP_MEMO_SIZE most
+    recently used identities.
+    """
+    ident_as_bytes = identity.to_bytes()
+    with self._memo_lock:
+      groups = self._memo.pop(ident_as_bytes, None)
+      if groups is not None:
+        self._memo[ident_as_bytes] = groups
+        return groups
+
+    members_idx, _, nested_idx, _ = self._indexes()
+    found = set(members_idx.get(ident_as_bytes, ()))
+    for _, names in self._matching_globs(identity):
+      found.update(names)
+    # Groups that nest the wildcard group include everyone. Unknown groups
+    # never show up, since only existing groups are in the indexes values.
+    found.add(model.GROUP_ALL)
+    pending = list(found)
+    while pending:
+      for parent in nested_idx.get(pending.pop(), ()):
+        if parent not in found:
+          found.add(parent)
+          pending.append(parent)
+    groups = frozenset(found)
+
+    with self._memo_lock:
+      self._memo[ident_as_bytes] = groups
+      if len(self._memo) > _MEMBERSHIP_MEMO_SIZE:
+        self._memo.popitem(last=False)
+    return groups
+
   def get_group(self, group_name):
     """Returns AuthGroup entity reconstructing it from the cache.
 
@@ -752,13 +969,12 @@ class AuthDB(object):
       graph.root_id, _ = add_node(principal)
 
       # Find all globs that match the identity. The identity will belong to
-      # all groups the globs belong to. Note that 'globs_idx' is OrderedDict.
-      for glob, groups_that_have_glob in globs_idx.items():
-        if glob.match(principal):
-          glob_id, _ = add_node(glob)
-          add_edge(graph.root_id, Graph.IN, glob_id)
-          for group in groups_that_have_glob:
-            add_edge(glob_id, Graph.IN, traverse(group))
+      # all groups the globs belong to. Note that they are sorted.
+      for glob, groups_that_have_glob in self._matching_globs(principal):
+        glob_id, _ = add_node(glob)
+        add_edge(graph.root_id, Graph.IN, glob_id)
+        for group in groups_that_have_glob:
+          add_edge(glob_id, Graph.IN, traverse(group))
 
       # Find all groups that directly mention the identity.
       for group in members_idx.get(principal.to_bytes(), ()):
@@ -807,11 +1023,15 @@ class AuthDB(object):
       if warn_if_missing:
         logging.error('Unknown IP whitelist: %s', whitelist_name)
       return False
-    # TODO(vadimsh): If number of subnets to check grows it makes sense to add
-    # an internal cache to 'subnet_from_string' (sort of like in re.compile).
-    return any(
-        ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
-        for net in subnets)
+    return self._ip_whitelist_subnets.contains(ip, whitelist_name)
+
+  def get_ip_whitelists_with_ip(self, ip):
+    """Returns a sorted list with names of all IP whitelists containing the IP.
+
+    Args:
+      ip: instance of ipaddr.IP.
+    """
+    return sorted(self._ip_whitelist_subnets.lookup(ip))
 
   def verify_ip_whitelisted(self, identity, ip):
     """Verifies IP is in a whitelist assigned to the Identity.
@@ -859,6 +1079,17 @@ class AuthDB(object):
 
     See has_permission() function below for more info.
     """
+    started = self._load_started
+    if started is not None:
+      self._load_started = None
+      try:
+        return self._has_permission(permission, realms, identity, attributes)
+      finally:
+        _report_first_check(self, started)
+    return self._has_permission(permission, realms, identity, attributes)
+
+  def _has_permission(self, permission, realms, identity, attributes):
+    """Implementation of has_permission."""
     self._check_realms_available()
 
     if not attributes:
@@ -949,7 +1180,8 @@ class AuthDB(object):
     """
     if not isinstance(name, basestring):
       raise TypeError('Bad realm: got %s, want a string' % (type(name),))
-    realm = self._realms.get(name)
+    realms_map = self._get_realms()
+    realm = realms_map.get(name)
     if realm:
       return realm
 
@@ -970,7 +1202,7 @@ class AuthDB(object):
       return None
 
     # Fallback to the root and log the outcome.
-    root = self._realms.get(root_name)
+    root = realms_map.get(root_name)
     if root:
       if perm:
         logging.warning(
@@ -1410,6 +1642,21 @@ def disable_process_cache():
   _process_cache_expiration_sec = 0
 
 
+def enable_membership_index():
+  """Makes AuthDB resolve group memberships through an index.
+
+  All groups an identity belongs to are then found at once on its first
+  membership check and memoized in the AuthDB (i.e. per AuthDB revision) for a
+  bounded number of recently used identities, making repeated checks for the
+  same identity (e.g. realm ACL checks for the same bot) O(1).
+
+  Useful for services doing many ACL checks. Should be called at the process
+  startup, e.g. in appengine_config.py.
+  """
+  global _membership_index_enabled
+  _membership_index_enabled = True
+
+
 def get_process_cache_expiration_sec():
   """How long auth db is cached in process memory."""
   return _process_cache_expiration_sec
@@ -1528,6 +1775,7 @@ def fetch_auth_db(known_auth_db=None):
   # In Replica mode load AuthDB snapshot proto stored in the datastore as is.
   # It is put there by replication.push_auth_db(...) when the replica receives
   # AuthDB pushes from the primary.
+  start = time.time()
   auth_db = replication.load_sharded_auth_db(
       replication_state.primary_url,
       replication_state.auth_db_rev,
@@ -1540,7 +1788,10 @@ def fetch_auth_db(known_auth_db=None):
             replication_state.auth_db_rev,
             ', '.join(replication_state.shard_ids),
         ))
-  return AuthDB.from_proto(replication_state, auth_db, additional_client_ids)
+  out = AuthDB.from_proto(replication_state, auth_db, additional_client_ids)
+  out._load_time = time.time() - start
+  out._load_started = start
+  return out
 
 
 def reset_local_state():
@@ -1684,6 +1935,32 @@ def _initialize_auth_db_cache():
   return _auth_db
 
 
+def _peak_rss():
+  """Returns peak RSS of the process as a string for logs."""
+  if not resource:
+    return 'unknown'
+  # ru_maxrss is in KB on Linux.
+  return '%.1f MB' % (
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+
+def _report_auth_db_load(auth_db):
+  """Logs how long it took to load |auth_db| and the process peak RSS."""
+  if auth_db._load_time is None:
+    return
+  logging.info(
+      'AuthDB rev %d was loaded in %.2f sec, peak RSS %s',
+      auth_db.auth_db_rev, auth_db._load_time, _peak_rss())
+
+
+def _report_first_check(auth_db, started):
+  """Logs time from the start of |auth_db| load to the end of its first check.
+  """
+  logging.info(
+      'AuthDB rev %d did its first check %.2f sec after the load started, '
+      'peak RSS %s', auth_db.auth_db_rev, time.time() - started, _peak_rss())
+
+
 def _roll_auth_db_cache(candidate):
   """Updates _auth_db if the given candidate AuthDB is fresher.
 
@@ -1695,6 +1972,7 @@ def _roll_auth_db_cache(candidate):
   # This may happen after 'reset_local_state' call.
   if _auth_db is None:
     logging.info('Fetched AuthDB at rev %d', candidate.auth_db_rev)
+    _report_auth_db_load(candidate)
     _auth_db = candidate
     _auth_db_expiration = time.time() + _process_cache_expiration_sec
     return _auth_db
@@ -1707,6 +1985,7 @@ def _roll_auth_db_cache(candidate):
         'AuthDB primary changed %s (rev %d) -> %s (rev %d)',
         _auth_db.primary_id, _auth_db.auth_db_rev,
         candidate.primary_id, candidate.auth_db_rev)
+    _report_auth_db_load(candidate)
     _auth_db = candidate
     _auth_db_expiration = time.time() + _process_cache_expiration_sec
     return _auth_db
@@ -1727,6 +2006,7 @@ def _roll_auth_db_cache(candidate):
     logging.info('Updated cached AuthDB: rev %d->%d (%d groups)',
                  _auth_db.auth_db_rev, candidate.auth_db_rev,
                  candidate.group_count)
+    _report_auth_db_load(candidate)
     _auth_db = candidate
   else:
     logging.info('Reusing cached AuthDB rev %d', _auth_db.auth_db_rev)
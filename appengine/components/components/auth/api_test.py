@@ -4,8 +4,10 @@
 # that can be found in the LICENSE file.
 
 import datetime
+import logging
 import sys
 import threading
+import time
 import unittest
 
 from six.moves import queue
@@ -141,6 +143,40 @@ class AuthDBTest(test_case.TestCase):
     self.assertFalse(
         is_member([with_nesting, with_listing], model.Anonymous, 'WithNesting'))
 
+  def test_is_group_member_with_index(self):
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    bob = model.Identity(model.IDENTITY_USER, 'bob@example.com')
+    groups = [
+        model.AuthGroup(id='WithGlob', globs=[
+            model.IdentityGlob(model.IDENTITY_USER, '*@example.com')]),
+        model.AuthGroup(id='WithListing', members=[joe]),
+        model.AuthGroup(id='WithNesting', nested=['WithListing']),
+        model.AuthGroup(id='Diamond', nested=['WithNesting', 'WithListing']),
+        model.AuthGroup(id='Cycle1', nested=['Cycle2', 'WithListing']),
+        model.AuthGroup(id='Cycle2', nested=['Cycle1']),
+        model.AuthGroup(id='WithAll', nested=['*']),
+        model.AuthGroup(id='WithMissing', nested=['Missing']),
+        model.AuthGroup(id='Empty'),
+    ]
+    names = [g.key.id() for g in groups] + ['*', 'Missing']
+    idents = [joe, bob, model.Anonymous]
+
+    db = new_auth_db(groups=groups)
+    expected = {
+        (g, i): db.is_group_member(g, i) for g in names for i in idents
+    }
+    self.mock(api, '_membership_index_enabled', True)
+    self.mock(api, '_MEMBERSHIP_MEMO_SIZE', 2)
+    db = new_auth_db(groups=groups)
+    actual = {(g, i): db.is_group_member(g, i) for g in names for i in idents}
+    self.assertEqual(expected, actual)
+    self.assertTrue(actual[('Cycle2', joe)])
+    self.assertTrue(actual[('WithAll', model.Anonymous)])
+    self.assertFalse(actual[('WithNesting', bob)])
+    # Only the most recently used identities are memoized.
+    self.assertEqual(
+        [bob.to_bytes(), model.Anonymous.to_bytes()], list(db._memo))
+
   def test_list_group(self):
     def list_group(groups, group, recursive):
       l = new_auth_db(groups=groups).list_group(group, recursive)
@@ -432,6 +468,11 @@ class AuthDBTest(test_case.TestCase):
     self.assertEqual(PRIMARY_ID, auth_db.primary_id)
     self.assertEqual(PRIMARY_URL, auth_db.primary_url)
     self.assertEqual(AUTH_DB_REV, auth_db.auth_db_rev)
+    self.assertIsNotNone(auth_db._load_time)
+    # Time to the first check is reported once.
+    self.assertIsNotNone(auth_db._load_started)
+    auth_db.is_group_member('Group A', model.Anonymous)
+    self.assertIsNone(auth_db._load_started)
 
   def test_get_secret_bootstrap(self):
     # Mock AuthSecret.bootstrap to capture calls to it.
@@ -464,6 +505,25 @@ class AuthDBTest(test_case.TestCase):
     self.assertFalse(test('192.168.1.0'))
     self.assertFalse(test('192.1.0.0'))
 
+  def test_get_ip_whitelists_with_ip(self):
+    auth_db = new_auth_db(ip_whitelists=[
+        model.AuthIPWhitelist(
+            key=model.ip_whitelist_key('a'),
+            subnets=['127.0.0.1', '192.168.0.0/24', '::1']),
+        model.AuthIPWhitelist(
+            key=model.ip_whitelist_key('b'),
+            subnets=['192.168.0.0/16', 'not a subnet']),
+    ])
+    test = lambda ip: auth_db.get_ip_whitelists_with_ip(
+        ipaddr.ip_from_string(ip))
+    self.assertEqual(['a'], test('127.0.0.1'))
+    self.assertEqual(['a', 'b'], test('192.168.0.1'))
+    self.assertEqual(['b'], test('192.168.1.1'))
+    self.assertEqual(['a'], test('::1'))
+    self.assertEqual([], test('::2'))
+    self.assertTrue(auth_db.is_in_ip_whitelist(
+        'b', ipaddr.ip_from_string('192.168.1.1')))
+
   @staticmethod
   def make_auth_db_with_ip_whitelist():
     """AuthDB with a@example.com assigned IP whitelist '127.0.0.1/32'."""
@@ -1336,6 +1396,26 @@ class RealmsTest(test_case.TestCase):
     self.assert_check(db, PERM1, ['proj:realm'], ID2, None, False)
     self.assert_check(db, PERM2, ['proj:realm'], ID2, None, True)
 
+  def test_lazy_loading(self):
+    db = self.auth_db({
+        'proj:@root': [],
+        'proj:realm': [
+            ([], [PERM0], ['group:Empty', 'group:Listed']),
+        ],
+    }, groups={'Empty': [], 'Listed': [ID1], 'Unused': [ID1]})
+    self.assertIsNone(db._realms)
+    self.assertFalse(any(
+        isinstance(g, api.CachedGroup) for g in db._groups._groups.values()))
+    self.assert_check(db, PERM0, ['proj:realm'], ID1, None, True)
+    self.assertEqual(['proj:@root', 'proj:realm'], sorted(db._realms))
+    self.assertIsNone(db._realms_pb)
+    converted = sorted(
+        name for name, g in db._groups._groups.items()
+        if isinstance(g, api.CachedGroup))
+    self.assertEqual(['Empty', 'Listed'], converted)
+    self.assertEqual(3, db.group_count)
+    self.assertEqual(frozenset([ID1.to_bytes()]), db._groups['Unused'].members)
+
   def test_conditional_bindings(self):
     conditions = [
         {'restrict': {'attribute': 'a1', 'values': ['a', 'b']}}, # 0
@@ -1503,6 +1583,73 @@ class RealmsTest(test_case.TestCase):
     self.assertEqual(None, realm_data('zzz:@root'))
 
 
+class MembershipIndexBenchmark(test_case.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def setUp(self):
+    super(MembershipIndexBenchmark, self).setUp()
+    self.mock(api, '_all_perms', {p.name: p for p in ALL_PERMS})
+    self.mock(api.logging, 'info', lambda *_args: None)
+
+  @staticmethod
+  def auth_db(count):
+    """AuthDB with `count` groups in a binary tree and a realm using the top 10.
+    """
+    groups = []
+    for i in range(count):
+      groups.append({
+          'name': 'group-%d' % i,
+          'members': [
+              'user:u%d-%d@example.com' % (i, j) for j in range(10)],
+          'globs': ['user:*@%d.example.com' % i] if not i % 100 else [],
+          'nested': [
+              'group-%d' % n for n in (2 * i + 1, 2 * i + 2) if n < count],
+          'created_by': 'user:zzz@example.com',
+          'modified_by': 'user:zzz@example.com',
+      })
+    return api.AuthDB.from_proto(
+        replication_state=model.AuthReplicationState(),
+        auth_db=replication_pb2.AuthDB(
+            groups=groups,
+            realms={
+                'api_version': realms.API_VERSION,
+                'permissions': [{'name': p.name} for p in ALL_PERMS],
+                'realms': [{
+                    'name': 'proj:realm',
+                    'bindings': [{
+                        'permissions': [0],
+                        'principals': [
+                            'group:group-%d' % i for i in range(10)
+                        ],
+                    }],
+                }],
+            }),
+        additional_client_ids=[])
+
+  def measure(self, db):
+    idents = [
+        model.Identity.from_bytes('user:u%d-0@example.com' % i)
+        for i in range(0, 10000, 100)
+    ]
+    checks = 0
+    start = time.time()
+    while time.time() - start < 2:
+      for ident in idents:
+        db.has_permission(PERM0, ['proj:realm'], ident)
+      checks += len(idents)
+    return checks / (time.time() - start)
+
+  def test_has_permission_10k_groups(self):
+    before = self.measure(self.auth_db(10000))
+    self.mock(api, '_membership_index_enabled', True)
+    after = self.measure(self.auth_db(10000))
+    logging.warning(
+        'ACL checks/s with 10k groups: %.0f without index, %.0f with index',
+        before, after)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -17,7 +17,75 @@ def match(s, pat):
   """
   if '\n' in s or '\n' in pat:
     raise ValueError('Multiline strings are not supported')
-  return bool(re.match(_translate(pat), s))
+  return bool(_compile(pat).match(s))
+
+
+class GlobSet(object):
+  """A set of glob-like patterns compiled to be matched against at once.
+
+  Patterns without '*' are looked up in a dict. Patterns with a single '*' as
+  the first or the last character (e.g. '*@domain.com' or 'prefix-*') are
+  looked up in dicts by the suffix or the prefix of the string of each
+  distinct length. Only the remaining patterns are matched one by one, through
+  precompiled regexps.
+  """
+
+  def __init__(self, patterns):
+    """Arguments:
+      patterns: a list of patterns, see match(...).
+    """
+    self._exact = {}     # {string => [pattern index]}
+    self._prefixes = {}  # {prefix => [pattern index]}
+    self._suffixes = {}  # {suffix => [pattern index]}
+    self._regexps = []   # [(compiled regexp, pattern index)]
+    for i, pat in enumerate(patterns):
+      if '\n' in pat:
+        raise ValueError('Multiline strings are not supported')
+      stars = pat.count('*')
+      if not stars:
+        self._exact.setdefault(pat, []).append(i)
+      elif stars == 1 and pat.startswith('*'):
+        self._suffixes.setdefault(pat[1:], []).append(i)
+      elif stars == 1 and pat.endswith('*'):
+        self._prefixes.setdefault(pat[:-1], []).append(i)
+      else:
+        self._regexps.append((re.compile(_translate(pat)), i))
+    self._prefix_lens = sorted(set(len(p) for p in self._prefixes))
+    self._suffix_lens = sorted(set(len(p) for p in self._suffixes))
+
+  def match(self, s):
+    """Returns a sorted list with indexes of all patterns that match 's'."""
+    if '\n' in s:
+      raise ValueError('Multiline strings are not supported')
+    out = list(self._exact.get(s, ()))
+    for l in self._prefix_lens:
+      if l > len(s):
+        break
+      out.extend(self._prefixes.get(s[:l], ()))
+    for l in self._suffix_lens:
+      if l > len(s):
+        break
+      out.extend(self._suffixes.get(s[len(s)-l:], ()))
+    for regexp, i in self._regexps:
+      if regexp.match(s):
+        out.append(i)
+    out.sort()
+    return out
+
+
+# Compiled regexps of patterns used with match(...), see _compile.
+_cache = {}
+_CACHE_MAX_SIZE = 10000
+
+
+def _compile(pat):
+  """Returns a compiled regexp for a pattern, caching it."""
+  compiled = _cache.get(pat)
+  if compiled is None:
+    if len(_cache) >= _CACHE_MAX_SIZE:
+      _cache.clear()
+    compiled = _cache[pat] = re.compile(_translate(pat))
+  return compiled
 
 
 def _translate(pat):
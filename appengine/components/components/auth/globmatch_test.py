@@ -37,6 +37,29 @@ class GlobMatchTest(unittest.TestCase):
     self.assertTrue(globmatch.match('p-abc', 'p-*'))
     self.assertFalse(globmatch.match('not-p-abc', 'p-*'))
 
+  def test_glob_set(self):
+    patterns = [
+        '*',
+        'abc',
+        '*@domain.com',
+        'p-*',
+        'p-*@domain.com',
+        '*@domain.com',
+        '*b*',
+    ]
+    globs = globmatch.GlobSet(patterns)
+    for s in ('', 'abc', 'abc@domain.com', '@domain.com', 'p-abc@domain.com',
+              'p-@anotherdomain.com', 'p-', 'zzz', 'domain.com'):
+      self.assertEqual(
+          [i for i, pat in enumerate(patterns) if globmatch.match(s, pat)],
+          globs.match(s), s)
+    self.assertEqual([0, 2, 3, 4, 5, 6], globs.match('p-abc@domain.com'))
+    with self.assertRaises(ValueError):
+      globs.match('a\nb')
+
+  def test_glob_set_empty(self):
+    self.assertEqual([], globmatch.GlobSet([]).match('abc'))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
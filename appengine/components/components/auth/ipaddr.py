@@ -16,6 +16,7 @@ __all__ = [
   'normalize_ip',
   'normalize_subnet',
   'Subnet',
+  'SubnetSet',
   'subnet_from_string',
   'subnet_to_string',
 ]
@@ -166,3 +167,47 @@ def normalize_subnet(subnet_str):
 def is_in_subnet(ip, subnet):
   """True if given IP instance belongs to Subnet."""
   return ip.bits == subnet.bits and (ip.value & subnet.mask) == subnet.base
+
+
+class SubnetSet(object):
+  """A set of subnets with values attached, to look up subnets containing IPs.
+
+  It is a binary trie keyed by IP bits, stored level by level: for each prefix
+  length used by at least one subnet there is a dict with bases of subnets of
+  that length. Empty levels are skipped, so a lookup does at most one dict
+  lookup per distinct prefix length, regardless of the number of subnets.
+  IPv4 and IPv6 subnets are kept in separate tries.
+  """
+
+  def __init__(self):
+    # {IP bits => {mask => {base => set of values}}}
+    self._tries = {}
+    # {IP bits => [mask]}, sorted from the shortest prefix.
+    self._masks = {}
+
+  def add(self, subnet, value):
+    """Adds a Subnet instance with a value attached to it."""
+    level = self._tries.setdefault(subnet.bits, {}).setdefault(subnet.mask, {})
+    level.setdefault(subnet.base, set()).add(value)
+    self._masks[subnet.bits] = sorted(self._tries[subnet.bits])
+
+  def lookup(self, ip):
+    """Returns a set with values of all subnets containing an IP instance."""
+    out = set()
+    trie = self._tries.get(ip.bits)
+    if trie:
+      for mask in self._masks[ip.bits]:
+        values = trie[mask].get(ip.value & mask)
+        if values:
+          out.update(values)
+    return out
+
+  def contains(self, ip, value):
+    """True if the IP instance is in a subnet with the given value attached."""
+    trie = self._tries.get(ip.bits)
+    if trie:
+      for mask in self._masks[ip.bits]:
+        values = trie[mask].get(ip.value & mask)
+        if values and value in values:
+          return True
+    return False
@@ -3,7 +3,9 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import logging
 import sys
+import time
 import unittest
 
 from test_support import test_env
@@ -192,6 +194,62 @@ class IpAddrTest(test_case.TestCase):
 
     self.assertFalse(call('0:0:0:0:0:0:0:0', '0.0.0.0/32'))
 
+  def test_subnet_set(self):
+    subnets = ipaddr.SubnetSet()
+    subnets.add(ipaddr.subnet_from_string('10.0.0.0/8'), 'a')
+    subnets.add(ipaddr.subnet_from_string('10.1.0.0/16'), 'b')
+    subnets.add(ipaddr.subnet_from_string('10.1.2.3'), 'a')
+    subnets.add(ipaddr.subnet_from_string('::/0'), 'c')
+
+    lookup = lambda ip: subnets.lookup(ipaddr.ip_from_string(ip))
+    self.assertEqual({'a'}, lookup('10.2.0.1'))
+    self.assertEqual({'a', 'b'}, lookup('10.1.0.1'))
+    self.assertEqual({'a', 'b'}, lookup('10.1.2.3'))
+    self.assertEqual(set(), lookup('11.0.0.0'))
+    self.assertEqual({'c'}, lookup('::1'))
+
+    contains = lambda ip, v: subnets.contains(ipaddr.ip_from_string(ip), v)
+    self.assertTrue(contains('10.1.0.1', 'b'))
+    self.assertFalse(contains('10.2.0.1', 'b'))
+    self.assertFalse(contains('0.0.0.0', 'c'))
+    self.assertTrue(contains('0:0:0:0:0:0:0:0', 'c'))
+
+
+class SubnetSetBenchmark(test_case.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def test_10k_subnets(self):
+    nets = ['10.%d.%d.0/24' % (i // 256, i % 256) for i in range(9000)]
+    nets += ['2001:db8:%x::/48' % i for i in range(1000)]
+    ips = [ipaddr.ip_from_string('10.35.%d.1' % i) for i in range(100)]
+    ips += [ipaddr.ip_from_string('192.168.0.%d' % i) for i in range(100)]
+
+    def linear(ip):
+      return any(
+          ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
+          for net in nets)
+
+    subnets = ipaddr.SubnetSet()
+    for net in nets:
+      subnets.add(ipaddr.subnet_from_string(net), 'wl')
+
+    def measure(check):
+      count = 0
+      start = time.time()
+      while time.time() - start < 2:
+        for ip in ips:
+          check(ip)
+        count += len(ips)
+      return count / (time.time() - start)
+
+    for ip in ips:
+      self.assertEqual(linear(ip), subnets.contains(ip, 'wl'))
+    logging.warning(
+        'Checks/s with 10k subnets: %.0f linear, %.0f SubnetSet',
+        measure(linear), measure(lambda ip: subnets.contains(ip, 'wl')))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: components/auth/proto/delta.proto
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import message as _message
+from google.protobuf import reflection as _reflection
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+from components.auth.proto import replication_pb2 as components_dot_auth_dot_proto_dot_replication__pb2
+
+
+DESCRIPTOR = _descriptor.FileDescriptor(
+  name='components/auth/proto/delta.proto',
+  package='components.auth',
+  syntax='proto3',
+  serialized_options=None,
+  create_key=_descriptor._internal_create_key,
+  serialized_pb=b'\n!components/auth/proto/delta.proto\x12\x0f\x63omponents.auth\x1a\'components/auth/proto/replication.proto\"\xa6\x02\n\x0b\x41uthDBDelta\x12\x31\n\x08revision\x18\x01 \x01(\x0b\x32\x1f.components.auth.AuthDBRevision\x12\x18\n\x10\x62\x61se_auth_db_rev\x18\x02 \x01(\x03\x12\x19\n\x11\x61uth_code_version\x18\x03 \x01(\t\x12(\n\x07\x61uth_db\x18\x04 \x01(\x0b\x32\x17.components.auth.AuthDB\x12\x16\n\x0eremoved_groups\x18\x05 \x03(\t\x12\x1d\n\x15removed_ip_whitelists\x18\x06 \x03(\t\x12\x1e\n\x16removed_realm_projects\x18\x07 \x03(\t\x12\x16\n\x0ereplace_realms\x18\x08 \x01(\x08\x12\x16\n\x0e\x61uth_db_sha256\x18\t \x01(\x0c\x62\x06proto3'
+  ,
+  dependencies=[components_dot_auth_dot_proto_dot_replication__pb2.DESCRIPTOR,])
+
+
+
+
+_AUTHDBDELTA = _descriptor.Descriptor(
+  name='AuthDBDelta',
+  full_name='components.auth.AuthDBDelta',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='revision', full_name='components.auth.AuthDBDelta.revision', index=0,
+      number=1, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='base_auth_db_rev', full_name='components.auth.AuthDBDelta.base_auth_db_rev', index=1,
+      number=2, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='auth_code_version', full_name='components.auth.AuthDBDelta.auth_code_version', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='auth_db', full_name='components.auth.AuthDBDelta.auth_db', index=3,
+      number=4, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='removed_groups', full_name='components.auth.AuthDBDelta.removed_groups', index=4,
+      number=5, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='removed_ip_whitelists', full_name='components.auth.AuthDBDelta.removed_ip_whitelists', index=5,
+      number=6, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='removed_realm_projects', full_name='components.auth.AuthDBDelta.removed_realm_projects', index=6,
+      number=7, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='replace_realms', full_name='components.auth.AuthDBDelta.replace_realms', index=7,
+      number=8, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='auth_db_sha256', full_name='components.auth.AuthDBDelta.auth_db_sha256', index=8,
+      number=9, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=96,
+  serialized_end=390,
+)
+
+_AUTHDBDELTA.fields_by_name['revision'].message_type = components_dot_auth_dot_proto_dot_replication__pb2._AUTHDBREVISION
+_AUTHDBDELTA.fields_by_name['auth_db'].message_type = components_dot_auth_dot_proto_dot_replication__pb2._AUTHDB
+DESCRIPTOR.message_types_by_name['AuthDBDelta'] = _AUTHDBDELTA
+_sym_db.RegisterFileDescriptor(DESCRIPTOR)
+
+AuthDBDelta = _reflection.GeneratedProtocolMessageType('AuthDBDelta', (_message.Message,), {
+  'DESCRIPTOR' : _AUTHDBDELTA,
+  '__module__' : 'components.auth.proto.delta_pb2'
+  # @@protoc_insertion_point(class_scope:components.auth.AuthDBDelta)
+  })
+_sym_db.RegisterMessage(AuthDBDelta)
+
+
+# @@protoc_insertion_point(module_scope)
@@ -8,7 +8,6 @@ Also includes common code used by both Replica and Primary.
 """
 
 import collections
-import cStringIO
 import hashlib
 import logging
 import zlib
@@ -23,6 +22,7 @@ from . import b64
 from . import model
 from . import realms
 from . import signature
+from .proto import delta_pb2
 from .proto import replication_pb2
 
 
@@ -34,6 +34,10 @@ LINKING_ERRORS = {
 }
 
 
+# Number of AuthDBSnapshotShard fetched at once by load_sharded_auth_db.
+_LOAD_SHARDS_WINDOW = 4
+
+
 # Returned by new_auth_db_snapshot.
 AuthDBSnapshot = collections.namedtuple(
     'AuthDBSnapshot',
@@ -291,6 +295,201 @@ def push_auth_db(revision, auth_db):
   return update_replication_state()
 
 
+def load_auth_db_delta(delta):
+  """Reconstructs AuthDB pushed by Primary as a delta on top of the stored one.
+
+  The result should be validated and then stored with push_auth_db.
+
+  Args:
+    delta: delta_pb2.AuthDBDelta with pushed changes.
+
+  Returns:
+    Tuple (replication_pb2.AuthDB or None, current AuthReplicationState).
+    AuthDB is None if the replica is already up-to-date or it can't apply the
+    delta (e.g. it doesn't have AuthDB at the base revision of the delta). In
+    the latter case Primary is expected to fall back to a full push.
+  """
+  revision = delta.revision
+  state = model.get_replication_state()
+  if (state.primary_id != revision.primary_id or
+      state.auth_db_rev >= revision.auth_db_rev):
+    return None, state
+
+  if state.auth_db_rev != delta.base_auth_db_rev:
+    logging.warning(
+        'Cannot apply AuthDB delta %d->%d: replica is at rev %d',
+        delta.base_auth_db_rev, revision.auth_db_rev, state.auth_db_rev)
+    return None, state
+
+  base = load_sharded_auth_db(
+      state.primary_url, state.auth_db_rev, state.shard_ids)
+  if not base:
+    return None, state
+  try:
+    return apply_auth_db_delta(base, delta), state
+  except ValueError as exc:
+    logging.error(
+        'Failed to apply AuthDB delta %d->%d: %s',
+        delta.base_auth_db_rev, revision.auth_db_rev, exc)
+    return None, state
+
+
+def make_auth_db_delta(base, auth_db):
+  """Computes the difference between two revisions of AuthDB.
+
+  Groups and IP whitelists are compared by name, realms are compared per
+  project. All other fields are small and are copied as is.
+
+  Args:
+    base: replication_pb2.AuthDB at the base revision.
+    auth_db: replication_pb2.AuthDB at the new revision.
+
+  Returns:
+    delta_pb2.AuthDBDelta with 'auth_db', 'removed_*', 'replace_realms' and
+    'auth_db_sha256' fields populated.
+  """
+  delta = delta_pb2.AuthDBDelta()
+  delta.auth_db.CopyFrom(auth_db)
+  delta.auth_db_sha256 = hashlib.sha256(auth_db.SerializeToString()).digest()
+
+  del delta.auth_db.groups[:]
+  changed, removed = _diff_by_name(
+      _by_name(base.groups), _by_name(auth_db.groups))
+  delta.auth_db.groups.extend(group for _, group in changed)
+  delta.removed_groups.extend(removed)
+
+  del delta.auth_db.ip_whitelists[:]
+  changed, removed = _diff_by_name(
+      _by_name(base.ip_whitelists), _by_name(auth_db.ip_whitelists))
+  delta.auth_db.ip_whitelists.extend(wl for _, wl in changed)
+  delta.removed_ip_whitelists.extend(removed)
+
+  # Bindings refer to permissions and conditions by their index in the merged
+  # list, so realms can be updated per project only if these lists are intact.
+  delta.auth_db.ClearField('realms')
+  if (not base.HasField('realms') or not auth_db.HasField('realms') or
+      base.realms.api_version != auth_db.realms.api_version or
+      base.realms.permissions != auth_db.realms.permissions or
+      base.realms.conditions != auth_db.realms.conditions):
+    delta.replace_realms = True
+    if auth_db.HasField('realms'):
+      delta.auth_db.realms.CopyFrom(auth_db.realms)
+  else:
+    changed, removed = _diff_by_name(
+        _realms_by_project(base.realms), _realms_by_project(auth_db.realms))
+    for _, project_realms in changed:
+      delta.auth_db.realms.realms.extend(project_realms)
+    delta.removed_realm_projects.extend(removed)
+
+  return delta
+
+
+def apply_auth_db_delta(base, delta):
+  """Applies a delta produced by make_auth_db_delta to the base AuthDB.
+
+  Args:
+    base: replication_pb2.AuthDB at the base revision of the delta.
+    delta: delta_pb2.AuthDBDelta to apply.
+
+  Returns:
+    replication_pb2.AuthDB at the new revision.
+
+  Raises:
+    ValueError if the result doesn't match the AuthDB the delta was made from.
+  """
+  out = replication_pb2.AuthDB()
+  out.CopyFrom(delta.auth_db)
+
+  del out.groups[:]
+  out.groups.extend(_merge_by_name(
+      _by_name(base.groups), _by_name(delta.auth_db.groups),
+      delta.removed_groups))
+
+  del out.ip_whitelists[:]
+  out.ip_whitelists.extend(_merge_by_name(
+      _by_name(base.ip_whitelists), _by_name(delta.auth_db.ip_whitelists),
+      delta.removed_ip_whitelists))
+
+  if not delta.replace_realms:
+    out.ClearField('realms')
+    if base.HasField('realms'):
+      out.realms.api_version = base.realms.api_version
+      out.realms.permissions.extend(base.realms.permissions)
+      out.realms.conditions.extend(base.realms.conditions)
+      merged = _merge_by_name(
+          _realms_by_project(base.realms),
+          _realms_by_project(delta.auth_db.realms),
+          delta.removed_realm_projects)
+      for project_realms in merged:
+        out.realms.realms.extend(project_realms)
+
+  if hashlib.sha256(out.SerializeToString()).digest() != delta.auth_db_sha256:
+    raise ValueError('AuthDB digest mismatch after applying the delta')
+  return out
+
+
+def _by_name(entities):
+  """Returns a list of (name, entity) pairs."""
+  return [(e.name, e) for e in entities]
+
+
+def _realms_by_project(realms_pb):
+  """Returns a list of (project ID, [realms_pb2.Realm]) pairs.
+
+  Realms of a project are adjacent in realms_pb2.Realms produced by
+  realms.merge, so the order of projects is preserved.
+  """
+  out = []
+  for realm in realms_pb.realms:
+    project = realm.name.split(':', 1)[0]
+    if not out or out[-1][0] != project:
+      out.append((project, []))
+    out[-1][1].append(realm)
+  return out
+
+
+def _diff_by_name(base, items):
+  """Diffs two lists of (name, value) pairs.
+
+  Returns:
+    Tuple (list of added or changed (name, value) pairs, list of removed names).
+  """
+  old = dict(base)
+  changed = [(name, v) for name, v in items if old.pop(name, None) != v]
+  return changed, sorted(old)
+
+
+def _merge_by_name(base, changed, removed):
+  """Merges two lists of (name, value) pairs sorted by name.
+
+  Values from |changed| replace values with the same name in |base| or get
+  inserted at their sorted position. Values with names from |removed| are
+  dropped.
+
+  Returns:
+    A list of values.
+  """
+  removed = set(removed)
+  out = []
+  idx = 0
+  for name, value in base:
+    while idx < len(changed) and _sort_key(changed[idx][0]) < _sort_key(name):
+      out.append(changed[idx][1])
+      idx += 1
+    if idx < len(changed) and changed[idx][0] == name:
+      out.append(changed[idx][1])
+      idx += 1
+    elif name not in removed:
+      out.append(value)
+  out.extend(value for _, value in changed[idx:])
+  return out
+
+
+def _sort_key(name):
+  """Orders names the same way as datastore orders string keys."""
+  return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
 @ndb.transactional
 def store_sharded_auth_db(auth_db, primary_url, auth_db_rev, shard_size):
   """Creates a bunch of AuthDBSnapshotShard entities with deflated AuthDB.
@@ -351,29 +550,105 @@ def load_sharded_auth_db(primary_url, auth_db_rev, shard_ids):
   if not shard_ids:
     raise ValueError('The list of shards is empty')
 
-  shards = ndb.get_multi(
+  keys = [
       model.snapshot_shard_key(primary_url, auth_db_rev, shard_id)
-      for shard_id in shard_ids)
-
-  missing = [sid for sid, shard in zip(shard_ids, shards) if not shard]
-  if missing:
-    logging.error(
-        'Cannot reconstruct AuthDB from %s at rev %d due to missing '
-        'AuthDBSnapshotShard: %r', primary_url, auth_db_rev, missing)
-    return None
-
-  out = cStringIO.StringIO()
+      for shard_id in shard_ids
+  ]
+
+  # Fetch shards in bounded windows, prefetching the next window while the
+  # current one is being decompressed and parsed, and parse complete top-level
+  # fields of the proto as soon as they are decompressed. That way the memory
+  # usage is bounded by a window of compressed shards plus the largest
+  # top-level field (instead of all compressed shards plus the entire
+  # decompressed AuthDB).
+  out = replication_pb2.AuthDB()
   decompressor = zlib.decompressobj()
-  for idx, shard in enumerate(shards):
-    data = decompressor.decompress(shard.blob)
-    # Release the memory held by the shard ASAP
-    shards[idx] = None
-    shard.blob = None
-    out.write(data)
-  out.write(decompressor.flush())
+  # Decompressed bytes not merged into |out| yet, and how many of them are
+  # needed to complete the next field.
+  pending = []
+  have = 0
+  need = 0
+  futures = ndb.get_multi_async(keys[:_LOAD_SHARDS_WINDOW])
+  for start in xrange(0, len(keys), _LOAD_SHARDS_WINDOW):
+    window = keys[start:start+_LOAD_SHARDS_WINDOW]
+    shards = [f.get_result() for f in futures]
+    futures = ndb.get_multi_async(
+        keys[start+_LOAD_SHARDS_WINDOW:start+2*_LOAD_SHARDS_WINDOW])
+    missing = [k.id() for k, shard in zip(window, shards) if not shard]
+    if missing:
+      logging.error(
+          'Cannot reconstruct AuthDB from %s at rev %d due to missing '
+          'AuthDBSnapshotShard: %r', primary_url, auth_db_rev, missing)
+      ndb.Future.wait_all(futures)
+      return None
+    for idx, shard in enumerate(shards):
+      data = decompressor.decompress(shard.blob)
+      # Release the memory held by the shard ASAP
+      shards[idx] = None
+      shard.blob = None
+      pending.append(data)
+      have += len(data)
+      if have >= need:
+        rest, need = _merge_complete_fields(out, ''.join(pending))
+        pending = [rest]
+        have = len(rest)
+  pending.append(decompressor.flush())
   del decompressor
+  rest, _ = _merge_complete_fields(out, ''.join(pending))
+  if rest:
+    raise ValueError('Truncated AuthDB proto')
+  return out
 
-  buf = out.getvalue()
-  del out
 
-  return replication_pb2.AuthDB.FromString(buf)
+def _decode_varint(buf, pos):
+  """Decodes a varint at |pos|, returns (value, new pos) or (None, None)."""
+  value = 0
+  shift = 0
+  while pos < len(buf):
+    b = ord(buf[pos])
+    pos += 1
+    value |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return value, pos
+    shift += 7
+  return None, None
+
+
+def _merge_complete_fields(msg, buf):
+  """Merges all complete top-level fields serialized in |buf| into |msg|.
+
+  Merging fields one after another is equivalent to parsing all of them at
+  once, since repeated fields are appended and singular ones are merged.
+
+  Returns:
+    Tuple (remaining bytes of the last incomplete field, number of bytes needed
+    to complete it if known or just more than remaining bytes otherwise).
+  """
+  pos = 0
+  end = 0
+  while True:
+    tag, pos = _decode_varint(buf, pos)
+    if tag is None:
+      break
+    wire_type = tag & 7
+    if wire_type == 0:
+      _, pos = _decode_varint(buf, pos)
+    elif wire_type == 1:
+      pos += 8
+    elif wire_type == 2:
+      size, pos = _decode_varint(buf, pos)
+      if size is not None:
+        pos += size
+    elif wire_type == 5:
+      pos += 4
+    else:
+      raise ValueError('Unsupported wire type %d in AuthDB proto' % wire_type)
+    if pos is None or pos > len(buf):
+      break
+    end = pos
+  if end:
+    msg.MergeFromString(buf[:end])
+  rest = buf[end:]
+  if pos is None:
+    return rest, len(rest) + 1
+  return rest, pos - end
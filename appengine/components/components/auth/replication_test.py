@@ -4,6 +4,8 @@
 # that can be found in the LICENSE file.
 
 import datetime
+import hashlib
+import logging
 import sys
 import unittest
 
@@ -548,6 +550,209 @@ class ShardedAuthDBTest(test_case.TestCase):
                                                    self.AUTH_DB_REV, shard_ids)
     self.assertEqual(reassembled, auth_db)
 
+  def test_works_in_windows(self):
+    self.mock(replication, '_LOAD_SHARDS_WINDOW', 3)
+    auth_db = make_auth_db_proto()
+    for i in range(20):
+      auth_db.groups.add(
+          name='group-%d' % i,
+          members=[
+              'user:%s@example.com' %
+              hashlib.sha256('%d/%d' % (i, j)).hexdigest()
+              for j in range(i)
+          ])
+    shard_ids = replication.store_sharded_auth_db(auth_db, self.PRIMARY_URL,
+                                                  self.AUTH_DB_REV, 100)
+    self.assertGreater(len(shard_ids), 10)
+    reassembled = replication.load_sharded_auth_db(self.PRIMARY_URL,
+                                                   self.AUTH_DB_REV, shard_ids)
+    self.assertEqual(reassembled, auth_db)
+
+  def test_missing_shard(self):
+    self.mock(replication, '_LOAD_SHARDS_WINDOW', 1)
+    shard_ids = replication.store_sharded_auth_db(make_auth_db_proto(),
+                                                  self.PRIMARY_URL,
+                                                  self.AUTH_DB_REV, 50)
+    self.assertGreater(len(shard_ids), 1)
+    model.snapshot_shard_key(self.PRIMARY_URL, self.AUTH_DB_REV,
+                             shard_ids[-1]).delete()
+    self.assertIsNone(
+        replication.load_sharded_auth_db(self.PRIMARY_URL, self.AUTH_DB_REV,
+                                         shard_ids))
+
+
+def make_delta_test_auth_db(groups, projects, permissions=('a.b.c',)):
+  """Returns replication_pb2.AuthDB with given groups and project realms.
+
+  Args:
+    groups: dict {group name => list of member emails}.
+    projects: dict {project ID => list of realm names}.
+    permissions: list of permission names.
+  """
+  auth_db = make_auth_db_proto()
+  for name, members in sorted(groups.items()):
+    auth_db.groups.add(
+        name=name, members=['user:%s' % m for m in members], owners='admins')
+  auth_db.realms.permissions.extend(
+      realms_pb2.Permission(name=p) for p in permissions)
+  for project, names in sorted(projects.items()):
+    for name in names:
+      auth_db.realms.realms.add(
+          name='%s:%s' % (project, name),
+          bindings=[{'permissions': [0], 'principals': ['group:%s' % name]}])
+  return auth_db
+
+
+class AuthDBDeltaTest(test_case.TestCase):
+  PRIMARY_ID = 'primary'
+  PRIMARY_URL = 'https://primary'
+
+  GROUPS = {
+      'a': ['a@example.com'],
+      'b': ['b@example.com'],
+      'c': ['c@example.com'],
+  }
+  PROJECTS = {
+      'proj': ['@root', 'r'],
+      'proj-x': ['@root'],
+  }
+
+  def assert_delta_works(self, base, auth_db):
+    delta = replication.make_auth_db_delta(base, auth_db)
+    self.assertEqual(auth_db, replication.apply_auth_db_delta(base, delta))
+    return delta
+
+  def test_no_changes(self):
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    delta = self.assert_delta_works(base, base)
+    self.assertEqual([], list(delta.auth_db.groups))
+    self.assertFalse(delta.auth_db.HasField('realms'))
+    self.assertFalse(delta.replace_realms)
+
+  def test_groups(self):
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    groups = self.GROUPS.copy()
+    groups['b'] = ['b@example.com', 'd@example.com']
+    groups['0'] = []
+    groups['z'] = []
+    del groups['c']
+    delta = self.assert_delta_works(
+        base, make_delta_test_auth_db(groups, self.PROJECTS))
+    self.assertEqual(['0', 'b', 'z'], [g.name for g in delta.auth_db.groups])
+    self.assertEqual(['c'], list(delta.removed_groups))
+
+  def test_realms(self):
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    delta = self.assert_delta_works(
+        base, make_delta_test_auth_db(self.GROUPS, {
+            'proj': ['@root', 'r', 'another'],
+            'proj-y': ['@root'],
+        }))
+    self.assertFalse(delta.replace_realms)
+    self.assertEqual(
+        ['proj:@root', 'proj:r', 'proj:another', 'proj-y:@root'],
+        [r.name for r in delta.auth_db.realms.realms])
+    self.assertEqual(['proj-x'], list(delta.removed_realm_projects))
+
+  def test_realms_permissions_changed(self):
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    delta = self.assert_delta_works(
+        base, make_delta_test_auth_db(
+            self.GROUPS, self.PROJECTS, ('a.b.c', 'a.b.d')))
+    self.assertTrue(delta.replace_realms)
+
+  def test_digest_mismatch(self):
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    delta = replication.make_auth_db_delta(base, base)
+    delta.removed_groups.append('a')
+    with self.assertRaises(ValueError):
+      replication.apply_auth_db_delta(base, delta)
+
+  def make_delta(self, base, auth_db, base_rev, rev):
+    delta = replication.make_auth_db_delta(base, auth_db)
+    delta.revision.primary_id = self.PRIMARY_ID
+    delta.revision.auth_db_rev = rev
+    delta.revision.modified_ts = 1234
+    delta.base_auth_db_rev = base_rev
+    return delta
+
+  def test_load_auth_db_delta(self):
+    model.AuthReplicationState(
+        key=model.replication_state_key(),
+        primary_id=self.PRIMARY_ID,
+        primary_url=self.PRIMARY_URL).put()
+    base = make_delta_test_auth_db(self.GROUPS, self.PROJECTS)
+    applied, _ = replication.push_auth_db(
+        replication_pb2.AuthDBRevision(
+            primary_id=self.PRIMARY_ID, auth_db_rev=1, modified_ts=1234),
+        base)
+    self.assertTrue(applied)
+
+    groups = self.GROUPS.copy()
+    groups['new'] = []
+    auth_db = make_delta_test_auth_db(groups, self.PROJECTS)
+
+    # Not based on the current revision.
+    loaded, state = replication.load_auth_db_delta(
+        self.make_delta(base, auth_db, 2, 3))
+    self.assertIsNone(loaded)
+    self.assertEqual(1, state.auth_db_rev)
+
+    delta = self.make_delta(base, auth_db, 1, 2)
+    loaded, state = replication.load_auth_db_delta(delta)
+    self.assertEqual(auth_db, loaded)
+    self.assertEqual(1, state.auth_db_rev)
+
+    # Already applied.
+    replication.push_auth_db(delta.revision, loaded)
+    loaded, state = replication.load_auth_db_delta(delta)
+    self.assertIsNone(loaded)
+    self.assertEqual(2, state.auth_db_rev)
+
+
+class AuthDBDeltaBenchmark(test_case.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def test_bytes_per_revision(self):
+    """Compares sizes of full and delta pushes on a typical change log."""
+    def members(group, count):
+      return [
+          '%s@example.com' % hashlib.sha256('%s/%d' % (group, i)).hexdigest()
+          for i in range(count)
+      ]
+    groups = {'group-%d' % i: members(i, 20) for i in range(2000)}
+    projects = {
+        'project-%d' % i: ['@root', 'ci', 'try', 'pools/%d' % i]
+        for i in range(200)
+    }
+
+    def add_member(groups, projects):
+      groups['group-42'] = groups['group-42'] + members('new', 1)
+    def remove_member(groups, projects):
+      groups['group-42'] = groups['group-42'][1:]
+    def add_group(groups, projects):
+      groups['group-new'] = members('group-new', 5)
+    def remove_group(groups, projects):
+      del groups['group-7']
+    def change_project(groups, projects):
+      projects['project-3'] = projects['project-3'] + ['pools/new']
+    changes = [
+        add_member, remove_member, add_group, remove_group, change_project,
+    ]
+
+    base = make_delta_test_auth_db(groups, projects)
+    for change in changes:
+      change(groups, projects)
+      auth_db = make_delta_test_auth_db(groups, projects)
+      delta = replication.make_auth_db_delta(base, auth_db)
+      self.assertEqual(auth_db, replication.apply_auth_db_delta(base, delta))
+      logging.warning(
+          '%s: full AuthDB is %d bytes, delta is %d bytes',
+          change.__name__, auth_db.ByteSize(), delta.ByteSize())
+      base = auth_db
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
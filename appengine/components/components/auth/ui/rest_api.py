@@ -30,6 +30,7 @@ from .. import model
 from .. import replication
 from .. import signature
 from .. import version
+from ..proto import delta_pb2
 from ..proto import replication_pb2
 
 
@@ -50,6 +51,8 @@ def get_rest_api_routes():
     webapp2.Route('/auth/api/v1/groups', GroupsHandler),
     webapp2.Route('/auth/api/v1/groups/<name:%s>' % group_re, GroupHandler),
     webapp2.Route('/auth/api/v1/internal/replication', ReplicationHandler),
+    webapp2.Route(
+        '/auth/api/v1/internal/replication/delta', ReplicationDeltaHandler),
     webapp2.Route('/auth/api/v1/ip_allowlists', IPAllowlistsHandler),
     webapp2.Route(
         '/auth/api/v1/ip_allowlists/<name:%s>' % ip_whitelist_re,
@@ -887,32 +890,10 @@ class ReplicationHandler(handler.AuthenticatingHandler):
       self.send_error(replication_pb2.ReplicationPushResponse.BAD_SIGNATURE)
       return
 
-    # Deserialize the request, check it is valid.
-    request = replication_pb2.ReplicationPushRequest.FromString(body)
-    if not request.revision or not request.HasField('auth_db'):
-      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
-      return
-
-    # Check the AuthDB in the request is not malformed.
-    try:
-      api.AuthDB.from_proto(
-          replication_state=model.AuthReplicationState(),
-          auth_db=request.auth_db,
-          additional_client_ids=[],
-      )
-    except ValueError as e:
-      logging.error('bad AuthDB from %s at rev %d: %s',
-                    request.revision.primary_id, request.revision.auth_db_rev,
-                    e)
-      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+    pushed = self.apply_push(body)
+    if not pushed:
       return
-
-    # Handle it.
-    logging.info('Received AuthDB push: rev %d', request.revision.auth_db_rev)
-    if request.auth_code_version:
-      logging.info(
-          'Primary\'s auth component version: %s', request.auth_code_version)
-    applied, state = replication.push_auth_db(request.revision, request.auth_db)
+    applied, state = pushed
     logging.info(
         'AuthDB push %s: rev is %d',
         'applied' if applied else 'skipped', state.auth_db_rev)
@@ -930,6 +911,76 @@ class ReplicationHandler(handler.AuthenticatingHandler):
     response.auth_code_version = version.__version__
     self.send_response(response)
 
+  def apply_push(self, body):
+    """Applies verified serialized ReplicationPushRequest.
+
+    Returns:
+      Tuple (True if update was applied, AuthReplicationState) or None if
+      the request is invalid (the error is already sent in that case).
+    """
+    # Deserialize the request, check it is valid.
+    request = replication_pb2.ReplicationPushRequest.FromString(body)
+    if not request.revision or not request.HasField('auth_db'):
+      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+      return None
+
+    if not self.validate_auth_db(request.revision, request.auth_db):
+      return None
+
+    # Handle it.
+    logging.info('Received AuthDB push: rev %d', request.revision.auth_db_rev)
+    if request.auth_code_version:
+      logging.info(
+          'Primary\'s auth component version: %s', request.auth_code_version)
+    return replication.push_auth_db(request.revision, request.auth_db)
+
+  def validate_auth_db(self, revision, auth_db):
+    """Checks the pushed AuthDB is not malformed.
+
+    Returns:
+      True if it is valid, False if not (the error is already sent).
+    """
+    try:
+      api.AuthDB.from_proto(
+          replication_state=model.AuthReplicationState(),
+          auth_db=auth_db,
+          additional_client_ids=[],
+      )
+    except (ValueError, api.RealmsError) as e:
+      logging.error('bad AuthDB from %s at rev %d: %s',
+                    revision.primary_id, revision.auth_db_rev, e)
+      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+      return False
+    return True
+
+
+class ReplicationDeltaHandler(ReplicationHandler):
+  """Accepts AuthDB delta push from Primary.
+
+  Replies with SKIPPED status if the delta can't be applied, so that Primary
+  falls back to a full push.
+  """
+
+  def apply_push(self, body):
+    """Applies verified serialized AuthDBDelta."""
+    delta = delta_pb2.AuthDBDelta.FromString(body)
+    if not delta.HasField('revision') or not delta.HasField('auth_db'):
+      self.send_error(replication_pb2.ReplicationPushResponse.BAD_REQUEST)
+      return None
+
+    logging.info(
+        'Received AuthDB delta push: rev %d->%d',
+        delta.base_auth_db_rev, delta.revision.auth_db_rev)
+    if delta.auth_code_version:
+      logging.info(
+          'Primary\'s auth component version: %s', delta.auth_code_version)
+    auth_db, state = replication.load_auth_db_delta(delta)
+    if not auth_db:
+      return False, state
+    if not self.validate_auth_db(delta.revision, auth_db):
+      return None
+    return replication.push_auth_db(delta.revision, auth_db)
+
 
 class IPAllowlistsHandler(handler.ApiHandler):
   """Lists all IP allowlists.
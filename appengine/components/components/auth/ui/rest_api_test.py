@@ -22,8 +22,11 @@ from components import utils
 from components.auth import api
 from components.auth import handler
 from components.auth import model
+from components.auth import realms
+from components.auth import replication
 from components.auth import signature
 from components.auth import version
+from components.auth.proto import replication_pb2
 from components.auth.ui import acl
 from components.auth.ui import rest_api
 from components.auth.ui import ui
@@ -2212,6 +2215,74 @@ class ServerStateHandlerTest(RestAPITestCase):
     self.assertEqual(expected, body)
 
 
+class ReplicationDeltaHandlerTest(test_case.TestCase):
+  def setUp(self):
+    super(ReplicationDeltaHandlerTest, self).setUp()
+    mock_replication_state('https://primary')
+    self.mock(
+        api, 'get_current_identity',
+        lambda: model.Identity(model.IDENTITY_SERVICE, 'mocked-primary'))
+    self.mock(replication, 'is_signed_by_primary', lambda *_args: True)
+    self.base = self.auth_db(['a'])
+    replication.push_auth_db(self.revision(1), self.base)
+
+  @staticmethod
+  def revision(rev):
+    return replication_pb2.AuthDBRevision(
+        primary_id='mocked-primary', auth_db_rev=rev, modified_ts=1234)
+
+  @staticmethod
+  def auth_db(groups, api_version=realms.API_VERSION):
+    auth_db = replication_pb2.AuthDB()
+    for name in groups:
+      auth_db.groups.add(
+          name=name,
+          created_by='user:a@example.com',
+          modified_by='user:a@example.com')
+    auth_db.realms.api_version = api_version
+    return auth_db
+
+  def push(self, auth_db, base_rev, rev):
+    delta = replication.make_auth_db_delta(self.base, auth_db)
+    delta.revision.CopyFrom(self.revision(rev))
+    delta.base_auth_db_rev = base_rev
+    response = call_post(
+        rest_api.ReplicationDeltaHandler,
+        delta.SerializeToString(),
+        headers={
+            'X-AuthDB-SigKey-v1': 'key',
+            'X-AuthDB-SigVal-v1': 'c2ln',
+        })
+    return replication_pb2.ReplicationPushResponse.FromString(response.body)
+
+  def test_applied(self):
+    auth_db = self.auth_db(['a', 'b'])
+    response = self.push(auth_db, 1, 2)
+    self.assertEqual(
+        replication_pb2.ReplicationPushResponse.APPLIED, response.status)
+    self.assertEqual(2, response.current_revision.auth_db_rev)
+    state = model.get_replication_state()
+    self.assertEqual(
+        auth_db,
+        replication.load_sharded_auth_db(
+            state.primary_url, state.auth_db_rev, state.shard_ids))
+
+  def test_skipped_on_gap(self):
+    response = self.push(self.auth_db(['a', 'b']), 2, 3)
+    self.assertEqual(
+        replication_pb2.ReplicationPushResponse.SKIPPED, response.status)
+    self.assertEqual(1, response.current_revision.auth_db_rev)
+
+  def test_bad_auth_db(self):
+    response = self.push(self.auth_db(['a'], api_version=12345), 1, 2)
+    self.assertEqual(
+        replication_pb2.ReplicationPushResponse.FATAL_ERROR, response.status)
+    self.assertEqual(
+        replication_pb2.ReplicationPushResponse.BAD_REQUEST,
+        response.error_code)
+    self.assertEqual(1, model.get_replication_state().auth_db_rev)
+
+
 class ForbidApiOnReplicaTest(test_case.TestCase):
   """Tests for rest_api.forbid_api_on_replica decorator."""
 
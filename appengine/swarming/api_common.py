@@ -79,11 +79,11 @@ def delete_bot(bot_id):
   """
   realms.check_bot_delete_acl(bot_id)
   bot_info_key = bot_management.get_info_key(bot_id)
-  _get_or_raise(bot_info_key)  # raises 404 if there is no such bot
+  bot_info = _get_or_raise(bot_info_key)  # raises 404 if there is no such bot
   # It is important to note that the bot is not there anymore, so it is not
   # a member of any task queue.
   task_queues.cleanup_after_bot(bot_id)
-  bot_info_key.delete()
+  bot_management.forget_bot(bot_info)
 
 
 def get_bot_events(bot_id, start, end, limit, cursor):
@@ -613,6 +613,11 @@ def count_bots(dimensions):
   except ValueError as e:
     raise handlers_exceptions.BadRequestException(str(e))
 
+  # Single pool filters are answered by the materialized counters.
+  counts = bot_management.get_bots_count(dimensions)
+  if counts is not None:
+    return BotsCount(*counts)
+
   f_count = q.count_async()
   f_dead = bot_management.filter_availability(q, None, None, True,
                                               None).count_async()
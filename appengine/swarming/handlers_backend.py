@@ -71,11 +71,16 @@ class CronAbortExpiredShardToRunHandler(_CronHandlerBase):
 
 
 class CronTidyTaskDimensionSets(_CronHandlerBase):
-  """Removes expired task dimension sets from the datastore."""
+  """Removes expired task dimension sets from the datastore and indexes sets
+  stored before the index existed.
+  """
 
   def run_cron(self):
-    f = task_queues.tidy_task_dimension_sets_async()
-    if not f.get_result():
+    futures = [
+        task_queues.tidy_task_dimension_sets_async(),
+        task_queues.backfill_dimensions_index_async(),
+    ]
+    if not all([f.get_result() for f in futures]):
       self.response.set_status(429, 'Need to retry')
 
 
@@ -178,6 +183,16 @@ class TaskCancelChildrenTasksHandler(webapp2.RequestHandler):
     task_scheduler.task_cancel_running_children_tasks(task)
 
 
+class TaskCompactOutputHandler(webapp2.RequestHandler):
+  """Merges output segments of a task into output chunks."""
+
+  @decorators.silence(runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('compact-output')
+  def post(self):
+    payload = json.loads(self.request.body)
+    task_scheduler.task_compact_output(payload['task_id'])
+
+
 class TaskExpireTasksHandler(webapp2.RequestHandler):
   """Expires a list of tasks, given a list of their ids."""
 
@@ -187,6 +202,15 @@ class TaskExpireTasksHandler(webapp2.RequestHandler):
     task_scheduler.task_expire_tasks(payload['entities'])
 
 
+class TaskHandleDeadTasksHandler(webapp2.RequestHandler):
+  """Aborts a list of tasks where the bot stopped sending updates."""
+
+  @decorators.require_taskqueue('task-dead')
+  def post(self):
+    payload = json.loads(self.request.body)
+    task_scheduler.task_handle_dead_tasks(payload['run_result_ids'])
+
+
 class TaskUpdateBotMatchesHandler(webapp2.RequestHandler):
   """Assigns new task queues to existing bots."""
 
@@ -207,6 +231,16 @@ class TaskRescanMatchingTaskSetsHandler(webapp2.RequestHandler):
       self.response.set_status(429, 'Need to retry')
 
 
+class TaskUpdateDimensionsIndexHandler(webapp2.RequestHandler):
+  """Updates the inverted index of task dimensions sets."""
+
+  @decorators.require_taskqueue('update-dimensions-index')
+  def post(self):
+    f = task_queues.update_dimensions_index_async(self.request.body)
+    if not f.get_result():
+      self.response.set_status(429, 'Need to retry')
+
+
 class TaskSendPubSubMessage(webapp2.RequestHandler):
   """Sends PubSub notification about task completion."""
 
@@ -230,9 +264,13 @@ class TaskESNotifyTasksHandler(webapp2.RequestHandler):
   @decorators.require_taskqueue('es-notify-tasks')
   def post(self):
     es_host = self.request.get('es_host')
-    request_json = self.request.get('request_json')
     request = plugin_pb2.NotifyTasksRequest()
-    json_format.Parse(request_json, request)
+    request_json = self.request.POST.get('request_json')
+    if request_json:
+      # TODO: Remove once no JSON encoded tasks are left in the queue.
+      json_format.Parse(request_json, request)
+    else:
+      request.ParseFromString(self.request.body)
     external_scheduler.notify_request_now(es_host, request)
 
 
@@ -285,11 +323,16 @@ def get_routes():
        TaskCancelTaskOnBotHandler),
       ('/internal/taskqueue/important/tasks/cancel-children-tasks',
        TaskCancelChildrenTasksHandler),
+      ('/internal/taskqueue/important/tasks/compact-output',
+       TaskCompactOutputHandler),
       ('/internal/taskqueue/important/tasks/expire', TaskExpireTasksHandler),
+      ('/internal/taskqueue/important/tasks/dead', TaskHandleDeadTasksHandler),
       ('/internal/taskqueue/important/task_queues/update-bot-matches',
        TaskUpdateBotMatchesHandler),
       ('/internal/taskqueue/important/task_queues/rescan-matching-task-sets',
        TaskRescanMatchingTaskSetsHandler),
+      ('/internal/taskqueue/important/task_queues/update-dimensions-index',
+       TaskUpdateDimensionsIndexHandler),
       (r'/internal/taskqueue/important/pubsub/notify-task/<task_id:[0-9a-f]+>',
        TaskSendPubSubMessage),
       (r'/internal/taskqueue/important/buildbucket/notify-task/'
@@ -84,7 +84,10 @@ class BackendTest(test_env_handlers.AppTestBase):
         ('cancel-tasks', '/internal/taskqueue/important/tasks/cancel'),
         ('cancel-children-tasks',
          '/internal/taskqueue/important/tasks/cancel-children-tasks'),
+        ('compact-output',
+         '/internal/taskqueue/important/tasks/compact-output'),
         ('task-expire', '/internal/taskqueue/important/tasks/expire'),
+        ('task-dead', '/internal/taskqueue/important/tasks/dead'),
         ('es-notify-tasks',
          '/internal/taskqueue/important/external_scheduler/notify-tasks'),
         ('es-notify-kick',
@@ -97,6 +100,8 @@ class BackendTest(test_env_handlers.AppTestBase):
          '/internal/taskqueue/important/task_queues/update-bot-matches'),
         ('rescan-matching-task-sets',
          '/internal/taskqueue/important/task_queues/rescan-matching-task-sets'),
+        ('update-dimensions-index',
+         '/internal/taskqueue/important/task_queues/update-dimensions-index'),
         ('named-cache-task',
          '/internal/taskqueue/important/named_cache/update-pool'),
     ],
@@ -8,6 +8,7 @@ import datetime
 import json
 import logging
 import urlparse
+import zlib
 
 import six
 
@@ -54,6 +55,14 @@ _BOT_AUTH_METHODS = (
     auth.oauth_authentication,
 )
 
+# Compression of task_update 'output' accepted from bots. Advertised in the
+# task_update response, so bots only start using it once the server supports
+# it.
+_ACCEPTED_OUTPUT_COMPRESSION = ['zlib']
+
+# Maximum size of decompressed task_update 'output'. Bots send at most ~250kb.
+_MAX_DECOMPRESSED_OUTPUT = 16 * 1024 * 1024
+
 
 def has_unexpected_subset_keys(expected_keys, minimum_keys, actual_keys, name):
   """Returns an error if unexpected keys are present or expected keys are
@@ -1383,6 +1392,7 @@ class BotTaskUpdateHandler(_BotApiHandler):
       u'named_caches_stats',
       u'output',
       u'output_chunk_start',
+      u'output_compression',
       u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
@@ -1421,6 +1431,7 @@ class BotTaskUpdateHandler(_BotApiHandler):
     cleanup_stats = request.get('cleanup_stats')
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
+    output_compression = request.get('output_compression')
     cas_output_root = request.get('cas_output_root')
     canceled = request.get('canceled')
 
@@ -1488,6 +1499,19 @@ class BotTaskUpdateHandler(_BotApiHandler):
         # and returning a HTTP 500 would only force the bot to stay in a retry
         # loop.
         logging.error('Failed to decode output\n%s\n%r', e, output)
+      if output_compression:
+        if output_compression not in _ACCEPTED_OUTPUT_COMPRESSION:
+          self.abort_with_error(
+              400, error='Unsupported output_compression %r' %
+              output_compression)
+        d = zlib.decompressobj()
+        try:
+          output = d.decompress(output, _MAX_DECOMPRESSED_OUTPUT)
+        except zlib.error as e:
+          # Save the output as-is instead, like when it can't be decoded.
+          logging.error('Failed to decompress output\n%s', e)
+        if d.unconsumed_tail:
+          self.abort_with_error(400, error='Decompressed output is too large')
     if cas_output_root:
       cas_output_root = task_request.CASReference(
           cas_instance=cas_output_root['cas_instance'],
@@ -1571,7 +1595,11 @@ class BotTaskUpdateHandler(_BotApiHandler):
     must_stop = state in (task_result.State.BOT_DIED, task_result.State.KILLED)
     if must_stop:
       logging.info('asking bot to kill the task')
-    self.send_response({'must_stop': must_stop, 'ok': True})
+    self.send_response({
+        'accepted_output_compression': _ACCEPTED_OUTPUT_COMPRESSION,
+        'must_stop': must_stop,
+        'ok': True,
+    })
 
 
 class BotTaskErrorHandler(_BotApiHandler):
@@ -13,6 +13,7 @@ import StringIO
 import sys
 import unittest
 import zipfile
+import zlib
 
 import mock
 from parameterized import parameterized
@@ -1413,7 +1414,12 @@ class BotApiTest(test_env_handlers.AppTestBase):
         'task_id': task_id,
     }
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
 
     self.set_as_user()
     response = self.client_get_results(task_id, include_performance_stats=True)
@@ -1704,7 +1710,12 @@ class BotApiTest(test_env_handlers.AppTestBase):
       """Cycles between bot update and user retrieving results."""
       self.set_as_bot()
       response = self.post_json('/swarming/api/v1/bot/task_update', params)
-      self.assertEqual({u'must_stop': must_stop, u'ok': True}, response)
+      self.assertEqual(
+          {
+              u'accepted_output_compression': [u'zlib'],
+              u'must_stop': must_stop,
+              u'ok': True,
+          }, response)
       self.set_as_user()
       self.assertEqual(expected, self.client_get_results(task_id))
 
@@ -1714,7 +1725,12 @@ class BotApiTest(test_env_handlers.AppTestBase):
     task_id = response['manifest']['task_id']
     params = _params()
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
 
     self.set_as_user()
     response = self.client_get_results(task_id)
@@ -1819,6 +1835,57 @@ class BotApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/bot/task_update', params, status=500)
     self.assertEqual({u'error': u'Sorry!'}, response)
 
+  def test_task_update_output_compression(self):
+    self.set_as_bot()
+    self.bot_poll()
+
+    self.set_as_user()
+    self.client_create_task_raw(
+        properties=dict(command=['python', 'runtest.py']))
+
+    self.set_as_bot()
+    params = self.do_handshake()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    task_id = response['manifest']['task_id']
+
+    outputs = []
+    bot_update_task = task_scheduler.bot_update_task
+
+    def bot_update_task_mock(**kwargs):
+      outputs.append(kwargs['output'])
+      return bot_update_task(**kwargs)
+
+    self.mock(task_scheduler, 'bot_update_task', bot_update_task_mock)
+    params = {
+        'cost_usd': 0.1,
+        'id': 'bot1',
+        'output': base64.b64encode(zlib.compress('result string' * 10)),
+        'output_chunk_start': 0,
+        'output_compression': 'zlib',
+        'task_id': task_id,
+    }
+    response = self.post_json('/swarming/api/v1/bot/task_update', params)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
+    self.assertEqual(['result string' * 10], outputs)
+
+    params['output_compression'] = 'lzma'
+    response = self.post_json(
+        '/swarming/api/v1/bot/task_update', params, status=400)
+    self.assertEqual({u'error': u"Unsupported output_compression u'lzma'"},
+                     response)
+
+    # Output that can't be decompressed is saved as-is.
+    params['output_compression'] = 'zlib'
+    params['output'] = base64.b64encode('not zlib')
+    response = self.post_json('/swarming/api/v1/bot/task_update', params)
+    self.assertEqual(True, response[u'ok'])
+    self.assertEqual(['result string' * 10, 'not zlib'], outputs)
+
   def test_task_failure(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     params = self.do_handshake(do_first_poll=True)
@@ -1941,7 +2008,12 @@ class BotApiTest(test_env_handlers.AppTestBase):
 
     self.set_as_bot()
     response = self.bot_complete_task(task_id=task_id)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': True,
+            u'ok': True,
+        }, response)
 
     self.set_as_user()
     expected = self.gen_run_result(
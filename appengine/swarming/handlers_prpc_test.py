@@ -477,7 +477,12 @@ class BotServicePrpcTest(PrpcTest):
     t4 = self.mock_now(second_ticker())
 
     resp = self.bot_complete_task(task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, resp)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, resp)
     params['event'] = 'bot_rebooting'
     params['message'] = 'for the best'
     t5 = self.mock_now(second_ticker())
@@ -714,7 +719,12 @@ class BotServicePrpcTest(PrpcTest):
     self.set_as_bot()
     res = self.bot_poll()
     response = self.bot_complete_task(task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
 
     now_1 = self.mock_now(self.now, 1)
     self.mock(random, 'getrandbits', lambda _: 0x55)
@@ -724,7 +734,12 @@ class BotServicePrpcTest(PrpcTest):
     res = self.bot_poll()
     response = self.bot_complete_task(exit_code=1,
                                       task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
 
     start = self.now + datetime.timedelta(seconds=0.5)
     end = now_1 + datetime.timedelta(seconds=0.5)
@@ -1420,7 +1435,12 @@ class TaskServicePrpcTest(PrpcTest):
     self.set_as_bot()
     params = _params(output=base64.b64encode('Oh '))
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
     self.set_as_user()
     expected = swarming_pb2.TaskResultResponse()
     self.apply_defaults_for_result_summary(expected)
@@ -1467,7 +1487,12 @@ class TaskServicePrpcTest(PrpcTest):
     self.set_as_bot()
     params = _params(output=base64.b64encode('hi'), output_chunk_start=3)
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': True,
+            u'ok': True,
+        }, response)
 
     # abandoned_ts is set but state isn't changed yet.
     self.set_as_user()
@@ -1507,7 +1532,12 @@ class TaskServicePrpcTest(PrpcTest):
                      duration=0.1,
                      exit_code=0)
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': True,
+            u'ok': True,
+        }, response)
 
     self.set_as_user()
     expected = swarming_pb2.TaskResultResponse()
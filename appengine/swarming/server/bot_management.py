@@ -39,6 +39,7 @@
 import datetime
 import functools
 import logging
+import random
 import time
 
 from google.appengine.api import datastore_errors
@@ -58,6 +59,18 @@ _OLD_BOT_EVENTS_CUT_OFF = datetime.timedelta(days=4 * 7)
 # BotInfo entities are deleted when they are older than the cutoff.
 _OLD_BOT_INFO_CUT_OFF = _OLD_BOT_EVENTS_CUT_OFF + datetime.timedelta(hours=4)
 
+# Number of BotsCounter shards per pool. Each shard sustains about one update
+# per second. Reconciliation of a pool without bots deletes all its shards in a
+# single cross-group transaction, which is limited to 25 entity groups.
+_BOTS_COUNTER_SHARDS = 16
+# BotsCounter are not trusted anymore if cron_update_bot_info didn't reconcile
+# them for this long, e.g. the cron job is broken.
+_BOTS_COUNTER_MAX_AGE = datetime.timedelta(minutes=10)
+# Length of the epochs BotsCounter are reconciled against. A scan by
+# cron_update_bot_info that spans two epochs doesn't reconcile, so it must be a
+# few times longer than a scan.
+_BOTS_COUNTER_EPOCH_SECS = 5 * 60
+
 
 ### Models.
 
@@ -244,6 +257,13 @@ class BotInfo(_BotCommon):
   # Avoid having huge amounts of indices to query by quarantined/idle.
   composite = ndb.IntegerProperty(repeated=True)
 
+  # The BotsCounter epoch of the first update of this entity in it, see
+  # _bots_counter_epoch().
+  counted_epoch = ndb.IntegerProperty(indexed=False)
+  # The result of _counted_state() as of the start of counted_epoch.
+  counted_epoch_state = datastore_utils.DeterministicJsonProperty(
+      json_type=list)
+
   def calc_composite(self):
     """Returns the value for BotInfo.composite, which permits quick searches."""
     return [
@@ -265,6 +285,7 @@ class BotInfo(_BotCommon):
     return self.DEAD in self.composite
 
   def to_dict(self, exclude=None):
+    exclude = ['counted_epoch', 'counted_epoch_state'] + (exclude or [])
     out = super(BotInfo, self).to_dict(exclude=exclude)
     # Inject the bot id, since it's the entity key.
     out['id'] = self.id
@@ -289,9 +310,9 @@ class BotInfo(_BotCommon):
     self.composite = self.calc_composite()
 
   @classmethod
-  def yield_alive_bots(cls):
-    """Yields BotInfo of all alive bots."""
-    q = cls.query(cls.composite == cls.ALIVE)
+  def yield_all_bots(cls):
+    """Yields BotInfo of all bots, alive or dead."""
+    q = cls.query()
     cursor = None
     more = True
     while more:
@@ -403,6 +424,38 @@ class BotSettings(ndb.Model):
   quarantined = ndb.BooleanProperty()
 
 
+class BotsCounter(ndb.Model):
+  """Materialized counts of the bots in a pool, split in shards.
+
+  Key id is '<pool>:<shard>'. No parent. The sum over the shards of a pool
+  gives the same values as the BotInfo count queries used by CountBots.
+
+  The counts are updated incrementally by bot_event() when a bot changes state.
+  Each shard also remembers its counts as of the start of the current epoch,
+  while each BotInfo remembers its state as of then. cron_update_bot_info()
+  periodically adds to shard 0 the difference between the two, so the updates
+  done during the scan are neither lost nor counted twice.
+  """
+  # {'' or 'key:value': [count, dead, quarantined, maintenance, busy]}. '' is
+  # the whole pool, other entries count the bots of the pool with this
+  # dimension. 'id' dimensions are not tracked.
+  counts = datastore_utils.DeterministicJsonProperty(
+      json_type=dict, compressed=True)
+  # When the counts were last reconciled. Only set on shard 0.
+  reconciled_ts = ndb.DateTimeProperty(indexed=False)
+  # The epoch of the last update, see _bots_counter_epoch().
+  epoch = ndb.IntegerProperty(indexed=False)
+  # `counts` as of the start of the epoch.
+  epoch_counts = datastore_utils.DeterministicJsonProperty(
+      json_type=dict, compressed=True)
+  # Counts of the bots deleted during the epoch, as of its start.
+  forgotten = datastore_utils.DeterministicJsonProperty(
+      json_type=dict, compressed=True)
+
+  _use_cache = False
+  _use_memcache = False
+
+
 ### Public APIs.
 
 
@@ -564,6 +617,57 @@ def filter_availability(q, quarantined, in_maintenance, is_dead, is_busy):
   return q
 
 
+def get_bots_count(dimensions):
+  """Returns the bot counts from BotsCounter if they can answer the filter.
+
+  Only a single pool, optionally with one other dimension, can be answered.
+
+  Arguments:
+    dimensions: list of "key:value" strings, already validated.
+
+  Returns:
+    [count, dead, quarantined, maintenance, busy] or None if the counters
+    cannot be used and the BotInfo queries must be done instead.
+  """
+  pools = [d for d in dimensions if d.startswith('pool:')]
+  others = [d for d in dimensions if not d.startswith('pool:')]
+  if len(pools) != 1 or len(others) > 1:
+    return None
+  if any(OR_DIM_SEP in d for d in dimensions):
+    return None
+  if others and others[0].startswith('id:'):
+    return None
+  pool = pools[0][len('pool:'):]
+  shards = ndb.get_multi(
+      [_bots_counter_key(pool, i) for i in range(_BOTS_COUNTER_SHARDS)])
+  if not shards[0] or not shards[0].reconciled_ts:
+    return None
+  if shards[0].reconciled_ts < utils.utcnow() - _BOTS_COUNTER_MAX_AGE:
+    logging.warning('BotsCounter for %s are stale', pool)
+    return None
+  key = others[0] if others else u''
+  total = [0] * 5
+  for shard in shards:
+    if shard:
+      total = [a + b for a, b in zip(total, shard.counts.get(key, [0] * 5))]
+  return total
+
+
+def forget_bot(bot_info):
+  """Deletes a BotInfo and removes the bot from BotsCounter.
+
+  Arguments:
+    bot_info: the BotInfo entity as currently stored.
+  """
+  epoch = _bots_counter_epoch(utils.utcnow())
+  bot_info.key.delete()
+  _update_bots_counters(
+      _counted_state(bot_info),
+      None,
+      epoch,
+      forgotten=_counted_state_at(bot_info, epoch))
+
+
 def _apply_event_updates(bot_info, event_type, now, task_id, task_name,
                          external_ip, authenticated_as, dimensions_flat, state,
                          version, quarantined, maintenance_msg,
@@ -676,6 +780,264 @@ def _should_store_event(event_type, before, after):
       or before[1] != after[1])
 
 
+def _bots_counter_key(pool, shard):
+  """Returns the ndb.Key of a BotsCounter shard."""
+  return ndb.Key(BotsCounter, '%s:%d' % (pool, shard))
+
+
+def _bots_counter_epoch(now):
+  """Returns the number of the BotsCounter epoch that contains `now`."""
+  return utils.datetime_to_timestamp(now) / (_BOTS_COUNTER_EPOCH_SECS * 1000000)
+
+
+def _counted_state(bot_info):
+  """Returns the state of a stored BotInfo as seen by the count queries.
+
+  Returns None if BotInfo wasn't stored yet.
+  """
+  if not bot_info.composite:
+    return None
+  return list(bot_info.dimensions_flat), list(bot_info.composite)
+
+
+def _counted_state_at(bot_info, epoch):
+  """Returns _counted_state() of a stored BotInfo as of the start of the epoch.
+  """
+  if bot_info.counted_epoch == epoch:
+    state = bot_info.counted_epoch_state
+    return tuple(state) if state else None
+  return _counted_state(bot_info)
+
+
+def _remember_counted_state(bot_info, epoch):
+  """Remembers the state of BotInfo as of the start of the epoch.
+
+  Must be called before modifying BotInfo.
+  """
+  if bot_info.counted_epoch != epoch:
+    state = _counted_state(bot_info)
+    bot_info.counted_epoch = epoch
+    bot_info.counted_epoch_state = list(state) if state else None
+
+
+def _bot_counts(state, sign):
+  """Returns {pool: {dimension: counts}} contributed by one bot.
+
+  Arguments:
+    state: a result of _counted_state() or None.
+    sign: 1 to add the bot, -1 to remove it.
+  """
+  if not state:
+    return {}
+  dimensions_flat, composite = state
+  counts = [
+      sign,
+      sign if BotInfo.DEAD in composite else 0,
+      sign if BotInfo.QUARANTINED in composite else 0,
+      sign if BotInfo.IN_MAINTENANCE in composite else 0,
+      sign if BotInfo.BUSY in composite else 0,
+  ]
+  dims = [u''] + [
+      d for d in dimensions_flat
+      if not d.startswith('pool:') and not d.startswith('id:')
+  ]
+  return {
+      pool: {d: counts for d in dims}
+      for pool in get_pools_from_dimensions_flat(dimensions_flat)
+  }
+
+
+def _add_counts(dst, src):
+  """Adds {dimension: counts} from src into dst, dropping zero counts."""
+  for d, counts in src.items():
+    total = [a + b for a, b in zip(dst.get(d, [0] * 5), counts)]
+    if any(total):
+      dst[d] = total
+    else:
+      dst.pop(d, None)
+
+
+def _negated(counts):
+  """Returns {dimension: counts} with all the counts negated."""
+  return {d: [-c for c in v] for d, v in counts.items()}
+
+
+def _add_epoch_counts(counter, counts, epoch, forgotten=None):
+  """Adds the counts of a change done during the epoch to a BotsCounter shard.
+
+  Arguments:
+    counter: the BotsCounter shard to update.
+    counts: {dimension: counts} to add.
+    epoch: the epoch of the change, see _bots_counter_epoch().
+    forgotten: {dimension: counts} of a deleted bot as of the start of the
+      epoch, if any.
+  """
+  if (counter.epoch or 0) < epoch:
+    # The first update in this epoch.
+    counter.epoch = epoch
+    counter.epoch_counts = dict(counter.counts)
+    counter.forgotten = {}
+  _add_counts(counter.counts, counts)
+  if counter.epoch > epoch:
+    # A late update from an earlier epoch, it happened before this one started.
+    _add_counts(counter.epoch_counts, counts)
+  elif forgotten:
+    _add_counts(counter.forgotten, forgotten)
+
+
+def _update_bots_counters(before, after, epoch, forgotten=None):
+  """Applies the transition of a bot from one state to another to BotsCounter.
+
+  This is best effort, cron_update_bot_info() eventually fixes the counts.
+
+  Arguments:
+    before: a result of _counted_state() or None if the bot was not stored.
+    after: a result of _counted_state() or None if the bot was deleted.
+    epoch: the epoch of the transition, see _bots_counter_epoch().
+    forgotten: if the bot was deleted, the result of _counted_state_at() for
+      this epoch.
+  """
+  if before == after:
+    return
+  delta = {}
+  for pool, counts in _bot_counts(before, -1).items():
+    _add_counts(delta.setdefault(pool, {}), counts)
+  for pool, counts in _bot_counts(after, 1).items():
+    _add_counts(delta.setdefault(pool, {}), counts)
+  forgotten = _bot_counts(forgotten, 1)
+
+  @ndb.tasklet
+  def txn(key, counts, pool_forgotten):
+    counter = yield key.get_async()
+    if not counter:
+      counter = BotsCounter(key=key, counts={})
+    _add_epoch_counts(counter, counts, epoch, pool_forgotten)
+    yield counter.put_async()
+
+  futures = []
+  for pool in sorted(set(delta) | set(forgotten)):
+    counts = delta.get(pool, {})
+    if not counts and not forgotten.get(pool):
+      continue
+    # Spread the updates over the shards to avoid contention on busy pools.
+    key = _bots_counter_key(pool, random.randint(0, _BOTS_COUNTER_SHARDS - 1))
+    futures.append(
+        datastore_utils.transaction_async(
+            functools.partial(txn, key, counts, forgotten.get(pool)),
+            retries=3))
+  for f in futures:
+    try:
+      f.get_result()
+    except datastore_utils.CommitError as e:
+      logging.warning('Failed to update BotsCounter: %s', e)
+
+
+def _bots_counters_pools():
+  """Returns the pools that have BotsCounter shards."""
+  return set(
+      k.id().rsplit(':', 1)[0]
+      for k in BotsCounter.query().iter(keys_only=True))
+
+
+def _counts_at(counters, epoch):
+  """Returns {dimension: counts} of BotsCounter shards as of the start of the
+  epoch, excluding the bots deleted since then.
+
+  Returns None if a shard was already updated in a later epoch.
+  """
+  total = {}
+  for counter in counters:
+    if not counter:
+      continue
+    if (counter.epoch or 0) > epoch:
+      return None
+    if (counter.epoch or 0) < epoch:
+      _add_counts(total, counter.counts)
+    else:
+      _add_counts(total, counter.epoch_counts or {})
+      _add_counts(total, _negated(counter.forgotten or {}))
+  return total
+
+
+def _reconcile_bots_counters(tallies, epoch, now):
+  """Corrects BotsCounter with the counts seen while scanning BotInfo.
+
+  The shards are not overwritten since bot_event() keeps updating them while
+  BotInfo is scanned. Instead shard 0 gets the difference between the tallies
+  and the counts of the shards, both as of the start of the epoch. The updates
+  done since then are already in the shards.
+
+  Pools without any bot left have their counters deleted once they sum to zero.
+
+  Arguments:
+    tallies: {pool: {dimension: counts}} of all the bots as of the start of
+      the epoch, see _counted_state_at().
+    epoch: the epoch of the scan, see _bots_counter_epoch().
+    now: reconciliation timestamp.
+  """
+  pools = set(tallies) | _bots_counters_pools()
+
+  @ndb.tasklet
+  def txn(pool, correction):
+    keys = [_bots_counter_key(pool, i) for i in range(_BOTS_COUNTER_SHARDS)]
+    # Only look at the other shards when the pool may be empty, to not conflict
+    # with bot_event() updates needlessly.
+    if pool in tallies:
+      counter = yield keys[0].get_async()
+      others = []
+    else:
+      counters = yield ndb.get_multi_async(keys)
+      counter, others = counters[0], counters[1:]
+    counts = _counts_at([counter], epoch)
+    if counts is None:
+      logging.warning('BotsCounter for %s moved to the next epoch', pool)
+      return
+    correction = dict(correction)
+    _add_counts(correction, _negated(counts))
+    counter = counter or BotsCounter(key=keys[0], counts={})
+    # The correction is as of the start of the epoch, so the next scans in this
+    # epoch don't apply it again.
+    _add_epoch_counts(counter, {}, epoch)
+    _add_counts(counter.counts, correction)
+    _add_counts(counter.epoch_counts, correction)
+    counter.reconciled_ts = now
+    if pool not in tallies:
+      total = {}
+      for c in [counter] + others:
+        if c:
+          _add_counts(total, c.counts)
+      if not total:
+        yield ndb.delete_multi_async(keys)
+        return
+    yield counter.put_async()
+
+  futures = []
+  for pool in sorted(pools):
+    # The other shards only change as of the start of the epoch when a late
+    # update from an earlier epoch lands, don't read them in the transaction.
+    counts = _counts_at(
+        ndb.get_multi([
+            _bots_counter_key(pool, i)
+            for i in range(1, _BOTS_COUNTER_SHARDS)
+        ]), epoch)
+    if counts is None:
+      logging.warning('BotsCounter for %s moved to the next epoch', pool)
+      continue
+    correction = {}
+    _add_counts(correction, tallies.get(pool, {}))
+    _add_counts(correction, _negated(counts))
+    futures.append((pool,
+                    datastore_utils.transaction_async(
+                        functools.partial(txn, pool, correction),
+                        retries=3,
+                        xg=True)))
+  for pool, f in futures:
+    try:
+      f.get_result()
+    except datastore_utils.CommitError as e:
+      logging.warning('Failed to reconcile BotsCounter for %s: %s', pool, e)
+
+
 def _insert_bot_with_txn(root_key, bot_info, event):
   """Stores BotInfo and/or BotEvent (skipping None)."""
   entities = []
@@ -806,6 +1168,10 @@ def bot_event(event_type,
 
   # Snapshot the state before any changes, used in _should_store_event.
   state_before = _snapshot_bot_info(bot_info)
+  # The state as seen by the count queries, used to update BotsCounter.
+  counted_before = _counted_state(bot_info)
+  epoch = _bots_counter_epoch(now)
+  _remember_counted_state(bot_info, epoch)
 
   # Mutate BotInfo in place based on the event details.
   _apply_event_updates(bot_info=bot_info,
@@ -851,11 +1217,14 @@ def bot_event(event_type,
                      message=event_msg)
     _insert_bot_with_txn(info_key.root(), bot_info if store_bot_info else None,
                          event)
+    if store_bot_info:
+      _update_bots_counters(counted_before, _counted_state(bot_info), epoch)
     return event.key
 
   # No need to emit an event. Just update BotInfo on its own.
   if store_bot_info:
     _insert_bot_with_txn(info_key.root(), bot_info, None)
+    _update_bots_counters(counted_before, _counted_state(bot_info), epoch)
   return None
 
 
@@ -924,7 +1293,7 @@ def get_pools_from_dimensions_flat(dimensions_flat):
 
 
 def cron_update_bot_info():
-  """Refreshes BotInfo.composite for dead bots."""
+  """Refreshes BotInfo.composite for dead bots and reconciles BotsCounter."""
   @ndb.tasklet
   def run(bot_key):
     bot = bot_key.get()
@@ -935,34 +1304,51 @@ def cron_update_bot_info():
     if not bot.is_dead and bot._should_be_dead():
       # `is_dead` is updated in _pre_put_hook based on should_be_dead.
       logging.info('Changing Bot status to DEAD: %s', bot.id)
+      counted_before = _counted_state(bot)
+      _remember_counted_state(bot, _bots_counter_epoch(utils.utcnow()))
       yield bot.put_async()
-      raise ndb.Return(bot)
+      raise ndb.Return((bot, counted_before))
     logging.debug('BotInfo changed since query or query was stale, %r', bot)
     raise ndb.Return(None)
 
+  # Counts of all the bots as of the start of the epoch, to reconcile
+  # BotsCounter.
+  tallies = {}
+
+  def tally(bot):
+    if bot:
+      state = _counted_state_at(bot, epoch)
+      for pool, counts in _bot_counts(state, 1).items():
+        _add_counts(tallies.setdefault(pool, {}), counts)
+
   # Note: tx_result can potentially block for a significant amount of time since
   # it makes several datastore updates (including a transaction) in a blocking
   # way.
-  def tx_result(future, stats):
+  def tx_result(future, bot_key, stats):
     try:
-      bot = future.get_result()
-      if not bot:
+      res = future.get_result()
+      if not res:
         stats['stale'] += 1
-        return
-      stats['dead'] += 1
-
-      # Unregister the bot from task queues since it can't reap anything.
-      task_queues.cleanup_after_bot(bot.id)
-
-      # Note: this is best effort at this point. If it fails, there'll be no
-      # retry: the bot is already marked as dead.
-      logging.info('Sending bot_missing event: %s', bot.id)
-      bot_event('bot_missing', bot.id)
+      else:
+        bot, counted_before = res
+        stats['dead'] += 1
+        _update_bots_counters(counted_before, _counted_state(bot),
+                              bot.counted_epoch)
+
+        # Unregister the bot from task queues since it can't reap anything.
+        task_queues.cleanup_after_bot(bot.id)
+
+        # Note: this is best effort at this point. If it fails, there'll be no
+        # retry: the bot is already marked as dead.
+        logging.info('Sending bot_missing event: %s', bot.id)
+        bot_event('bot_missing', bot.id)
     except datastore_utils.CommitError:
       logging.warning('Failed to commit a Tx')
       stats['failed'] += 1
+    # The bot changed since the query, count it as it is now.
+    tally(bot_key.get(use_cache=False, use_memcache=False))
 
-  # The assumption here is that a cron job can visit all alive bots fast enough.
+  # The assumption here is that a cron job can visit all bots fast enough.
   # The number of bots is expected to be up to ~30k. It takes about a minute to
   # process them (assuming there's negligible amount of dead bots). See also
   # cron.yaml `/internal/cron/monitoring/bots/update_bot_info` entry that
@@ -974,23 +1360,30 @@ def cron_update_bot_info():
       'stale': 0,
   }
 
+  now = utils.utcnow()
   # _deadline() hits the instance config cache. Do it only once here instead of
   # several thousand times inside _should_be_dead() in the loop below.
   deadline = BotInfo._deadline()
 
+  # The counters are reconciled as of the start of this epoch, see
+  # _reconcile_bots_counters().
+  epoch = _bots_counter_epoch(now)
+
   futures = []
   logging.debug('Finding dead based on deadline %s...', deadline)
   try:
-    for info in BotInfo.yield_alive_bots():
+    for info in BotInfo.yield_all_bots():
       cron_stats['seen'] += 1
       if cron_stats['seen'] % 500 == 0:
         logging.debug('Visited %d bots so far', cron_stats['seen'])
 
-      # We visit all alive bots and check if any should be marked as dead now.
-      # Note that an alternative would be to have an index on `last_seen_ts`,
-      # but this index turns out to be very hot (being update on every poll).
+      # We visit all bots and check if any alive one should be marked as dead
+      # now. Note that an alternative would be to have an index on
+      # `last_seen_ts`, but this index turns out to be very hot (being update
+      # on every poll).
       # See https://chromium.googlesource.com/infra/luci/luci-py/+/4e9aecba.
       if info.is_dead or not info._should_be_dead(deadline):
+        tally(info)
         continue
 
       # Transactionally flip the state of the bot to DEAD. Retry more often than
@@ -998,22 +1391,28 @@ def cron_update_bot_info():
       # should be plenty of time to do the retries.
       f = datastore_utils.transaction_async(functools.partial(run, info.key),
                                             retries=5)
-      futures.append(f)
+      futures.append((f, info.key))
 
       # Limit the number of concurrent transactions to avoid OOMs.
       if len(futures) > 20:
-        ndb.Future.wait_any(futures)
+        ndb.Future.wait_any([f for f, _ in futures])
         pending = []
-        for f in futures:
+        for f, key in futures:
           if f.done():
-            tx_result(f, cron_stats)
+            tx_result(f, key, cron_stats)
           else:
-            pending.append(f)
+            pending.append((f, key))
         futures = pending
 
     # Collect all remaining futures.
-    for f in futures:
-      tx_result(f, cron_stats)
+    for f, key in futures:
+      tx_result(f, key, cron_stats)
+
+    # Only reconcile after a complete scan, otherwise bots would be missing.
+    if _bots_counter_epoch(utils.utcnow()) == epoch:
+      _reconcile_bots_counters(tallies, epoch, now)
+    else:
+      logging.warning('The scan spanned two epochs, not reconciling')
 
   finally:
     logging.debug('Seen: %d, marked as dead: %d, stale: %d, failed: %d',
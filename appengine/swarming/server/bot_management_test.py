@@ -726,6 +726,130 @@ class BotManagementTest(test_case.TestCase):
     last_seen_ts.FromDatetime(bot1_dead['last_seen_ts'])
     self.assertEqual(bq_event.bot.info.last_seen_ts, last_seen_ts)
 
+  def test_get_bots_count(self):
+    pool = [u'pool:default']
+    os_ = [u'pool:default', u'os:Ubuntu']
+    _bot_event(event_type='request_sleep')
+    _bot_event(event_type='request_task', bot_id='id2', task_id='12311')
+    _bot_event(event_type='request_sleep', bot_id='id3', quarantined=True)
+    # Never reconciled, the queries must be used.
+    self.assertIsNone(bot_management.get_bots_count(pool))
+
+    self.assertEqual(0, bot_management.cron_update_bot_info())
+    self.assertEqual([3, 0, 1, 0, 2], bot_management.get_bots_count(pool))
+    self.assertEqual([3, 0, 1, 0, 2], bot_management.get_bots_count(os_))
+    self.assertIsNone(bot_management.get_bots_count([u'pool:other']))
+    # Arbitrary filters are not supported.
+    self.assertIsNone(bot_management.get_bots_count([u'os:Ubuntu']))
+    self.assertIsNone(
+        bot_management.get_bots_count([u'pool:default', u'id:id1']))
+    self.assertIsNone(
+        bot_management.get_bots_count([u'pool:default', u'os:Ubuntu|Mac']))
+    self.assertIsNone(
+        bot_management.get_bots_count(
+            [u'pool:default', u'os:Ubuntu', u'os:Ubuntu-16.04']))
+
+    # Transitions are applied incrementally.
+    _bot_event(event_type='task_completed', bot_id='id2', task_id='12311')
+    _bot_event(event_type='request_sleep', bot_id='id2')
+    _bot_event(
+        event_type='request_sleep',
+        bot_id='id4',
+        dimensions={
+            u'id': [u'id4'],
+            u'os': [u'Mac'],
+            u'pool': [u'default'],
+        },
+        maintenance_msg='very busy')
+    self.assertEqual([4, 0, 1, 1, 2], bot_management.get_bots_count(pool))
+    self.assertEqual([3, 0, 1, 0, 1], bot_management.get_bots_count(os_))
+    self.assertEqual(
+        [1, 0, 0, 1, 1],
+        bot_management.get_bots_count([u'pool:default', u'os:Mac']))
+
+    # Dead bots are counted after the cron job.
+    timeout = bot_management.config.settings().bot_death_timeout_secs
+    self.mock_now(self.now, timeout)
+    self.assertEqual(4, bot_management.cron_update_bot_info())
+    self.assertEqual([4, 4, 1, 1, 4], bot_management.get_bots_count(pool))
+
+    # Stale counters are not used.
+    self.mock_now(self.now, timeout + 11 * 60)
+    self.assertIsNone(bot_management.get_bots_count(pool))
+
+  def test_get_bots_count_updated_during_scan(self):
+    pool = [u'pool:default']
+    _bot_event(event_type='request_sleep')
+    _bot_event(event_type='request_sleep', bot_id='id2')
+    bot_management.cron_update_bot_info()
+    self.assertEqual([2, 0, 0, 0, 0], bot_management.get_bots_count(pool))
+
+    # A bot shows up after the scan went past it, it must stay counted.
+    yield_all_bots = bot_management.BotInfo.yield_all_bots
+
+    def yield_and_register():
+      for bot in list(yield_all_bots()):
+        yield bot
+      _bot_event(event_type='request_sleep', bot_id='id3')
+
+    self.mock(bot_management.BotInfo, 'yield_all_bots', yield_and_register)
+    bot_management.cron_update_bot_info()
+    self.assertEqual([3, 0, 0, 0, 0], bot_management.get_bots_count(pool))
+
+  def test_get_bots_count_updated_before_visit(self):
+    pool = [u'pool:default']
+    _bot_event(event_type='request_sleep')
+    _bot_event(event_type='request_sleep', bot_id='id2')
+    _bot_event(event_type='request_sleep', bot_id='id3')
+    bot_management.cron_update_bot_info()
+    self.assertEqual([3, 0, 0, 0, 0], bot_management.get_bots_count(pool))
+
+    # In the next epoch, bots change after the scan started but before it
+    # visits them. They must be counted once.
+    self.mock_now(self.now, bot_management._BOTS_COUNTER_EPOCH_SECS)
+    yield_all_bots = bot_management.BotInfo.yield_all_bots
+
+    def update_and_yield():
+      _bot_event(event_type='request_task', bot_id='id2', task_id='12311')
+      _bot_event(event_type='task_completed', bot_id='id2', task_id='12311')
+      _bot_event(event_type='request_task', bot_id='id2', task_id='12321')
+      bot_management.forget_bot(bot_management.get_info_key('id3').get())
+      for bot in yield_all_bots():
+        yield bot
+
+    self.mock(bot_management.BotInfo, 'yield_all_bots', update_and_yield)
+    bot_management.cron_update_bot_info()
+    self.assertEqual([2, 0, 0, 0, 1], bot_management.get_bots_count(pool))
+    # The next scan in the same epoch doesn't apply the correction again.
+    self.mock(bot_management.BotInfo, 'yield_all_bots', yield_all_bots)
+    bot_management.cron_update_bot_info()
+    self.assertEqual([2, 0, 0, 0, 1], bot_management.get_bots_count(pool))
+
+    # Counters that drifted before the epoch, e.g. due to a lost update, are
+    # fixed.
+    counter = bot_management._bots_counter_key('default', 0).get()
+    bot_management._add_counts(counter.counts, {u'': [5, 0, 0, 0, 5]})
+    bot_management._add_counts(counter.epoch_counts, {u'': [5, 0, 0, 0, 5]})
+    counter.put()
+    bot_management.cron_update_bot_info()
+    self.assertEqual([2, 0, 0, 0, 1], bot_management.get_bots_count(pool))
+
+  def test_forget_bot(self):
+    pool = [u'pool:default']
+    _bot_event(event_type='request_sleep')
+    _bot_event(event_type='request_sleep', bot_id='id2')
+    bot_management.cron_update_bot_info()
+    self.assertEqual([2, 0, 0, 0, 0], bot_management.get_bots_count(pool))
+
+    bot_management.forget_bot(bot_management.get_info_key('id1').get())
+    self.assertIsNone(bot_management.get_info_key('id1').get())
+    self.assertEqual([1, 0, 0, 0, 0], bot_management.get_bots_count(pool))
+
+    # The counters of an empty pool are deleted on reconciliation.
+    bot_management.forget_bot(bot_management.get_info_key('id2').get())
+    bot_management.cron_update_bot_info()
+    self.assertIsNone(bot_management.get_bots_count(pool))
+
   def test_filter_dimensions(self):
     pass # Tested in handlers_endpoints_test
 
@@ -0,0 +1,177 @@
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Matching of bot and task dimensions using integer bitmaps.
+
+Each `key:value` dimension string seen by the process is interned into a small
+integer (a bit number). A set of dimensions is then represented by a python int
+with the corresponding bits set, and checking that a bot has all dimensions
+required by a task becomes a bitwise AND and a comparison.
+
+Compiled task dimensions are cached in-process, so a bot that visits many
+TaskToRunShard entities of the same queue (or the same TaskDimensionsSets
+entity over and over again) doesn't reformat and look up `key:value` strings
+for each of them.
+
+The interning table is capped. When it overflows, it is replaced with a new
+empty table (bumping its generation), and all bitmaps computed for the previous
+generation are lazily recomputed.
+"""
+
+import threading
+
+from server.constants import OR_DIM_SEP
+
+
+# Maximum number of interned `key:value` strings before the table is reset.
+#
+# Bitmaps are python ints, the larger bit numbers are, the slower bitwise
+# operations are. This keeps all bitmaps under 8 KB.
+_MAX_INTERNED = 1 << 16
+
+# Maximum number of cached compiled task dimensions before the cache is reset.
+_MAX_COMPILED = 10000
+
+
+class _Interner(object):
+  """Assigns bit numbers to `key:value` strings."""
+
+  def __init__(self, max_size):
+    self._lock = threading.Lock()
+    self._max_size = max_size
+    # (generation, {`key:value` => bit number}). Replaced as a whole on reset,
+    # so it can be used as a consistent snapshot without holding the lock.
+    self._state = (0, {})
+
+  def snapshot(self):
+    """Returns the current state of the table to pass to bits(...).
+
+    Bitmaps computed from different snapshots are not comparable.
+    """
+    state = self._state
+    if len(state[1]) >= self._max_size:
+      with self._lock:
+        if self._state is state:
+          self._state = (state[0] + 1, {})
+        state = self._state
+    return state
+
+  def bits(self, state, dimensions):
+    """Returns an int bitmap for an iterable of `key:value` strings.
+
+    Interns strings not seen before.
+
+    Arguments:
+      state: a snapshot returned by snapshot().
+      dimensions: an iterable of `key:value` strings.
+    """
+    table = state[1]
+    bits = 0
+    for kv in dimensions:
+      bit = table.get(kv)
+      if bit is None:
+        with self._lock:
+          bit = table.setdefault(kv, len(table))
+      bits |= 1 << bit
+    return bits
+
+
+_INTERNER = _Interner(_MAX_INTERNED)
+
+# Cache key => (interner snapshot, source value, compiled value).
+_COMPILED = {}
+
+
+def _compiled(state, cache_key, source, compile_fn):
+  """Returns compile_fn(state, source), caching it under `cache_key`.
+
+  The cached value is used only if it was compiled for the same interner
+  snapshot and the same (as in ==) source value.
+  """
+  if cache_key is not None:
+    entry = _COMPILED.get(cache_key)
+    if entry and entry[0] is state and entry[1] == source:
+      return entry[2]
+  compiled = compile_fn(state, source)
+  if cache_key is not None:
+    if len(_COMPILED) >= _MAX_COMPILED:
+      _COMPILED.clear()
+    _COMPILED[cache_key] = (state, source, compiled)
+  return compiled
+
+
+def _compile_flat_sets(state, sets):
+  """Compiles a value of TaskDimensionsSets.sets into a tuple of bitmaps."""
+  return tuple(_INTERNER.bits(state, s['dimensions']) for s in sets)
+
+
+def _compile_request(state, request_dimensions):
+  """Compiles task request dimensions into (required bitmap, OR bitmaps).
+
+  Here if request dimensions are {'k': ['a', 'b|c']}, `k:a` bit is in the
+  required bitmap, and there is an OR bitmap with `k:b` and `k:c` bits.
+  """
+  required = []
+  any_of = []
+  for key, vals in request_dimensions.iteritems():
+    for val in vals:
+      variants = val.split(OR_DIM_SEP)
+      if len(variants) == 1:
+        required.append(u'%s:%s' % (key, val))
+      else:
+        any_of.append(
+            _INTERNER.bits(state, [u'%s:%s' % (key, v) for v in variants]))
+  return _INTERNER.bits(state, required), tuple(any_of)
+
+
+class BotDimensions(object):
+  """Bot dimensions as a bitmap, can be matched against task dimensions."""
+
+  __slots__ = ('_flat', '_state', '_bits')
+
+  def __init__(self, bot_dimensions_flat):
+    """Initializes the object.
+
+    Arguments:
+      bot_dimensions_flat: a list of `key:value` strings with bot dimensions.
+    """
+    self._flat = tuple(bot_dimensions_flat)
+    self._state = None
+    self._bits = 0
+
+  def _current(self):
+    """Returns (interner snapshot, bot bitmap in this snapshot)."""
+    state = _INTERNER.snapshot()
+    if state is not self._state:
+      self._bits = _INTERNER.bits(state, self._flat)
+      self._state = state
+    return state, self._bits
+
+  def matches_flat_sets(self, sets, cache_key=None):
+    """True if any of the flat task dimensions sets is a subset of the bot's.
+
+    Arguments:
+      sets: a value of TaskDimensionsSets.sets entity property.
+      cache_key: if given, a key to cache the compiled `sets` under.
+    """
+    state, bot = self._current()
+    compiled = _compiled(state, cache_key, sets, _compile_flat_sets)
+    return any(task & bot == task for task in compiled)
+
+  def matches_request(self, request_dimensions, cache_key=None):
+    """True if the bot can run a task with the given request dimensions.
+
+    Arguments:
+      request_dimensions: a dict {key: [values]}, values may have "|" inside.
+      cache_key: if given, a key to cache the compiled dimensions under.
+    """
+    state, bot = self._current()
+    required, any_of = _compiled(state, cache_key, request_dimensions,
+                                 _compile_request)
+    if required & bot != required:
+      return False
+    for variants in any_of:
+      if not variants & bot:
+        return False
+    return True
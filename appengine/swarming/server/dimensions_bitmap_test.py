@@ -0,0 +1,158 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import random
+import sys
+import timeit
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+from test_support import test_case
+
+from server import dimensions_bitmap
+from server.constants import OR_DIM_SEP
+
+
+# pylint: disable=W0212
+
+
+def _string_matcher(bot_flat):
+  """The string based matcher dimensions_bitmap replaced, for benchmarks."""
+  bot_flat = frozenset(bot_flat)
+
+  def matcher(request_dimensions):
+    for key, vals in request_dimensions.iteritems():
+      for val in vals:
+        if not any(u'%s:%s' % (key, variant) in bot_flat
+                   for variant in val.split(OR_DIM_SEP)):
+          return False
+    return True
+
+  return matcher
+
+
+class DimensionsBitmapTest(test_case.TestCase):
+
+  def setUp(self):
+    super(DimensionsBitmapTest, self).setUp()
+    self.mock(dimensions_bitmap, '_INTERNER', dimensions_bitmap._Interner(100))
+    self.mock(dimensions_bitmap, '_COMPILED', {})
+
+  def test_matches_request(self):
+    bot = dimensions_bitmap.BotDimensions(
+        [u'cpu:x86', u'cpu:x86-64', u'os:Linux', u'pool:p'])
+    self.assertTrue(bot.matches_request({}))
+    self.assertTrue(bot.matches_request({u'pool': [u'p']}))
+    self.assertTrue(
+        bot.matches_request({
+            u'pool': [u'p'],
+            u'cpu': [u'x86', u'x86-64']
+        }))
+    self.assertTrue(
+        bot.matches_request({
+            u'pool': [u'p'],
+            u'os': [u'Mac|Linux']
+        }))
+    self.assertFalse(bot.matches_request({u'pool': [u'other']}))
+    self.assertFalse(
+        bot.matches_request({
+            u'pool': [u'p'],
+            u'os': [u'Mac|Windows']
+        }))
+    self.assertFalse(
+        bot.matches_request({
+            u'pool': [u'p'],
+            u'cpu': [u'x86', u'arm']
+        }))
+
+  def test_matches_request_cached(self):
+    bot = dimensions_bitmap.BotDimensions([u'os:Linux', u'pool:p'])
+    self.assertTrue(bot.matches_request({u'os': [u'Linux']}, cache_key=1))
+    self.assertEqual(1, len(dimensions_bitmap._COMPILED))
+    # Different dimensions under the same key (e.g. a hash collision) are
+    # recompiled.
+    self.assertFalse(bot.matches_request({u'os': [u'Mac']}, cache_key=1))
+    self.assertTrue(bot.matches_request({u'os': [u'Linux']}, cache_key=1))
+
+  def test_matches_flat_sets(self):
+    bot = dimensions_bitmap.BotDimensions([u'os:Linux', u'pool:p'])
+    sets = [
+        {
+            'dimensions': [u'os:Mac', u'pool:p']
+        },
+        {
+            'dimensions': [u'os:Linux', u'pool:p']
+        },
+    ]
+    self.assertTrue(bot.matches_flat_sets(sets, cache_key='pool:p:1'))
+    self.assertTrue(bot.matches_flat_sets(sets, cache_key='pool:p:1'))
+    self.assertFalse(bot.matches_flat_sets(sets[:1], cache_key='pool:p:1'))
+    self.assertFalse(bot.matches_flat_sets([]))
+
+  def test_interner_reset(self):
+    bot = dimensions_bitmap.BotDimensions([u'os:Linux', u'pool:p'])
+    self.assertTrue(bot.matches_request({u'os': [u'Linux']}, cache_key=1))
+    state = dimensions_bitmap._INTERNER.snapshot()
+    # Overflow the table. The next snapshot is a brand new table.
+    dimensions_bitmap._INTERNER.bits(state, [u'k:%d' % i for i in xrange(100)])
+    self.assertIsNot(state, dimensions_bitmap._INTERNER.snapshot())
+    self.assertEqual(state[0] + 1, dimensions_bitmap._INTERNER.snapshot()[0])
+    # Still works, all bitmaps are recalculated.
+    self.assertTrue(bot.matches_request({u'os': [u'Linux']}, cache_key=1))
+    self.assertFalse(bot.matches_request({u'os': [u'Mac']}, cache_key=2))
+
+
+class DimensionsBitmapBenchmark(test_case.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py to get meaningful
+  # numbers.
+  no_run = 1
+
+  def test_benchmark(self):
+    # Realistic sizes: a bot has ~40 dimensions with some multi-valued ones, a
+    # task requests ~8 of them, one with an OR.
+    rnd = random.Random(0)
+    bot_flat = sorted(
+        [u'id:bot-123', u'pool:chromium.tests'] +
+        [u'dim%d:value-%d' % (i, rnd.randint(0, 3)) for i in xrange(30)] +
+        [u'os:Linux', u'os:Ubuntu', u'os:Ubuntu-22', u'os:Ubuntu-22.04'] +
+        [u'cpu:x86', u'cpu:x86-64', u'cpu:x86-64-avx2'] +
+        [u'gpu:none', u'python:3', u'python:3.8', u'zone:us-central1-b'])
+    bot_dims = {}
+    for kv in bot_flat:
+      k, v = kv.split(':', 1)
+      bot_dims.setdefault(k, []).append(v)
+    request = {
+        u'pool': [u'chromium.tests'],
+        u'os': [u'Ubuntu-22.04'],
+        u'cpu': [u'x86-64'],
+        u'gpu': [u'none'],
+        u'python': [u'3.8|3.11'],
+    }
+    for i in xrange(3):
+      request[u'dim%d' % i] = bot_dims[u'dim%d' % i]
+
+    string_matcher = _string_matcher(bot_flat)
+    bot = dimensions_bitmap.BotDimensions(bot_flat)
+    self.assertTrue(string_matcher(request))
+    self.assertTrue(bot.matches_request(request, cache_key=1))
+
+    n = 100000
+    string_secs = timeit.timeit(lambda: string_matcher(request), number=n)
+    bitmap_secs = timeit.timeit(
+        lambda: bot.matches_request(request, cache_key=1), number=n)
+    logging.warning(
+        'dimensions matching, %d iterations: strings %.3fs, bitmaps %.3fs '
+        '(%.1fx)', n, string_secs, bitmap_secs, string_secs / bitmap_secs)
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
@@ -7,6 +7,8 @@
 import collections
 import json
 import logging
+import time
+import urllib
 
 from components import utils
 from components import datastore_utils
@@ -21,11 +23,31 @@ from proto.api import swarming_pb2
 from proto.plugin import plugin_pb2
 from proto.plugin import plugin_prpc_pb2
 
+import ts_mon_metrics
+
 from server import config
 from server import pools_config
 from server import task_queues
 
 
+# Seconds a notification sits in es-notify-tasks-batch before it can be
+# leased. Notifications of the same task within this window are coalesced.
+_BATCH_DELAY_SECS = 1
+
+# Maximum number of notifications sent in one NotifyTasksRequest. Larger
+# batches are split.
+_BATCH_MAX_NOTIFICATIONS = 200
+
+# Number of es-notify-kick tasks to keep queued. The queue runs at 1/s.
+_KICK_BACKLOG = 600
+
+# Seconds the QueueStatistics of es-notify-kick are reused for.
+_KICK_STATS_EXPIRATION_SECS = 10
+
+# Cached QueueStatistics of es-notify-kick, see _should_kick().
+_kick_stats = {'expiration': 0, 'tasks': 0}
+
+
 class ExternalSchedulerException(Exception):
   """Raised when an external-scheduler related error occurs."""
 
@@ -226,36 +248,59 @@ def notify_requests(es_cfg, requests, use_tq, is_callback, batch_mode=False):
     notify_request_now(es_cfg.address, req)
     return
 
-  request_json = json_format.MessageToJson(req)
   # If enable_batch_es_notifications is true, the notifications will be sent in
   # a batched mode along with others, to reduce traffic to external scheduler.
   if batch_mode and config.settings().enable_batch_es_notifications:
-    payload = {'es_host': es_cfg.address, 'request_json': request_json}
-    req = taskqueue.Task(payload=json.dumps(payload), method='PULL')
+    # The pull task is tagged with the external scheduler address and holds the
+    # serialized request.
+    countdown = _BATCH_DELAY_SECS or None
+    req = taskqueue.Task(
+        payload=req.SerializeToString(),
+        method='PULL',
+        tag=es_cfg.address,
+        countdown=countdown)
     if not req.add(
         queue_name='es-notify-tasks-batch', transactional=ndb.in_transaction()):
       raise datastore_utils.CommitError('Failed to enqueue task')
-    stats = taskqueue.QueueStatistics.fetch('es-notify-kick')
-    # Add a kicker task if there are fewer than 10 minutes worth.
-    if stats.tasks < 600:
+    if _should_kick():
       job_enqueued = utils.enqueue_task(
           '/internal/taskqueue/important/external_scheduler/notify-kick',
           'es-notify-kick',
+          countdown=countdown,
           transactional=ndb.in_transaction())
       if not job_enqueued:
         logging.info('Failed to add a notify-kick for request.')
     return
 
-  enqueued = utils.enqueue_task(
-      '/internal/taskqueue/important/external_scheduler/notify-tasks',
+  if not _enqueue_notify_tasks(es_cfg.address, req):
+    raise datastore_utils.CommitError('Failed to enqueue task')
+
+
+def _should_kick():
+  """Returns True if a es-notify-kick task should be added.
+
+  Keeps fewer than _KICK_BACKLOG tasks queued, without fetching the queue
+  statistics on every notification.
+  """
+  now = time.time()
+  if _kick_stats['expiration'] <= now:
+    _kick_stats['tasks'] = taskqueue.QueueStatistics.fetch(
+        'es-notify-kick').tasks
+    _kick_stats['expiration'] = now + _KICK_STATS_EXPIRATION_SECS
+  if _kick_stats['tasks'] >= _KICK_BACKLOG:
+    return False
+  _kick_stats['tasks'] += 1
+  return True
+
+
+def _enqueue_notify_tasks(es_host, req):
+  """Enqueues a serialized NotifyTasksRequest on es-notify-tasks."""
+  return utils.enqueue_task(
+      '/internal/taskqueue/important/external_scheduler/notify-tasks?' +
+      urllib.urlencode({'es_host': es_host}),
       'es-notify-tasks',
-      params={
-          'es_host': es_cfg.address,
-          'request_json': request_json
-      },
+      payload=req.SerializeToString(),
       transactional=ndb.in_transaction())
-  if not enqueued:
-    raise datastore_utils.CommitError('Failed to enqueue task')
 
 
 def notify_request_now(es_host, proto):
@@ -270,7 +315,11 @@ def notify_request_now(es_host, proto):
 
 
 def task_batch_handle_notifications():
-  """Batches notifications from pull queue, and forwards to push queue."""
+  """Batches notifications from pull queue, and forwards to push queue.
+
+  Notifications are grouped per external scheduler and only the latest one of
+  each task is sent.
+  """
 
   # Number of seconds to lease the tasks. Once it expires, the
   # tasks will be available again for the next worker.
@@ -282,30 +331,57 @@ def task_batch_handle_notifications():
   if not tasks:
     return
   requests = {}
+  # (scheduler_id, es_host) -> {task_id: notification}.
+  latest = collections.defaultdict(dict)
   tasks_per_scheduler = collections.defaultdict(list)
   for task in tasks:
-    proto = plugin_pb2.NotifyTasksRequest()
-    payload = json.loads(task.payload)
-    json_format.Parse(payload['request_json'], proto)
-    s_tuple = (proto.scheduler_id, payload['es_host'])
+    address, proto = _parse_batch_task(task)
+    s_tuple = (proto.scheduler_id, address)
     tasks_per_scheduler[s_tuple].append(task)
     if s_tuple not in requests:
       requests[s_tuple] = proto
-    else:
-      requests[s_tuple].notifications.extend(proto.notifications)
-
-  # pylint: disable=consider-iterating-dictionary
-  for s_id, address in requests.keys():
-    request_json = json_format.MessageToJson(requests[s_id, address])
-    enqueued = utils.enqueue_task(
-        '/internal/taskqueue/important/external_scheduler/notify-tasks',
-        'es-notify-tasks',
-        params={'es_host': address, 'request_json': request_json},
-        transactional=ndb.in_transaction())
-    if not enqueued:
-      logging.warning('Failed to enqueue external scheduler task, skipping')
-      continue
-    queue.delete_tasks(tasks_per_scheduler[s_id, address])
+    notifications = latest[s_tuple]
+    for n in proto.notifications:
+      prev = notifications.get(n.task.id)
+      if not prev or _timestamp_key(n.time) >= _timestamp_key(prev.time):
+        notifications[n.task.id] = n
+
+  now = utils.utcnow()
+  for s_tuple, notifications in latest.items():
+    s_id, address = s_tuple
+    notifications = sorted(
+        notifications.values(), key=lambda n: _timestamp_key(n.time))
+    ok = True
+    for i in range(0, len(notifications), _BATCH_MAX_NOTIFICATIONS):
+      chunk = notifications[i:i + _BATCH_MAX_NOTIFICATIONS]
+      req = plugin_pb2.NotifyTasksRequest()
+      req.CopyFrom(requests[s_tuple])
+      del req.notifications[:]
+      req.notifications.extend(chunk)
+      if not _enqueue_notify_tasks(address, req):
+        logging.warning('Failed to enqueue external scheduler task, skipping')
+        ok = False
+        break
+      ts_mon_metrics.on_es_notifications_flushed(
+          s_id, len(chunk), now - chunk[0].time.ToDatetime())
+    if ok:
+      queue.delete_tasks(tasks_per_scheduler[s_tuple])
+
+
+def _parse_batch_task(task):
+  """Returns (es_host, NotifyTasksRequest) of a es-notify-tasks-batch task."""
+  proto = plugin_pb2.NotifyTasksRequest()
+  if task.tag:
+    proto.ParseFromString(task.payload)
+    return task.tag, proto
+  # TODO: Remove once no JSON encoded tasks are left in the queue.
+  payload = json.loads(task.payload)
+  json_format.Parse(payload['request_json'], proto)
+  return payload['es_host'], proto
+
+
+def _timestamp_key(ts):
+  return ts.seconds, ts.nanos
 
 
 def get_cancellations(es_cfg):
@@ -138,6 +138,8 @@ class ExternalSchedulerApiTest(test_env_handlers.AppTestBase):
     # Use the local fake client to external scheduler..
     self.mock(external_scheduler, '_get_client', self._get_client)
     self._client = None
+    self.mock(external_scheduler, '_BATCH_DELAY_SECS', 0)
+    self.mock(external_scheduler, '_kick_stats', {'expiration': 0, 'tasks': 0})
 
     # Setup the backend to handle task queues.
     self.app = webtest.TestApp(
@@ -330,8 +332,8 @@ class ExternalSchedulerApiTestBatchMode(test_env_handlers.AppTestBase):
     # There should have 2 calls to the external scheduler.
     self.assertEqual(len(called_with), 2)
     called_with.sort(key=lambda x: x.scheduler_id)
-    # Request foo should have 2 notifications.
-    self.assertEqual(len(called_with[0].notifications), 2)
+    # Request foo should have 1 notification, as both were for the same task.
+    self.assertEqual(len(called_with[0].notifications), 1)
     self.assertEqual(called_with[0].scheduler_id, u'foo')
     # Request hoe should have 1 notification.
     self.assertEqual(len(called_with[1].notifications), 1)
@@ -341,6 +343,37 @@ class ExternalSchedulerApiTestBatchMode(test_env_handlers.AppTestBase):
     stats = taskqueue.QueueStatistics.fetch('es-notify-tasks-batch')
     self.assertEqual(0, stats.tasks)
 
+  def test_notify_request_with_tq_batch_mode_split(self):
+    self.mock(external_scheduler, '_BATCH_MAX_NOTIFICATIONS', 2)
+    now = self.mock_now(datetime.datetime(2014, 1, 2, 3, 4, 5))
+    requests = []
+    for i in range(3):
+      request = _gen_request(name=u'task%d' % i)
+      requests.append((request, task_scheduler.schedule_request(request)))
+    self.execute_tasks()
+
+    # The first task is notified twice, only the latest state is sent.
+    external_scheduler.notify_requests(
+        self.cfg_foo, requests, True, False, batch_mode=True)
+    self.mock_now(now, 1)
+    external_scheduler.notify_requests(
+        self.cfg_foo, requests[:1], True, False, batch_mode=True)
+
+    self._setup_client()
+    # 2 kickers, 2 batched requests.
+    self.assertEqual(4, self.execute_tasks())
+
+    called_with = self._client.called_with_requests
+    self.assertEqual([2, 1], [len(c.notifications) for c in called_with])
+    task_ids = [n.task.id for c in called_with for n in c.notifications]
+    self.assertEqual(
+        sorted(r.task_id for r, _ in requests), sorted(task_ids))
+    # The notification of the first task that was sent is the latest one.
+    self.assertEqual(requests[0][0].task_id, task_ids[-1])
+    self.assertEqual(
+        now + datetime.timedelta(seconds=1),
+        called_with[-1].notifications[-1].time.ToDatetime())
+
   def test_notify_request_with_tq_batch_mode_false(self):
     request = _gen_request()
     result_summary = task_scheduler.schedule_request(request)
@@ -27,12 +27,18 @@ updated.
 
 Caches for named cache that haven't been updated for 8 days are deleted.
 
+The percentile is calculated over a _SizeSketch, which is exact for up to
+_SKETCH_MAX_BINS distinct sizes per named cache and OS, and overestimates the
+size by at most ~2% (_SKETCH_ACCURACY) beyond that.
+
 The caches will only be precalculated for the pools defined in pools.cfg.
 """
 
 import datetime
 import json
 import logging
+import math
+import time
 
 from google.appengine.ext import ndb
 
@@ -41,6 +47,17 @@ from server import bot_management
 from server import pools_config
 
 
+# Relative accuracy of a _SizeSketch once it has been compacted.
+_SKETCH_ACCURACY = 0.01
+
+# Number of distinct sizes a _SizeSketch counts exactly before rounding them
+# into logarithmic buckets.
+_SKETCH_MAX_BINS = 256
+
+# Number of BotInfo fetched per page by task_update_pool.
+_BOTS_PAGE_SIZE = 500
+
+
 ### Models.
 
 
@@ -73,33 +90,151 @@ def _named_cache_key(pool, os, name):
   return ndb.Key(NamedCacheRoot, pool, NamedCache, os + ':' + name)
 
 
-def _update_named_cache(pool, os, name, hint):
-  """Opportunistically update a named cache if the hint was off by 10% or more.
+def _new_named_cache(e, key, os, name, hint, now):
+  """Returns an updated NamedCache if the hint was off by 10% or more.
 
   Arguments:
-  - pool: pool name
+  - e: the current NamedCache or None
+  - key: ndb.Key of the NamedCache
   - os: reduced 'os' value
   - name: named cache name
   - hint: observed size hint to use on the fleet
+  - now: the current time, without microseconds
 
   It will be updated when:
   - The NamedCache is older than 24 hours, where the new size is used and the
     old maximum ignored.
   - The new maximum is at least 10% higher than the previous one.
+
+  Returns None if the NamedCache doesn't need to be updated.
   """
-  assert isinstance(pool, basestring), repr(pool)
   assert isinstance(os, basestring), repr(os)
   assert isinstance(name, basestring), repr(name)
   assert isinstance(hint, (int, long)), repr(hint)
-  key = _named_cache_key(pool, os, name)
-  now = utils.utcnow().replace(microsecond=0)
-  e = key.get()
   exp = now - datetime.timedelta(hours=24)
   if not e or e.hint <= hint*0.9 or e.ts < exp:
-    e = NamedCache(key=key, ts=now, os=os, name=name, hint=hint)
-    e.put()
-    return True
-  return False
+    return NamedCache(key=key, ts=now, os=os, name=name, hint=hint)
+  return None
+
+
+class _SizeSketch(object):
+  """Mergeable approximation of the distribution of a named cache sizes.
+
+  Sizes are counted exactly until there are more than _SKETCH_MAX_BINS distinct
+  ones. Then all sizes are rounded up to the next power of _GAMMA, which bounds
+  the number of buckets to a few thousands for any realistic size while
+  overestimating quantiles by at most 2*_SKETCH_ACCURACY.
+  """
+  __slots__ = ('bins', 'count', 'compact')
+
+  _GAMMA = (1. + _SKETCH_ACCURACY) / (1. - _SKETCH_ACCURACY)
+
+  def __init__(self):
+    # {size: number of occurrences}
+    self.bins = {}
+    self.count = 0
+    self.compact = False
+
+  def add(self, size, count=1):
+    if self.compact:
+      size = self._round(size)
+    self.bins[size] = self.bins.get(size, 0) + count
+    self.count += count
+    if not self.compact and len(self.bins) > _SKETCH_MAX_BINS:
+      self._compact()
+
+  def merge(self, other):
+    """Adds all sizes counted by another _SizeSketch."""
+    if other.compact and not self.compact:
+      self._compact()
+    for size, count in other.bins.iteritems():
+      self.add(size, count)
+
+  def quantile(self, q):
+    """Returns the size at quantile q, i.e. sorted(sizes)[int(len * q)]."""
+    assert self.count, 'Empty sketch'
+    rank = int(float(self.count) * q)
+    seen = 0
+    for size in sorted(self.bins):
+      seen += self.bins[size]
+      if seen > rank:
+        return size
+    return size
+
+  def _compact(self):
+    bins = self.bins
+    self.bins = {}
+    self.count = 0
+    self.compact = True
+    for size, count in bins.iteritems():
+      self.add(size, count)
+
+  @classmethod
+  def _round(cls, size):
+    return int(math.ceil(cls._GAMMA**math.ceil(math.log(size, cls._GAMMA))))
+
+
+def _get_cache_size(bot_id, value):
+  """Returns the size of a named cache as reported in the bot state or None.
+
+  The format is [['shortname', size], timestamp].
+  """
+  if not value or not isinstance(value, list) or len(value) != 2:
+    logging.error('%s has bad cache (A): %s', bot_id, value)
+    return None
+  if not value[0] or not isinstance(value[0], list) or len(value[0]) != 2:
+    logging.error('%s has bad cache (B): %s', bot_id, value)
+    return None
+  size = value[0][1]
+  if not size or not isinstance(size, (int, long)) or size < 0:
+    logging.error('%s has bad cache (C): %s', bot_id, value)
+    return None
+  return size
+
+
+def _aggregate_pool(pool):
+  """Streams the bots in a pool and aggregates their named caches sizes.
+
+  Pages are fetched asynchronously while the previous one is being aggregated.
+
+  Returns:
+    tuple({os: {name: _SizeSketch}}, number of alive bots).
+  """
+  q = bot_management.filter_dimensions(bot_management.BotInfo.query(),
+                                       [u'pool:' + pool])
+  found = {}
+  bots = 0
+  exp = utils.utcnow().replace(microsecond=0) - datetime.timedelta(hours=4)
+  future = q.fetch_page_async(_BOTS_PAGE_SIZE)
+  while future:
+    page, cursor, more = future.get_result()
+    future = None
+    if more:
+      future = q.fetch_page_async(_BOTS_PAGE_SIZE, start_cursor=cursor)
+    for bot in page:
+      if bot.last_seen_ts < exp:
+        # Very dead bot; it hasn't pinged for 4 hours.
+        continue
+      bots += 1
+      state = bot.state
+      if not state or not isinstance(state, dict):
+        logging.debug('%s has no state', bot.id)
+        continue
+      # TODO(maruel): Use structured data instead of adhoc json.
+      c = state.get('named_caches')
+      if not isinstance(c, dict):
+        continue
+      # Some bots do not have 'os' correctly specified. They fall into the
+      # 'unknown' OS bucket.
+      d = found.setdefault(_reduce_oses(bot.dimensions.get('os') or []), {})
+      for name, value in c.iteritems():
+        size = _get_cache_size(bot.id, value)
+        if size is not None:
+          sketch = d.get(name)
+          if not sketch:
+            sketch = d[name] = _SizeSketch()
+          sketch.add(size)
+  return found, bots
 
 
 def _reduce_oses(oses):
@@ -159,65 +294,50 @@ def task_update_pool(pool):
   This needs to be able to scale for several thousands bots and hundreds of
   different caches.
 
-  - Query all the bots in a pool.
-  - Calculate the named caches for the bots in this pool.
-  - Update the entities.
+  - Stream all the bots in a pool, aggregating the named caches sizes.
+  - Calculate the size hints for the bots in this pool.
+  - Update the entities that changed, and delete the stale ones.
   """
-  q = bot_management.BotInfo.query()
-  found = {}
-  bots = 0
-  exp = utils.utcnow().replace(microsecond=0) - datetime.timedelta(hours=4)
-  for bot in bot_management.filter_dimensions(q, [u'pool:'+pool]):
-    if bot.last_seen_ts < exp:
-      # Very dead bot; it hasn't pinged for 4 hours.
-      continue
-    bots += 1
-    # Some bots do not have 'os' correctly specified. They fall into the
-    # 'unknown' OS bucket.
-    os = _reduce_oses(bot.dimensions.get('os') or [])
-    state = bot.state
-    if not state or not isinstance(state, dict):
-      logging.debug('%s has no state', bot.id)
-      continue
-    # TODO(maruel): Use structured data instead of adhoc json.
-    c = state.get('named_caches')
-    if not isinstance(c, dict):
-      continue
-    d = found.setdefault(os, {})
-    for key, value in sorted(c.items()):
-      if not value or not isinstance(value, list) or len(value) != 2:
-        logging.error('%s has bad cache (A): %s', bot.id, value)
-        continue
-      if not value[0] or not isinstance(value[0], list) or len(value[0]) != 2:
-        logging.error('%s has bad cache (B): %s', bot.id, value)
-        continue
-      if not value[0][1] or not isinstance(value[0][1], (int, long)):
-        logging.error('%s has bad cache (C): %s', bot.id, value)
-        continue
-      s = value[0][1]
-      d.setdefault(key, []).append(s)
+  start = time.time()
+  found, bots = _aggregate_pool(pool)
   logging.info(
       'Found %d bots, %d caches in %d distinct OSes in pool %r',
       bots, sum(len(f) for f in found.values()), len(found), pool)
 
-  # TODO(maruel): Parallelise.
-  for os, d in sorted(found.items()):
-    for name, sizes in sorted(d.items()):
-      # Adhoc calculation to take the ~95th percentile.
-      sizes.sort()
-      hint = sizes[int(float(len(sizes)) * 0.95)]
-      if _update_named_cache(pool, os, name, hint):
-        logging.debug('Pool %r  OS %r  Cache %r  hint=%d', pool, os, name, hint)
-
-  # Delete the old ones.
-  exp = utils.utcnow().replace(microsecond=0) - datetime.timedelta(days=8)
+  now = utils.utcnow().replace(microsecond=0)
   ancestor = ndb.Key(NamedCacheRoot, pool)
+  # Look for the old ones while the hints are being updated.
+  exp = now - datetime.timedelta(days=8)
   logging.info('Exp: %s', exp)
-  q = NamedCache.query(NamedCache.ts < exp, ancestor=ancestor)
-  keys = q.fetch(keys_only=True)
+  stale_future = NamedCache.query(
+      NamedCache.ts < exp, ancestor=ancestor).fetch_async(keys_only=True)
+
+  hints = []
+  for os, d in sorted(found.items()):
+    for name, sketch in sorted(d.items()):
+      # Adhoc calculation to take the ~95th percentile.
+      hints.append(
+          (_named_cache_key(pool, os, name), os, name, sketch.quantile(0.95)))
+  changed = []
+  for (key, os, name, hint), e in zip(hints,
+                                      ndb.get_multi([h[0] for h in hints])):
+    e = _new_named_cache(e, key, os, name, hint, now)
+    if e:
+      logging.debug('Pool %r  OS %r  Cache %r  hint=%d', pool, os, name, hint)
+      changed.append(e)
+  put_futures = ndb.put_multi_async(changed)
+
+  # Delete the old ones, except the ones that were just updated.
+  updated = set(e.key for e in changed)
+  keys = [k for k in stale_future.get_result() if k not in updated]
   if keys:
     logging.info('Deleting %d stale entities', len(keys))
     ndb.delete_multi(keys)
+  ndb.Future.wait_all(put_futures)
+  for f in put_futures:
+    f.check_success()
+  logging.info('Updated %d/%d hints in pool %r in %.3fs', len(changed),
+               len(hints), pool, time.time() - start)
   return True
 
 
@@ -8,6 +8,7 @@ import hashlib
 import json
 import logging
 import sys
+import time
 import unittest
 
 # pylint: disable=wrong-import-position
@@ -113,6 +114,65 @@ class NamedCachesTest(test_case.TestCase):
     self.assertEqual(2, named_caches.cron_update_named_caches())
     self.assertEqual(0, named_caches.NamedCache.query().count())
 
+  def test_unchanged_hints_not_updated(self):
+    now = datetime.datetime(2015, 1, 1, 1, 1, 1)
+    self.mock_now(now)
+    _bot_event('first1', 'first', {'build': 100000}, ['Mac'])
+    self.assertEqual(2, named_caches.cron_update_named_caches())
+
+    self.mock_now(now, 60 * 60)
+    _bot_event('first1', 'first', {'build': 100001}, ['Mac'])
+    self.assertEqual(2, named_caches.cron_update_named_caches())
+    self.assertEqual([(now, 100000)],
+                     [(e.ts, e.hint) for e in named_caches.NamedCache.query()])
+
+  def test_size_sketch(self):
+    sketches = [named_caches._SizeSketch(), named_caches._SizeSketch()]
+    for i in range(10000):
+      sketches[i % 2].add((i + 1) * 1000)
+    self.assertTrue(sketches[0].compact)
+    sketches[0].merge(sketches[1])
+    self.assertEqual(10000, sketches[0].count)
+    # The exact value is 9501000. It is never underestimated.
+    p95 = sketches[0].quantile(0.95)
+    self.assertLessEqual(9501000, p95)
+    self.assertLess(p95, 9501000 * (1 + 2 * named_caches._SKETCH_ACCURACY))
+
+
+class NamedCachesBenchmark(test_case.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+  APP_DIR = test_env.APP_DIR
+
+  def test_task_update_pool_10k_bots(self):
+    now = datetime.datetime(2015, 1, 1, 1, 1, 1)
+    self.mock_now(now)
+    bots = []
+    for i in range(10000):
+      bot_id = u'bot%d' % i
+      bots.append(
+          bot_management.BotInfo(
+              key=bot_management.get_info_key(bot_id),
+              dimensions_flat=[
+                  u'id:' + bot_id, u'os:' + [u'Linux', u'Mac'][i % 2],
+                  u'pool:first'
+              ],
+              state={
+                  'named_caches': {
+                      'cache%d' % j: [['a', (i * 7919 + j) % 10**9 + 1], 10]
+                      for j in range(100)
+                  }
+              },
+              last_seen_ts=now))
+    for i in range(0, len(bots), 500):
+      ndb.put_multi(bots[i:i + 500])
+
+    start = time.time()
+    self.assertEqual(True, named_caches.task_update_pool(u'first'))
+    logging.warning('task_update_pool for 10k bots: %.3fs', time.time() - start)
+    self.assertEqual(200, named_caches.NamedCache.query().count())
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
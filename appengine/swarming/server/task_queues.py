@@ -24,12 +24,14 @@ import urllib
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
 
 from components import datastore_utils
 from components import utils
 from server import config
+from server import dimensions_bitmap
 from server.constants import OR_DIM_SEP
 
 
@@ -102,14 +104,14 @@ class TaskDimensionsSets(ndb.Model):
     """
     return any(task_dimensions_flat == s['dimensions'] for s in self.sets)
 
-  def matches_bot_dimensions(self, bot_dimensions_set):
+  def matches_bot_dimensions(self, bot_dimensions):
     """True if any of stored `sets` matches given bot dimensions.
 
     Arguments:
-      bot_dimensions_set: a set of `k:v` pairs with bot dimensions.
+      bot_dimensions: dimensions_bitmap.BotDimensions with bot dimensions.
     """
-    return any(
-        bot_dimensions_set.issuperset(s['dimensions']) for s in self.sets)
+    return bot_dimensions.matches_flat_sets(
+        self.sets, cache_key=self.key.string_id() if self.key else None)
 
   @staticmethod
   def dimensions_to_id(dimensions):
@@ -231,6 +233,79 @@ class TaskDimensionsInfo(ndb.Model):
     return _sets_to_expiry_map(self.sets)
 
 
+class TaskDimensionsIndex(ndb.Model):
+  """An inverted index from a flat task dimension to pool TaskDimensionsSets.
+
+  Root entity. Key ID is `pool:<url-encoded-pool-id>:<url-encoded-k:v>`.
+
+  Used by _tq_rescan_matching_task_sets_async to find TaskDimensionsSets that
+  can potentially match a bot without scanning all TaskDimensionsSets in the
+  pool: a bot fetches index entities for all its dimensions and counts how many
+  of them mention each dimensions set. A dimensions set is a candidate if all
+  its dimensions were mentioned.
+
+  Only `pool:` TaskDimensionsSets are indexed. `bot:` sets are few per bot and
+  they are still found via a datastore scan.
+
+  `pool:<pool-id>` dimension itself is shared by all dimensions sets in the
+  pool and it is not indexed, with one exception: sets that have no other
+  dimensions are indexed under `pool:<pool-id>` (otherwise they can't be found).
+
+  Updated asynchronously by _tq_update_dimensions_index_async whenever the list
+  of sets in a TaskDimensionsSets changes. May be slightly stale or have extra
+  entries, all candidates are double checked against TaskDimensionsSets.
+  """
+  # Disable useless in-process per-request cache to save some RAM.
+  _use_cache = False
+
+  # Dimensions sets that have this dimension as a dict:
+  #
+  #   {
+  #     "<dimensions_hash>": {
+  #       "<set key>": <number of indexed dimensions in the set>,
+  #       ...
+  #     },
+  #     ...
+  #   }
+  #
+  # Where `<dimensions_hash>` is the last component of TaskDimensionsSets ID
+  # (the pool is already a part of this entity ID) and `<set key>` identifies
+  # one flat dimensions set stored in TaskDimensionsSets, see
+  # _dimensions_index_postings(...).
+  sets = datastore_utils.DeterministicJsonProperty(
+      compressed=True, json_type=dict)
+
+  @staticmethod
+  def make_key(pool, dimension):
+    """Returns ndb.Key of an index entity for the given pool and `k:v`."""
+    if isinstance(dimension, unicode):
+      dimension = dimension.encode('utf-8')
+    return ndb.Key(
+        TaskDimensionsIndex, '%s:%s' % (TaskDimensionsSets.id_prefix(
+            'pool', pool), urllib.quote_plus(dimension)))
+
+
+class TaskDimensionsIndexBackfill(ndb.Model):
+  """Progress of indexing TaskDimensionsSets stored before TaskDimensionsIndex.
+
+  Root entity. Key ID is 1.
+
+  Such sets are not indexed by the regular updates, since their list of sets
+  doesn't change when they are stored again. backfill_dimensions_index_async
+  indexes them, resuming from `cursor`. Until `done` is set, rescans do a full
+  scan of bot's pools, since the index may be incomplete.
+  """
+  # Disable useless in-process per-request cache to save some RAM.
+  _use_cache = False
+
+  # Urlsafe datastore cursor of the last indexed TaskDimensionsSets page.
+  cursor = ndb.StringProperty(indexed=False)
+  # True once all TaskDimensionsSets that existed before were indexed.
+  done = ndb.BooleanProperty(indexed=False, default=False)
+  # When the entity was updated last time.
+  modified_ts = ndb.DateTimeProperty(indexed=False)
+
+
 class BotDimensionsMatches(ndb.Model):
   """Stores what TaskDimensionsSets are matched to a bot.
 
@@ -303,6 +378,22 @@ class BotDimensionsMatches(ndb.Model):
 
 ### Internal APIs.
 
+# Probability of a rescan doing a full scan of TaskDimensionsSets in bot's pools
+# instead of relying only on TaskDimensionsIndex, once the index is complete.
+_FULL_RESCAN_PROBABILITY = 0.05
+
+# How long a single backfill_dimensions_index_async call runs before stopping
+# to resume in the next cron tick.
+_INDEX_BACKFILL_DURATION = datetime.timedelta(minutes=5)
+
+# Memcache namespace with the per-bot poll cache and generation numbers of
+# TaskDimensionsSets, see _check_matches_cached_async.
+_POLL_CACHE_NAMESPACE = 'task_queues_poll'
+
+# How long a per-bot poll cache entry lives. Bounds staleness if a generation
+# number bump is lost.
+_POLL_CACHE_EXPIRATION_SECS = 10 * 60
+
 # Exceptions that can be raised by transaction_async(...).
 _TXN_EXCEPTIONS = (
     # Deadline starting or landing the transaction.
@@ -369,11 +460,15 @@ def _expiry_map_to_sets(expiry_map, with_expiry=True):
   return sets
 
 
+@ndb.tasklet
 def _put_task_dimensions_sets_async(sets_id, expiry_map):
   """Puts TaskDimensionsSets and TaskDimensionsInfo entities.
 
   Must be called in a transaction to make sure both entities stay in sync.
 
+  If the list of stored sets changes, transactionally enqueues a task queue task
+  to update TaskDimensionsIndex.
+
   Arguments:
     sets_id: string ID of TaskDimensionsSets to store under.
     expiry_map: an expiry map to store there, must not be empty.
@@ -389,38 +484,195 @@ def _put_task_dimensions_sets_async(sets_id, expiry_map):
   # to not perfectly synchronized clocks.
   next_cleanup_ts = min(expiry_map.values()) + datetime.timedelta(minutes=5)
 
-  return ndb.put_multi_async([
-      TaskDimensionsSets(key=sets_key,
-                         sets=_expiry_map_to_sets(expiry_map,
-                                                  with_expiry=False)),
-      TaskDimensionsInfo(
-          key=info_key,
-          sets=_expiry_map_to_sets(expiry_map, with_expiry=True),
-          next_cleanup_ts=next_cleanup_ts,
-      ),
-  ])
+  # Need the currently stored sets to know what index entries to update.
+  prev = yield sets_key.get_async()
+  sets = _expiry_map_to_sets(expiry_map, with_expiry=False)
+
+  _bump_sets_generation(sets_id)
+  yield (
+      ndb.put_multi_async([
+          TaskDimensionsSets(key=sets_key, sets=sets),
+          TaskDimensionsInfo(
+              key=info_key,
+              sets=_expiry_map_to_sets(expiry_map, with_expiry=True),
+              next_cleanup_ts=next_cleanup_ts,
+          ),
+      ]),
+      _enqueue_dimensions_index_update_async(sets_id, prev.sets
+                                             if prev else [], sets),
+  )
 
 
+@ndb.tasklet
 def _delete_task_dimensions_sets_async(sets_id):
   """Deletes TaskDimensionsSets and TaskDimensionsInfo entities.
 
   Must be called in a transaction to make sure both entities stay in sync.
 
+  Transactionally enqueues a task queue task to remove the deleted sets from
+  TaskDimensionsIndex.
+
   Arguments:
     sets_id: string ID of TaskDimensionsSets to delete.
   """
   assert ndb.in_transaction()
   sets_key = ndb.Key(TaskDimensionsSets, sets_id)
   info_key = ndb.Key(TaskDimensionsInfo, 1, parent=sets_key)
-  return ndb.delete_multi_async([sets_key, info_key])
+  prev = yield sets_key.get_async()
+  _bump_sets_generation(sets_id)
+  yield (
+      ndb.delete_multi_async([sets_key, info_key]),
+      _enqueue_dimensions_index_update_async(sets_id, prev.sets
+                                             if prev else [], []),
+  )
+
+
+def _dimensions_index_postings(sets_id, sets):
+  """Returns TaskDimensionsIndex entries for the given dimensions sets.
+
+  Arguments:
+    sets_id: string ID of `pool:` TaskDimensionsSets that stores the sets.
+    sets: a value of `TaskDimensionsSets.sets` entity property.
+
+  Returns:
+    A dict {`k:v` => {set key => number of indexed dimensions in the set}}.
+  """
+  if isinstance(sets_id, unicode):
+    sets_id = sets_id.encode('utf-8')
+  _, pool, _ = TaskDimensionsSets.split_id(sets_id)
+  pool_dim = u'pool:%s' % pool.decode('utf-8')
+  postings = collections.defaultdict(dict)
+  for s in sets:
+    dims = s['dimensions']
+    # All sets in the pool have `pool:<pool-id>`, no need to index it, see
+    # TaskDimensionsIndex doc.
+    indexed = [kv for kv in dims if kv != pool_dim] or [pool_dim]
+    # Sets are identified by a short digest, which is stable across updates of
+    # TaskDimensionsSets and small enough to keep index entities compact.
+    set_key = hashlib.md5(u'\n'.join(dims).encode('utf-8')).hexdigest()[:8]
+    for kv in indexed:
+      postings[kv][set_key] = len(indexed)
+  return dict(postings)
+
+
+@ndb.tasklet
+def _enqueue_dimensions_index_update_async(sets_id, old_sets, new_sets):
+  """Enqueues a TQ task to update TaskDimensionsIndex if necessary.
+
+  Must be called in a transaction that updates TaskDimensionsSets.
+
+  Arguments:
+    sets_id: string ID of the updated TaskDimensionsSets.
+    old_sets: `TaskDimensionsSets.sets` before the update.
+    new_sets: `TaskDimensionsSets.sets` after the update.
+  """
+  # Only pool sets are indexed, see TaskDimensionsIndex doc. This also skips
+  # malformed IDs used in some tests.
+  if not sets_id.startswith('pool:'):
+    raise ndb.Return(None)
+  try:
+    old = _dimensions_index_postings(sets_id, old_sets)
+    new = _dimensions_index_postings(sets_id, new_sets)
+  except ValueError:
+    raise ndb.Return(None)
+  changed = sorted(
+      kv for kv in set(old) | set(new) if old.get(kv) != new.get(kv))
+  if not changed:
+    raise ndb.Return(None)
+  # This eventually calls _tq_update_dimensions_index_async.
+  ok = yield utils.enqueue_task_async(
+      '/internal/taskqueue/important/task_queues/update-dimensions-index',
+      'update-dimensions-index',
+      payload=utils.encode_to_json({
+          'task_sets_id': sets_id,
+          'dimensions': changed,
+      }),
+      transactional=True)
+  if not ok:
+    raise datastore_utils.CommitError('Failed to enqueue a TQ task')
+
+
+@ndb.tasklet
+def _enqueue_dimensions_index_repair_async(sets_ents, log):
+  """Enqueues TQ tasks to index TaskDimensionsSets missing from the index.
+
+  Arguments:
+    sets_ents: `pool:` TaskDimensionsSets entities to index.
+    log: _Logger to use for logs.
+  """
+  futures = []
+  for ent in sets_ents:
+    sets_id = ent.key.string_id()
+    try:
+      postings = _dimensions_index_postings(sets_id, ent.sets)
+    except ValueError:
+      continue
+    futures.append(
+        utils.enqueue_task_async(
+            '/internal/taskqueue/important/task_queues/update-dimensions-index',
+            'update-dimensions-index',
+            payload=utils.encode_to_json({
+                'task_sets_id': sets_id,
+                'dimensions': sorted(postings),
+            })))
+  oks = yield futures
+  if not all(oks):
+    log.warning('failed to enqueue some index repairs')
 
 
 @ndb.tasklet
-def _check_matches_async(bot_dimensions_set, sets_ids):
+def _dimensions_index_complete_async():
+  """Returns True if all TaskDimensionsSets were added to the index once."""
+  state = yield ndb.Key(TaskDimensionsIndexBackfill, 1).get_async()
+  raise ndb.Return(bool(state and state.done))
+
+
+def _poll_cache_key(bot_id):
+  """Returns a memcache key of the per-bot poll cache entry."""
+  return 'poll:' + TaskDimensionsSets.id_prefix('bot', bot_id)
+
+
+def _sets_generation_key(sets_id):
+  """Returns a memcache key of the generation number of the sets.
+
+  Each TaskDimensionsSets has its own generation number, so that modifying a
+  set invalidates only the poll cache entries of bots that matched it.
+  """
+  if isinstance(sets_id, unicode):
+    sets_id = sets_id.encode('utf-8')
+  return 'gen:' + sets_id
+
+
+def _bump_sets_generation(sets_id):
+  """Bumps the generation number of the sets once the transaction lands.
+
+  This invalidates per-bot poll cache entries that mention these sets, see
+  _check_matches_cached_async.
+
+  Arguments:
+    sets_id: string ID of the modified TaskDimensionsSets.
+  """
+  key = _sets_generation_key(sets_id)
+
+  def bump():
+    # If the entry was evicted, restart from the current time in ms to avoid
+    # reusing a number some poll cache entry may still refer to.
+    res = memcache.incr(
+        key,
+        initial_value=int(time.time() * 1000),
+        namespace=_POLL_CACHE_NAMESPACE)
+    if res is None:
+      logging.warning('failed to bump the generation of %s', key)
+
+  ndb.get_context().call_on_commit(bump)
+
+
+@ndb.tasklet
+def _check_matches_async(bot_dimensions, sets_ids):
   """Loads TaskDimensionsSets and checks if they still exist and match the bot.
 
   Arguments:
-    bot_dimensions_set: a set of `k:v` pairs with bot dimensions.
+    bot_dimensions: dimensions_bitmap.BotDimensions with bot dimensions.
     sets_ids: string IDs of TaskDimensionsSets to load and check.
 
   Returns:
@@ -432,7 +684,7 @@ def _check_matches_async(bot_dimensions_set, sets_ids):
   alive = set()
   stale = set()
   for sets_id, sets_ent in zip(sets_ids, sets_ents):
-    if sets_ent and sets_ent.matches_bot_dimensions(bot_dimensions_set):
+    if sets_ent and sets_ent.matches_bot_dimensions(bot_dimensions):
       alive.add(sets_id)
     else:
       stale.add(sets_id)
@@ -440,6 +692,65 @@ def _check_matches_async(bot_dimensions_set, sets_ids):
   raise ndb.Return((alive, stale))
 
 
+@ndb.tasklet
+def _check_matches_cached_async(bot_id, bot_dimensions_flat, bot_dimensions,
+                                sets_ids, log):
+  """Same as _check_matches_async, but uses the per-bot poll cache.
+
+  The cache entry stores the bot dimensions, matched sets IDs and generation
+  numbers of these sets as they were when all sets were found alive and
+  matching. If none of them changed since then, the check is skipped.
+
+  Arguments:
+    bot_id: ID of the bot.
+    bot_dimensions_flat: a list of bot dimensions as `k:v` pairs.
+    bot_dimensions: dimensions_bitmap.BotDimensions with bot dimensions.
+    sets_ids: string IDs of TaskDimensionsSets to load and check.
+    log: _Logger to use.
+
+  Returns:
+    set(alive and still matching sets IDs), set(stale sets IDs).
+  """
+  import ts_mon_metrics  # pylint: disable=cyclic-import
+  ctx = ndb.get_context()
+  cache_key = _poll_cache_key(bot_id)
+  gen_keys = [_sets_generation_key(x) for x in sorted(set(sets_ids))]
+  # Read the generation numbers before the sets, so that a concurrent update
+  # bumping them after we loaded stale sets invalidates what we store below.
+  res = yield [
+      ctx.memcache_get(k, namespace=_POLL_CACHE_NAMESPACE)
+      for k in [cache_key] + gen_keys
+  ]
+  cached, gens = res[0], tuple(res[1:])
+
+  if None not in gens:
+    state = (tuple(bot_dimensions_flat), tuple(sets_ids), gens)
+    if cached == state:
+      log.info('poll cache hit, skipped loading %d dimensions sets',
+               len(sets_ids))
+      ts_mon_metrics.on_poll_cache_lookup(True, len(sets_ids))
+      raise ndb.Return((set(sets_ids), set()))
+  else:
+    # Initialize missing generation numbers (e.g. evicted ones). They'll be
+    # used by the next poll.
+    yield [
+        ctx.memcache_add(
+            k, int(time.time() * 1000), namespace=_POLL_CACHE_NAMESPACE)
+        for k, gen in zip(gen_keys, gens)
+        if gen is None
+    ]
+
+  ts_mon_metrics.on_poll_cache_lookup(False, 0)
+  alive, stale = yield _check_matches_async(bot_dimensions, sets_ids)
+  if not stale and None not in gens:
+    yield ctx.memcache_set(
+        cache_key,
+        state,
+        time=_POLL_CACHE_EXPIRATION_SECS,
+        namespace=_POLL_CACHE_NAMESPACE)
+  raise ndb.Return((alive, stale))
+
+
 @ndb.tasklet
 def _assert_task_dimensions_async(task_dimensions, exp_ts):
   """Ensures there's corresponding TaskDimensionsSets stored in the datastore.
@@ -712,6 +1023,103 @@ def _maybe_add_match_async(bot_matches_ent, task_sets_id, task_sets_dims,
     raise ndb.Return(False)
 
 
+@ndb.tasklet
+def _tq_update_dimensions_index_async(task_sets_id, dimensions):
+  """Updates TaskDimensionsIndex entries of a TaskDimensionsSets.
+
+  Brings index entities of the given dimensions in sync with the current state
+  of the TaskDimensionsSets entity (which may already be gone).
+
+  Arguments:
+    task_sets_id: string ID of `pool:` TaskDimensionsSets that changed.
+    dimensions: a list with `k:v` dimensions whose index entities to update.
+
+  Returns:
+    True if succeeded, False if the TQ task needs to be retried.
+  """
+  assert task_sets_id.startswith('pool:'), task_sets_id
+  if isinstance(task_sets_id, unicode):
+    task_sets_id = task_sets_id.encode('utf-8')
+  _, pool, num = TaskDimensionsSets.split_id(task_sets_id)
+  sets_key = ndb.Key(TaskDimensionsSets, task_sets_id)
+  num = str(num)
+
+  log = _Logger('tq_update_index(%s)', task_sets_id)
+
+  @ndb.tasklet
+  def update_async(kv):
+    index_key = TaskDimensionsIndex.make_key(pool, kv)
+
+    # Reads TaskDimensionsSets in the transaction to make sure concurrently
+    # running TQ tasks do not overwrite fresh index entries with stale ones.
+    @ndb.tasklet
+    def txn():
+      sets_ent, index_ent = yield ndb.get_multi_async([sets_key, index_key])
+      postings = _dimensions_index_postings(task_sets_id,
+                                            sets_ent.sets if sets_ent else [])
+      want = postings.get(kv)
+      index_ent = index_ent or TaskDimensionsIndex(key=index_key, sets={})
+      if index_ent.sets.get(num) == want:
+        raise ndb.Return(False)
+      if want:
+        index_ent.sets[num] = want
+      else:
+        index_ent.sets.pop(num, None)
+      if index_ent.sets:
+        yield index_ent.put_async()
+      else:
+        yield index_key.delete_async()
+      raise ndb.Return(True)
+
+    try:
+      updated = yield datastore_utils.transaction_async(txn, retries=5, xg=True)
+      if updated:
+        log.info('updated %s', kv)
+      raise ndb.Return(True)
+    except _TXN_EXCEPTIONS:
+      log.warning('error updating %s', kv)
+      raise ndb.Return(False)
+
+  oks = yield [update_async(kv) for kv in dimensions]
+  if not all(oks):
+    log.error('need a retry')
+  raise ndb.Return(all(oks))
+
+
+@ndb.tasklet
+def _find_indexed_task_sets_async(pool, bot_dimensions_flat):
+  """Uses TaskDimensionsIndex to find pool sets that may match the bot.
+
+  Arguments:
+    pool: a pool to look for TaskDimensionsSets in.
+    bot_dimensions_flat: a list of bot dimensions as `k:v` pairs.
+
+  Returns:
+    A list of string IDs of candidate TaskDimensionsSets, they still need to be
+    checked by matches_bot_dimensions(...) since the index is updated
+    asynchronously.
+  """
+  index_ents = yield ndb.get_multi_async(
+      [TaskDimensionsIndex.make_key(pool, kv) for kv in bot_dimensions_flat])
+
+  # A set matches the bot if all its indexed dimensions are among bot's ones,
+  # i.e. if the set is mentioned by as many index entities as it has indexed
+  # dimensions.
+  hits = collections.Counter()
+  candidates = set()
+  for ent in index_ents:
+    if not ent:
+      continue
+    for num, postings in ent.sets.items():
+      for set_key, count in postings.items():
+        hits[num, set_key] += 1
+        if hits[num, set_key] == count:
+          candidates.add(num)
+
+  pfx = TaskDimensionsSets.id_prefix('pool', pool)
+  raise ndb.Return(['%s:%s' % (pfx, num) for num in sorted(candidates)])
+
+
 @ndb.tasklet
 def _cleanup_task_dimensions_async(dims_info, log):
   """Removes stale dimensions sets from a TaskDimensions[Sets|Info] entities.
@@ -775,7 +1183,7 @@ def _assert_bot_dimensions_async(bot_dimensions):
   """
   bot_id = bot_dimensions[u'id'][0]
   bot_dimensions_flat = bot_dimensions_to_flat(bot_dimensions)
-  bot_dimensions_set = set(bot_dimensions_flat)
+  bot_dims_bitmap = dimensions_bitmap.BotDimensions(bot_dimensions_flat)
 
   log = _Logger('assert_bot(%s)', bot_id)
 
@@ -784,9 +1192,11 @@ def _assert_bot_dimensions_async(bot_dimensions):
   matches = yield BotDimensionsMatches.get_or_default_async(bot_id)
 
   # Load associated dimension sets to check the bot still matches them. This is
-  # the hottest spot that heavily relies on ndb memcache.
+  # the hottest spot that heavily relies on ndb memcache. The poll cache allows
+  # to skip it for idle bots when no matched sets changed.
   log.info('checking %d dimensions sets', len(matches.matches))
-  alive, stale = yield _check_matches_async(bot_dimensions_set, matches.matches)
+  alive, stale = yield _check_matches_cached_async(
+      bot_id, bot_dimensions_flat, bot_dims_bitmap, matches.matches, log)
   if stale:
     log.info('will unmatch: %s', ' '.join(stale))
 
@@ -886,7 +1296,7 @@ def _tq_rescan_matching_task_sets_async(bot_id, rescan_counter, rescan_reason):
   log.info('enqueued %s ago', utils.utcnow() - matches.last_rescan_enqueued_ts)
 
   bot_dimensions_flat = matches.dimensions
-  bot_dimensions_set = set(bot_dimensions_flat)
+  bot_dims_bitmap = dimensions_bitmap.BotDimensions(bot_dimensions_flat)
 
   def scan_prefix_query(set_kind, pfx):
     pfx = TaskDimensionsSets.id_prefix(set_kind, pfx)
@@ -901,29 +1311,70 @@ def _tq_rescan_matching_task_sets_async(bot_id, rescan_counter, rescan_reason):
     )
     return query, log.derive('%s', pfx)
 
+  pools = []
+  for kv in bot_dimensions_flat:
+    k, v = kv.split(':', 1)
+    if k == 'pool':
+      pools.append(v)
+
+  # Occasionally do a full scan of pools to pick up sets that are missing from
+  # the index, e.g. if TQ tasks that update it were lost. Always do it until
+  # the sets stored before the index existed are backfilled into it.
+  full_scan = random.random() < _FULL_RESCAN_PROBABILITY
+  if not full_scan:
+    full_scan = not (yield _dimensions_index_complete_async())
+
   # Construct queries that scan for potentially matching TaskDimensionsSets.
+  # `bot:` sets are always scanned, there are very few of them.
   #
   # TODO(vadimsh): Each query can be sharded to parallelize the scan even more
   # if necessary.
   queries = [scan_prefix_query('bot', bot_id)]
-  for kv in bot_dimensions_flat:
-    k, v = kv.split(':', 1)
-    if k == 'pool':
-      queries.append(scan_prefix_query('pool', v))
+  if full_scan:
+    queries.extend(scan_prefix_query('pool', pool) for pool in pools)
 
   # A set of matching TaskDimensionsSets IDs discovered by the scans.
   alive = set()
+  # Matching `pool:` TaskDimensionsSets discovered by the scans, by ID.
+  alive_pool_ents = {}
   # A counter of visited items for debugging.
   visited = [0]
 
   def visit_task_dimensions_set(task_dims_sets):
     visited[0] += 1
-    if task_dims_sets.matches_bot_dimensions(bot_dimensions_set):
-      alive.add(task_dims_sets.key.string_id())
+    if task_dims_sets.matches_bot_dimensions(bot_dims_bitmap):
+      sets_id = task_dims_sets.key.string_id()
+      alive.add(sets_id)
+      if sets_id.startswith('pool:'):
+        alive_pool_ents[sets_id] = task_dims_sets
+
+  # Find candidate pool sets via the index, they are usually a small fraction
+  # of all sets in the pool.
+  candidates = yield [
+      _find_indexed_task_sets_async(pool, bot_dimensions_flat)
+      for pool in pools
+  ]
+  candidates = sorted(set(sum(candidates, [])))
+  candidates_ents = yield ndb.get_multi_async(
+      [ndb.Key(TaskDimensionsSets, sets_id) for sets_id in candidates])
+  indexed_alive = set(
+      ent.key.string_id()
+      for ent in candidates_ents
+      if ent and ent.matches_bot_dimensions(bot_dims_bitmap))
 
   # Find all TaskDimensionsSets matching the bot dimensions.
   visited_all = yield _map_async(queries, visit_task_dimensions_set)
-  log.info('visited %d entities, found %d matches', visited[0], len(alive))
+  log.info('visited %d entities via scan (full scan: %s), %d via index',
+           visited[0], full_scan, len(candidates))
+  if full_scan:
+    missing = sorted(
+        sets_id for sets_id in alive_pool_ents if sets_id not in indexed_alive)
+    if missing:
+      log.warning('not in the index: %s', ' '.join(missing))
+      yield _enqueue_dimensions_index_repair_async(
+          [alive_pool_ents[sets_id] for sets_id in missing], log)
+  alive |= indexed_alive
+  log.info('found %d matches', len(alive))
 
   # Double check any currently matched sets that were not discovered by the scan
   # are indeed dead and should be unmatched. This is particularly important if
@@ -931,7 +1382,7 @@ def _tq_rescan_matching_task_sets_async(bot_id, rescan_counter, rescan_reason):
   # matters if the query is "eventually consistent" and omits some very recent
   # entities. We don't want to delete active matches.
   _, stale = yield _check_matches_async(
-      bot_dimensions_set, [sid for sid in matches.matches if sid not in alive])
+      bot_dims_bitmap, [sid for sid in matches.matches if sid not in alive])
 
   # Store new matches in the entity if the entity still has dimensions we
   # scanned for. This returns `last_rescan_enqueued_ts` if the entity was
@@ -1392,6 +1843,7 @@ def cleanup_after_bot(bot_id):
     bot_id: ID of the bot to unregister.
   """
   ndb.Key(BotDimensionsMatches, bot_id).delete()
+  memcache.delete(_poll_cache_key(bot_id), namespace=_POLL_CACHE_NAMESPACE)
 
 
 @ndb.tasklet
@@ -1472,6 +1924,81 @@ def rescan_matching_task_sets_async(payload):
                                              payload['rescan_reason'])
 
 
+def update_dimensions_index_async(payload):
+  """Updates TaskDimensionsIndex after a change to TaskDimensionsSets.
+
+  Task queue task handler, part of assert_task_async(...) implementation.
+  """
+  logging.info('TQ task payload:\n%s', payload)
+  payload = json.loads(payload)
+  return _tq_update_dimensions_index_async(payload['task_sets_id'],
+                                           payload['dimensions'])
+
+
+@ndb.tasklet
+def backfill_dimensions_index_async():
+  """Adds TaskDimensionsSets stored before TaskDimensionsIndex to the index.
+
+  Runs for up to _INDEX_BACKFILL_DURATION and resumes from where the previous
+  call stopped. Does nothing once all sets were indexed. Sets stored later are
+  indexed by the regular TaskDimensionsIndex updates.
+
+  Returns:
+    True if made progress or already done, False if something failed.
+  """
+  log = _Logger('backfill_index')
+  key = ndb.Key(TaskDimensionsIndexBackfill, 1)
+  state = yield key.get_async()
+  state = state or TaskDimensionsIndexBackfill(key=key)
+  if state.done:
+    raise ndb.Return(True)
+
+  @ndb.tasklet
+  def index_async(ent):
+    sets_id = ent.key.string_id()
+    try:
+      postings = _dimensions_index_postings(sets_id, ent.sets)
+    except ValueError:
+      raise ndb.Return(True)
+    ok = yield _tq_update_dimensions_index_async(sets_id, sorted(postings))
+    raise ndb.Return(ok)
+
+  # All `pool:` sets. ';' follows ':'.
+  q = ndb.Query(
+      kind='TaskDimensionsSets',
+      filters=ndb.ConjunctionNode(
+          ndb.FilterNode('__key__', '>', ndb.Key(TaskDimensionsSets, 'pool:')),
+          ndb.FilterNode('__key__', '<', ndb.Key(TaskDimensionsSets, 'pool;')),
+      ),
+  )
+  cursor = None
+  if state.cursor:
+    cursor = datastore_query.Cursor(urlsafe=state.cursor)
+  deadline = utils.utcnow() + _INDEX_BACKFILL_DURATION
+  count = 0
+  ok = True
+  while not state.done and utils.utcnow() < deadline:
+    ents, cursor, more = yield q.fetch_page_async(100, start_cursor=cursor)
+    # Sets of a pool share most of their index entities, index them one by one
+    # to avoid contention.
+    for ent in ents:
+      ok = yield index_async(ent)
+      if not ok:
+        break
+    if not ok:
+      break
+    count += len(ents)
+    state.cursor = cursor.urlsafe() if cursor and more else None
+    state.done = not more
+    state.modified_ts = utils.utcnow()
+    yield state.put_async()
+
+  log.info('indexed %d sets, done: %s', count, state.done)
+  if not ok:
+    log.error('need a retry')
+  raise ndb.Return(ok)
+
+
 @ndb.tasklet
 def tidy_task_dimension_sets_async():
   """Removes expired task dimension sets from the datastore.
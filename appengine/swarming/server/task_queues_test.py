@@ -103,6 +103,9 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
 
     self.mock(task_queues, '_random_timedelta_mins', random_dt)
 
+    # Sets are indexed as they are created, there is nothing to backfill.
+    task_queues.TaskDimensionsIndexBackfill(id=1, done=True).put()
+
   def _assert_bot(self, bot_id=u'bot1', dimensions=None):
     bot_dimensions = {
         u'cpu': [u'x86-64', u'x64'],
@@ -163,21 +166,21 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assert_count(1, task_queues.TaskDimensionsSets)
 
   def test_assert_task_async_no_update(self):
-    # Ran TQ tasks to register the new dimension set.
+    # Ran TQ tasks to register the new dimension set and to index it.
     tq_tasks = self._assert_task()
-    self.assertEqual(tq_tasks, 1)
+    self.assertEqual(tq_tasks, 2)
     # Already seen it, no new tasks.
     tq_tasks = self._assert_task()
     self.assertEqual(tq_tasks, 0)
 
   def test_assert_task_async_or_dims(self):
-    # Ran TQ tasks to register the new dimension set.
+    # Ran TQ tasks to register the new dimension set and to index it.
     tq_tasks = self._assert_task({
         u'pool': [u'default'],
         u'os': [u'v1|v2'],
         u'gpu': [u'nv|amd'],
     })
-    self.assertEqual(tq_tasks, 1)
+    self.assertEqual(tq_tasks, 2)
     # Already seen it, no new tasks.
     tq_tasks = self._assert_task({
         u'pool': [u'default'],
@@ -755,6 +758,140 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     # Tested as a part of the overall workflow.
     pass
 
+  def test_update_dimensions_index_async(self):
+    def index():
+      return {
+          ent.key.string_id(): ent.sets
+          for ent in task_queues.TaskDimensionsIndex.query()
+      }
+
+    # A new set is indexed under all its dimensions, except the pool one.
+    self._create_task_dims_set('pool:p:1', ['a:1', 'b:1', 'pool:p'])
+    self._create_task_dims_set('pool:p:2', ['pool:p'])
+    self.assertEqual(2, self.execute_tasks())
+    self.assertEqual(
+        index(), {
+            'pool:p:a%3A1': {
+                '1': {
+                    '24ac21f1': 2
+                }
+            },
+            'pool:p:b%3A1': {
+                '1': {
+                    '24ac21f1': 2
+                }
+            },
+            'pool:p:pool%3Ap': {
+                '2': {
+                    'a7336269': 1
+                }
+            },
+        })
+
+    # Only bot sets that match all indexed dimensions are candidates.
+    def candidates(bot_dims):
+      return task_queues._find_indexed_task_sets_async('p',
+                                                       bot_dims).get_result()
+
+    self.assertEqual(candidates(['a:1', 'b:1', 'pool:p']),
+                     ['pool:p:1', 'pool:p:2'])
+    self.assertEqual(candidates(['a:1', 'pool:p']), ['pool:p:2'])
+    self.assertEqual(candidates(['a:1', 'b:1']), ['pool:p:1'])
+
+    # Replacing a set updates only changed index entities.
+    self._create_task_dims_set('pool:p:1', ['a:1', 'c:1', 'pool:p'])
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(
+        index(), {
+            'pool:p:a%3A1': {
+                '1': {
+                    'aff0ff38': 2
+                }
+            },
+            'pool:p:c%3A1': {
+                '1': {
+                    'aff0ff38': 2
+                }
+            },
+            'pool:p:pool%3Ap': {
+                '2': {
+                    'a7336269': 1
+                }
+            },
+        })
+
+    # Deleted sets are removed from the index.
+    self._delete_task_dims_set('pool:p:1')
+    self._delete_task_dims_set('pool:p:2')
+    self.assertEqual(2, self.execute_tasks())
+    self.assertEqual(index(), {})
+
+    # Sets that target a bot are not indexed.
+    self._create_task_dims_set('bot:b:1', ['id:b', 'a:1'])
+    self.assertEqual(0, self.execute_tasks())
+
+  def test_backfill_dimensions_index_async(self):
+    def index():
+      return {
+          ent.key.string_id(): ent.sets
+          for ent in task_queues.TaskDimensionsIndex.query()
+      }
+
+    # Sets stored before the index existed.
+    self._create_task_dims_set('pool:p:1', ['a:1', 'b:1', 'pool:p'])
+    self._create_task_dims_set('pool:p:2', ['pool:p'])
+    self._create_task_dims_set('bot:b:3', ['id:b', 'a:1'])
+    self.execute_tasks()
+    expected = index()
+    self.assertEqual(3, len(expected))
+    ndb.delete_multi(task_queues.TaskDimensionsIndex.query().fetch(
+        keys_only=True))
+    ndb.Key(task_queues.TaskDimensionsIndexBackfill, 1).delete()
+
+    self.assertTrue(task_queues.backfill_dimensions_index_async().get_result())
+    self.assertEqual(expected, index())
+    state = ndb.Key(task_queues.TaskDimensionsIndexBackfill, 1).get()
+    self.assertTrue(state.done)
+    self.assertIsNone(state.cursor)
+
+    # Once done, it does nothing.
+    ndb.delete_multi(task_queues.TaskDimensionsIndex.query().fetch(
+        keys_only=True))
+    self.assertTrue(task_queues.backfill_dimensions_index_async().get_result())
+    self.assertEqual({}, index())
+
+  def test_tq_rescan_matching_task_sets_async_repairs_index(self):
+    self.mock(task_queues, '_FULL_RESCAN_PROBABILITY', 0.0)
+    self._create_task_dims_set('pool:p:1', ['pool:p', 'dim:0'])
+    self._create_task_dims_set('pool:p:2', ['pool:p', 'dim:1'])
+    self.execute_tasks()
+    ndb.delete_multi(task_queues.TaskDimensionsIndex.query().fetch(
+        keys_only=True))
+
+    def rescan():
+      task_queues.BotDimensionsMatches(
+          id='bot-id',
+          dimensions=[u'dim:0', u'id:bot-id', u'pool:p'],
+          last_rescan_enqueued_ts=utils.utcnow(),
+          rescan_counter=1,
+      ).put()
+      self.assertTrue(
+          task_queues._tq_rescan_matching_task_sets_async(
+              'bot-id', 1, 'reason').get_result())
+      return ndb.Key(task_queues.BotDimensionsMatches, 'bot-id').get().matches
+
+    # The index is complete, the set missing from it is not found.
+    self.assertEqual([], rescan())
+    self.assertEqual(0, self.execute_tasks())
+
+    # Until the backfill is done, the pool is scanned and the sets missing from
+    # the index are indexed.
+    ndb.Key(task_queues.TaskDimensionsIndexBackfill, 1).delete()
+    self.assertEqual([u'pool:p:1'], rescan())
+    self.assertEqual(1, self.execute_tasks())
+    task_queues.TaskDimensionsIndexBackfill(id=1, done=True).put()
+    self.assertEqual([u'pool:p:1'], rescan())
+
   def test_tidy_task_dimension_sets_async(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
 
@@ -1015,10 +1152,83 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
             'rescan_counter': prev_state['rescan_counter'],
         })
 
-  def test_tq_rescan_matching_task_sets_async(self):
+  def test_assert_bot_dimensions_async_poll_cache(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
     self.mock_now(now)
 
+    checked = []
+    orig_check_matches_async = task_queues._check_matches_async
+
+    def mocked_check_matches_async(bot_dimensions, sets_ids):
+      checked.append(sorted(sets_ids))
+      return orig_check_matches_async(bot_dimensions, sets_ids)
+
+    self.mock(task_queues, '_check_matches_async', mocked_check_matches_async)
+    self.mock(task_queues, '_tq_rescan_matching_task_sets_async',
+              ndb.tasklet(lambda *_args: True))
+
+    dims = {
+        'id': ['bot-id'],
+        'pool': ['pool1'],
+        'dim': ['0'],
+    }
+    self._create_task_dims_set('bot:bot-id:1', ['id:bot-id'])
+    self._create_task_dims_set('pool:pool1:2', ['pool:pool1'])
+    task_queues.BotDimensionsMatches(
+        id='bot-id',
+        dimensions=task_queues.bot_dimensions_to_flat(dims),
+        matches=['bot:bot-id:1', 'pool:pool1:2'],
+        next_rescan_ts=now + datetime.timedelta(minutes=30)).put()
+
+    def assert_bot(expected, expected_checked):
+      queues = task_queues._assert_bot_dimensions_async(dims).get_result()
+      self.assertEqual(queues, expected)
+      self.assertEqual(checked, expected_checked)
+      del checked[:]
+
+    both = {'bot:bot-id:1', 'pool:pool1:2'}
+
+    # The first poll loads the sets and populates the cache.
+    assert_bot(both, [['bot:bot-id:1', 'pool:pool1:2']])
+    # An idle poll skips loading the sets.
+    assert_bot(both, [])
+    assert_bot(both, [])
+
+    # Updating some sets invalidates the cache.
+    self._create_task_dims_set('pool:pool1:2', ['pool:pool1'])
+    assert_bot(both, [['bot:bot-id:1', 'pool:pool1:2']])
+    assert_bot(both, [])
+
+    # Updating sets in another pool doesn't.
+    self._create_task_dims_set('pool:pool2:3', ['pool:pool2'])
+    assert_bot(both, [])
+
+    # Nor updating sets in the same pool that the bot doesn't match.
+    self._create_task_dims_set('pool:pool1:4', ['pool:pool1', 'dim:1'])
+    assert_bot(both, [])
+
+    # Deleting the sets is noticed.
+    self._delete_task_dims_set('pool:pool1:2')
+    assert_bot({'bot:bot-id:1'}, [['bot:bot-id:1', 'pool:pool1:2']])
+    assert_bot({'bot:bot-id:1'}, [['bot:bot-id:1']])
+    assert_bot({'bot:bot-id:1'}, [])
+
+    # Bot dimensions change invalidates the cache.
+    dims['dim'] = ['1']
+    assert_bot({'bot:bot-id:1'}, [['bot:bot-id:1']])
+
+    # Evicted generation numbers disable the cache until they are restored.
+    memcache.flush_all()
+    assert_bot({'bot:bot-id:1'}, [['bot:bot-id:1']])
+    assert_bot({'bot:bot-id:1'}, [['bot:bot-id:1']])
+    assert_bot({'bot:bot-id:1'}, [])
+
+  @parameterized.expand([(0.0,), (1.0,)])
+  def test_tq_rescan_matching_task_sets_async(self, full_rescan_probability):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    self.mock(task_queues, '_FULL_RESCAN_PROBABILITY', full_rescan_probability)
+
     # Prepare all active task dims sets.
     self._create_task_dims_set('bot:bot-id:1', ['id:bot-id'])
     self._create_task_dims_set('bot:bot-id:2', ['id:bot-id', 'dim:0'])
@@ -1039,6 +1249,9 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self._create_task_dims_set('pool:pool1:/', ['pool:pool1'])
     self._create_task_dims_set('pool:pool1::', ['pool:pool1'])
 
+    # Update TaskDimensionsIndex.
+    self.execute_tasks()
+
     # Prepare BotDimensionsMatches in some initial pre-scan state: it has new
     # dimensions (dim:1), but matches are still for old ones (dim:0).
     task_queues.BotDimensionsMatches(
@@ -12,7 +12,8 @@ store tasks results.
 - TaskRunResult represents the result for one 'try'. There can
   be multiple tries for one job, for example if a bot dies.
 - The stdout of the task is saved under TaskOutput, chunked in TaskOutputChunk
-  entities to fit the entity size limit.
+  entities to fit the entity size limit. Recent updates may still be stored as
+  TaskOutputSegment entities, until they are merged into TaskOutputChunk.
 
 Graph of schema:
 
@@ -90,6 +91,21 @@ _BOT_TASK_ALLOWED_SORTS = {'created_ts', 'started_ts', 'completed_ts'}
 # - deduped relies on try_number which is not part of `task_run_result`.
 _BOT_TASK_DISALLOWED_STATES = {'pending', 'pending_running', 'deduped'}
 
+# Granularity of TaskRunResult.dead_after_bucket. The indexed value only changes
+# once per bucket, while dead_after_ts changes on every bot ping.
+_DEAD_AFTER_BUCKET_SECS = 60
+
+# Runs stored before TaskRunResult.dead_after_bucket existed are looked for
+# until then. It's past the deployment of dead_after_bucket by more than the
+# longest bot_ping_tolerance_secs, by then they all were found once and marked
+# as BOT_DIED.
+# TODO(maruel): Remove along yield_run_result_keys_without_dead_after().
+_DEAD_AFTER_FALLBACK_UNTIL = datetime.datetime(2026, 11, 15)
+
+# Number of times get_output() reads the output again when a compaction
+# happened while it was reading.
+_GET_OUTPUT_ATTEMPTS = 3
+
 
 class State(object):
   """Represents the current task state.
@@ -174,6 +190,15 @@ class LargeIntegerArray(ndb.BlobProperty):
     return super(LargeIntegerArray, self)._do_validate(value) or None
 
 
+def _dead_after_bucket(dead_after_ts):
+  """Rounds dead_after_ts down to the start of its bucket."""
+  if not dead_after_ts:
+    return None
+  secs = int(utils.datetime_to_timestamp(dead_after_ts) / 1e6)
+  return utils.timestamp_to_datetime(
+      (secs - secs % _DEAD_AFTER_BUCKET_SECS) * 1e6)
+
+
 def _calculate_failure(result_common):
   # When the task command times out, there may not be any exit code, it is still
   # a user process failure mode, not an infrastructure failure mode.
@@ -201,6 +226,11 @@ class TaskOutput(ndb.Model):
   # Maximum number of chunks.
   PUT_MAX_CHUNKS = 1024
 
+  # Number of TaskOutputSegment entities written between compactions, see
+  # compact_output(). This is also the maximum number of segments merged in a
+  # single transaction.
+  COMPACT_SEGMENTS = 32
+
   # Maximum content size saved in a TaskOutput.
   @classmethod
   def PUT_MAX_CONTENT(cls):
@@ -227,6 +257,28 @@ class TaskOutputChunk(ndb.Model):
     return self.key.integer_id() - 1
 
 
+class TaskOutputSegment(ndb.Model):
+  """Represents a piece of the task output that wasn't merged into a
+  TaskOutputChunk yet.
+
+  Parent is TaskOutput. Key id is the offset of the data in the output plus 1,
+  since 0 is not a valid id. A segment never crosses a TaskOutputChunk
+  boundary.
+
+  It is written as-is on each output update, without reading anything, and is
+  immutable. Segments are merged into TaskOutputChunk by compact_output().
+  Until then, TaskOutputChunk content is overridden by segments content.
+  """
+  data = ndb.BlobProperty(compressed=True)
+  # Sequence number of the write, from TaskRunResult.stdout_segments. When
+  # segments overlap, the one written last wins.
+  seq = ndb.IntegerProperty(indexed=False)
+
+  @property
+  def offset(self):
+    return self.key.integer_id() - 1
+
+
 class OperationStats(ndb.Model):
   """Statistics for an operation.
 
@@ -517,9 +569,14 @@ class _TaskResultCommon(ndb.Model):
   # automatically if possible.
   internal_failure = ndb.BooleanProperty(indexed=False, default=False)
 
-  # Number of TaskOutputChunk entities for the output.
+  # Number of TaskOutputChunk entities for the output. With append-only output
+  # it also accounts for chunks that exist only as TaskOutputSegment entities.
   stdout_chunks = ndb.IntegerProperty(indexed=False)
 
+  # Number of TaskOutputSegment entities ever written for the output, including
+  # ones already merged by compact_output(). Used as the write sequence number.
+  stdout_segments = ndb.IntegerProperty(indexed=False)
+
   # Process exit code. May be missing when task_runner dies and bot_main tries
   # to recover the task and in some cases with state TIMED_OUT.
   exit_code = ndb.IntegerProperty(indexed=False, name='exit_codes')
@@ -760,8 +817,9 @@ class _TaskResultCommon(ndb.Model):
     out = super(_TaskResultCommon, self).to_dict(**kwargs)
     # TODO(crbug.com/1255535): deprecated.
     out.pop('outputs_ref')
-    # stdout_chunks is an implementation detail.
+    # stdout_chunks and stdout_segments are implementation details.
     out.pop('stdout_chunks')
+    out.pop('stdout_segments')
     out['id'] = self.task_id
     return out
 
@@ -869,15 +927,52 @@ class _TaskResultCommon(ndb.Model):
         _output_key_to_output_chunk_key(output_key, i)
         for i in range(first_chunk, last_chunk)
     ]
+    segments = []
+    if self.stdout_segments:
+      # Not yet compacted output, if any. The ancestor query is strongly
+      # consistent. compact_output() merges segments into the chunks and
+      # deletes them in a transaction, so if a segment read before the chunks
+      # is gone after, the chunks may already contain it. Read again then.
+      lo = _output_key_to_output_segment_key(output_key,
+                                             first_chunk * chunk_size)
+      hi = _output_key_to_output_segment_key(output_key,
+                                             last_chunk * chunk_size)
+      q = TaskOutputSegment.query(ancestor=output_key).filter(
+          TaskOutputSegment.key >= lo).filter(TaskOutputSegment.key < hi)
+      for attempt in range(_GET_OUTPUT_ATTEMPTS):
+        segments = q.fetch()
+        chunks = ndb.get_multi(keys)
+        if not segments:
+          break
+        remaining = set(q.fetch(keys_only=True))
+        if all(seg.key in remaining for seg in segments):
+          break
+        logging.info('get_output(%s): compacted while reading, attempt %d',
+                     self.task_id, attempt)
+      else:
+        logging.warning('get_output(%s): output may be inconsistent',
+                        self.task_id)
+    else:
+      chunks = ndb.get_multi(keys)
+
     void = None
     parts = []
-    for e in ndb.get_multi(keys):
-      if e:
-        parts.append(e.chunk)
-      else:
-        if not void:
-          void = '\x00' * TaskOutput.CHUNK_SIZE
-        parts.append(void)
+    if not segments:
+      for e in chunks:
+        if e:
+          parts.append(e.chunk)
+        else:
+          if not void:
+            void = '\x00' * TaskOutput.CHUNK_SIZE
+          parts.append(void)
+    else:
+      parts = [e.chunk if e else '' for e in chunks]
+      for seg in sorted(segments, key=lambda seg: seg.seq):
+        i = seg.offset / chunk_size - first_chunk
+        parts[i] = _output_splice(parts[i], seg.offset % chunk_size, seg.data)
+      # Fill the holes.
+      for i in range(len(parts) - 1):
+        parts[i] = parts[i].ljust(chunk_size, '\x00')
 
     # Process the output.
     start_offset = offset % chunk_size
@@ -1009,6 +1104,11 @@ class TaskRunResult(_TaskResultCommon):
   # task is RUNNING and set to None once the task terminates.
   dead_after_ts = ndb.DateTimeProperty(indexed=False)
 
+  # dead_after_ts rounded down to _DEAD_AFTER_BUCKET_SECS. Set in
+  # _pre_put_hook. Indexed so cron_handle_bot_died only looks at runs whose
+  # ping deadline may have passed instead of all running tasks.
+  dead_after_bucket = ndb.DateTimeProperty()
+
   @property
   def created_ts(self):
     # Use the copied property if available (it is missing for older entities),
@@ -1064,8 +1164,31 @@ class TaskRunResult(_TaskResultCommon):
     assert self.stdout_chunks <= TaskOutput.PUT_MAX_CHUNKS
     return entities
 
+  def append_output_segments(self, output, output_chunk_start):
+    """Appends output to the stdout as new TaskOutputSegment entities.
+
+    Unlike append_output(), it doesn't read anything from the DB.
+
+    Returns the entities to save.
+    """
+    output_key = _run_result_key_to_output_key(self.key)
+    entities = []
+    for key, start, data in _output_split(output_key, output,
+                                          output_chunk_start):
+      chunk_number = key.integer_id() - 1
+      offset = chunk_number * TaskOutput.CHUNK_SIZE + start
+      self.stdout_chunks = max(self.stdout_chunks or 0, chunk_number + 1)
+      self.stdout_segments = (self.stdout_segments or 0) + 1
+      entities.append(
+          TaskOutputSegment(
+              key=_output_key_to_output_segment_key(output_key, offset),
+              data=data,
+              seq=self.stdout_segments))
+    return entities
+
   def to_dict(self, **kwargs):
     out = super(TaskRunResult, self).to_dict(exclude=[
+        'dead_after_bucket',
         'request_created',
         'request_tags',
         'request_name',
@@ -1083,6 +1206,7 @@ class TaskRunResult(_TaskResultCommon):
         raise datastore_errors.BadValueError('.dead_after_ts should be None')
     elif self.state == State.RUNNING:
       raise datastore_errors.BadValueError('Must update .dead_after_ts')
+    self.dead_after_bucket = _dead_after_bucket(self.dead_after_ts)
 
 
 class TaskResultSummary(_TaskResultCommon):
@@ -1127,7 +1251,7 @@ class TaskResultSummary(_TaskResultCommon):
   # - self.failure == False
   # - self.internal_failure == False
   #
-  # The index is used to find duplicate tasks.
+  # Duplicate tasks are found via TaskDedupEntry, which is keyed by this value.
   properties_hash = ndb.BlobProperty(indexed=True)
 
   # Bot that ran this task.
@@ -1334,6 +1458,38 @@ class TaskResultSummary(_TaskResultCommon):
     return super(TaskResultSummary, self).to_dict(exclude=['properties_hash'])
 
 
+class TaskDedupEntry(ndb.Model):
+  """Points to the TaskResultSummary that can be reused by idempotent tasks
+  with the given properties_hash.
+
+  Key id is the hex encoded properties_hash, see create_key(). It is written
+  when an idempotent task completes successfully, so the most recent successful
+  task wins.
+
+  It is a reverse map of TaskResultSummary.properties_hash, which allows finding
+  a task to dedupe against with a single get instead of an eventually
+  consistent query.
+  """
+  # Caching is done explicitly by the task scheduler.
+  _use_cache = False
+  _use_memcache = False
+
+  # The task_id (TaskResultSummary packed key) of the task to reuse.
+  task_id = ndb.StringProperty(required=True, indexed=False)
+
+  # Copy of TaskResultSummary.created_ts, used to check the results are not too
+  # old to be reused.
+  created_ts = ndb.DateTimeProperty(required=True, indexed=False)
+
+  # When this entity should expire and be removed from datastore.
+  # TTL https://cloud.google.com/datastore/docs/ttl
+  expire_at = ndb.DateTimeProperty(indexed=False)
+
+  @classmethod
+  def create_key(cls, properties_hash):
+    return ndb.Key(cls, properties_hash.encode('hex'))
+
+
 ### Private stuff.
 
 
@@ -1353,6 +1509,46 @@ def _output_key_to_output_chunk_key(output_key, chunk_number):
   return ndb.Key(TaskOutputChunk, chunk_number+1, parent=output_key)
 
 
+def _output_key_to_output_segment_key(output_key, offset):
+  """Returns a ndb.key to a TaskOutputSegment starting at the given offset."""
+  assert output_key.kind() == 'TaskOutput', output_key
+  assert offset >= 0, offset
+  return ndb.Key(TaskOutputSegment, offset+1, parent=output_key)
+
+
+def _output_split(output_key, output, output_chunk_start):
+  """Splits output to be written at output_chunk_start by TaskOutputChunk.
+
+  It silently drops the output that goes over ~100Mib.
+
+  Returns:
+    A list of (TaskOutputChunk key, start offset in the chunk, data).
+  """
+  assert output and isinstance(output, str), output
+  assert output_key.kind() == 'TaskOutput', output_key
+  chunks = []
+  while output:
+    chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
+    if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
+      # TODO(maruel): Log into TaskOutput that data was dropped.
+      logging.warning('Dropping output\n%d bytes were lost', len(output))
+      break
+    key = _output_key_to_output_chunk_key(output_key, chunk_number)
+    start = output_chunk_start % TaskOutput.CHUNK_SIZE
+    next_start = TaskOutput.CHUNK_SIZE - start
+    chunks.append((key, start, output[:next_start]))
+    output = output[next_start:]
+    output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
+  return chunks
+
+
+def _output_splice(data, start, output_chunk):
+  """Returns data with output_chunk written at start, padding with zeros."""
+  if len(data) < start:
+    data = data + '\x00' * (start-len(data))
+  return data[:start] + output_chunk + data[start + len(output_chunk):]
+
+
 def _output_append(output_key, number_chunks, output, output_chunk_start):
   """Appends output to a TaskOutput in TaskOutputChunk entities.
 
@@ -1375,24 +1571,10 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
     A tuple of (list of entities to save, number_chunks). The number_chunks is
     the number of TaskOutputChunk instances for this output.
   """
-  assert output and isinstance(output, str), output
-  assert output_key.kind() == 'TaskOutput', output_key
-
   # Split everything in small bits.
-  chunks = []
-  while output:
-    chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
-    if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
-      # TODO(maruel): Log into TaskOutput that data was dropped.
-      logging.warning('Dropping output\n%d bytes were lost', len(output))
-      break
-    key = _output_key_to_output_chunk_key(output_key, chunk_number)
-    start = output_chunk_start % TaskOutput.CHUNK_SIZE
-    next_start = TaskOutput.CHUNK_SIZE - start
-    chunks.append((key, start, output[:next_start]))
-    output = output[next_start:]
-    number_chunks = max(number_chunks, chunk_number + 1)
-    output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
+  chunks = _output_split(output_key, output, output_chunk_start)
+  for key, _start, _output_chunk in chunks:
+    number_chunks = max(number_chunks, key.integer_id())
 
   if not chunks:
     return [], number_chunks
@@ -1411,50 +1593,54 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
     if not entities[i]:
       # Fill up for missing entities.
       entities[i] = TaskOutputChunk(key=key)
-    chunk = entities[i]
-    # Magically combine everything.
-    end = start + len(output_chunk)
-    if len(chunk.chunk) < start:
-      # Insert blank data automatically.
-      chunk.gaps.extend((len(chunk.chunk), start))
-      chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
-
-    # Strip gaps that are being written to.
-    new_gaps = []
-    for j in range(0, len(chunk.gaps), 2):
-      # All values are relative to the starting offset of the chunk itself.
-      gap_start = chunk.gaps[j]
-      gap_end = chunk.gaps[j + 1]
-      # If the gap overlaps the chunk being written, strip it. Cases:
-      #   Gap:     |   |
-      #   Chunk: |   |
-      if start <= gap_start <= end <= gap_end:
-        gap_start = end
-
-      #   Gap:     |   |
-      #   Chunk:     |   |
-      if gap_start <= start <= gap_end <= end:
-        gap_end = start
-
-      #   Gap:       |  |
-      #   Chunk:   |      |
-      if start <= gap_start <= end and start <= gap_end <= end:
-        continue
-
-      #   Gap:     |      |
-      #   Chunk:     |  |
-      if gap_start < start < gap_end and gap_start <= end <= gap_end:
-        # Create a hole.
-        new_gaps.extend((gap_start, start))
-        new_gaps.extend((end, gap_end))
-      else:
-        new_gaps.extend((gap_start, gap_end))
-
-    chunk.gaps = new_gaps
-    chunk.chunk = chunk.chunk[:start] + output_chunk + chunk.chunk[end:]
+    _output_chunk_write(entities[i], start, output_chunk)
   return entities, number_chunks
 
 
+def _output_chunk_write(chunk, start, output_chunk):
+  """Writes output_chunk into a TaskOutputChunk entity, updating its gaps."""
+  # Magically combine everything.
+  end = start + len(output_chunk)
+  if len(chunk.chunk) < start:
+    # Insert blank data automatically.
+    chunk.gaps.extend((len(chunk.chunk), start))
+    chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
+
+  # Strip gaps that are being written to.
+  new_gaps = []
+  for j in range(0, len(chunk.gaps), 2):
+    # All values are relative to the starting offset of the chunk itself.
+    gap_start = chunk.gaps[j]
+    gap_end = chunk.gaps[j + 1]
+    # If the gap overlaps the chunk being written, strip it. Cases:
+    #   Gap:     |   |
+    #   Chunk: |   |
+    if start <= gap_start <= end <= gap_end:
+      gap_start = end
+
+    #   Gap:     |   |
+    #   Chunk:     |   |
+    if gap_start <= start <= gap_end <= end:
+      gap_end = start
+
+    #   Gap:       |  |
+    #   Chunk:   |      |
+    if start <= gap_start <= end and start <= gap_end <= end:
+      continue
+
+    #   Gap:     |      |
+    #   Chunk:     |  |
+    if gap_start < start < gap_end and gap_start <= end <= gap_end:
+      # Create a hole.
+      new_gaps.extend((gap_start, start))
+      new_gaps.extend((end, gap_end))
+    else:
+      new_gaps.extend((gap_start, gap_end))
+
+  chunk.gaps = new_gaps
+  chunk.chunk = chunk.chunk[:start] + output_chunk + chunk.chunk[end:]
+
+
 def _outputchunk_key_to_request(output_chunk_key):
   """Returns the ndb.Key for the TaskRequest."""
   summary_key = output_chunk_key.parent().parent().parent()
@@ -1611,6 +1797,68 @@ def new_run_result(request, to_run, bot_id, bot_details, bot_dimensions,
       server_versions=[utils.get_app_version()])
 
 
+def compact_output(run_result_key):
+  """Merges TaskOutputSegment entities of a task into TaskOutputChunk entities.
+
+  Each batch of segments is merged and deleted in a transaction, so
+  get_output() can detect a merge that happened while it was reading.
+
+  Returns:
+    Number of merged TaskOutputSegment entities.
+  """
+  output_key = _run_result_key_to_output_key(run_result_key)
+  limit = TaskOutput.COMPACT_SEGMENTS
+  chunk_size = TaskOutput.CHUNK_SIZE
+
+  def txn():
+    q = TaskOutputSegment.query(ancestor=output_key)
+    segments = q.order(TaskOutputSegment.key).fetch(limit)
+    if len(segments) == limit:
+      # Segments of the last chunk may continue past the batch, and overlapping
+      # segments must be merged in order. Leave this chunk for the next batch.
+      last = segments[-1].offset / chunk_size
+      trimmed = [seg for seg in segments if seg.offset / chunk_size != last]
+      if trimmed:
+        segments = trimmed
+      else:
+        # The whole batch is in a single chunk. Merge the segments of this
+        # chunk written first, the next batches override them.
+        lo = _output_key_to_output_segment_key(output_key, last * chunk_size)
+        hi = _output_key_to_output_segment_key(output_key,
+                                               (last + 1) * chunk_size)
+        segments = sorted(
+            q.filter(TaskOutputSegment.key >= lo).filter(
+                TaskOutputSegment.key < hi).fetch(),
+            key=lambda seg: seg.seq)[:limit]
+    if not segments:
+      return 0
+    keys = sorted(
+        set(
+            _output_key_to_output_chunk_key(output_key, seg.offset / chunk_size)
+            for seg in segments))
+    chunks = {
+        key: chunk or TaskOutputChunk(key=key)
+        for key, chunk in zip(keys, ndb.get_multi(keys))
+    }
+    for seg in sorted(segments, key=lambda seg: seg.seq):
+      key = _output_key_to_output_chunk_key(output_key, seg.offset / chunk_size)
+      _output_chunk_write(chunks[key], seg.offset % chunk_size, seg.data)
+    ndb.put_multi(chunks.values())
+    ndb.delete_multi(seg.key for seg in segments)
+    return len(segments)
+
+  total = 0
+  while True:
+    merged = datastore_utils.transaction(txn)
+    total += merged
+    if not merged:
+      break
+  if total:
+    logging.info('Merged %d output segments of %s', total,
+                 task_pack.pack_run_result_key(run_result_key))
+  return total
+
+
 def yield_result_summary_by_parent_task_id(parent_task_id):
   """Yields child TaskResultSummary entities by parent task id."""
   q = task_request.yield_request_keys_by_parent_task_id(parent_task_id)
@@ -1620,6 +1868,38 @@ def yield_result_summary_by_parent_task_id(parent_task_id):
     yield result_summary_key.get(use_cache=False, use_memcache=False)
 
 
+def yield_run_result_keys_past_dead_after(now):
+  """Yields TaskRunResult keys whose bot may have stopped sending pings.
+
+  It's a superset of the runs with dead_after_ts <= now, the caller must check
+  dead_after_ts again.
+  """
+  q = TaskRunResult.query(
+      TaskRunResult.dead_after_bucket >= utils.EPOCH,
+      TaskRunResult.dead_after_bucket <= now)
+  for key in q.iter(keys_only=True, batch_size=500):
+    yield key
+
+
+def yield_run_result_keys_without_dead_after(now):
+  """Yields keys of running TaskRunResult without dead_after_bucket.
+
+  These are runs stored before TaskRunResult.dead_after_bucket was added, that
+  weren't updated since, e.g. because their bot died. They are the difference
+  between two keys-only queries, which is much cheaper than looking at the
+  entities. Yields nothing once `now` is past _DEAD_AFTER_FALLBACK_UNTIL, since
+  the keys of all the running runs are held in memory.
+  """
+  if now >= _DEAD_AFTER_FALLBACK_UNTIL:
+    return
+  q = TaskRunResult.query(TaskRunResult.dead_after_bucket >= utils.EPOCH)
+  with_bucket = set(q.iter(keys_only=True, batch_size=500))
+  q = TaskRunResult.query(TaskRunResult.completed_ts == None)
+  for key in q.iter(keys_only=True, batch_size=500):
+    if key not in with_bucket:
+      yield key
+
+
 def get_run_results_query(start, end, sort, state, bot_id):
   """Returns TaskRunResult.query() with these filters.
 
@@ -680,6 +680,49 @@ class TaskResultApiTest(TestCase):
     self.assertEqual(sorted(expected),
                      sorted(s.key for s in result_summary_iter))
 
+  def test_yield_run_result_keys_past_dead_after(self):
+    run_result = _gen_run_result()
+    deadline = run_result.dead_after_ts
+    self.assertEqual(
+        deadline.replace(second=0, microsecond=0),
+        run_result.dead_after_bucket)
+
+    def keys(now):
+      return list(task_result.yield_run_result_keys_past_dead_after(now))
+
+    self.assertEqual([], keys(self.now))
+    self.assertEqual([], keys(deadline - datetime.timedelta(minutes=1)))
+    self.assertEqual([run_result.key], keys(deadline))
+
+    # Terminated runs are not returned.
+    run_result.completed_ts = deadline
+    run_result.duration = 0.1
+    run_result.exit_code = 0
+    run_result.state = task_result.State.COMPLETED
+    run_result.modified_ts = deadline
+    run_result.dead_after_ts = None
+    ndb.transaction(run_result.put)
+    self.assertIsNone(run_result.key.get().dead_after_bucket)
+    self.assertEqual([], keys(deadline))
+
+  def test_yield_run_result_keys_without_dead_after(self):
+    run_result = _gen_run_result()
+
+    cutoff = task_result._DEAD_AFTER_FALLBACK_UNTIL
+
+    def keys(now=cutoff - datetime.timedelta(seconds=1)):
+      return list(task_result.yield_run_result_keys_without_dead_after(now))
+
+    self.assertEqual([], keys())
+
+    # Stored before dead_after_bucket existed.
+    self.mock(task_result, '_dead_after_bucket', lambda _: None)
+    ndb.transaction(run_result.put)
+    self.assertEqual([run_result.key], keys())
+
+    # Not looked for anymore past the cutoff.
+    self.assertEqual([], keys(cutoff))
+
   def test_set_from_run_result(self):
     request = _gen_request()
     result_summary = task_result.new_result_summary(request)
@@ -1143,6 +1186,10 @@ class TaskResultApiTest(TestCase):
     # Tested by test_fetch_task_results already.
     pass
 
+  def test_compact_output(self):
+    # Tested in TestOutput.
+    pass
+
 
 class TestOutput(TestCase):
 
@@ -1300,6 +1347,114 @@ class TestOutput(TestCase):
         'gaps': [3, 4, 7, 8]
     }])
 
+  def assertTaskOutputSegment(self, expected):
+    q = task_result.TaskOutputSegment.query().order(
+        task_result.TaskOutputSegment.key)
+    self.assertEqual(expected, [(t.offset, t.data) for t in q.fetch()])
+
+  def test_append_output_segments(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output_segments('FooBar', 0))
+    ndb.put_multi(run_result.append_output_segments('Baz', 6))
+    self.assertEqual(3, run_result.stdout_chunks)
+    self.assertEqual(4, run_result.stdout_segments)
+    self.assertTaskOutputSegment([(0, 'FooB'), (4, 'ar'), (6, 'Ba'),
+                                  (8, 'z')])
+    self.assertTaskOutputChunk([])
+    self.assertEqual('FooBarBaz', run_result.get_output(0, 0))
+    self.assertEqual('arBa', run_result.get_output(4, 4))
+    self.assertEqual('Baz', run_result.get_output(6, 0))
+
+  def test_append_output_segments_over_chunks(self):
+    # Tasks that were running when append-only output was enabled have both.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('FooBar', 0))
+    ndb.put_multi(run_result.append_output_segments('X', 1))
+    ndb.put_multi(run_result.append_output_segments('Baz', 10))
+    self.assertEqual('FXoBar\x00\x00\x00\x00Baz',
+                     run_result.get_output(0, 0))
+
+  def test_append_output_segments_overwrite(self):
+    # The last write wins, regardless of offsets.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 8)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output_segments('X', 3))
+    ndb.put_multi(run_result.append_output_segments('FooBar', 0))
+    self.assertEqual('FooBar', run_result.get_output(0, 0))
+    ndb.put_multi(run_result.append_output_segments('Y', 3))
+    self.assertEqual('FooYar', run_result.get_output(0, 0))
+
+  def test_compact_output(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    self.mock(task_result.TaskOutput, 'COMPACT_SEGMENTS', 3)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Fo', 0))
+    ndb.put_multi(run_result.append_output_segments('X', 3))
+    ndb.put_multi(run_result.append_output_segments('oBar', 2))
+    ndb.put_multi(run_result.append_output_segments('Baz', 10))
+    expected = 'FooBar\x00\x00\x00\x00Baz'
+    self.assertEqual(expected, run_result.get_output(0, 0))
+
+    self.assertEqual(5, task_result.compact_output(run_result.key))
+    self.assertTaskOutputSegment([])
+    self.assertTaskOutputChunk([
+        {
+            'chunk': 'FooB',
+            'gaps': []
+        },
+        {
+            'chunk': 'ar',
+            'gaps': []
+        },
+        {
+            'chunk': '\x00\x00Ba',
+            'gaps': [0, 2]
+        },
+        {
+            'chunk': 'z',
+            'gaps': []
+        },
+    ])
+    self.assertEqual(expected, run_result.get_output(0, 0))
+    self.assertEqual(0, task_result.compact_output(run_result.key))
+
+  def test_compact_output_overwrite(self):
+    # Segments of a single chunk don't fit a batch, they must still be merged in
+    # the order they were written.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 8)
+    self.mock(task_result.TaskOutput, 'COMPACT_SEGMENTS', 2)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output_segments('Z', 2))
+    ndb.put_multi(run_result.append_output_segments('y', 1))
+    ndb.put_multi(run_result.append_output_segments('abc', 0))
+    self.assertEqual('abc', run_result.get_output(0, 0))
+
+    self.assertEqual(3, task_result.compact_output(run_result.key))
+    self.assertTaskOutputSegment([])
+    self.assertTaskOutputChunk([{'chunk': 'abc', 'gaps': []}])
+    self.assertEqual('abc', run_result.get_output(0, 0))
+
+  def test_get_output_compacted_while_reading(self):
+    # A segment written and merged after the segments were read must not be
+    # overwritten by the older segments.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 8)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output_segments('FooXar', 0))
+    get_multi = ndb.get_multi
+    calls = []
+
+    def get_multi_mock(keys, **kwargs):
+      if not calls:
+        calls.append(keys)
+        ndb.put_multi(run_result.append_output_segments('Y', 3))
+        self.assertEqual(2, task_result.compact_output(run_result.key))
+      return get_multi(keys, **kwargs)
+
+    self.mock(ndb, 'get_multi', get_multi_mock)
+    self.assertEqual('FooYar', run_result.get_output(0, 0))
+
   def test_get_output_subset(self):
     self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 16)
     run_result = _gen_run_result()
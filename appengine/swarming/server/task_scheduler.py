@@ -9,6 +9,7 @@ This is the interface closest to the HTTP handlers.
 
 import collections
 import datetime
+import itertools
 import json
 import logging
 import math
@@ -18,7 +19,10 @@ import urlparse
 import uuid
 
 from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
 from google.protobuf import timestamp_pb2
 
 from components import auth
@@ -57,6 +61,43 @@ _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 # life. This number should be larger than the bot polling period.
 _ES_FALLBACK_SLACK = datetime.timedelta(minutes=6)
 
+# If True, task output updates are written as TaskOutputSegment entities, which
+# doesn't require reading existing TaskOutputChunk entities. Segments are merged
+# into chunks by task_result.compact_output() in the background.
+_APPEND_ONLY_OUTPUT = True
+
+# Memcache namespace for TaskDedupEntry lookups, see _find_dupe_task().
+_DEDUP_MEMCACHE_NAMESPACE = 'task_dedup'
+
+# In-process cache of hex properties_hash => (task_id, created_ts) for
+# _find_dupe_task(). Cleared when it reaches _DEDUP_CACHE_MAX_SIZE entries.
+_DEDUP_CACHE = {}
+_DEDUP_CACHE_MAX_SIZE = 10000
+
+# When TaskDedupEntry was deployed. Tasks completed before don't have one, so
+# _find_dupe_task() queries TaskResultSummary.properties_hash as long as such
+# tasks may still be reused.
+# TODO(maruel): Remove along the query once reusable_task_age_secs passed.
+_DEDUP_ENTRY_SINCE = datetime.datetime(2026, 10, 19)
+
+# Number of dead task transactions in flight in task_handle_dead_tasks().
+_DEAD_TASK_CONCURRENCY = 50
+
+# Memcache namespace with the observed task_expire_tasks() throughput.
+_EXPIRE_MEMCACHE_NAMESPACE = 'task_expire'
+
+# Number of TaskToRunShard per task_expire_tasks() call. The default is used
+# until a throughput is observed, then it is adjusted so that a call takes about
+# _EXPIRE_TARGET_SECS, within [_EXPIRE_BATCH_MIN, _EXPIRE_BATCH_MAX].
+_EXPIRE_BATCH_SIZE = 50
+_EXPIRE_BATCH_MIN = 10
+_EXPIRE_BATCH_MAX = 500
+_EXPIRE_TARGET_SECS = 30
+
+# Maximum number of claimed candidates whose entities are prefetched ahead of
+# the one being reaped in bot_reap_task().
+_REAP_PREFETCH_MAX = 4
+
 
 # Non-essential bot information for reaping a task
 BotDetails = collections.namedtuple('BotDetails',
@@ -131,8 +172,8 @@ def _expire_slice_tx(request, to_run_key, terminal_state, capacity, es_cfg):
 
   # Record the expiration delay if the slice expired by reaching its deadline.
   # It may end up negative if there's a clock drift between the process that ran
-  # yield_expired_task_to_run() and the process that runs this transaction. This
-  # should be rare.
+  # scan_expired_task_to_run_async() and the process that runs this transaction.
+  # This should be rare.
   if terminal_state == task_result.State.EXPIRED:
     delay = (now - to_run.expiration_ts).total_seconds()
     if delay < 0:
@@ -795,44 +836,130 @@ def _pubsub_notify(task_id, topic, auth_token, userdata, tags, state,
           tags, state, http_status_code, latency)
 
 
+def _cache_dupe_candidate(hex_hash, candidate):
+  """Stores a (task_id, created_ts) tuple in the in-process cache."""
+  if len(_DEDUP_CACHE) >= _DEDUP_CACHE_MAX_SIZE:
+    _DEDUP_CACHE.clear()
+  _DEDUP_CACHE[hex_hash] = candidate
+
+
+def _register_dupe_task(result_summary):
+  """Makes a successfully completed idempotent task findable by
+  _find_dupe_task().
+
+  This is best effort. A failure only means a future task with the same
+  properties will run instead of being deduped.
+  """
+  h = result_summary.properties_hash
+  assert h, result_summary
+  key = task_result.TaskDedupEntry.create_key(h)
+  candidate = (result_summary.task_id, result_summary.created_ts)
+  age = datetime.timedelta(seconds=config.settings().reusable_task_age_secs)
+  try:
+    task_result.TaskDedupEntry(
+        key=key,
+        task_id=candidate[0],
+        created_ts=candidate[1],
+        expire_at=candidate[1] + age).put()
+    memcache.set(key.string_id(),
+                 candidate,
+                 time=int(age.total_seconds()),
+                 namespace=_DEDUP_MEMCACHE_NAMESPACE)
+  except (datastore_errors.Error, apiproxy_errors.Error) as e:
+    logging.warning('Failed to register %s for dedup: %s',
+                    result_summary.task_id, e)
+    return
+  _cache_dupe_candidate(key.string_id(), candidate)
+
+
 def _find_dupe_task(now, h):
   """Finds a previously run task that is also idempotent and completed.
 
-  Fetch items that can be used to dedupe the task. See the comment for this
-  property for more details.
+  Looks up the TaskDedupEntry stored by _register_dupe_task(), first in the
+  in-process cache, then in memcache and finally in datastore. A layer that has
+  a too old candidate is skipped in favor of the next one, since a more recent
+  task may have been registered since then. If there's no TaskDedupEntry and
+  tasks completed before _DEDUP_ENTRY_SINCE can still be reused, falls back to
+  querying TaskResultSummary.properties_hash and registers the result.
 
-  Do not use "task_result.TaskResultSummary.created_ts > oldest" here because
-  this would require an index. It's unnecessary because TaskRequest.key is
-  equivalent to decreasing TaskRequest.created_ts, ordering by key works as
-  well and doesn't require an index.
+  Returns:
+    TaskResultSummary to dedupe against or None.
   """
   logging.info("_find_dupe_task for properties_hash: %s", h.encode('hex'))
-  # TODO(maruel): Make a reverse map on successful task completion so this
-  # becomes a simple ndb.get().
-  cls = task_result.TaskResultSummary
-  q = cls.query(cls.properties_hash==h).order(cls.key)
-  for i, dupe_summary in enumerate(q.iter(batch_size=1)):
-    # It is possible for the query to return stale items.
-    if (dupe_summary.state != task_result.State.COMPLETED or
-        dupe_summary.failure):
-      if i == 2:
-        logging.info("indexes are very inconsistent, give up.")
-        return None
-      continue
+  start = utils.utcnow()
+  # Refuse tasks older than X days. This is due to the isolate server
+  # dropping files.
+  # TODO(maruel): The value should be calculated from the isolate server
+  # setting and be unbounded when no isolated input was used.
+  age = datetime.timedelta(seconds=config.settings().reusable_task_age_secs)
+  oldest = now - age
+  key = task_result.TaskDedupEntry.create_key(h)
+  hex_hash = key.string_id()
+
+  def lookup():
+    candidate = _DEDUP_CACHE.get(hex_hash)
+    if candidate and candidate[1] > oldest:
+      return 'process', candidate
+    candidate = memcache.get(hex_hash, namespace=_DEDUP_MEMCACHE_NAMESPACE)
+    if candidate and candidate[1] > oldest:
+      _cache_dupe_candidate(hex_hash, candidate)
+      return 'memcache', candidate
+    entry = key.get()
+    if not entry:
+      if oldest < _DEDUP_ENTRY_SINCE:
+        return query()
+      return 'none', None
+    candidate = (entry.task_id, entry.created_ts)
+    memcache.set(hex_hash,
+                 candidate,
+                 time=int(age.total_seconds()),
+                 namespace=_DEDUP_MEMCACHE_NAMESPACE)
+    _cache_dupe_candidate(hex_hash, candidate)
+    return 'datastore', candidate
+
+  def query():
+    # Tasks completed before TaskDedupEntry existed don't have one.
+    cls = task_result.TaskResultSummary
+    q = cls.query(cls.properties_hash == h).order(cls.key)
+    for i, dupe_summary in enumerate(q.iter(batch_size=1)):
+      # It is possible for the query to return stale items.
+      if (dupe_summary.state != task_result.State.COMPLETED or
+          dupe_summary.failure):
+        if i == 2:
+          logging.info("indexes are very inconsistent, give up.")
+          break
+        continue
+      # Newer tasks are returned first, no need to look further.
+      if dupe_summary.created_ts <= oldest:
+        break
+      _register_dupe_task(dupe_summary)
+      return 'query', (dupe_summary.task_id, dupe_summary.created_ts)
+    return 'none', None
 
-    # Refuse tasks older than X days. This is due to the isolate server
-    # dropping files.
-    # TODO(maruel): The value should be calculated from the isolate server
-    # setting and be unbounded when no isolated input was used.
-    oldest = now - datetime.timedelta(
-        seconds=config.settings().reusable_task_age_secs)
-    if dupe_summary.created_ts <= oldest:
-      logging.info("found result (%s) is older than threshold (%s)",
-                   dupe_summary.created_ts, oldest)
-      return None
-    logging.info("_find_dupe_task: dupped with %s", dupe_summary.task_id)
+  def done(source, result, dupe_summary=None):
+    ts_mon_metrics.on_dedup_lookup(source, result, utils.utcnow() - start)
     return dupe_summary
-  return None
+
+  source, candidate = lookup()
+  if not candidate:
+    return done(source, 'miss')
+  task_id, created_ts = candidate
+  if created_ts <= oldest:
+    logging.info("found result (%s) is older than threshold (%s)", created_ts,
+                 oldest)
+    return done(source, 'expired')
+
+  dupe_summary = task_pack.unpack_result_summary_key(task_id).get()
+  # The TaskResultSummary may have been deleted since then.
+  if (not dupe_summary or dupe_summary.properties_hash != h or
+      dupe_summary.state != task_result.State.COMPLETED or
+      dupe_summary.failure):
+    logging.warning("_find_dupe_task: %s can't be reused", task_id)
+    _DEDUP_CACHE.pop(hex_hash, None)
+    memcache.delete(hex_hash, namespace=_DEDUP_MEMCACHE_NAMESPACE)
+    return done(source, 'stale')
+  logging.info("_find_dupe_task: dupped with %s", dupe_summary.task_id)
+  return done(source, 'hit', dupe_summary)
 
 
 def _copy_summary(src, dst, skip_list):
@@ -993,7 +1120,8 @@ def _bot_update_tx(run_result_key, bot_id, output, output_chunk_start,
   if cipd_pins:
     run_result.cipd_pins = cipd_pins
 
-  if run_result.state in task_result.State.STATES_RUNNING:
+  was_running = run_result.state in task_result.State.STATES_RUNNING
+  if was_running:
     # Task was still registered as running. Look if it should be terminated now.
     if run_result.killing:
       if canceled:
@@ -1031,9 +1159,29 @@ def _bot_update_tx(run_result_key, bot_id, output, output_chunk_start,
 
   run_result.signal_server_version()
   to_put = [run_result]
-  if output:
+  compact = False
+  if output and _APPEND_ONLY_OUTPUT:
+    # This does no GETs. This also modifies run_result in place.
+    written = run_result.stdout_segments or 0
+    to_put.extend(
+        run_result.append_output_segments(output, output_chunk_start or 0))
+    interval = task_result.TaskOutput.COMPACT_SEGMENTS
+    compact = run_result.stdout_segments / interval > written / interval
+  elif output:
     # This does 1 multi GETs. This also modifies run_result in place.
     to_put.extend(run_result.append_output(output, output_chunk_start or 0))
+  # The output won't change anymore once the task is over, merge what's left.
+  if (was_running and run_result.stdout_segments and
+      run_result.state not in task_result.State.STATES_RUNNING):
+    compact = True
+  if compact:
+    ok = utils.enqueue_task(
+        '/internal/taskqueue/important/tasks/compact-output',
+        'compact-output',
+        transactional=True,
+        payload=utils.encode_to_json({'task_id': run_result.task_id}))
+    if not ok:
+      raise datastore_utils.CommitError('Failed to enqueue output compaction')
   if performance_stats:
     performance_stats.key = task_pack.run_result_key_to_performance_stats_key(
         run_result.key)
@@ -1318,6 +1466,87 @@ def _should_allow_es_fallback(es_cfg, request):
   return task_es_cfg == es_cfg
 
 
+class _CandidatePrefetcher(object):
+  """Prefetches the entities of the claimed candidates of bot_reap_task().
+
+  The TaskRequest and TaskResultSummary of the next candidates are fetched
+  asynchronously while the current one is being reaped. The prefetch depth
+  starts at 0 and grows by one each time a candidate is lost, up to
+  _REAP_PREFETCH_MAX, so an uncontended poll claims a single candidate.
+  """
+
+  def __init__(self, candidates, claims):
+    """
+    Arguments:
+    - candidates: iterable of claimed TaskToRunShard.
+    - claims: dict {TaskToRunShard key: task_to_run.Claim} of the candidates.
+    """
+    self._candidates = iter(candidates)
+    self._claims = claims
+    self._depth = 0
+    # Prefetched (TaskToRunShard, TaskRequest future, TaskResultSummary future).
+    self._window = collections.deque()
+    self._exhausted = False
+
+  def next(self):
+    """Returns the next (TaskToRunShard, TaskRequest future, TaskResultSummary
+    future), or None when there is no more candidate.
+    """
+    self._fill(1)
+    if not self._window:
+      return None
+    item = self._window.popleft()
+    self._fill(self._depth)
+    return item
+
+  def lost(self, to_run_key):
+    """Gives up on a candidate so another bot can claim it right away."""
+    self._depth = min(self._depth + 1, _REAP_PREFETCH_MAX)
+    self.release(to_run_key)
+
+  def release(self, to_run_key):
+    claim = self._claims.pop(to_run_key, None)
+    if claim:
+      claim.release()
+
+  def close(self):
+    """Releases the claims of the candidates prefetched but not processed."""
+    while self._window:
+      self.release(self._window.popleft()[0].key)
+
+  def _fill(self, depth):
+    while not self._exhausted and len(self._window) < depth:
+      to_run = next(self._candidates, None)
+      if not to_run:
+        self._exhausted = True
+        return
+      request_key = task_to_run.task_to_run_key_to_request_key(to_run.key)
+      summary_key = task_pack.request_key_to_result_summary_key(request_key)
+      self._window.append((
+          to_run,
+          request_key.get_async(),
+          summary_key.get_async(use_cache=False, use_memcache=False),
+      ))
+
+
+def _is_candidate_lost(bot_id, to_run, result_summary):
+  """Returns True if a TaskToRunShard can't be reaped, based on its
+  TaskResultSummary fetched outside a transaction.
+
+  This is a cheap pre-check; _reap_task() checks again transactionally.
+  """
+  if not result_summary:
+    return True
+  if result_summary.state != task_result.State.PENDING:
+    # Another bot won it, or it was canceled or expired.
+    return True
+  if result_summary.current_task_slice != to_run.task_slice_index:
+    # The index is stale, the task moved to another slice.
+    return True
+  # See the matching check in _reap_task().
+  return result_summary.bot_id == bot_id
+
+
 ### Public API.
 
 
@@ -1657,17 +1886,31 @@ def bot_reap_task(bot_dimensions, queues, bot_details, deadline):
   expired = 0
   failures = 0
   stale_index = 0
+  lost = 0
+  claims = {}
+  q = task_to_run.yield_next_available_task_to_dispatch(
+      bot_id, pool, queues, match_bot_dimensions, scan_deadline, claims)
+  prefetcher = _CandidatePrefetcher(q, claims)
   try:
-    q = task_to_run.yield_next_available_task_to_dispatch(
-        bot_id, pool, queues, match_bot_dimensions, scan_deadline)
-    for to_run in q:
+    while True:
+      candidate = prefetcher.next()
+      if not candidate:
+        break
+      to_run, request_future, summary_future = candidate
       iterated += 1
-      request = task_to_run.task_to_run_key_to_request_key(to_run.key).get()
+      request = request_future.get_result()
 
       # When falling back from external scheduler, ignore other es-owned tasks.
       if es_cfg and not _should_allow_es_fallback(es_cfg, request):
         logging.debug('Skipped es-owned request %s during es fallback',
                       request.task_id)
+        prefetcher.lost(to_run.key)
+        continue
+
+      if _is_candidate_lost(bot_id, to_run, summary_future.get_result()):
+        logging.debug('Skipped lost candidate %s', request.task_id)
+        lost += 1
+        prefetcher.lost(to_run.key)
         continue
 
       now = utils.utcnow()
@@ -1730,14 +1973,17 @@ def bot_reap_task(bot_dimensions, queues, bot_details, deadline):
 
         # Try to claim it for ourselves right away. On failure, give it up for
         # some other bot to claim.
-        if not task_to_run.Claim.obtain(new_to_run.key):
+        claim = task_to_run.Claim.obtain(new_to_run.key)
+        if not claim:
           continue
+        claims[new_to_run.key] = claim
         to_run = new_to_run
 
       run_result, secret_bytes = _reap_task(bot_dimensions, bot_details,
                                             to_run.key, request)
       if not run_result:
         failures += 1
+        prefetcher.lost(to_run.key)
         # Sad thing is that there is not way here to know the try number.
         logging.info(
             'failed to reap: %s0',
@@ -1756,10 +2002,11 @@ def bot_reap_task(bot_dimensions, queues, bot_details, deadline):
       return request, secret_bytes, run_result
     return None, None, None
   finally:
+    prefetcher.close()
     logging.debug(
         'bot_reap_task(%s) in %.3fs: %d iterated, %d reenqueued, %d expired, '
-        '%d stale_index, %d failed', bot_id,
-        time.time() - start, iterated, reenqueued, expired, stale_index,
+        '%d stale_index, %d lost, %d failed', bot_id,
+        time.time() - start, iterated, reenqueued, expired, stale_index, lost,
         failures)
 
 
@@ -1918,6 +2165,9 @@ def bot_update_task(run_result_key, bot_id, output, output_chunk_start,
     logging.error('Task %s %s', packed, error)
     return None
 
+  if smry.properties_hash:
+    _register_dupe_task(smry)
+
   update_pubsub_success = _maybe_pubsub_notify_now(smry, request)
 
   # Caller must retry if PubSub enqueue fails.
@@ -2185,6 +2435,34 @@ def expire_slice(to_run_key, terminal_state, reason):
 ### Cron job.
 
 
+def _expire_batch_size():
+  """Returns the number of TaskToRunShard to send per task_expire_tasks()."""
+  rate = memcache.get('rate', namespace=_EXPIRE_MEMCACHE_NAMESPACE)
+  if not rate:
+    return _EXPIRE_BATCH_SIZE
+  return max(_EXPIRE_BATCH_MIN,
+             min(_EXPIRE_BATCH_MAX, int(rate * _EXPIRE_TARGET_SECS)))
+
+
+def _record_expire_throughput(count, duration):
+  """Updates the moving average of task_expire_tasks() throughput.
+
+  Best effort, concurrent updates may be lost.
+
+  Arguments:
+    count: number of TaskToRunShard processed.
+    duration: datetime.timedelta it took.
+  """
+  secs = duration.total_seconds()
+  if not count or secs <= 0:
+    return
+  rate = count / secs
+  prev = memcache.get('rate', namespace=_EXPIRE_MEMCACHE_NAMESPACE)
+  if prev:
+    rate = 0.8 * prev + 0.2 * rate
+  memcache.set('rate', rate, namespace=_EXPIRE_MEMCACHE_NAMESPACE)
+
+
 def cron_abort_expired_task_to_run():
   """Aborts expired TaskToRunShard requests to execute a TaskRequest on a bot.
 
@@ -2199,17 +2477,21 @@ def cron_abort_expired_task_to_run():
   - Server has internal failures causing it to fail to either distribute the
     tasks or properly receive results from the bots.
 
-  This cron job just emits Task Queue tasks handled by task_expire_tasks(...).
+  All TaskToRunShard kinds are scanned concurrently, each resuming from its own
+  checkpoint. This cron job just emits Task Queue tasks handled by
+  task_expire_tasks(...).
   """
   enqueued = []
+  batch_size = _expire_batch_size()
 
-  def _enqueue_task(to_runs):
+  @ndb.tasklet
+  def _enqueue_task_async(to_runs):
     payload = {
         'entities': [(ttr.task_id, ttr.shard_index, ttr.key.integer_id())
                      for ttr in to_runs],
     }
     logging.debug('Expire tasks: %s', payload['entities'])
-    ok = utils.enqueue_task(
+    ok = yield utils.enqueue_task_async(
         '/internal/taskqueue/important/tasks/expire',
         'task-expire',
         payload=utils.encode_to_json(payload))
@@ -2217,112 +2499,75 @@ def cron_abort_expired_task_to_run():
       logging.warning('Failed to enqueue task for %d tasks', len(to_runs))
     else:
       enqueued.append(len(to_runs))
+    raise ndb.Return(ok)
+
+  @ndb.tasklet
+  def _page_cb(to_runs):
+    oks = yield [
+        _enqueue_task_async(to_runs[i:i + batch_size])
+        for i in range(0, len(to_runs), batch_size)
+    ]
+    raise ndb.Return(all(oks))
 
   delay_sec = 0.0
   if pools_config.all_pools_migrated_to_rbe():
     logging.info('Delaying the expiration check to expire through RBE instead')
     delay_sec = 60.0
 
-  task_to_runs = []
+  futures = [
+      task_to_run.scan_expired_task_to_run_async(shard, delay_sec, _page_cb)
+      for shard in range(task_to_run.N_SHARDS)
+  ]
   try:
-    for to_run in task_to_run.yield_expired_task_to_run(delay_sec):
-      task_to_runs.append(to_run)
-      # Enqueue every 50 TaskToRunShards.
-      if len(task_to_runs) == 50:
-        _enqueue_task(task_to_runs)
-        task_to_runs = []
-    # Enqueue remaining TaskToRunShards.
-    if task_to_runs:
-      _enqueue_task(task_to_runs)
+    for shard, f in enumerate(futures):
+      _, lag = f.get_result()
+      ts_mon_metrics.on_expiration_scan(shard, lag)
   finally:
-    logging.debug('Enqueued %d task for %d tasks', len(enqueued), sum(enqueued))
+    logging.debug('Enqueued %d task for %d tasks (batch size %d)',
+                  len(enqueued), sum(enqueued), batch_size)
 
 
 def cron_handle_bot_died():
   """Aborts TaskRunResult where the bot stopped sending updates.
 
-  The task will be canceled.
+  Only looks at runs whose ping deadline bucket has passed, see
+  TaskRunResult.dead_after_bucket, and at older runs that don't have the bucket
+  yet until task_result._DEAD_AFTER_FALLBACK_UNTIL. This cron job just emits
+  Task Queue tasks handled by task_handle_dead_tasks(...).
 
   Returns:
-  - task IDs killed
-  - number of task ignored
+    Number of TaskRunResult enqueued for a check.
   """
-  count = {'total': 0, 'ignored': 0, 'killed': 0}
-  killed = []
-  futures = []
-
-  def _handle_future(f):
-    key, state_changed, latency, tags = None, False, None, None
-    try:
-      key, state_changed, latency, tags = f.get_result()
-    except datastore_utils.CommitError as e:
-      logging.error('Failed to updated dead task. error=%s', e)
+  enqueued = []
 
-    if key:
-      killed.append(task_pack.pack_run_result_key(key))
-      count['killed'] += 1
+  def _enqueue_task(run_result_ids):
+    ok = utils.enqueue_task(
+        '/internal/taskqueue/important/tasks/dead',
+        'task-dead',
+        payload=utils.encode_to_json({'run_result_ids': run_result_ids}))
+    if not ok:
+      logging.warning('Failed to enqueue task for %d tasks',
+                      len(run_result_ids))
     else:
-      count['ignored'] += 1
-    checked = count['killed'] + count['ignored']
-    if checked % 500 == 0:
-      logging.info('Checked %d tasks', checked)
-    if state_changed:
-      ts_mon_metrics.on_dead_task_detection_latency(tags, latency, True)
-
-  def _wait_futures(futs, cap):
-    while len(futs) > cap:
-      ndb.Future.wait_any(futs)
-      _futs = []
-      for f in futs:
-        if f.done():
-          _handle_future(f)
-        else:
-          _futs.append(f)
-      futs = _futs
-    return futs
+      enqueued.append(len(run_result_ids))
 
   start = utils.utcnow()
-  # Timeout at 9.5 mins, we want to gracefully terminate prior to App Engine
-  # handler expiry. This will reduce the deadline exceeded 500 errors arising
-  # from the endpoint.
-  time_to_stop = start + datetime.timedelta(seconds=int(9.5 * 60))
+  run_result_ids = []
   try:
-    cursor = None
-    q = task_result.TaskRunResult.query(
-        task_result.TaskRunResult.completed_ts == None)
-    while utils.utcnow() <= time_to_stop:
-      keys, cursor, more = q.fetch_page(500,
-                                        keys_only=True,
-                                        start_cursor=cursor)
-      if not keys:
-        break
-      count['total'] += len(keys)
-      logging.info('Fetched %d keys', count['total'])
-      for run_result_key in keys:
-        f = _detect_dead_task_async(run_result_key)
-        if f:
-          futures.append(f)
-        else:
-          count['ignored'] += 1
-        # Limit the number of futures.
-        futures = _wait_futures(futures, 5)
-      # wait the remaining ones.
-      _wait_futures(futures, 0)
-      if not more:
-        break
+    keys = itertools.chain(
+        task_result.yield_run_result_keys_past_dead_after(start),
+        task_result.yield_run_result_keys_without_dead_after(start))
+    for run_result_key in keys:
+      run_result_ids.append(task_pack.pack_run_result_key(run_result_key))
+      if len(run_result_ids) == 100:
+        _enqueue_task(run_result_ids)
+        run_result_ids = []
+    if run_result_ids:
+      _enqueue_task(run_result_ids)
   finally:
-    now = utils.utcnow()
-    logging.info('cron_handle_bot_died time elapsed: %ss',
-                 (now - start).total_seconds())
-    if now > time_to_stop:
-      logging.warning('Terminating cron_handle_bot_died early')
-    if killed:
-      logging.warning('BOT_DIED!\n%d tasks:\n%s', count['killed'],
-                      '\n'.join('  %s' % i for i in killed))
-    logging.info('total %d, killed %d, ignored: %d', count['total'],
-                 count['killed'], count['ignored'])
-  # These are returned primarily for unit testing verification.
-  return killed, count['ignored']
+    logging.info('Enqueued %d tasks for %d runs in %ss', len(enqueued),
+                 sum(enqueued), (utils.utcnow() - start).total_seconds())
+  return sum(enqueued)
 
 
 def cron_handle_external_cancellations():
@@ -2398,12 +2643,21 @@ def task_handle_pubsub_task(payload):
 def task_expire_tasks(task_to_runs):
   """Expires TaskToRunShardXXX enqueued by cron_abort_expired_task_to_run.
 
+  The expiration scan doesn't look at entities it handed over again, so if some
+  of them failed to expire, raises CommitError at the end to have the task queue
+  retry the whole list. Entities that expired already are skipped on retry.
+
   Arguments:
     task_to_runs: a list of (<task ID>, <TaskToRunShard index>, <entity ID>).
+
+  Raises:
+    datastore_utils.CommitError if some transactions failed.
   """
   expired = []
   reenqueued = 0
   skipped = 0
+  failed = []
+  start = utils.utcnow()
 
   try:
     for task_id, shard_index, entity_id in task_to_runs:
@@ -2420,15 +2674,20 @@ def task_expire_tasks(task_to_runs):
 
       # Expire the slice and schedule the next one (if any). Obtain a claim
       # to make sure bot_reap_task doesn't try to pick it up.
-      summary, new_to_run = _expire_slice(
-          request,
-          to_run_key,
-          task_result.State.EXPIRED,
-          claim=True,
-          txn_retries=4,
-          txn_catch_errors=True,
-          reason='task_expire_tasks',
-      )
+      try:
+        summary, new_to_run = _expire_slice(
+            request,
+            to_run_key,
+            task_result.State.EXPIRED,
+            claim=True,
+            txn_retries=4,
+            txn_catch_errors=False,
+            reason='task_expire_tasks',
+        )
+      except datastore_utils.CommitError as exc:
+        logging.warning('Failed to expire %s: %s', task_id, exc)
+        failed.append(task_id)
+        continue
       if new_to_run:
         # The next slice was enqueued.
         reenqueued += 1
@@ -2438,16 +2697,78 @@ def task_expire_tasks(task_to_runs):
         expired.append(
             (task_id, request.task_slice(slice_index).properties.dimensions))
       else:
-        # The task was not updated => the slice already expired or the
-        # transaction failed.
+        # The task was not updated => the slice already expired.
         skipped += 1
   finally:
     if expired:
       logging.info(
           'EXPIRED!\n%d tasks:\n%s', len(expired),
           '\n'.join('  %s  %s' % (task_id, dims) for task_id, dims in expired))
-    logging.info('Reenqueued %d tasks, expired %d, skipped %d', reenqueued,
-                 len(expired), skipped)
+    logging.info('Reenqueued %d tasks, expired %d, skipped %d, failed %d',
+                 reenqueued, len(expired), skipped, len(failed))
+  _record_expire_throughput(len(task_to_runs), utils.utcnow() - start)
+  if failed:
+    raise datastore_utils.CommitError(
+        'Failed to expire %d tasks: %s' % (len(failed), ', '.join(failed)))
+
+
+def task_handle_dead_tasks(run_result_ids):
+  """Aborts TaskRunResult enqueued by cron_handle_bot_died.
+
+  Arguments:
+    run_result_ids: a list of packed TaskRunResult IDs.
+
+  Returns:
+  - task IDs killed
+  - number of task ignored
+  """
+  count = {'ignored': 0}
+  killed = []
+  futures = []
+
+  def _handle_future(f):
+    key, state_changed, latency, tags = None, False, None, None
+    try:
+      key, state_changed, latency, tags = f.get_result()
+    except datastore_utils.CommitError as e:
+      logging.error('Failed to updated dead task. error=%s', e)
+
+    if key:
+      killed.append(task_pack.pack_run_result_key(key))
+    else:
+      count['ignored'] += 1
+    if state_changed:
+      ts_mon_metrics.on_dead_task_detection_latency(tags, latency, True)
+
+  try:
+    for run_result_id in run_result_ids:
+      f = _detect_dead_task_async(
+          task_pack.unpack_run_result_key(run_result_id))
+      if f:
+        futures.append(f)
+      else:
+        count['ignored'] += 1
+      # Limit the number of futures.
+      while len(futures) >= _DEAD_TASK_CONCURRENCY:
+        ndb.Future.wait_any(futures)
+        for done in [x for x in futures if x.done()]:
+          futures.remove(done)
+          _handle_future(done)
+    for f in futures:
+      _handle_future(f)
+  finally:
+    if killed:
+      logging.warning('BOT_DIED!\n%d tasks:\n%s', len(killed),
+                      '\n'.join('  %s' % i for i in killed))
+    logging.info('total %d, killed %d, ignored: %d', len(run_result_ids),
+                 len(killed), count['ignored'])
+  # These are returned primarily for unit testing verification.
+  return killed, count['ignored']
+
+
+def task_compact_output(run_result_id):
+  """Merges not yet compacted output of a task into TaskOutputChunk entities."""
+  task_result.compact_output(task_pack.unpack_run_result_key(run_result_id))
 
 
 def task_cancel_running_children_tasks(parent_result_summary_id):
@@ -10,6 +10,7 @@ import logging
 import os
 import random
 import sys
+import time
 import unittest
 import uuid
 
@@ -209,6 +210,8 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self._enqueue_async_orig = self.mock(utils, 'enqueue_task_async',
                                          self._enqueue_async)
     self.mock(task_scheduler, '_route_to_go', lambda **_kwargs: False)
+    self.mock(task_scheduler, '_DEDUP_CACHE', {})
+    self.mock(task_to_run, '_CLAIM_CACHE', {})
 
     # See mock_pub_sub()
     self._pub_sub_mocked = False
@@ -472,6 +475,28 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(queued_tasks, self.execute_tasks())
     return run_result
 
+  def _cron_handle_bot_died(self):
+    """Runs the cron job and the 'task-dead' TQ tasks it enqueued.
+
+    Returns what task_handle_dead_tasks(...) returned, merged over TQ tasks.
+    """
+    enqueued = task_scheduler.cron_handle_bot_died()
+    tasks = self._taskqueue_stub.GetTasks('task-dead')
+    self.assertEqual(
+        enqueued,
+        sum(
+            len(_decode_tq_task_body(t['body'])['run_result_ids'])
+            for t in tasks))
+    killed = []
+    ignored = 0
+    for t in tasks:
+      k, i = task_scheduler.task_handle_dead_tasks(
+          _decode_tq_task_body(t['body'])['run_result_ids'])
+      killed.extend(k)
+      ignored += i
+      self._taskqueue_stub.DeleteTask('task-dead', t['name'])
+    return killed, ignored
+
   def _cancel_running_task(self, run_result):
     """Cancels running task"""
     canceled, was_running = task_scheduler.cancel_task(run_result.request,
@@ -503,6 +528,64 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertIsNone(to_run_key.get().queue_number)
     self.assertIsNone(to_run_key.get().expiration_ts)
 
+  def _mark_won_by_other_bot(self, result_summary):
+    """Makes a pending task look reaped by another bot while its
+    TaskToRunShard is still in the index, like under contention.
+    """
+    result_summary = result_summary.key.get()
+    result_summary.state = State.RUNNING
+    result_summary.bot_id = u'other'
+    result_summary.put()
+
+  def test_bot_reap_task_lost_candidates(self):
+    self._register_bot(self.bot_dimensions)
+    summaries = []
+    for i in range(3):
+      self.mock_now(self.now, i)
+      summaries.append(self._quick_schedule())
+    self._mark_won_by_other_bot(summaries[0])
+    self._mark_won_by_other_bot(summaries[1])
+
+    request, _, run_result = self._bot_reap_task()
+    self.assertEqual(summaries[2].request_key, request.key)
+    self.assertEqual('localhost', run_result.bot_id)
+    for summary in summaries[:2]:
+      to_run_key = task_to_run.request_to_task_to_run_key(
+          summary.request_key.get(), 0)
+      # Not touched, and released early for other bots.
+      self.assertTrue(to_run_key.get().is_reapable)
+      self.assertFalse(task_to_run.Claim.check(to_run_key))
+      self.assertEqual(u'other', summary.key.get().bot_id)
+
+  def test_bot_reap_task_contention(self):
+    # 3 out of 4 candidates were already won by other bots. Logs the P50/P99
+    # of bot_reap_task() latency.
+    self._register_bot(self.bot_dimensions)
+    summaries = []
+    for i in range(20):
+      self.mock_now(self.now, i)
+      summaries.append(self._quick_schedule())
+    for i, summary in enumerate(summaries):
+      if i % 4:
+        self._mark_won_by_other_bot(summary)
+
+    reaped = []
+    latencies = []
+    while True:
+      start = time.time()
+      request, _, _ = self._bot_reap_task()
+      latencies.append(time.time() - start)
+      if not request:
+        break
+      reaped.append(request.key)
+    self.assertEqual([s.request_key for s in summaries[::4]], reaped)
+    latencies.sort()
+    logging.info(
+        'bot_reap_task() under contention: P50 %.1fms, P99 %.1fms',
+        latencies[len(latencies) // 2] * 1000.,
+        latencies[int(len(latencies) * 0.99)] * 1000.)
+    self.execute_tasks()
+
   def test_bot_reap_build_task(self):
     pub_sub_calls = self.mock_pub_sub()
     run_result = self._quick_reap(
@@ -1630,6 +1713,93 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
             fields=_update_fields_schedule(
                 status=State.to_string(State.COMPLETED))).sum)
 
+  def test_task_idempotent_dedup_entry(self):
+    task_id = self._task_ran_successfully()
+    summary = task_pack.unpack_result_summary_key(task_id).get()
+    entry = task_result.TaskDedupEntry.create_key(
+        summary.properties_hash).get()
+    self.assertEqual(task_id, entry.task_id)
+    self.assertEqual(summary.created_ts, entry.created_ts)
+    self.assertEqual(
+        summary.created_ts +
+        datetime.timedelta(seconds=config.settings().reusable_task_age_secs),
+        entry.expire_at)
+
+    # Found via datastore in another process.
+    task_scheduler._DEDUP_CACHE.clear()
+    self.mock(task_scheduler.memcache, 'get', lambda *_args, **_kwargs: None)
+    self.assertEqual(task_id,
+                     task_scheduler._find_dupe_task(
+                         utils.utcnow(), summary.properties_hash).task_id)
+    self.assertEqual(
+        1,
+        ts_mon_metrics._dedup_lookups.get(fields={
+            'source': 'datastore',
+            'result': 'hit',
+        }))
+    # Then in the in-process cache.
+    self.assertEqual(task_id,
+                     task_scheduler._find_dupe_task(
+                         utils.utcnow(), summary.properties_hash).task_id)
+    self.assertEqual(
+        1,
+        ts_mon_metrics._dedup_lookups.get(fields={
+            'source': 'process',
+            'result': 'hit',
+        }))
+
+  def test_task_idempotent_dedup_entry_missing(self):
+    # Tasks completed before TaskDedupEntry existed are found via a query.
+    task_id = self._task_ran_successfully()
+    properties_hash = task_pack.unpack_result_summary_key(
+        task_id).get().properties_hash
+    entry_key = task_result.TaskDedupEntry.create_key(properties_hash)
+    entry_key.delete()
+    task_scheduler._DEDUP_CACHE.clear()
+    self.mock(task_scheduler.memcache, 'get', lambda *_args, **_kwargs: None)
+
+    self.assertEqual(
+        task_id,
+        task_scheduler._find_dupe_task(utils.utcnow(), properties_hash).task_id)
+    self.assertEqual(
+        1,
+        ts_mon_metrics._dedup_lookups.get(fields={
+            'source': 'query',
+            'result': 'hit',
+        }))
+    # It is registered for the next time.
+    self.assertEqual(task_id, entry_key.get().task_id)
+
+    # Once tasks completed before TaskDedupEntry existed can't be reused, there
+    # is no query anymore.
+    entry_key.delete()
+    task_scheduler._DEDUP_CACHE.clear()
+    self.mock(task_scheduler, '_DEDUP_ENTRY_SINCE', utils.EPOCH)
+    fields = {'source': 'none', 'result': 'miss'}
+    misses = ts_mon_metrics._dedup_lookups.get(fields=fields) or 0
+    self.assertIsNone(
+        task_scheduler._find_dupe_task(utils.utcnow(), properties_hash))
+    self.assertEqual(misses + 1,
+                     ts_mon_metrics._dedup_lookups.get(fields=fields))
+    self.assertIsNone(entry_key.get())
+
+  def test_task_idempotent_dedup_entry_stale(self):
+    task_id = self._task_ran_successfully()
+    # The TaskResultSummary is gone, e.g. it was cleaned up.
+    summary_key = task_pack.unpack_result_summary_key(task_id)
+    properties_hash = summary_key.get().properties_hash
+    summary_key.delete()
+
+    self.assertIsNone(
+        task_scheduler._find_dupe_task(utils.utcnow(), properties_hash))
+    self.assertEqual(
+        1,
+        ts_mon_metrics._dedup_lookups.get(fields={
+            'source': 'process',
+            'result': 'stale',
+        }))
+    self.assertEqual({}, task_scheduler._DEDUP_CACHE)
+
   def test_task_invalid_parent(self):
     parent_id = self._task_ran_successfully()
     self.assertTrue(parent_id.endswith('1'))
@@ -1872,6 +2042,48 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertEqual('hihey', run_result.key.get().get_output(0, 0))
     self.assertEqual(1, self.execute_tasks())
 
+  def test_task_compact_output(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    self.mock(task_result.TaskOutput, 'COMPACT_SEGMENTS', 2)
+    run_result = self._quick_reap()
+    self.execute_tasks()
+    self.assertEqual(
+        State.RUNNING,
+        _bot_update_task(
+            run_result_key=run_result.key, output='hi', output_chunk_start=0))
+    self.assertEqual(0, self.execute_tasks())
+    # Crosses COMPACT_SEGMENTS.
+    self.assertEqual(
+        State.RUNNING,
+        _bot_update_task(
+            run_result_key=run_result.key, output='hey', output_chunk_start=2))
+    self.assertEqual(3, task_result.TaskOutputSegment.query().count())
+    self.assertEqual('hihey', run_result.key.get().get_output(0, 0))
+
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual(0, task_result.TaskOutputSegment.query().count())
+    self.assertEqual(3, task_result.TaskOutputChunk.query().count())
+    self.assertEqual('hihey', run_result.key.get().get_output(0, 0))
+
+  def test_task_compact_output_completed(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    run_result = self._quick_reap()
+    self.execute_tasks()
+    self.assertEqual(
+        State.RUNNING,
+        _bot_update_task(
+            run_result_key=run_result.key, output='hi', output_chunk_start=0))
+    self.assertEqual(0, self.execute_tasks())
+    # The remaining segments are merged when the task completes.
+    self.assertEqual(
+        State.COMPLETED,
+        _bot_update_task(
+            run_result_key=run_result.key, exit_code=0, duration=0.1))
+    self.assertEqual(1, task_result.TaskOutputSegment.query().count())
+    self.assertLessEqual(1, self.execute_tasks())
+    self.assertEqual(0, task_result.TaskOutputSegment.query().count())
+    self.assertEqual('hi', run_result.key.get().get_output(0, 0))
+
   def test_bot_update_task_new_overwrite(self):
     self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
     run_result = self._quick_reap()
@@ -3091,6 +3303,18 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
             fields=_update_fields_pubsub(status=status,
                                          http_status_code=200)).sum)
 
+  def test_expire_batch_size(self):
+    self.assertEqual(50, task_scheduler._expire_batch_size())
+    # 2 tasks/s, a call should handle 60 of them to take 30s.
+    task_scheduler._record_expire_throughput(20, datetime.timedelta(seconds=10))
+    self.assertEqual(60, task_scheduler._expire_batch_size())
+    # Nothing measured.
+    task_scheduler._record_expire_throughput(20, datetime.timedelta())
+    self.assertEqual(60, task_scheduler._expire_batch_size())
+    # Moving average of 21.6 tasks/s, capped.
+    task_scheduler._record_expire_throughput(100, datetime.timedelta(seconds=1))
+    self.assertEqual(500, task_scheduler._expire_batch_size())
+
   def test_cron_abort_expired_fallback(self):
     # 1 and 4 have capacity.
     self.bot_dimensions[u'item'] = [u'1', u'4']
@@ -3243,7 +3467,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         1)
     self.assertEqual(([run_result.task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
     self.assertEqual(1, self.execute_tasks())
     self.assertEqual(2, len(pub_sub_calls))  # RUNNING -> COMPLETED
     self.assertEqual(False, is_claimed(key))
@@ -3283,6 +3507,20 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
 
     self.assertEqual(0, self.execute_tasks())
 
+  def test_cron_handle_bot_died_without_dead_after_bucket(self):
+    # Runs stored before TaskRunResult.dead_after_bucket existed are still
+    # found.
+    self.mock(task_result, '_dead_after_bucket', lambda _: None)
+    run_result = self._quick_reap()
+    self.assertIsNone(run_result.key.get().dead_after_bucket)
+    request = run_result.request_key.get()
+
+    self.mock_now(
+        self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
+        1)
+    self.assertEqual(([run_result.task_id], 0), self._cron_handle_bot_died())
+    self.assertEqual(State.BOT_DIED, run_result.key.get().state)
+
   def test_cron_handle_bot_died_backend_task(self):
     # This test is similar to test_cron_handle_bot_died, but asserts
     # that the normal swarming notification behavior works in parallel with
@@ -3318,7 +3556,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         1)
     self.assertEqual(([run_result.task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
     #2 because pubsub_nofity + bb update TQ tasks were executed
     self.assertEqual(2, self.execute_tasks())
     self.assertEqual(4, len(pub_sub_calls))  # RUNNING -> COMPLETED
@@ -3387,7 +3625,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         1)
     self.assertEqual(([run_result.task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
     self.assertEqual(1, self.execute_tasks())
     self.assertEqual(2, len(pub_sub_calls))  # RUNNING -> COMPLETED
     status = State.to_string(State.BOT_DIED)
@@ -3446,7 +3684,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     # Very unusual, the TaskRequest disappeared:
     run_result.request_key.delete()
 
-    self.assertEqual(([], 1), task_scheduler.cron_handle_bot_died())
+    self.assertEqual(([], 1), self._cron_handle_bot_died())
 
   def test_bot_poll_http_500_but_bot_reapears_after_BOT_PING_TOLERANCE(self):
     # A bot reaped a task, sleeps for over BOT_PING_TOLERANCE (2 minutes), then
@@ -3472,7 +3710,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         1)
     self.assertEqual(([to_run_key_1.get().task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
 
     # Now the task is available. Bot magically wakes up (let's say a laptop that
     # went to sleep). The update is denied.
@@ -3509,7 +3747,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         1)
     self.assertEqual(([run_result.task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
     # Refresh and compare:
     # The interesting point here is that even though the task is PENDING, it has
     # worker information from the initial BOT_DIED task.
@@ -3564,7 +3802,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         601)
     self.assertEqual((['1d69b9f088008911'], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
 
   def test_cron_handle_bot_died_killing(self):
     # Test first retry, then success.
@@ -3585,7 +3823,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
         self.now + datetime.timedelta(seconds=request.bot_ping_tolerance_secs),
         601)
     self.assertEqual(([run_result.task_id], 0),
-                     task_scheduler.cron_handle_bot_died())
+                     self._cron_handle_bot_died())
     # state should be KILLED
     run_result = run_result.key.get()
     self.assertEqual(
@@ -3598,6 +3836,27 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
             'cron': True,
         }).sum)
 
+  def test_cron_handle_bot_died_pinged(self):
+    run_result = self._quick_reap(
+        task_slices=[
+            task_request.TaskSlice(
+                expiration_secs=1200,
+                properties=_gen_properties(),
+                wait_for_capacity=False),
+        ])
+    request = run_result.request_key.get()
+    tolerance = datetime.timedelta(seconds=request.bot_ping_tolerance_secs)
+
+    # The deadline didn't pass, the run isn't even looked at.
+    self.assertEqual(0, task_scheduler.cron_handle_bot_died())
+
+    # The bot pings before the deadline, pushing it further.
+    self.mock_now(self.now + tolerance, -1)
+    self.assertEqual(State.RUNNING, _bot_update_task(run_result.key))
+    self.mock_now(self.now + tolerance, 1)
+    self.assertEqual(0, task_scheduler.cron_handle_bot_died())
+    self.assertEqual(State.RUNNING, run_result.key.get().state)
+
   def test_cron_handle_external_cancellations(self):
     es_address = 'externalscheduler_address'
     es_id = 'es_id'
@@ -3797,6 +4056,31 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     # Tested indirectly via test_cron_abort_expired_*
     pass
 
+  def test_task_expire_tasks_commit_error(self):
+    self._register_bot(self.bot_dimensions)
+    result_summary = self._quick_schedule()
+    ttr = task_to_run.get_task_to_runs(result_summary.request, 0)[0]
+    to_runs = [(ttr.task_id, ttr.shard_index, ttr.key.integer_id())]
+    self.mock_now(self.now, 60 * 60 * 25)
+
+    def _expire_slice_tx(*_args):
+      raise datastore_utils.CommitError('Oops')
+
+    # The failure is raised, to be retried by the task queue.
+    orig = self.mock(task_scheduler, '_expire_slice_tx', _expire_slice_tx)
+    with self.assertRaises(datastore_utils.CommitError):
+      task_scheduler.task_expire_tasks(to_runs)
+    self.assertEqual(State.PENDING, result_summary.key.get().state)
+
+    # The retry expires it.
+    self.mock(task_scheduler, '_expire_slice_tx', orig)
+    task_scheduler.task_expire_tasks(to_runs)
+    self.assertEqual(State.EXPIRED, result_summary.key.get().state)
+
+  def test_task_handle_dead_tasks(self):
+    # Tested indirectly via test_cron_handle_bot_died_*
+    pass
+
   def test_task_expire_with_invalid_slice_index(self):
     self.mock_pub_sub()
     self._setup_es(False)
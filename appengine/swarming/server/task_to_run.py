@@ -29,8 +29,10 @@ Graph of the schema:
     +--------------+     +--------------+
 """
 
+import collections
 import datetime
-import heapq
+import hashlib
+import itertools
 import logging
 import random
 import time
@@ -44,11 +46,11 @@ from components import datastore_utils
 from components import utils
 
 from proto.config import pools_pb2
+from server import dimensions_bitmap
 from server import rbe
 from server import task_pack
 from server import task_queues
 from server import task_request
-from server.constants import OR_DIM_SEP
 import ts_mon_metrics
 
 
@@ -271,6 +273,25 @@ def get_shard_kind(shard):
   return _TaskToRunShards[shard]
 
 
+class ExpirationScanCheckpoint(ndb.Model):
+  """Remembers how far the expiration scan of a TaskToRunShard kind got.
+
+  Root entity. Key ID is the TaskToRunShard kind name.
+
+  Updated by scan_expired_task_to_run_async(...) once all expired entities it
+  found were handed over, so the next scan doesn't revisit the whole backsearch
+  window.
+  """
+  _use_cache = False
+  _use_memcache = False
+
+  # All TaskToRunShard with expiration_ts before this time were already seen.
+  scanned_until = ndb.DateTimeProperty(indexed=False)
+  # Number of scans since the last one that looked at the whole backsearch
+  # window.
+  scans_since_full = ndb.IntegerProperty(indexed=False, default=0)
+
+
 ### Private functions.
 
 
@@ -350,6 +371,68 @@ def _queue_number_priority(v):
   return int(_queue_number_order_priority(v) >> 22)
 
 
+# _QueueCursor starts fetching the next page when it has fewer buffered items.
+_PREFETCH_THRESHOLD = 100
+
+# How far back the expiration scan looks when there's no checkpoint. In practice
+# expiration_ts should not be more than 1 minute old (as the cron job runs every
+# minute) but keep it high in case there's an outage.
+_EXPIRATION_BACKSEARCH = datetime.timedelta(hours=24)
+
+# How far before the checkpoint the expiration scan starts, to cover entities
+# that were not visible to the previous scan yet.
+_EXPIRATION_CHECKPOINT_SLACK = datetime.timedelta(minutes=5)
+
+# How often the expiration scan ignores the checkpoint and looks at the whole
+# backsearch window, in number of scans. It finds entities stored with an
+# expiration_ts already before the checkpoint, e.g. a slice enabled by
+# task_scheduler._ensure_active_slice() long after it was created.
+_EXPIRATION_FULL_SCAN_EVERY = 60
+
+# Fraction of the time left until the scan deadline that _yield_potential_tasks
+# may spend waiting for lagging queues to be able to merge them in order.
+_WAIT_BUDGET_FRACTION = 0.1
+
+# The minimum wait budget in seconds, unless the deadline is even closer.
+_MIN_WAIT_BUDGET = 1.0
+
+
+# In-process cache {memcache claim key => expiry as utils.time_time()} of
+# TaskToRunShard claims recently obtained by this process or lost to someone
+# else. It allows skipping contested candidates without a memcache round trip.
+# Cleared when it reaches _CLAIM_CACHE_MAX_SIZE entries.
+_CLAIM_CACHE = {}
+_CLAIM_CACHE_MAX_SIZE = 10000
+
+# How long (in sec) a claim seen held by someone else is assumed to be still
+# held. Short, since the other bot either reaps the task within a few seconds
+# or releases the claim.
+_LOST_CLAIM_CACHE_SECS = 5
+
+# Maximum number of candidates claimed in a single memcache.add_multi() RPC by
+# yield_next_available_task_to_dispatch(). The window grows only when claims
+# are being lost, i.e. when multiple bots contest over the same queue.
+_CLAIM_WINDOW_MAX = 4
+
+
+# Memcache namespace with known-skippable prefixes of the queues, see
+# _ActiveQuery.
+_SCAN_NAMESPACE = 'task_to_run_scan'
+
+# How long (in sec) a known-skippable prefix of a queue is trusted. It bounds
+# how long a higher priority task submitted into the prefix range (or a claim
+# released within it) may stay unseen by bots that skip the prefix.
+_SCAN_PREFIX_TTL = 10
+
+# Probability of ignoring the known-skippable prefix and scanning the queue
+# from its head anyway, to recover from inconsistencies of the index.
+_FULL_SCAN_PROBABILITY = 0.1
+
+# Minimum number of skippable entries at the head of a queue to bother storing
+# the prefix.
+_SCAN_PREFIX_MIN_ENTRIES = 10
+
+
 def _memcache_to_run_key(to_run_key):
   """Encodes TaskToRunShard key as a string to address it in the memcache.
 
@@ -360,22 +443,77 @@ def _memcache_to_run_key(to_run_key):
                        task_to_run_key_slice_index(to_run_key))
 
 
+def _is_claimed_locally(key, now):
+  """Returns True if the claim cache says the memcache claim key is held."""
+  expiry = _CLAIM_CACHE.get(key)
+  if expiry is None:
+    return False
+  if expiry <= now:
+    _CLAIM_CACHE.pop(key, None)
+    return False
+  return True
+
+
+def _cache_claim(key, expiry):
+  """Remembers that the memcache claim key is held until `expiry`."""
+  if len(_CLAIM_CACHE) >= _CLAIM_CACHE_MAX_SIZE:
+    _CLAIM_CACHE.clear()
+  _CLAIM_CACHE[key] = expiry
+
+
 class _QueryStats(object):
   """Statistics for a yield_next_available_task_to_dispatch() loop."""
   claimed = 0
+  claimed_locally = 0
+  claim_keys = 0
+  claim_rpcs = 0
+  inversions = 0
+  lookups_saved = 0
   mismatch = 0
+  prefixes = 0
   stale = 0
   total = 0
   visited = 0
 
+  @property
+  def claim_rpcs_saved(self):
+    """Number of claim related memcache RPCs avoided compared to one claim RPC
+    per candidate.
+    """
+    return self.claim_keys - self.claim_rpcs + self.lookups_saved
+
   def __str__(self):
-    return ('%d total, %d visited, %d already claimed, %d stale, '
-            '%d dimensions mismatch') % (self.total, self.visited, self.claimed,
-                                         self.stale, self.mismatch)
+    return ('%d total, %d visited, %d already claimed (%d locally), %d stale, '
+            '%d dimensions mismatch, %d priority inversions, '
+            '%d claim RPCs saved, %d queue prefixes skipped') % (
+                self.total, self.visited, self.claimed, self.claimed_locally,
+                self.stale, self.mismatch, self.inversions,
+                self.claim_rpcs_saved, self.prefixes)
+
+
+def _scan_prefix_key(dim_hash, profile):
+  """Returns the memcache key of the known-skippable prefix of a queue."""
+  return '%d-%s' % (dim_hash, profile)
+
+
+def _get_scan_prefixes(queues, profile):
+  """Returns {dimensions hash: queue_number} of known-skippable prefixes.
+
+  Returns an empty dict if the bot has no dimensions profile.
+  """
+  if not profile:
+    return {}
+  keys = [_scan_prefix_key(d, profile) for d in queues]
+  found = _MC_CLIENT.get_multi(keys, namespace=_SCAN_NAMESPACE)
+  return {
+      d: found[k] for d, k in zip(queues, keys) if found.get(k) is not None
+  }
 
 
-def _get_task_to_run_query(dimensions_hash):
+def _get_task_to_run_query(dimensions_hash, after=None):
   """Returns a ndb.Query of TaskToRunShard within this dimensions_hash queue.
+
+  If `after` is given, only entities with a larger queue_number are returned.
   """
   # dimensions_hash should be 32 bits but on AppEngine, which is using 32 bits
   # python, it is silently upgraded to long.
@@ -383,53 +521,112 @@ def _get_task_to_run_query(dimensions_hash):
   # See _gen_queue_number() as of why << 31. This query cannot use the key
   # because it is not a root entity.
   def _query(kind):
-    return kind.query().order(kind.queue_number).filter(
+    q = kind.query().order(kind.queue_number).filter(
         kind.queue_number >= (dimensions_hash << 31), kind.queue_number <
         ((dimensions_hash + 1) << 31))
+    if after is not None:
+      q = q.filter(kind.queue_number > after)
+    return q
 
   return [_query(get_shard_kind(dimensions_hash % N_SHARDS))]
 
 
-class _TaskToRunItem(object):
-  __slots__ = ('key', 'ttr')
+class _QueueCursor(object):
+  """Buffers TaskToRunShard fetched by an _ActiveQuery in priority order.
 
-  def __init__(self, ttr):
-    self.key = _queue_number_order_priority(ttr)
-    self.ttr = ttr
-
-  def __cmp__(self, other):
-    return cmp(self.key, other.key)
+  Used by _yield_potential_tasks to merge multiple queues. Results of a single
+  query are already ordered by queue_number, and therefore by priority, so the
+  head of the buffer is the best item this queue can produce until the buffer
+  is drained.
+  """
 
+  def __init__(self, query):
+    self.query = query
+    self._buffer = collections.deque()
+    self._fetching = True
+    self._exhausted = False
 
-class _PriorityQueue(object):
-  def __init__(self):
-    self._heap = []
+  @property
+  def dim_hash(self):
+    return self.query.dim_hash
 
-  def add_heapified(self, ttr):
-    heapq.heappush(self._heap, _TaskToRunItem(ttr))
+  @property
+  def done(self):
+    """True if the cursor has no items and won't produce any more."""
+    return self._exhausted and not self._buffer
 
-  def add_unordered(self, ttr):
-    self._heap.append(_TaskToRunItem(ttr))
+  @property
+  def blocked(self):
+    """True if the buffer is empty, but the query may still produce items."""
+    return not self._buffer and not self._exhausted
 
-  def heapify(self):
-    heapq.heapify(self._heap)
+  @property
+  def buffered(self):
+    return len(self._buffer)
 
-  def pop(self):
-    return heapq.heappop(self._heap).ttr
+  def poll(self):
+    """Moves the fetched page (if any) into the buffer without blocking.
 
-  def size(self):
-    return len(self._heap)
+    Returns:
+      A list with newly buffered TaskToRunShard.
+    """
+    if not self._fetching or not self.query.ready():
+      return []
+    runs = self.query.page()
+    # TaskToRunShard submitted within the same 100ms interval at the same
+    # priority have the same queue sorting number (see _gen_queue_number).
+    # By shuffling them here we reduce chances of multiple bots contesting
+    # over the same items. This is effective only for queues with more
+    # than 10 tasks per second. The sort is stable, so the shuffled order of
+    # equal items is preserved.
+    random.shuffle(runs)
+    runs.sort(key=_queue_number_order_priority)
+    self._buffer.extend(runs)
+    self._fetching = False
+    self._maybe_fetch()
+    return runs
+
+  def head_key(self):
+    """Returns the order priority of the best buffered item."""
+    return _queue_number_order_priority(self._buffer[0])
 
-  def empty(self):
-    return not self._heap
+  def pop(self):
+    """Pops the best buffered item, maybe starting fetching the next page."""
+    ttr = self._buffer.popleft()
+    self._maybe_fetch()
+    return ttr
+
+  def _maybe_fetch(self):
+    # Prefetch the next page while there are still some items in the buffer to
+    # reduce the chance of blocking other queues on this one.
+    if (not self._fetching and not self._exhausted and
+        len(self._buffer) < _PREFETCH_THRESHOLD):
+      if self.query.advance():
+        self._fetching = True
+      else:
+        self._exhausted = True
 
 
 _MC_CLIENT = memcache.Client()
 
 
 class _ActiveQuery(object):
+  """Fetches pages of a single queue and filters out unusable items.
+
+  If `prefix_key` is given, the query also keeps track of the longest prefix of
+  the queue made of entries that are known to be unusable by bots with the
+  same dimensions profile (i.e. already claimed, or not matching the bot
+  dimensions), and stores its last queue_number in the memcache under this
+  key. The next scans can then start past it, see _get_scan_prefixes.
+
+  The prefix is a best-effort hint, trusted only for _SCAN_PREFIX_TTL seconds:
+  higher priority tasks submitted later and released claims may fall into it.
+  Since scans starting past a prefix may extend it further, some scans ignore
+  the stored prefix (`full_scan`) and replace it with what they actually see.
+  """
+
   def __init__(self, query, dim_hash, bot_id, stats, bot_dims_matcher,
-               deadline):
+               deadline, prefix_key=None, start=None, full_scan=False):
     self._query = query
     self._dim_hash = dim_hash
     self._bot_id = bot_id
@@ -438,6 +635,10 @@ class _ActiveQuery(object):
     self._deadline = deadline
     self._canceled = False
     self._pages = 0
+    self._prefix_key = prefix_key
+    self._prefix_end = start
+    self._prefix_len = 0
+    self._full_scan = full_scan
     self._page_size = 10
     self._future = self._fetch_and_filter(None)
 
@@ -522,14 +723,29 @@ class _ActiveQuery(object):
     # Filter out all entries that have already been claimed by other bots. This
     # is an optimization to skip claimed entries as fast as possible. The bots
     # will then contest on remaining entries in Claim.obtain(...), and finally
-    # in the datastore transaction.
+    # in the datastore transaction. Claims known to this process are skipped
+    # without looking them up in the memcache.
     available = []
     if fresh:
-      keys = [_memcache_to_run_key(ttr.key) for ttr in fresh]
-      taken = yield _MC_CLIENT.get_multi_async(keys, namespace=Claim._NAMESPACE)
-      for i in xrange(len(keys)):
-        if not taken.get(keys[i]):
-          available.append(fresh[i])
+      now = utils.time_time()
+      keys = []
+      unknown = []
+      for ttr in fresh:
+        key = _memcache_to_run_key(ttr.key)
+        if not _is_claimed_locally(key, now):
+          keys.append(key)
+          unknown.append(ttr)
+      self._stats.claimed_locally += len(fresh) - len(unknown)
+      if keys:
+        taken = yield _MC_CLIENT.get_multi_async(
+            keys, namespace=Claim._NAMESPACE)
+        for key, ttr in zip(keys, unknown):
+          if taken.get(key):
+            _cache_claim(key, now + _LOST_CLAIM_CACHE_SECS)
+          else:
+            available.append(ttr)
+      else:
+        self._stats.lookups_saved += 1
       self._stats.claimed += len(fresh) - len(available)
 
     # The queue_number hash may have conflicts or the queues being polled aren't
@@ -537,7 +753,7 @@ class _ActiveQuery(object):
     # that don't match bot dimensions.
     matched = []
     for ttr in available:
-      if self._bot_dims_matcher(ttr.dimensions):
+      if self._bot_dims_matcher(ttr.dimensions, self._dim_hash):
         matched.append(ttr)
       else:
         self._log('TaskToRunShard %s (slice %d) dimensions mismatch',
@@ -552,38 +768,86 @@ class _ActiveQuery(object):
                 len(available) - len(matched))
     if not more:
       self._log('exhausted')
+
+    if self._prefix_key and (not self._extend_prefix(fetched, matched) or
+                             not more):
+      yield self._store_prefix_async()
     raise ndb.Return((matched, cursor, more))
 
+  def _extend_prefix(self, fetched, matched):
+    """Extends the known-skippable prefix over the leading unusable entries.
+
+    Returns:
+      True if all fetched entries are skippable and the prefix may continue
+      with the next page.
+    """
+    usable = set(ttr.key for ttr in matched)
+    for ttr in fetched:
+      if not ttr.is_reapable or ttr.queue_number is None:
+        # Stale, it will be gone from the index soon.
+        continue
+      # A dimensions mismatch of a task targeting a specific bot is not shared
+      # by other bots with the same profile.
+      if ttr.key in usable or u'id' in ttr.dimensions:
+        return False
+      self._prefix_end = ttr.queue_number
+      self._prefix_len += 1
+    return True
+
+  @ndb.tasklet
+  def _store_prefix_async(self):
+    """Stores the known-skippable prefix, if it is long enough to matter."""
+    key = self._prefix_key
+    self._prefix_key = None
+    if self._prefix_len >= _SCAN_PREFIX_MIN_ENTRIES:
+      self._log('skipping %d entries next time', self._prefix_len)
+      yield ndb.get_context().memcache_set(
+          key, self._prefix_end, time=_SCAN_PREFIX_TTL,
+          namespace=_SCAN_NAMESPACE)
+    elif self._full_scan:
+      yield ndb.get_context().memcache_delete(key, namespace=_SCAN_NAMESPACE)
+
   def _log(self, msg, *args):
     logging.debug('_ActiveQuery(%s, %d): %s', self._bot_id, self._dim_hash,
                   msg % args)
 
 
+def _wait_budget(deadline):
+  """Returns how long (in sec) the merge may block waiting for lagging queues.
+
+  It is a fraction of the time left until the deadline, so that on slow
+  datastore days bots still get a task instead of waiting for the perfect one.
+  """
+  left = (deadline - utils.utcnow()).total_seconds()
+  return min(max(_MIN_WAIT_BUDGET, left * _WAIT_BUDGET_FRACTION), left)
+
+
 def _yield_potential_tasks(bot_id, pool, queues, stats, bot_dims_matcher,
                            deadline):
   """Queries given task queues in parallel and yields the tasks in order
   of priority until all queues are exhausted or the deadline is reached.
 
-  The ordering is opportunistic, not strict. There's a risk of not returning
-  exactly in the priority order depending on index staleness and query execution
-  latency. The number of queries is unbounded.
+  Does a k-way merge of the queues: an item is yielded only when every queue
+  that may still produce items has a fetched head item that is no better than
+  it. If some queue is lagging for longer than the wait budget (see
+  _wait_budget), the best known item is yielded anyway. Items that arrive
+  later and are better than an already yielded item are counted as priority
+  inversions in `stats`.
+
+  The ordering may still be violated because of index staleness. The number of
+  queries is unbounded.
 
   Arguments:
     bot_id: id of the bot to poll tasks for.
     pool: this bot's pool for monitoring metrics.
     queues: a list of integers with dimensions hashes of queues to poll.
     stats: a _QueryStats object to update in-place.
-    bot_dims_matcher: a predicate that checks if task dimensions match bot's
-        dimensions.
+    bot_dims_matcher: a predicate returned by dimensions_matcher(...) that
+        checks if task dimensions match bot's dimensions.
     deadline: datetime.datetime when to give up.
 
   Yields:
-    TaskToRunShard entities, trying to yield the highest priority one first.
-    To have finite execution time, starts yielding results once one of these
-    conditions are met:
-    - 1 second elapsed; in this case, continue iterating in the background
-    - First page of every query returned
-    - All queries exhausted
+    TaskToRunShard entities, highest priority first.
 
   Raises:
     ScanDeadlineError if reached the deadline before exhausting queues.
@@ -599,125 +863,95 @@ def _yield_potential_tasks(bot_id, pool, queues, stats, bot_dims_matcher,
   # Start fetching first pages of each per dimension set query. Note that
   # the default ndb.EVENTUAL_CONSISTENCY is used so stale items may be
   # returned. It's handled specifically by consumers of this function.
+  # Bots with the same dimensions share known-skippable prefixes of queues.
+  profile = getattr(bot_dims_matcher, 'profile', None)
+  full_scan = random.random() < _FULL_SCAN_PROBABILITY
+  prefixes = {} if full_scan else _get_scan_prefixes(queues, profile)
   queries = []
   for d in queues:
-    for q in _get_task_to_run_query(d):
+    start = prefixes.get(d)
+    if start is not None:
+      stats.prefixes += 1
+    for q in _get_task_to_run_query(d, after=start):
       queries.append(
-          _ActiveQuery(q, d, bot_id, stats, bot_dims_matcher, deadline))
+          _ActiveQuery(q, d, bot_id, stats, bot_dims_matcher, deadline,
+                       _scan_prefix_key(d, profile) if profile else None,
+                       start, full_scan))
+  cursors = [_QueueCursor(q) for q in queries]
 
-  # Run tasklets for at most 1 sec or until all fetches are done.
-  #
-  # TODO(vadimsh): Why only 1 sec? This also makes priority-based sorting kind
-  # of useless for loaded multi-queue bots, since we can't control what
-  # queries manage to finish first within 1 sec.
   start = time.time()
-  while (time.time() - start) < 1 and not all(q.ready() for q in queries):
-    r = ndb.eventloop.run0()
-    if r is None:
+  wait_budget = _wait_budget(deadline)
+  waited = 0.0
+  yielded = 0
+  # The worst order priority yielded so far.
+  worst_yielded = None
+
+  while True:
+    # Pick up all fetched pages. Their items can't be better than items already
+    # buffered for the same queue, but may be better than items already yielded
+    # from other queues if we ran out of the wait budget.
+    for c in cursors:
+      for ttr in c.poll():
+        if (worst_yielded is not None and
+            _queue_number_order_priority(ttr) < worst_yielded):
+          stats.inversions += 1
+
+    cursors = [c for c in cursors if not c.done]
+    if not cursors:
       break
-    if r > 0:
-      time.sleep(r)
-
-  # Log how many items we actually got. On loaded servers it will actually
-  # be 0 pretty often, since 1 sec is not that much.
-  logging.debug(
-      '_yield_potential_tasks(%s): waited %.3fs for %d items from queues '
-      '%s', bot_id,
-      time.time() - start, sum(len(q.page()) for q in queries if q.ready()),
-      [q.dim_hash for q in queries])
-
-  # We may be running of time already if the initial fetch above was
-  # particularly slow.
-  if utils.utcnow() >= deadline:
-    for q in queries:
-      q.cancel()
-    logging.debug('_yield_potential_tasks(%s): deadline before the poll loop',
-                  bot_id)
-    raise ScanDeadlineError('initializing', 'Deadline before the poll loop')
-
-  # A priority queue with TaskToRunShard ordered by the priority+timestamp,
-  # extracted from queue_number using _queue_number_order_priority.
-  queue = _PriorityQueue()
-
-  def _poll_queries(queries, use_heap):
-    enqueue = queue.add_heapified if use_heap else queue.add_unordered
-
-    # Get items from pages we already fetched and add them into `queue`. We
-    # don't block here, just pick what already was fetched.
-    pending = []
-    changed = False
-    for q in queries:
-      # Retain in the pending list if still working on some page.
-      if not q.ready():
-        pending.append(q)
-        continue
 
-      runs = q.page()
-      if runs:
-        # TaskToRunShard submitted within the same 100ms interval at the same
-        # priority have the same queue sorting number (see _gen_queue_number).
-        # By shuffling them here we reduce chances of multiple bots contesting
-        # over the same items. This is effective only for queues with more
-        # than 10 tasks per second.
-        random.shuffle(runs)
-
-        # Add them to the local priority queue.
-        changed = True
-        for r in runs:
-          enqueue(r)
-
-      # Start fetching the next page, if any.
-      if q.advance():
-        pending.append(q)
-      else:
-        # The queue has no more results, don't add it to `pending`.
-        changed = True
-
-    # Log the final stats if anything changed.
-    if changed:
-      logging.debug(
-          '_yield_potential_tasks(%s): %s items pending. active queues %s',
-          bot_id, queue.size(), [q.dim_hash for q in pending])
-    return pending
-
-  # Pick up all first pages we managed to fetch in 1 sec above and put them
-  # into the list in whatever order they were fetched.
-  active = _poll_queries(queries, use_heap=False)
-
-  # Transform the list into an actual priority queue before polling from it.
-  queue.heapify()
-
-  while not queue.empty() or active:
-    # Grab the top-priority item and let the caller try to process it.
-    if not queue.empty():
-      yield queue.pop()
+    ready = [c for c in cursors if not c.blocked]
+    lagging = [c for c in cursors if c.blocked]
+    if ready and (not lagging or waited >= wait_budget):
+      if lagging:
+        logging.debug(
+            '_yield_potential_tasks(%s): out of wait budget, not waiting for '
+            'queues %s', bot_id, [c.dim_hash for c in lagging])
+      best = min(ready, key=lambda c: c.head_key())
+      ttr = best.pop()
+      key = _queue_number_order_priority(ttr)
+      worst_yielded = key if worst_yielded is None else max(worst_yielded, key)
+      if not yielded:
+        logging.debug(
+            '_yield_potential_tasks(%s): waited %.3fs for the first item, '
+            '%d items buffered', bot_id,
+            time.time() - start, sum(c.buffered for c in cursors) + 1)
+      yielded += 1
+      yield ttr
     else:
-      # No pending items, but there are some pending futures. Run one step of
-      # ndb event loop to move things forward.
+      # Either nothing is fetched yet or need to wait for lagging queues to
+      # know what item is the best. Run one step of ndb event loop to move
+      # things forward. Only the waiting while having items to yield counts
+      # towards the budget.
+      wait_start = time.time()
       ndb.eventloop.run1()
+      if ready:
+        waited += time.time() - wait_start
+
     # On the overall deadline asynchronously cancel remaining queries and exit.
     if utils.utcnow() >= deadline:
-      for q in active:
+      for q in queries:
         q.cancel()
       break
-    # Poll for any new query pages, adding fetched items to the local queue.
-    # Do it only if the local queue is sufficiently shallow. If it is not,
-    # then the consumer is too slow. Adding more items will just result in
-    # eventually running out of memory.
-    if queue.size() < 1000:
-      active = _poll_queries(active, use_heap=True)
 
+  if stats.inversions:
+    logging.debug('_yield_potential_tasks(%s): %d priority inversions', bot_id,
+                  stats.inversions)
+
+  dropped = sum(c.buffered for c in cursors)
   canceled = [q for q in queries if q.canceled]
   if canceled:
     logging.debug(
         '_yield_potential_tasks(%s): deadline in queues %s, dropping %d items',
-        bot_id, [q.dim_hash for q in canceled], queue.size())
+        bot_id, [q.dim_hash for q in canceled], dropped)
+    if not yielded:
+      raise ScanDeadlineError('initializing', 'Deadline before the poll loop')
     raise ScanDeadlineError('fetching', 'Deadline fetching queues')
 
   if utils.utcnow() >= deadline:
     logging.debug(
         '_yield_potential_tasks(%s): deadline processing, dropping %d items',
-        bot_id, queue.size())
+        bot_id, dropped)
     raise ScanDeadlineError('processing', 'Deadline processing fetched items')
 
   logging.debug('_yield_potential_tasks(%s): all queues exhausted', bot_id)
@@ -820,26 +1054,34 @@ def dimensions_matcher(bot_dimensions):
 
   Assumes request dimensions have been validated already.
 
+  The predicate accepts an optional `cache_key` argument. If given, compiled
+  request dimensions are cached in-process under this key, which speeds up
+  checking many TaskToRunShard with the same dimensions. Dimensions hash is a
+  good key, since compiled values are checked against the actual dimensions
+  before being used.
+
   Returns:
-    func(request_dimensions) -> bool.
+    func(request_dimensions, cache_key=None) -> bool.
   """
   assert isinstance(bot_dimensions, dict), bot_dimensions
-  bot_flat = frozenset(task_queues.bot_dimensions_to_flat(bot_dimensions))
+  bot_flat = task_queues.bot_dimensions_to_flat(bot_dimensions)
+  bot_bitmap = dimensions_bitmap.BotDimensions(bot_flat)
 
-  def matcher(request_dimensions):
+  def matcher(request_dimensions, cache_key=None):
     assert isinstance(request_dimensions, dict), request_dimensions
-    for key, vals in request_dimensions.iteritems():
-      # Here if key='k' and vals=['a', 'b|c'], we should check that
-      #   ('k:a' in bot_flat) AND ('k:b' in bot_flat OR 'k:c' in bot_flat)
-      for val in vals:
-        match = any(u'%s:%s' % (key, variant) in bot_flat
-                    for variant in val.split(OR_DIM_SEP))
-        if not match:
-          logging.warning('Mismatch: bot %r, req %r', bot_dimensions,
-                          request_dimensions)
-          return False
-    return True
-
+    # Here if key='k' and vals=['a', 'b|c'], we should check that
+    #   ('k:a' in bot_flat) AND ('k:b' in bot_flat OR 'k:c' in bot_flat)
+    if bot_bitmap.matches_request(request_dimensions, cache_key):
+      return True
+    logging.warning('Mismatch: bot %r, req %r', bot_dimensions,
+                    request_dimensions)
+    return False
+
+  # Identifies bots that match the same requests, except ones targeting a
+  # specific bot via 'id' dimension. See _ActiveQuery.
+  matcher.profile = hashlib.md5('\n'.join(
+      d for d in bot_flat if not d.startswith(u'id:')).encode(
+          'utf-8')).hexdigest()[:16]
   return matcher
 
 
@@ -870,12 +1112,57 @@ class Claim(object):
       Claim if the TaskToRunShard was claimed by us or None if by someone else.
     """
     assert duration > 1, duration
-    expiry = utils.time_time() + duration
+    now = utils.time_time()
+    expiry = now + duration
     key = _memcache_to_run_key(to_run_key)
+    if _is_claimed_locally(key, now):
+      return None
     if not memcache.add(key, True, time=duration, namespace=cls._NAMESPACE):
+      _cache_claim(key, now + _LOST_CLAIM_CACHE_SECS)
       return None
+    _cache_claim(key, expiry)
     return cls(key, expiry)
 
+  @classmethod
+  def obtain_multi(cls, to_run_keys, duration=60, stats=None):
+    """Same as obtain(...), but claims multiple TaskToRunShard at once.
+
+    Candidates known to be claimed by the local claim cache are skipped, the
+    rest are claimed in a single memcache.add_multi(...) RPC.
+
+    Arguments:
+      to_run_keys: a list of TaskToRunShard keys to claim.
+      duration: how long the claims are held, in seconds.
+      stats: an optional _QueryStats to update in-place.
+
+    Returns:
+      A list with a Claim or None for each key in `to_run_keys`.
+    """
+    assert duration > 1, duration
+    now = utils.time_time()
+    expiry = now + duration
+    keys = [_memcache_to_run_key(k) for k in to_run_keys]
+    mapping = {k: True for k in keys if not _is_claimed_locally(k, now)}
+    not_set = set()
+    if mapping:
+      not_set = set(
+          memcache.add_multi(mapping, time=duration, namespace=cls._NAMESPACE))
+    if stats is not None:
+      stats.claimed_locally += len(keys) - len(mapping)
+      stats.claim_keys += len(keys)
+      stats.claim_rpcs += 1 if mapping else 0
+    out = []
+    for key in keys:
+      if key not in mapping:
+        out.append(None)
+      elif key in not_set:
+        _cache_claim(key, now + _LOST_CLAIM_CACHE_SECS)
+        out.append(None)
+      else:
+        _cache_claim(key, expiry)
+        out.append(cls(key, expiry))
+    return out
+
   @classmethod
   def check(cls, to_run_key):
     """Returns True if there's an existing claim on TaskToRunShard."""
@@ -910,8 +1197,22 @@ class Claim(object):
     # picked arbitrarily.
     if not self._released and self._expiry - utils.time_time() > 2:
       memcache.delete(self._key, namespace=self._NAMESPACE)
+      _CLAIM_CACHE.pop(self._key, None)
       self._released = True
 
+  @classmethod
+  def release_multi(cls, claims):
+    """Same as release(...) for multiple claims, in a single RPC."""
+    now = utils.time_time()
+    keys = []
+    for claim in claims:
+      if not claim._released and claim._expiry - now > 2:
+        keys.append(claim._key)
+        _CLAIM_CACHE.pop(claim._key, None)
+        claim._released = True
+    if keys:
+      memcache.delete_multi(keys, namespace=cls._NAMESPACE)
+
   def __enter__(self):
     return self
 
@@ -920,44 +1221,74 @@ class Claim(object):
 
 
 def yield_next_available_task_to_dispatch(bot_id, pool, queues,
-                                          bot_dims_matcher, deadline):
+                                          bot_dims_matcher, deadline,
+                                          claims=None):
   """Yields next available TaskToRunShard in roughly decreasing order of
   priority.
 
-  All yielded items are already claimed via Claim.obtain(...). The caller should
-  do necessary datastore transactions to finalize the assignment and remove
-  TaskToRunShard from the queue.
+  All yielded items are already claimed via Claim.obtain_multi(...). The caller
+  should do necessary datastore transactions to finalize the assignment and
+  remove TaskToRunShard from the queue.
+
+  Candidates are claimed one at a time while there is no contention. When
+  claims are lost to other bots, a window of up to _CLAIM_WINDOW_MAX top
+  candidates is claimed in a single RPC. Claims of candidates that were not
+  yielded are released when the generator is closed.
 
   Arguments:
     bot_id: id of the bot to poll tasks for.
     pool: this bot's pool for monitoring metrics.
     queues: a list of integers with dimensions hashes of queues to poll.
-    bot_dims_matcher: a predicate that checks if task dimensions match bot's
-        dimensions.
+    bot_dims_matcher: a predicate returned by dimensions_matcher(...) that
+        checks if task dimensions match bot's dimensions.
     deadline: datetime.datetime when to give up.
+    claims: optional dict populated with {TaskToRunShard key: Claim} for the
+        yielded items, so the caller can release the ones it gives up on.
 
   Raises:
     ScanDeadlineError if reached the deadline before clearing queues.
   """
   now = utils.utcnow()
   stats = _QueryStats()
+  potential = _yield_potential_tasks(bot_id, pool, queues, stats,
+                                     bot_dims_matcher, deadline)
+  window = 1
+  # (TaskToRunShard, Claim) claimed but not yielded yet.
+  pending = collections.deque()
   try:
-    for ttr in _yield_potential_tasks(bot_id, pool, queues, stats,
-                                      bot_dims_matcher, deadline):
-      # Try to claim this TaskToRunShard. Only one bot will pass this. It then
-      # will have ~60s to submit a transaction that assigns the TaskToRunShard
-      # to this bot before another bot will be able to try that.
-      if Claim.obtain(ttr.key):
-        logging.debug(
-            'yield_next_available_task_to_dispatch(%s): ready to reap %s',
-            bot_id, ttr.task_id)
-        stats.visited += 1
-        yield ttr
-      else:
-        logging.debug(
-            'yield_next_available_task_to_dispatch(%s): skipping claimed %s',
-            bot_id, ttr.task_id)
+    while True:
+      if not pending:
+        batch = list(itertools.islice(potential, window))
+        if not batch:
+          break
+        # Try to claim these TaskToRunShard. Only one bot will pass this for
+        # each of them. It then will have ~60s to submit a transaction that
+        # assigns the TaskToRunShard to this bot before another bot will be
+        # able to try that.
+        won = Claim.obtain_multi([ttr.key for ttr in batch], stats=stats)
+        for ttr, claim in zip(batch, won):
+          if claim:
+            pending.append((ttr, claim))
+          else:
+            logging.debug(
+                'yield_next_available_task_to_dispatch(%s): skipping claimed '
+                '%s', bot_id, ttr.task_id)
+        if len(pending) < len(batch):
+          window = min(window * 2, _CLAIM_WINDOW_MAX)
+        else:
+          window = 1
+        continue
+      ttr, claim = pending.popleft()
+      logging.debug(
+          'yield_next_available_task_to_dispatch(%s): ready to reap %s',
+          bot_id, ttr.task_id)
+      stats.visited += 1
+      if claims is not None:
+        claims[ttr.key] = claim
+      yield ttr
   finally:
+    if pending:
+      Claim.release_multi([claim for _, claim in pending])
     logging.debug(
         'yield_next_available_task_to_dispatch(%s) in %.3fs: %s',
         bot_id, (utils.utcnow() - now).total_seconds(), stats)
@@ -966,38 +1297,70 @@ def yield_next_available_task_to_dispatch(bot_id, pool, queues,
                                        mismatch=stats.mismatch,
                                        stale=stats.stale,
                                        total=stats.total,
-                                       visited=stats.visited)
+                                       visited=stats.visited,
+                                       inversions=stats.inversions,
+                                       claim_rpcs_saved=stats.claim_rpcs_saved)
 
 
-def yield_expired_task_to_run(delay_sec):
-  """Yields the expired TaskToRunShard still marked as available."""
-  # The query fetches tasks that reached expiration time recently
-  # to avoid fetching all past tasks. It uses a large batch size
-  # since the entities are very small and to reduce RPC overhead.
-  def _query(kind):
-    now = utils.utcnow() - datetime.timedelta(seconds=delay_sec)
-    # The backsearch here is just to ensure that we find entities that we forgot
-    # about before because the cron job couldn't keep up. In practice
-    # expiration_ts should not be more than 1 minute old (as the cron job runs
-    # every minutes) but keep it high in case there's an outage.
-    cut_off = now - datetime.timedelta(hours=24)
-    return kind.query(kind.expiration_ts < now,
-                      kind.expiration_ts > cut_off,
-                      default_options=ndb.QueryOptions(batch_size=256))
-
-  # Shuffle the order in which we visit shards to give all shards equal chance
-  # to be visited first (matters if there's a backlog).
-  shards = list(range(N_SHARDS))
-  random.shuffle(shards)
+@ndb.tasklet
+def scan_expired_task_to_run_async(shard, delay_sec, page_cb):
+  """Finds expired TaskToRunShard still marked as available in one shard.
+
+  Resumes from the shard's ExpirationScanCheckpoint, if any, instead of looking
+  at the whole backsearch window, except every _EXPIRATION_FULL_SCAN_EVERY
+  scans. Multiple shards can be scanned concurrently.
+
+  Arguments:
+    shard: index of the TaskToRunShard kind to scan.
+    delay_sec: how long after expiration_ts an entity is considered expired.
+    page_cb: a tasklet called with a list of expired TaskToRunShard entities,
+      returns True if they were successfully handed over for expiration. The
+      checkpoint is moved only if all pages were handed over.
 
+  Returns:
+    Tuple (number of entities found, datetime.timedelta between now and the
+    oldest expiration_ts found or None if nothing was found).
+  """
+  now = utils.utcnow()
+  scan_ts = now - datetime.timedelta(seconds=delay_sec)
+  kind = get_shard_kind(shard)
+  checkpoint_key = ndb.Key(ExpirationScanCheckpoint, kind._get_kind())
+  checkpoint = yield checkpoint_key.get_async()
+
+  cut_off = scan_ts - _EXPIRATION_BACKSEARCH
+  scans_since_full = 0
+  if (checkpoint and checkpoint.scanned_until and
+      checkpoint.scans_since_full + 1 < _EXPIRATION_FULL_SCAN_EVERY):
+    cut_off = max(cut_off,
+                  checkpoint.scanned_until - _EXPIRATION_CHECKPOINT_SLACK)
+    scans_since_full = checkpoint.scans_since_full + 1
+
+  # It uses a large batch size since the entities are very small and to reduce
+  # RPC overhead. Results are ordered by expiration_ts.
+  q = kind.query(kind.expiration_ts < scan_ts, kind.expiration_ts > cut_off)
   total = 0
-  try:
-    for shard in shards:
-      for task in _query(get_shard_kind(shard)):
-        yield task
-        total += 1
-  finally:
-    logging.debug('Yielded %d tasks', total)
+  lag = None
+  handed_over = True
+  cursor = None
+  more = True
+  while more:
+    page, cursor, more = yield q.fetch_page_async(256, start_cursor=cursor)
+    if not page:
+      break
+    if lag is None:
+      lag = now - page[0].expiration_ts
+    total += len(page)
+    ok = yield page_cb(page)
+    handed_over = handed_over and ok
+
+  if handed_over:
+    yield ExpirationScanCheckpoint(
+        key=checkpoint_key,
+        scanned_until=scan_ts,
+        scans_since_full=scans_since_full).put_async()
+  logging.debug('Shard %d: found %d expired tasks since %s', shard, total,
+                cut_off)
+  raise ndb.Return((total, lag))
 
 
 def get_task_to_runs(request, slice_until):
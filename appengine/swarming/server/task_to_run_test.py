@@ -18,6 +18,7 @@ import test_env_handlers
 import webtest
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 import handlers_backend
@@ -32,6 +33,7 @@ from server import pools_config
 from server import task_queues
 from server import task_request
 from server import task_to_run
+import ts_mon_metrics
 
 # pylint: disable=W0212
 # Method could be a function - pylint: disable=R0201
@@ -132,6 +134,7 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
             'SERVER_SOFTWARE': os.environ['SERVER_SOFTWARE'],
         })
     self._enqueue_orig = self.mock(utils, 'enqueue_task_async', self._enqueue)
+    self.mock(task_to_run, '_CLAIM_CACHE', {})
     self.mock_pool_config('default')
 
   def _enqueue(self, *args, **kwargs):
@@ -917,6 +920,41 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     collected.sort(key=lambda ttr: ttr['created_ts'])
     self.assertEqual(submitted, collected)
 
+  def test_yield_next_available_task_to_dispatch_merges_queues(self):
+    visits = []
+    self.mock(ts_mon_metrics, 'on_scheduler_visits',
+              lambda **kwargs: visits.append(kwargs))
+
+    # Interleave tasks in 3 queues, so that each query returns multiple pages
+    # and the merged order differs from the order of any single query.
+    submitted = []
+    pools = [u'p1', u'p2', u'p3']
+    for i in range(60):
+      self.mock_now(self.now, i)
+      request_dimensions = {
+          u'os': [u'Windows-3.1.1'],
+          u'pool': [pools[i % 3]],
+      }
+      request = self.mkreq(
+          _gen_request(
+              properties=_gen_properties(dimensions=request_dimensions),
+              priority=50))
+      ttr = task_to_run.new_task_to_run(request, 0)
+      ttr.put()
+      submitted.append(ttr.to_dict())
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': pools,
+    }
+    collected = list(
+        self._yield_next_available_task_to_dispatch(bot_dimensions))
+    # Strictly LIFO (the default in _gen_request) across all queues.
+    self.assertEqual(list(reversed(submitted)), collected)
+    self.assertEqual(1, len(visits))
+    self.assertEqual(0, visits[0]['inversions'])
+
   def test_yield_next_available_task_checks_cache(self):
     request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
     bot_dimensions = {
@@ -959,6 +997,50 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     collected.sort(key=lambda ttr: ttr['created_ts'])
     self.assertEqual(available, collected)
 
+  def test_yield_next_available_task_to_dispatch_skips_prefix(self):
+    visits = []
+    self.mock(ts_mon_metrics, 'on_scheduler_visits',
+              lambda **kwargs: visits.append(kwargs))
+    self.mock(task_to_run, '_FULL_SCAN_PROBABILITY', 0)
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'p1'],
+    }
+    submitted = []
+    for i in range(15):
+      self.mock_now(self.now, i)
+      request = self.mkreq(
+          _gen_request(
+              properties=_gen_properties(dimensions=request_dimensions)))
+      ttr = task_to_run.new_task_to_run(request, 0)
+      ttr.put()
+      submitted.append(ttr.to_dict())
+      # LIFO: the 12 newest ones are at the head of the queue.
+      if i >= 3:
+        task_to_run.Claim.obtain(ttr.key)
+
+    collected = self._yield_next_available_task_to_dispatch(bot_dimensions)
+    self.assertEqual(list(reversed(submitted[:3])), collected)
+    self.assertEqual(15, visits[-1]['total'])
+    self.assertEqual(1, len(memcache.get_multi(
+        [task_to_run._scan_prefix_key(
+            task_queues.hash_dimensions(request_dimensions),
+            task_to_run.dimensions_matcher(bot_dimensions).profile)],
+        namespace=task_to_run._SCAN_NAMESPACE)))
+
+    # The next scan starts past the claimed entries.
+    self.assertEqual(
+        [], self._yield_next_available_task_to_dispatch(bot_dimensions))
+    self.assertEqual(3, visits[-1]['total'])
+
+    # Unless it is a full scan.
+    self.mock(task_to_run, '_FULL_SCAN_PROBABILITY', 1)
+    self.assertEqual(
+        [], self._yield_next_available_task_to_dispatch(bot_dimensions))
+    self.assertEqual(15, visits[-1]['total'])
+
   def test_yield_next_available_task_to_dispatch_deadline(self):
     request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
     for _ in range(40):
@@ -995,7 +1077,7 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     self.assertTrue(raised)
     self.assertEqual(23, seen)
 
-  def test_yield_expired_task_to_run(self):
+  def test_scan_expired_task_to_run_async(self):
     # There's a cut off at 2019-09-01, so the default self.now on Jan 2nd
     # doesn't work when looking 4 weeks ago.
     self.now = datetime.datetime(2019, 10, 10, 3, 4, 5, 6)
@@ -1034,12 +1116,79 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(
         0, len(self._yield_next_available_task_to_dispatch(bot_dimensions)))
 
-    actual = list(task_to_run.yield_expired_task_to_run(0.0))
+    pages = []
+
+    @ndb.tasklet
+    def page_cb(to_runs):
+      pages.append(to_runs)
+      raise ndb.Return(True)
+
+    def scan(shard):
+      return task_to_run.scan_expired_task_to_run_async(shard, 0.0,
+                                                        page_cb).get_result()
 
-    # Only to_run_2 and to_run_3 should be yielded. to_run_4 is too old and is
+    shard = to_run_2.shard_index
+    self.assertEqual(shard, to_run_3.shard_index)
+    count, lag = scan(shard)
+
+    # Only to_run_2 and to_run_3 should be found. to_run_4 is too old and is
     # ignored.
-    expected = [to_run_3, to_run_2]
-    self.assertEqual(expected, actual)
+    self.assertEqual([[to_run_3, to_run_2]], pages)
+    self.assertEqual(2, count)
+    self.assertEqual(self.now - to_run_3.expiration_ts, lag)
+    del pages[:]
+
+    # The checkpoint limits what the next scan looks at.
+    self.mock_now(self.now, 1)
+    self.assertEqual((1, self.now + datetime.timedelta(seconds=1) -
+                      to_run_2.expiration_ts), scan(shard))
+    self.assertEqual([[to_run_2]], pages)
+    del pages[:]
+
+    # Other shards have nothing.
+    self.assertEqual((0, None), scan((shard + 1) % task_to_run.N_SHARDS))
+    self.assertEqual([], pages)
+
+  def test_scan_expired_task_to_run_async_full_scan(self):
+    self.now = datetime.datetime(2019, 10, 10, 3, 4, 5, 6)
+    self.mock(task_to_run, '_EXPIRATION_FULL_SCAN_EVERY', 3)
+    pages = []
+
+    @ndb.tasklet
+    def page_cb(to_runs):
+      pages.append(to_runs)
+      raise ndb.Return(True)
+
+    def scan(shard):
+      self.mock_now(self.now, len(scanned))
+      scanned.append(shard)
+      return task_to_run.scan_expired_task_to_run_async(shard, 0.0,
+                                                        page_cb).get_result()
+
+    scanned = []
+    _, to_run = self._gen_new_task_to_run_slices(
+        created_ts=self.now - datetime.timedelta(hours=1),
+        task_slices=[{
+            'expiration_secs': 60,
+            'properties': _gen_properties()
+        }])
+    shard = to_run.shard_index
+    self.assertEqual(1, scan(shard)[0])
+
+    # Stored after the scan, but already expired before the checkpoint. It is
+    # only found by the next full scan.
+    _, to_run_late = self._gen_new_task_to_run_slices(
+        created_ts=self.now - datetime.timedelta(hours=2),
+        task_slices=[{
+            'expiration_secs': 60,
+            'properties': _gen_properties()
+        }])
+    self.assertEqual(shard, to_run_late.shard_index)
+    del pages[:]
+    self.assertEqual(0, scan(shard)[0])
+    self.assertEqual(0, scan(shard)[0])
+    self.assertEqual(2, scan(shard)[0])
+    self.assertEqual([[to_run_late, to_run]], pages)
 
   def test_is_reapable(self):
     request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'default']}
@@ -1066,6 +1215,108 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
       self.assertTrue(task_to_run.Claim.check(to_run))
     self.assertFalse(task_to_run.Claim.check(to_run))
 
+  def test_claim_lost_is_cached(self):
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    request = self.mkreq(_gen_request())
+    to_run = task_to_run.new_task_to_run(request, 0).key
+    # Claimed by another process.
+    self.assertTrue(task_to_run.Claim.obtain(to_run))
+    task_to_run._CLAIM_CACHE.clear()
+    self.assertIsNone(task_to_run.Claim.obtain(to_run))
+    self.assertEqual(1, len(task_to_run._CLAIM_CACHE))
+    # Released by the other process, but still assumed to be held for a while.
+    memcache.flush_all()
+    self.assertIsNone(task_to_run.Claim.obtain(to_run))
+    now[0] += task_to_run._LOST_CLAIM_CACHE_SECS
+    self.assertTrue(task_to_run.Claim.obtain(to_run))
+
+  def test_claim_obtain_multi(self):
+    keys = []
+    for i in range(3):
+      self.mock_now(self.now, i)
+      request = self.mkreq(_gen_request())
+      keys.append(task_to_run.new_task_to_run(request, 0).key)
+    self.assertTrue(task_to_run.Claim.obtain(keys[0]))
+
+    stats = task_to_run._QueryStats()
+    claims = task_to_run.Claim.obtain_multi(keys, stats=stats)
+    self.assertIsNone(claims[0])
+    self.assertTrue(claims[1])
+    self.assertTrue(claims[2])
+    self.assertTrue(task_to_run.Claim.check(keys[1]))
+    self.assertTrue(task_to_run.Claim.check(keys[2]))
+    self.assertEqual(1, stats.claimed_locally)
+    self.assertEqual(3, stats.claim_keys)
+    self.assertEqual(1, stats.claim_rpcs)
+    self.assertEqual(2, stats.claim_rpcs_saved)
+
+    task_to_run.Claim.release_multi(claims[1:])
+    self.assertFalse(task_to_run.Claim.check(keys[1]))
+    self.assertFalse(task_to_run.Claim.check(keys[2]))
+    self.assertNotIn(
+        task_to_run._memcache_to_run_key(keys[1]), task_to_run._CLAIM_CACHE)
+
+  def test_yield_next_available_task_to_dispatch_claim_window(self):
+    visits = []
+    self.mock(ts_mon_metrics, 'on_scheduler_visits',
+              lambda **kwargs: visits.append(kwargs))
+    calls = []
+    add_multi = memcache.add_multi
+
+    def mocked_add_multi(mapping, **kwargs):
+      calls.append(sorted(mapping))
+      if len(calls) == 1:
+        # Lost the race for the first candidate to another bot.
+        return list(mapping)
+      return add_multi(mapping, **kwargs)
+
+    self.mock(memcache, 'add_multi', mocked_add_multi)
+
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
+    keys = []
+    for i in range(3):
+      self.mock_now(self.now, i)
+      request = self.mkreq(
+          _gen_request(
+              properties=_gen_properties(dimensions=request_dimensions)))
+      ttr = task_to_run.new_task_to_run(request, 0)
+      ttr.put()
+      keys.append(ttr.key)
+
+    bot_dimensions = {
+        u'id': [u'localhost'],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'p1'],
+    }
+    bot_management.bot_event(event_type='bot_connected',
+                             bot_id='localhost',
+                             external_ip='1.2.3.4',
+                             authenticated_as='joe@localhost',
+                             dimensions=bot_dimensions,
+                             state={'state': 'real'},
+                             version='1234',
+                             register_dimensions=False)
+    task_queues.assert_bot(bot_dimensions)
+    self.execute_tasks()
+    queues = task_queues.freshen_up_queues('localhost')
+    gen = task_to_run.yield_next_available_task_to_dispatch(
+        'localhost', 'pool-for-monitoring', queues,
+        task_to_run.dimensions_matcher(bot_dimensions),
+        utils.utcnow() + datetime.timedelta(minutes=1))
+    # LIFO: the newest one was lost, the next two are claimed in one RPC.
+    self.assertEqual(keys[1], next(gen).key)
+    gen.close()
+
+    self.assertEqual(2, len(calls))
+    self.assertEqual(1, len(calls[0]))
+    self.assertEqual(2, len(calls[1]))
+    # The claim of the candidate that was not yielded is released.
+    self.assertTrue(task_to_run.Claim.check(keys[1]))
+    self.assertFalse(task_to_run.Claim.check(keys[0]))
+    self.assertEqual(1, len(visits))
+    self.assertEqual(1, visits[0]['claim_rpcs_saved'])
+
   def test_pre_put_hook(self):
     _, to_run = self._gen_new_task_to_run()
 
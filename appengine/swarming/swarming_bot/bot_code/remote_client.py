@@ -16,6 +16,7 @@ import threading
 import time
 import traceback
 import uuid
+import zlib
 
 from utils import net
 
@@ -122,6 +123,9 @@ class RemoteClientNative(object):
     self._bot_work_dir = work_dir
     self._bot_id = None
     self._poll_request_uuid = None
+    # Output compression accepted by the server, learned from its response to
+    # post_task_update().
+    self._output_compression = None
 
   @property
   def server(self):
@@ -293,7 +297,13 @@ class RemoteClientNative(object):
     data.update(params)
     # Preserving prior behaviour: empty stdout is not transmitted
     if stdout_and_chunk and stdout_and_chunk[0]:
-      data['output'] = base64.b64encode(stdout_and_chunk[0]).decode()
+      output = stdout_and_chunk[0]
+      if self._output_compression == 'zlib':
+        compressed = zlib.compress(output, 1)
+        if len(compressed) < len(output):
+          output = compressed
+          data['output_compression'] = 'zlib'
+      data['output'] = base64.b64encode(output).decode()
       data['output_chunk_start'] = stdout_and_chunk[1]
     if exit_code != None:
       data['exit_code'] = exit_code
@@ -304,6 +314,10 @@ class RemoteClientNative(object):
     if not resp or resp.get('error'):
       raise InternalError(
           resp.get('error') if resp else 'Failed to contact server')
+    # The server may be rolled back to a version that doesn't accept it.
+    self._output_compression = None
+    if 'zlib' in resp.get('accepted_output_compression', []):
+      self._output_compression = 'zlib'
     return not resp.get('must_stop', False)
 
   def post_task_error(self,
@@ -3,6 +3,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import base64
 import datetime
 import logging
 import os
@@ -12,6 +13,7 @@ import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 import test_env_bot_code
 test_env_bot_code.setup_test_env()
@@ -163,6 +165,58 @@ class TestRemoteClient(auto_stub.TestCase):
     resp = c.mint_id_token('task_id', 'account_id', 'https://example.com')
     self.assertEqual(fake_resp, resp)
 
+  def test_post_task_update_output_compression(self):
+    c = remote_client.RemoteClientNative('http://localhost:1', None,
+                                         'localhost', '/')
+    c.bot_id = 'bot_id'
+    calls = []
+    resp = {'must_stop': False, 'ok': True}
+
+    def mocked_call(url_path, data):
+      self.assertEqual('/swarming/api/v1/bot/task_update/task_id', url_path)
+      calls.append(data)
+      return resp
+
+    self.mock(c, '_url_read_json', mocked_call)
+    output = b'hello world\n' * 100
+
+    # The server didn't say it accepts compressed output yet.
+    self.assertTrue(c.post_task_update('task_id', {}, (output, 0)))
+    self.assertEqual([{
+        'id': 'bot_id',
+        'output': base64.b64encode(output).decode(),
+        'output_chunk_start': 0,
+        'task_id': 'task_id',
+    }], calls)
+    del calls[:]
+
+    resp['accepted_output_compression'] = ['zlib']
+    self.assertTrue(c.post_task_update('task_id', {}))
+    self.assertTrue(c.post_task_update('task_id', {}, (output, 1200)))
+    self.assertEqual(2, len(calls))
+    self.assertEqual('zlib', calls[1]['output_compression'])
+    self.assertEqual(
+        output, zlib.decompress(base64.b64decode(calls[1]['output'])))
+    self.assertEqual(1200, calls[1]['output_chunk_start'])
+    del calls[:]
+
+    # The server stopped accepting compressed output.
+    del resp['accepted_output_compression']
+    self.assertTrue(c.post_task_update('task_id', {}))
+    self.assertTrue(c.post_task_update('task_id', {}, (output, 2400)))
+    self.assertNotIn('output_compression', calls[1])
+    self.assertEqual(output, base64.b64decode(calls[1]['output']))
+    del calls[:]
+
+    # Output that doesn't compress is sent as is.
+    self.assertTrue(c.post_task_update('task_id', {}, (b'x', 2400)))
+    self.assertEqual([{
+        'id': 'bot_id',
+        'output': base64.b64encode(b'x').decode(),
+        'output_chunk_start': 2400,
+        'task_id': 'task_id',
+    }], calls)
+
   @parameterized.expand([
       ('mint_oauth_token', ['scope-a', 'scope-b']),
       ('mint_id_token', 'https://audience.example.com'),
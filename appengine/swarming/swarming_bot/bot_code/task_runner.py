@@ -576,8 +576,11 @@ class _OutputBuffer:
     self._max_packet_interval = self._MAX_PACKET_INTERVAL
 
     # Mutable:
-    # Buffered data to send to the server.
-    self._stdout = b''
+    # Buffered data to send to the server, as a list of chunks to not copy the
+    # whole buffer on each add(). Joined once in pop().
+    self._stdout = []
+    # Total size of self._stdout.
+    self._stdout_size = 0
     # Offset at which the buffered data shall be sent to the server.
     self._output_chunk_start = 0
     # Last time proc.yield_any() yielded.
@@ -605,20 +608,22 @@ class _OutputBuffer:
     self._last_loop = monotonic_time()
     if data:
       self._last_io = self._last_loop
-      self._stdout += data
+      self._stdout.append(data)
+      self._stdout_size += len(data)
 
   def pop(self):
     """Pops the buffered data to send it to the server."""
     o = self._output_chunk_start
-    s = self._stdout
-    self._output_chunk_start += len(self._stdout)
-    self._stdout = b''
+    s = b''.join(self._stdout)
+    self._output_chunk_start += self._stdout_size
+    self._stdout = []
+    self._stdout_size = 0
     self._last_pop = monotonic_time()
     return (s, o)
 
   def maxsize(self):
     """Returns the maximum number of bytes proc.yield_any() can return."""
-    return self._max_chunk_size - len(self._stdout)
+    return self._max_chunk_size - self._stdout_size
 
   def should_post_update(self):
     """Returns True if it's time to send a task_update packet via post_update().
@@ -631,9 +636,9 @@ class _OutputBuffer:
     """
     packet_interval = (
         self._min_packet_interval
-        if self._stdout else self._max_packet_interval)
+        if self._stdout_size else self._max_packet_interval)
     return (
-        len(self._stdout) >= self._max_chunk_size or
+        self._stdout_size >= self._max_chunk_size or
         (self._last_loop - self._last_pop) > packet_interval)
 
   def calc_yield_wait(self, timed_out):
@@ -650,7 +655,7 @@ class _OutputBuffer:
       return 0.
 
     out = (
-        self._min_packet_interval if self._stdout
+        self._min_packet_interval if self._stdout_size
         else self._max_packet_interval)
     now = monotonic_time()
     if self._task_details.hard_timeout:
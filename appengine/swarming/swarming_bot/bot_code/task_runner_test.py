@@ -21,6 +21,7 @@ import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 import mock
 
@@ -1434,6 +1435,64 @@ class TestTaskRunnerKilled(TestTaskRunnerBase):
     self.assertEqual(expected, errors)
 
 
+class TestOutputBuffer(auto_stub.TestCase):
+
+  def test_add_pop(self):
+    now = [100.]
+    self.mock(task_runner, 'monotonic_time', lambda: now[0])
+    buf = task_runner._OutputBuffer(None, now[0])
+    self.assertEqual(250000, buf.maxsize())
+    self.assertFalse(buf.should_post_update())
+
+    buf.add('stdout', b'foo')
+    buf.add('stdout', b'')
+    buf.add('stdout', b'bar')
+    self.assertEqual(250000 - 6, buf.maxsize())
+    self.assertFalse(buf.should_post_update())
+    now[0] += 5
+    buf.add('stdout', None)
+    self.assertTrue(buf.should_post_update())
+    self.assertEqual((b'foobar', 0), buf.pop())
+    self.assertEqual(250000, buf.maxsize())
+    self.assertFalse(buf.should_post_update())
+
+    buf.add('stdout', b'x' * 250000)
+    self.assertEqual(0, buf.maxsize())
+    self.assertTrue(buf.should_post_update())
+    self.assertEqual((b'x' * 250000, 6), buf.pop())
+    self.assertEqual((b'', 250006), buf.pop())
+
+
+class OutputBufferBenchmark(unittest.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def _forward(self, total, read_size, compress):
+    """Forwards `total` bytes read `read_size` at a time, like run_command()."""
+    buf = task_runner._OutputBuffer(None, 0)
+    data = (string.ascii_letters.encode() * (read_size // 52 + 1))[:read_size]
+    sent = 0
+    start = time.perf_counter()
+    while sent < total:
+      buf.add('stdout', data[:buf.maxsize()])
+      if buf.maxsize() <= 0:
+        output, _ = buf.pop()
+        if compress:
+          output = zlib.compress(output, 1)
+        base64.b64encode(output)
+        sent += task_runner._OutputBuffer(None, 0)._max_chunk_size
+    return sent / (time.perf_counter() - start)
+
+  def test_benchmark_forward(self):
+    # A 100 MB/s producer, read from the pipe 4kb or 64kb at a time.
+    for read_size in (4096, 65536):
+      for compress in (False, True):
+        rate = self._forward(100 * 1024 * 1024, read_size, compress)
+        logging.warning('read=%5d compress=%-5s %.1f MB/s', read_size,
+                        compress, rate / 1024. / 1024.)
+
+
 class TaskRunnerNoServer(auto_stub.TestCase):
   """Test cases that do not talk to the server."""
 
@@ -44,6 +44,7 @@ from server import pools_config
 from server import realms
 from server import service_accounts
 from server import task_queues
+from server import task_to_run
 
 # Realm permissions used in Swarming.
 _ALL_PERMS = [
@@ -61,6 +62,7 @@ class AppTestBase(test_case.TestCase):
     self.testbed.init_user_stub()
 
     gae_ts_mon.reset_for_unittest(disable=True)
+    self.mock(task_to_run, '_CLAIM_CACHE', {})
 
     # By default requests in tests are coming from bot with fake IP.
     # WSGI app that implements auth REST API.
@@ -499,7 +501,12 @@ class AppTestBase(test_case.TestCase):
     res = self.bot_poll()
     task_id = res['manifest']['task_id']
     response = self.bot_complete_task(task_id=task_id)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual(
+        {
+            u'accepted_output_compression': [u'zlib'],
+            u'must_stop': False,
+            u'ok': True,
+        }, response)
     return task_id
 
   # Client
@@ -158,6 +158,35 @@ _tasks_slice_expiration_delay = gae_ts_mon.CumulativeDistributionMetric(
     bucketer=gae_ts_mon.FixedWidthBucketer(width=30),
 )
 
+# Instance metric. Metric fields:
+# - shard: index of the scanned TaskToRunShard kind.
+_expiration_scan_lags = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/tasks/expiration_scan_lag',
+    'Delay between expiration_ts of the oldest expired TaskToRunShard found by '
+    'the expiration scan and the scan, in seconds.', [
+        gae_ts_mon.IntegerField('shard'),
+    ],
+    bucketer=_bucketer)
+
+# Instance metric. Metric fields:
+# - scheduler_id: id of the external scheduler.
+_es_notify_batch_sizes = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/external_scheduler/notify_batch_size',
+    'Number of notifications sent per batched NotifyTasks request.', [
+        gae_ts_mon.StringField('scheduler_id'),
+    ],
+    bucketer=_bucketer)
+
+# Instance metric. Metric fields:
+# - scheduler_id: id of the external scheduler.
+_es_notify_flush_latencies = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/external_scheduler/notify_flush_latency',
+    'Delay between the oldest notification of a batched NotifyTasks request '
+    'and its flush to es-notify-tasks, in ms.', [
+        gae_ts_mon.StringField('scheduler_id'),
+    ],
+    bucketer=_scheduler_bucketer)
+
 # Instance metric. Metric fields:
 # - auth_method = one of 'luci_token', 'service_account', 'ip_whitelist'.
 # - condition = depends on the auth method (e.g. email for 'service_account').
@@ -237,6 +266,42 @@ _ttr_consume_latencies = \
     bucketer=_scheduler_bucketer,
 )
 
+# Instance metric. Metric fields:
+# - source: where the dedup candidate was found: 'process', 'memcache',
+#   'datastore', 'query' or 'none'.
+# - result: 'hit', 'miss', 'expired' or 'stale'.
+_dedup_lookups = gae_ts_mon.CounterMetric(
+    'swarming/tasks/dedup_lookups',
+    'Number of lookups of a task to dedupe an idempotent task against', [
+        gae_ts_mon.StringField('source'),
+        gae_ts_mon.StringField('result'),
+    ])
+
+# Instance metric. Metric fields:
+# - source: same as in swarming/tasks/dedup_lookups.
+_dedup_lookup_latencies = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/tasks/dedup_lookup_latencies',
+    'Latency (in ms) of a lookup of a task to dedupe against',
+    [
+        gae_ts_mon.StringField('source'),
+    ],
+    bucketer=_bucketer,
+)
+
+# Instance metric. Metric fields:
+# - result: 'hit' if the per-bot poll cache allowed to skip loading matched
+#   TaskDimensionsSets, 'miss' otherwise.
+_poll_cache_lookups = gae_ts_mon.CounterMetric(
+    'swarming/bots/poll_cache_lookups',
+    'Number of lookups of the per-bot poll cache of matched task queues', [
+        gae_ts_mon.StringField('result'),
+    ])
+
+# Instance metric.
+_poll_cache_rpcs_saved = gae_ts_mon.CounterMetric(
+    'swarming/bots/poll_cache_rpcs_saved',
+    'Number of TaskDimensionsSets loads skipped thanks to the poll cache', [])
+
 # Instance metric. Metric fields:
 # - pool: e.g. 'skia'.
 # - queue_count: number of queues scanned in parallel (up to 30).
@@ -248,7 +313,10 @@ _scheduler_scans = gae_ts_mon.CounterMetric(
 
 # Instance metric. Metric fields:
 # - pool: e.g. 'skia'.
-# - status: 'claimed', 'expired', etc.
+# - status: 'claimed', 'expired', etc. 'inversion' is a number of items that
+#   were fetched after a lower priority item was already yielded.
+#   'claim_rpcs_saved' is a number of memcache claim RPCs avoided thanks to the
+#   local claim cache and batched claims.
 _scheduler_visits = gae_ts_mon.CumulativeDistributionMetric(
     'swarming/scheduler/visits',
     'Distribution of TaskToRunShard visited per scan', [
@@ -395,6 +463,18 @@ def on_task_to_run_consumed(summary, task_to_run):
   _ttr_consume_latencies.add(max(0, round(latency * 1000)), fields=fields)
 
 
+def on_expiration_scan(shard, lag):
+  if lag is not None:
+    _expiration_scan_lags.add(lag.total_seconds(), fields={'shard': shard})
+
+
+def on_es_notifications_flushed(scheduler_id, count, latency):
+  fields = {'scheduler_id': scheduler_id}
+  _es_notify_batch_sizes.add(count, fields=fields)
+  _es_notify_flush_latencies.add(
+      max(0, round(latency.total_seconds() * 1000)), fields=fields)
+
+
 def on_bot_auth_success(auth_method, condition):
   _bot_auth_successes.increment(fields={
       'auth_method': auth_method,
@@ -435,6 +515,18 @@ def on_dead_task_detection_latency(tags, latency, cron):
                                      fields=fields)
 
 
+def on_dedup_lookup(source, result, latency):
+  _dedup_lookups.increment(fields={'source': source, 'result': result})
+  _dedup_lookup_latencies.add(round(latency.total_seconds() * 1000),
+                              fields={'source': source})
+
+
+def on_poll_cache_lookup(hit, rpcs_saved):
+  _poll_cache_lookups.increment(fields={'result': 'hit' if hit else 'miss'})
+  if rpcs_saved:
+    _poll_cache_rpcs_saved.increment_by(rpcs_saved)
+
+
 def on_scheduler_scan(pool, queue_count):
   _scheduler_scans.increment(
       fields={
@@ -443,11 +535,20 @@ def on_scheduler_scan(pool, queue_count):
       })
 
 
-def on_scheduler_visits(pool, claimed, mismatch, stale, total, visited):
+def on_scheduler_visits(pool,
+                        claimed,
+                        mismatch,
+                        stale,
+                        total,
+                        visited,
+                        inversions=0,
+                        claim_rpcs_saved=0):
   def add(key, val):
     _scheduler_visits.add(val, fields={'pool': pool, 'status': key})
 
   add('claimed', claimed)
+  add('claim_rpcs_saved', claim_rpcs_saved)
+  add('inversion', inversions)
   add('mismatch', mismatch)
   add('stale', stale)
   add('total', total)
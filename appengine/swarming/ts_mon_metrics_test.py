@@ -239,6 +239,24 @@ class TestMetrics(test_case.TestCase):
         5000.0,
         ts_mon_metrics._ttr_consume_latencies.get(fields=fields).sum)
 
+  def test_on_expiration_scan(self):
+    ts_mon_metrics.on_expiration_scan(3, datetime.timedelta(seconds=70))
+    ts_mon_metrics.on_expiration_scan(3, None)
+    self.assertEqual(
+        70,
+        ts_mon_metrics._expiration_scan_lags.get(fields={
+            'shard': 3
+        }).sum)
+
+  def test_on_es_notifications_flushed(self):
+    ts_mon_metrics.on_es_notifications_flushed(
+        'foo', 3, datetime.timedelta(seconds=2))
+    fields = {'scheduler_id': 'foo'}
+    self.assertEqual(3, ts_mon_metrics._es_notify_batch_sizes.get(
+        fields=fields).sum)
+    self.assertEqual(2000, ts_mon_metrics._es_notify_flush_latencies.get(
+        fields=fields).sum)
+
   def test_on_task_status_change_scheduler_latency(self):
     tags = [
         'project:test_project', 'subproject:test_subproject', 'pool:test_pool',
@@ -425,6 +443,30 @@ class TestMetrics(test_case.TestCase):
             'cron': True,
         }).sum)
 
+  def test_on_dedup_lookup(self):
+    ts_mon_metrics.on_dedup_lookup('memcache', 'hit',
+                                   datetime.timedelta(milliseconds=3))
+    self.assertEqual(
+        1,
+        ts_mon_metrics._dedup_lookups.get(fields={
+            'source': 'memcache',
+            'result': 'hit',
+        }))
+    self.assertEqual(
+        3,
+        ts_mon_metrics._dedup_lookup_latencies.get(fields={
+            'source': 'memcache',
+        }).sum)
+
+  def test_on_poll_cache_lookup(self):
+    ts_mon_metrics.on_poll_cache_lookup(True, 3)
+    ts_mon_metrics.on_poll_cache_lookup(False, 0)
+    self.assertEqual(
+        1, ts_mon_metrics._poll_cache_lookups.get(fields={'result': 'hit'}))
+    self.assertEqual(
+        1, ts_mon_metrics._poll_cache_lookups.get(fields={'result': 'miss'}))
+    self.assertEqual(3, ts_mon_metrics._poll_cache_rpcs_saved.get())
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
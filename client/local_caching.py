@@ -68,6 +68,11 @@ def is_valid_file(path, size):
   return True
 
 
+def _named_cache_size(value):
+  """Returns the size of a NamedCache LRU value (rel_path, size)."""
+  return value[1]
+
+
 def trim_caches(caches, path, min_free_space, max_age_secs):
   """Trims multiple caches.
 
@@ -314,8 +319,8 @@ class MemoryContentAddressedCache(ContentAddressedCache):
     """
     super(MemoryContentAddressedCache, self).__init__(None)
     self._file_mode_mask = file_mode_mask
-    # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    # Items in a LRU lookup dict(digest: content).
+    self._lru = lru.LRUDict(size_fn=len)
 
   # Cache interface implementation.
 
@@ -334,7 +339,7 @@ class MemoryContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(len(i) for i in self._lru.values())
+      return self._lru.total_size
 
   def oldest_evictable_ts(self):
     with self._lock:
@@ -396,9 +401,16 @@ class MemoryContentAddressedCache(ContentAddressedCache):
 class DiskContentAddressedCache(ContentAddressedCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
-  Saves its state as json file.
+  Saves its state in STATE_FILE, in the binary journaled format of LRUDict.
   """
   STATE_FILE = 'state.json'
+  # Digest up to which cleanup() verified the items, in sorted order. Present
+  # only while a verification is in progress.
+  CLEANUP_CURSOR_FILE = 'cleanup.cursor'
+  # Number of items verified concurrently by cleanup().
+  VERIFY_THREADS = 8
+  # Number of items verified before committing the results.
+  VERIFY_BATCH = 256
 
   def __init__(self, cache_dir, policies, trim, time_fn=None):
     """
@@ -414,7 +426,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     self.policies = policies
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
     # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=int, binary=True)
     # Current cached free disk space. It is updated by self._trim().
     file_path.ensure_tree(self.cache_dir)
     self._free_disk = file_path.get_free_space(self.cache_dir)
@@ -446,7 +458,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(self._lru.values())
+      return self._lru.total_size
 
   def oldest_evictable_ts(self):
     with self._lock:
@@ -487,7 +499,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       previous = set(self._lru)
       # It'd be faster if there were a readdir() function.
       for filename in fs.listdir(self.cache_dir):
-        if filename == self.STATE_FILE:
+        if filename in (self.STATE_FILE, self.CLEANUP_CURSOR_FILE):
           fs.chmod(os.path.join(self.cache_dir, filename), 0o600)
           continue
         if filename in previous:
@@ -520,41 +532,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     # Verify hash of every single item to detect corruption. the corrupted
     # files will be evicted.
-    total = 0
-    verified = 0
-    deleted = 0
-    logging.info(
-        'DiskContentAddressedCache.cleanup(): Verifying modified files')
-    with self._lock:
-      for digest, (_, timestamp) in list(self._lru._items.items()):
-        total += 1
-        # verify only if the mtime is grather than the timestamp in state.json
-        # to avoid take too long time.
-        if self._get_mtime(digest) <= timestamp:
-          continue
-        logging.warning(
-            'DiskContentAddressedCache.cleanup(): Item has been modified.'
-            ' verifying item: %s', digest)
-        is_valid = self._is_valid_hash(digest)
-        verified += 1
-        logging.warning(
-            'DiskContentAddressedCache.cleanup(): verified. is_valid: %s, '
-            'item: %s', is_valid, digest)
-        if is_valid:
-          # Update timestamp in state.json
-          self._lru.touch(digest)
-          continue
-        # remove corrupted file from LRU and file system
-        self._lru.pop(digest)
-        self._delete_file(digest, UNKNOWN_FILE_SIZE)
-        deleted += 1
-        logging.error(
-            'DiskContentAddressedCache.cleanup(): Deleted corrupted item: %s',
-            digest)
-      self._save()
-    logging.info(
-        'DiskContentAddressedCache.cleanup(): Verified modified files.'
-        ' total: %d, verified: %d, deleted: %d', total, verified, deleted)
+    self._verify_items()
 
   # ContentAddressedCache interface implementation.
 
@@ -647,7 +625,8 @@ class DiskContentAddressedCache(ContentAddressedCache):
     else:
       # Load state of the cache.
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            self.state_file, size_fn=int, binary=True)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken cache dir.
@@ -688,11 +667,8 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.values())
-      while total_size > self.policies.max_cache_size:
-        e = self._remove_lru_file(True)
-        evicted.append(e)
-        total_size -= e
+      while self._lru.total_size > self.policies.max_cache_size:
+        evicted.append(self._remove_lru_file(True))
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
@@ -709,7 +685,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       evicted.append(self._remove_lru_file(True))
 
     if evicted:
-      total_usage = sum(self._lru.values())
+      total_usage = self._lru.total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -736,7 +712,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     try:
       digest, _ = self._lru.get_oldest()
       if not allow_protected and digest == self._protected:
-        total_size = sum(self._lru.values())
+        total_size = self._lru.total_size
         msg = ('Not enough space to fetch the whole isolated tree.\n'
                ' %s\n  cache=%d bytes (%.3f GiB), %d items; '
                '%s bytes (%.3f GiB) free_space') % (
@@ -790,6 +766,106 @@ class DiskContentAddressedCache(ContentAddressedCache):
       if e.errno != errno.ENOENT:
         logging.error('Error attempting to delete a file %s:\n%s' % (digest, e))
 
+  def _verify_items(self):
+    """Verifies the items modified since they were added and evicts corrupted
+    ones.
+
+    The files are checked without holding the lock, in sorted digest order, by
+    a thread pool. Results are committed every VERIFY_BATCH items and the last
+    committed digest is saved in CLEANUP_CURSOR_FILE, so an interrupted
+    verification resumes where it stopped.
+    """
+    cursor_file = os.path.join(self.cache_dir, self.CLEANUP_CURSOR_FILE)
+    cursor = ''
+    try:
+      with fs.open(cursor_file, 'r') as f:
+        cursor = f.read().strip()
+      logging.info(
+          'DiskContentAddressedCache.cleanup(): Resuming verification after %s',
+          cursor)
+    except (IOError, OSError):
+      pass
+    with self._lock:
+      items = sorted(
+          (digest, item)
+          for digest, item in self._lru._items.items() if digest > cursor)
+
+    total = 0
+    verified = 0
+    deleted = 0
+    hashed_bytes = 0
+    start = time.time()
+    logging.info(
+        'DiskContentAddressedCache.cleanup(): Verifying modified files')
+    with threading_utils.ThreadPool(
+        0, self.VERIFY_THREADS, 0, prefix='cache-verify') as pool:
+      for i in range(0, len(items), self.VERIFY_BATCH):
+        batch = items[i:i + self.VERIFY_BATCH]
+        for digest, (_, timestamp) in batch:
+          pool.add_task(0, self._verify_item, digest, timestamp)
+        results = dict(pool.join())
+        with self._lock:
+          for digest, item in batch:
+            total += 1
+            is_valid, size = results[digest]
+            if is_valid is None:
+              # Not modified.
+              continue
+            verified += 1
+            hashed_bytes += size
+            if self._lru._items.get(digest) != item:
+              # Modified while being verified, it will be checked next time.
+              continue
+            if is_valid:
+              # Update timestamp in state.json
+              self._lru.touch(digest)
+              continue
+            # remove corrupted file from LRU and file system
+            self._lru.pop(digest)
+            self._delete_file(digest, UNKNOWN_FILE_SIZE)
+            deleted += 1
+            logging.error(
+                'DiskContentAddressedCache.cleanup(): Deleted corrupted item: '
+                '%s', digest)
+          self._save()
+          with fs.open(cursor_file, 'w') as f:
+            f.write(batch[-1][0])
+    file_path.try_remove(cursor_file)
+
+    duration = max(time.time() - start, 0.001)
+    logging.info(
+        'DiskContentAddressedCache.cleanup(): Verified modified files.'
+        ' total: %d, verified: %d, deleted: %d, %.1f files/s, %.1f bytes/s',
+        total, verified, deleted, total / duration, hashed_bytes / duration)
+
+  def _verify_item(self, digest, timestamp):
+    """Checks one item. Called without the lock held.
+
+    Returns:
+      (digest, (is_valid, size)) where is_valid is None if the file was not
+      modified since it was added to the cache.
+    """
+    try:
+      # verify only if the mtime is grather than the timestamp in state.json
+      # to avoid take too long time.
+      if self._get_mtime(digest) <= timestamp:
+        return digest, (None, 0)
+      size = fs.stat(self._path(digest)).st_size
+    except OSError:
+      # The file is gone, evict the item.
+      return digest, (False, 0)
+    logging.warning(
+        'DiskContentAddressedCache.cleanup(): Item has been modified.'
+        ' verifying item: %s', digest)
+    try:
+      is_valid = self._is_valid_hash(digest)
+    except (IOError, OSError):
+      is_valid = False
+    logging.warning(
+        'DiskContentAddressedCache.cleanup(): verified. is_valid: %s, '
+        'item: %s', is_valid, digest)
+    return digest, (is_valid, size)
+
   def _get_mtime(self, digest):
     """Get mtime of cache file."""
     return  os.path.getmtime(self._path(digest))
@@ -836,13 +912,14 @@ class NamedCache(Cache):
     self._policies = policies
     # LRU {cache_name -> tuple(cache_location, size)}
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=_named_cache_size)
     self._keep = set(keep or [])
     if not fs.isdir(self.cache_dir):
       fs.makedirs(self.cache_dir)
     elif fs.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            self.state_file, size_fn=_named_cache_size)
         for _, size in self._lru.values():
           if not isinstance(size, int):
             with open(self.state_file, 'r') as f:
@@ -855,7 +932,7 @@ class NamedCache(Cache):
             'NamedCache: failed to load named cache state file; obliterating')
         file_path.rmtree(self.cache_dir)
         fs.makedirs(self.cache_dir)
-        self._lru = lru.LRUDict()
+        self._lru = lru.LRUDict(size_fn=_named_cache_size)
       with self._lock:
         self._try_upgrade()
     if time_fn:
@@ -1038,7 +1115,7 @@ class NamedCache(Cache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(size for _rel_path, size in self._lru.values())
+      return self._lru.total_size
 
   def _oldest_evictable_item(self):
     self._lock.assert_locked()
@@ -1120,8 +1197,7 @@ class NamedCache(Cache):
       # Trim according to maximum total size.
       if self._policies.max_cache_size:
         while self._lru:
-          total = sum(size for _rel_cache, size in self._lru.values())
-          if total <= self._policies.max_cache_size:
+          if self._lru.total_size <= self._policies.max_cache_size:
             break
           name, size = self._remove_lru_item()
           if not name:
@@ -0,0 +1,173 @@
+#!/usr/bin/env vpython3
+# Copyright 2026 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import threading
+import time
+
+# Mutates sys.path.
+import test_env
+
+# third_party/
+from depot_tools import auto_stub
+from infra_libs import bqh
+
+_real_sleep = time.sleep
+
+
+class FakeBigQueryClient:
+  """Implements the parts of google.cloud.bigquery.client.Client used by bqh.
+
+  errors maps a row to the list of insert errors to return for it, one per
+  attempt. The row is inserted once they are exhausted.
+  """
+
+  project = 'fake-project'
+
+  def __init__(self, errors=None, delay=0):
+    self.errors = {k: list(v) for k, v in (errors or {}).items()}
+    self.delay = delay
+    self.tables = 0
+    self.requests = []
+    self.inserted = []
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self._lock = threading.Lock()
+
+  def dataset(self, dataset_id):
+    return self
+
+  def table(self, table_id):
+    return table_id
+
+  def get_table(self, table):
+    self.tables += 1
+    return table
+
+  def create_rows(self, table, rows):
+    with self._lock:
+      self.requests.append(list(rows))
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    try:
+      time.sleep(self.delay)
+      insert_errors = []
+      with self._lock:
+        for i, row in enumerate(rows):
+          errors = self.errors.get(row)
+          if errors:
+            insert_errors.append({
+                'index': i,
+                'errors': [{
+                    'reason': errors.pop(0)
+                }],
+            })
+          else:
+            self.inserted.append(row)
+      return insert_errors
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+
+
+def _rows(count):
+  return [(i,) for i in range(count)]
+
+
+class SendRowsStreamingTest(auto_stub.TestCase):
+
+  def setUp(self):
+    super(SendRowsStreamingTest, self).setUp()
+    self.mock(bqh, '_table_cache', {})
+    self.mock(bqh.time, 'sleep', lambda _: None)
+
+  def test_batching(self):
+    client = FakeBigQueryClient()
+    self.assertEqual((7, []),
+                     bqh.send_rows_streaming(
+                         client, 'dataset', 'table', iter(_rows(7)),
+                         batch_size=3, max_in_flight=1))
+    self.assertEqual([_rows(7)[0:3], _rows(7)[3:6], _rows(7)[6:]],
+                     client.requests)
+    # The table is reused.
+    bqh.send_rows_streaming(client, 'dataset', 'table', _rows(1))
+    self.assertEqual(1, client.tables)
+
+  def test_max_in_flight(self):
+    # Use the real sleep to have the requests overlap.
+    self.mock(bqh.time, 'sleep', _real_sleep)
+    client = FakeBigQueryClient(delay=0.01)
+    consumed = []
+
+    def rows():
+      for row in _rows(40):
+        consumed.append(row)
+        # Rows are consumed at most a few batches ahead of the requests: the
+        # queued ones, the ones taken by the workers and the one being filled.
+        ahead = len(consumed) - 2 * len(client.requests)
+        self.assertLessEqual(ahead, 2 * (3 + 3 + 1))
+        yield row
+
+    self.assertEqual((40, []),
+                     bqh.send_rows_streaming(
+                         client, 'dataset', 'table', rows(),
+                         batch_size=2, max_in_flight=3))
+    self.assertEqual(sorted(_rows(40)), sorted(client.inserted))
+    self.assertLessEqual(client.max_in_flight, 3)
+
+  def test_retry_partial_errors(self):
+    client = FakeBigQueryClient(
+        errors={
+            (1,): ['backendError'],
+            (2,): ['invalid'],
+            (3,): ['stopped', 'timeout'],
+        })
+    inserted, errors = bqh.send_rows_streaming(
+        client, 'dataset', 'table', _rows(5), batch_size=5)
+    self.assertEqual(4, inserted)
+    self.assertEqual([{'index': 2, 'errors': [{'reason': 'invalid'}]}], errors)
+    # Only the rows that failed transiently are resent.
+    self.assertEqual([_rows(5), [(1,), (3,)], [(3,)]], client.requests)
+
+  def test_retry_exhausted(self):
+    client = FakeBigQueryClient(errors={(6,): ['backendError'] * 3})
+    inserted, errors = bqh.send_rows_streaming(
+        client, 'dataset', 'table', _rows(8), batch_size=5, retries=2)
+    self.assertEqual(7, inserted)
+    # The index is the position of the row in the input.
+    self.assertEqual([{'index': 6, 'errors': [{'reason': 'backendError'}]}],
+                     errors)
+    self.assertEqual(4, len(client.requests))
+
+  def test_generator_raises(self):
+    client = FakeBigQueryClient()
+
+    def rows():
+      for row in _rows(5):
+        yield row
+      raise ValueError('Oops')
+
+    with self.assertRaises(ValueError):
+      bqh.send_rows_streaming(
+          client, 'dataset', 'table', rows(), batch_size=2, max_in_flight=2)
+    # The complete batches were sent and the workers are gone.
+    self.assertEqual(sorted(_rows(4)), sorted(client.inserted))
+    self.assertEqual(
+        [], [t for t in threading.enumerate()
+             if t.name == 'bqh.send_rows_streaming'])
+
+  def test_create_rows_raises(self):
+    client = FakeBigQueryClient()
+
+    def create_rows(table, rows):
+      raise IOError('Oops')
+
+    self.mock(client, 'create_rows', create_rows)
+    with self.assertRaises(IOError):
+      bqh.send_rows_streaming(client, 'dataset', 'table', _rows(10),
+                              batch_size=2)
+
+
+if __name__ == '__main__':
+  test_env.main()
@@ -5,6 +5,7 @@
 
 import hashlib
 import json
+import logging
 import os
 import random
 import string
@@ -329,7 +330,7 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
         sorted([h, cache.STATE_FILE]), sorted(fs.listdir(cache.cache_dir)))
     items = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.STATE_FILE))
     self.assertEqual(1, len(items))
-    self.assertEqual((h, [2, 1000]), items.get_oldest())
+    self.assertEqual((h, (2, 1000)), items.get_oldest())
 
   def test_cleanup_disk(self):
     # Inject an item without a state.json, one is lost. Both will be deleted on
@@ -395,6 +396,39 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
                           (fs.listdir(cache.cache_dir)))
     self.assertCountEqual([(h_b, (1, mtime_b))], cache._lru._items.items())
 
+  def test_cleanup_disk_resume(self):
+    self._free_disk = 1003
+    cache = self.get_cache(_get_policies(min_free_space=1000))
+    digests = sorted(cache.write(self._algo(c).hexdigest(), [c])
+                     for c in (b'a', b'b', b'c'))
+    # All the files look modified.
+    self.mock(cache, '_get_mtime', lambda _: self._now + 1)
+    hashed = []
+    def _is_valid_hash(digest):
+      if digest == digests[2] and not hashed.count(digest):
+        hashed.append(digest)
+        # Simulates the bot being interrupted.
+        raise IndexError('interrupted')
+      hashed.append(digest)
+      return True
+    self.mock(cache, '_is_valid_hash', _is_valid_hash)
+    self.mock(cache, 'VERIFY_BATCH', 1)
+    cursor_file = os.path.join(cache.cache_dir, cache.CLEANUP_CURSOR_FILE)
+
+    # Interrupted while verifying the last item, the progress was recorded.
+    with self.assertRaises(IndexError):
+      cache.cleanup()
+    self.assertEqual(digests, hashed)
+    with fs.open(cursor_file, 'r') as f:
+      self.assertEqual(digests[1], f.read())
+
+    # Resumes after the last committed item.
+    cache.cleanup()
+    self.assertEqual(digests + [digests[2]], hashed)
+    self.assertEqual(
+        sorted(digests + [cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+
   def test_policies_active_trimming(self):
     # Start with a larger cache, add many object.
     # Reload the cache with smaller policies, the cache should be trimmed on
@@ -871,6 +905,46 @@ class NamedCacheTest(TestCase, CacheTestMixin):
                      sorted(fs.listdir(cache.cache_dir)))
 
 
+class DiskContentAddressedCacheBenchmark(TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def test_benchmark_trim(self):
+    # time.time() is mocked by TestCase, use time.perf_counter().
+    n = 500000
+    cache = local_caching.DiskContentAddressedCache(
+        os.path.join(self.tempdir, 'cache'), _get_policies(), trim=False)
+    # Only measure the LRU bookkeeping, not the file system or the state file.
+    self.mock(cache, '_delete_file', lambda *_: None)
+    self.mock(cache, '_save', lambda: None)
+    with cache._lock:
+      for i in range(n):
+        cache._lru.add('%040x' % i, 1000 + i % 1000)
+    expected = sum(cache._lru.values())
+    self.assertEqual(expected, cache.total_size)
+
+    start = time.perf_counter()
+    for _ in range(10):
+      sum(cache._lru.values())
+    sum_secs = (time.perf_counter() - start) / 10
+    start = time.perf_counter()
+    for _ in range(100):
+      _ = cache.total_size
+    total_size_secs = (time.perf_counter() - start) / 100
+
+    # Evict 1% of the entries.
+    cache.policies.max_cache_size = expected * 99 // 100
+    start = time.perf_counter()
+    evicted = cache.trim()
+    trim_secs = time.perf_counter() - start
+    self.assertEqual(expected - sum(evicted), cache.total_size)
+    logging.warning(
+        '%d entries: sum() %.1fms, total_size %.4fms; trimmed %d entries in '
+        '%.1fms', n, sum_secs * 1000, total_size_secs * 1000, len(evicted),
+        trim_secs * 1000)
+
+
 def _gen_state(items):
   state = {'items': items, 'version': lru.CURRENT_VERSION}
   return json.dumps(
@@ -910,10 +984,14 @@ class FnTest(TestCase):
         self._algo(_gen_data(n)).hexdigest(): _gen_data(n)
         for n in items
     }
-    expected[cache.STATE_FILE] = _gen_state(
-        [[self._algo(_gen_data(n)).hexdigest(), [n, self._now + n - 1]]
-         for n in items])
-    self.assertEqual(expected, read_tree(cache.cache_dir))
+    actual = read_tree(cache.cache_dir)
+    # The state file is in the binary format.
+    self.assertTrue(actual.pop(cache.STATE_FILE).startswith(b'LRUB'))
+    self.assertEqual(expected, actual)
+    state = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.STATE_FILE))
+    self.assertEqual(
+        [(self._algo(_gen_data(n)).hexdigest(), (n, self._now + n - 1))
+         for n in items], list(state._items.items()))
 
   def _prepare_named_cache(self, cache):
     self._prepare_cache(cache)
@@ -3,9 +3,12 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import hashlib
 import json
+import logging
 import os
 import tempfile
+import time
 import unittest
 
 # Mutates sys.path.
@@ -150,6 +153,46 @@ class LRUDictTest(unittest.TestCase):
     lru_dict.transform(lambda k, v: v + '*')
     self.assert_same_data([('ka', 'va*'), ('kb', 'vb*')], lru_dict)
 
+  def test_total_size(self):
+    lru_dict = lru.LRUDict(size_fn=len)
+    self.assertEqual(0, lru_dict.total_size)
+    lru_dict.add('ka', 'va')
+    lru_dict.add('kb', 'vbb')
+    lru_dict.add('kc', 'vccc')
+    self.assertEqual(9, lru_dict.total_size)
+    lru_dict.add('ka', 'vaaaa')
+    self.assertEqual(12, lru_dict.total_size)
+    lru_dict.touch('kb')
+    self.assertEqual(12, lru_dict.total_size)
+    lru_dict.pop('kc')
+    self.assertEqual(8, lru_dict.total_size)
+    lru_dict.pop_oldest()
+    self.assertEqual(3, lru_dict.total_size)
+    lru_dict.transform(lambda k, v: v + '*')
+    self.assertEqual(4, lru_dict.total_size)
+    # No size_fn, nothing is tracked.
+    self.assertEqual(0, _prepare_lru_dict([(1, 'one')]).total_size)
+
+  def test_load_total_size(self):
+    state = json.dumps({
+        'version': lru.CURRENT_VERSION,
+        'items': [
+            ['key1', [10, 1]],
+            ['key2', [20, 2]],
+        ],
+    })
+    handle, tmp_name = tempfile.mkstemp(prefix='lru_test')
+    os.close(handle)
+    try:
+      with open(tmp_name, 'w') as f:
+        f.write(state)
+      self.assertEqual(30, lru.LRUDict.load(tmp_name, size_fn=int).total_size)
+      # Values without a valid size.
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load(tmp_name, size_fn=lambda v: v[1])
+    finally:
+      os.unlink(tmp_name)
+
   def test_load_save_empty(self):
     self.assertFalse(_save_and_load(lru.LRUDict()))
 
@@ -213,5 +256,200 @@ class LRUDictTest(unittest.TestCase):
       ]))
 
 
+
+def _digest(i):
+  return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+class LRUDictBinaryTest(unittest.TestCase):
+  def setUp(self):
+    super(LRUDictBinaryTest, self).setUp()
+    handle, self.state_file = tempfile.mkstemp(prefix='lru_test')
+    os.close(handle)
+    self.now = 1
+
+  def tearDown(self):
+    try:
+      os.unlink(self.state_file)
+    finally:
+      super(LRUDictBinaryTest, self).tearDown()
+
+  def _new(self, load=False):
+    if load:
+      lru_dict = lru.LRUDict.load(self.state_file, size_fn=int, binary=True)
+    else:
+      lru_dict = lru.LRUDict(size_fn=int, binary=True)
+    lru_dict.time_fn = lambda: self.now
+    return lru_dict
+
+  def _read(self):
+    with open(self.state_file, 'rb') as f:
+      return f.read()
+
+  def test_load_save(self):
+    lru_dict = self._new()
+    for i in range(3):
+      lru_dict.add(_digest(i), i + 10)
+      self.now += 1
+    self.assertTrue(lru_dict.save(self.state_file))
+    self.assertTrue(self._read().startswith(b'LRUB'))
+    expected = [
+        (_digest(0), (10, 1)),
+        (_digest(1), (11, 2)),
+        (_digest(2), (12, 3)),
+    ]
+    loaded = self._new(load=True)
+    self.assertEqual(expected, list(loaded._items.items()))
+    self.assertEqual(33, loaded.total_size)
+    self.assertFalse(loaded.save(self.state_file))
+
+  def test_journal(self):
+    lru_dict = self._new()
+    for i in range(3):
+      lru_dict.add(_digest(i), i + 10)
+    lru_dict.save(self.state_file)
+    snapshot = self._read()
+
+    lru_dict = self._new(load=True)
+    self.now = 5
+    lru_dict.touch(_digest(0))
+    lru_dict.pop(_digest(1))
+    lru_dict.add(_digest(3), 13)
+    lru_dict.pop_oldest()
+    self.assertTrue(lru_dict.save(self.state_file))
+    # Only the 4 operations were appended.
+    content = self._read()
+    self.assertEqual(snapshot, content[:len(snapshot)])
+    self.assertEqual(4 * (1 + 32 + 8 + 8), len(content) - len(snapshot))
+    expected = [(_digest(0), (10, 5)), (_digest(3), (13, 5))]
+    self.assertEqual(expected, list(self._new(load=True)._items.items()))
+
+  def test_journal_compaction(self):
+    lru_dict = self._new()
+    lru_dict.add(_digest(0), 1)
+    lru_dict.save(self.state_file)
+    size = len(self._read())
+    # Enough touches to make the file rewritten.
+    for i in range(lru._JOURNAL_SLACK + 10):
+      self.now = i
+      lru_dict.touch(_digest(0))
+    lru_dict.save(self.state_file)
+    self.assertEqual(size, len(self._read()))
+    expected = [(_digest(0), (1, lru._JOURNAL_SLACK + 9))]
+    self.assertEqual(expected, list(self._new(load=True)._items.items()))
+
+  def test_transform_rewrites(self):
+    lru_dict = self._new()
+    lru_dict.add(_digest(0), 1)
+    lru_dict.add(_digest(1), 2)
+    lru_dict.save(self.state_file)
+    size = len(self._read())
+    lru_dict.transform(lambda _k, v: v * 10)
+    lru_dict.save(self.state_file)
+    self.assertEqual(size, len(self._read()))
+    loaded = self._new(load=True)
+    self.assertEqual([10, 20], list(loaded.values()))
+    self.assertEqual(30, loaded.total_size)
+
+  def test_partial_record(self):
+    lru_dict = self._new()
+    lru_dict.add(_digest(0), 1)
+    lru_dict.save(self.state_file)
+    lru_dict = self._new(load=True)
+    lru_dict.add(_digest(1), 2)
+    lru_dict.save(self.state_file)
+    # Simulate a crash in the middle of an append.
+    content = self._read()
+    with open(self.state_file, 'wb') as f:
+      f.write(content[:-5])
+    lru_dict = self._new(load=True)
+    self.assertEqual([_digest(0)], list(lru_dict))
+    # The file is rewritten on the next save.
+    lru_dict.add(_digest(2), 3)
+    lru_dict.save(self.state_file)
+    self.assertEqual([_digest(0), _digest(2)], list(self._new(load=True)))
+
+  def test_json_migration(self):
+    lru_dict = lru.LRUDict()
+    lru_dict.time_fn = lambda: self.now
+    lru_dict.add(_digest(0), 1)
+    lru_dict.save(self.state_file)
+    self.assertTrue(self._read().startswith(b'{'))
+    lru_dict = self._new(load=True)
+    self.assertEqual([(_digest(0), [1, 1])], list(lru_dict._items.items()))
+    lru_dict.add(_digest(1), 2)
+    lru_dict.save(self.state_file)
+    self.assertTrue(self._read().startswith(b'LRUB'))
+    self.assertEqual([_digest(0), _digest(1)], list(self._new(load=True)))
+
+  def test_json_fallback(self):
+    # Items that can't be represented in binary are saved as json.
+    lru_dict = self._new()
+    lru_dict.add('not a digest', 1)
+    lru_dict.save(self.state_file)
+    self.assertTrue(self._read().startswith(b'{'))
+    self.assertEqual(['not a digest'], list(self._new(load=True)))
+
+  def test_corrupted(self):
+    with open(self.state_file, 'wb') as f:
+      f.write(b'LRUB')
+    with self.assertRaises(ValueError):
+      self._new(load=True)
+    lru_dict = self._new()
+    lru_dict.add(_digest(0), 1)
+    lru_dict.save(self.state_file)
+    with open(self.state_file, 'ab') as f:
+      # Pop of an unknown key.
+      f.write(lru._binary_record(32).pack(
+          lru._OP_POP, bytes.fromhex(_digest(1)), 0, 0))
+    with self.assertRaises(ValueError):
+      self._new(load=True)
+
+
+class LRUDictBenchmark(unittest.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  def _benchmark(self, n):
+    lru_dict = lru.LRUDict(size_fn=int, binary=True)
+    for i in range(n):
+      lru_dict.add(_digest(i), i)
+    handle, state_file = tempfile.mkstemp(prefix='lru_test')
+    os.close(handle)
+    try:
+      for binary in (False, True):
+        lru_dict._binary = binary
+        lru_dict._dirty = True
+        start = time.perf_counter()
+        lru_dict.save(state_file)
+        save_secs = time.perf_counter() - start
+        size = os.path.getsize(state_file)
+        start = time.perf_counter()
+        loaded = lru.LRUDict.load(state_file, size_fn=int, binary=True)
+        load_secs = time.perf_counter() - start
+        self.assertEqual(n, len(loaded))
+        logging.warning(
+            '%d entries, %s: save %.3fs, load %.3fs, %.1fMiB', n,
+            'binary' if binary else 'json', save_secs, load_secs,
+            size / 1024. / 1024.)
+
+      # Save after a task touching a few hundred entries.
+      for i in range(0, n, n // 200):
+        loaded.touch(_digest(i))
+      start = time.perf_counter()
+      loaded.save(state_file)
+      logging.warning('%d entries, binary: save of 200 changes %.4fs', n,
+                      time.perf_counter() - start)
+    finally:
+      os.unlink(state_file)
+
+  def test_benchmark_100k(self):
+    self._benchmark(100000)
+
+  def test_benchmark_1m(self):
+    self._benchmark(1000000)
+
+
 if __name__ == '__main__':
   test_env.main()
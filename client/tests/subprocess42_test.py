@@ -8,6 +8,7 @@ from __future__ import print_function
 import ctypes
 import errno
 import itertools
+import logging
 import os
 import platform
 import signal
@@ -890,6 +891,74 @@ time.sleep(60)
     # be 0.
     self.assertLessEqual(0, proc.duration())
 
+  def test_yield_any_maxsize(self):
+    # Both pipes are drained in the same wakeups; chunks must still honor
+    # maxsize and not be reordered within a pipe.
+    script = (
+        'import sys;'
+        'sys.stdout.write("o" * 100000);sys.stdout.flush();'
+        'sys.stderr.write("e" * 100000);sys.stderr.flush()')
+    proc = subprocess42.Popen([sys.executable, '-c', script],
+                              stdout=subprocess42.PIPE,
+                              stderr=subprocess42.PIPE)
+    actual = {'stdout': b'', 'stderr': b''}
+    for p, data in proc.yield_any(maxsize=1000):
+      self.assertLessEqual(len(data), 1000)
+      actual[p] += data
+    self.assertEqual({'stdout': b'o' * 100000, 'stderr': b'e' * 100000}, actual)
+    self.assertEqual(0, proc.returncode)
+
+  def test_communicate_after_recv_any(self):
+    # Data already read by recv_any() from the other pipe must not be lost.
+    script = (
+        'import sys,time;'
+        'sys.stderr.write("A");sys.stderr.flush();'
+        'sys.stdout.write("B");sys.stdout.flush();'
+        'time.sleep(0.1);'
+        'sys.stdout.write("C")')
+    proc = subprocess42.Popen([sys.executable, '-c', script],
+                              stdout=subprocess42.PIPE,
+                              stderr=subprocess42.PIPE)
+    self.assertEqual(b'A', proc.recv_err(timeout=60))
+    stdout, stderr = proc.communicate(timeout=60)
+    self.assertEqual(b'BC', stdout)
+    self.assertEqual(b'', stderr)
+    self.assertEqual(0, proc.returncode)
+
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_recv_out_leaves_stderr(self):
+    # Reading stdout doesn't read stderr, even if the child keeps writing to it.
+    script = (
+        'import sys;'
+        'sys.stdout.write("A");sys.stdout.flush();'
+        'sys.stderr.write("e" * 1000000);sys.stderr.flush();'
+        'sys.stdout.write("B")')
+    proc = subprocess42.Popen([sys.executable, '-c', script],
+                              stdout=subprocess42.PIPE,
+                              stderr=subprocess42.PIPE)
+    self.assertEqual(b'A', proc.recv_out(timeout=60))
+    self.assertEqual(None, proc.recv_out(timeout=0.1))
+    self.assertEqual([], list(proc._reader._pending))
+    stdout, stderr = proc.communicate(timeout=60)
+    self.assertEqual(b'B', stdout)
+    self.assertEqual(b'e' * 1000000, stderr)
+    self.assertEqual(0, proc.returncode)
+
+  def test_recv_any_timeout_0(self):
+    # timeout=0 polls without waiting.
+    proc = subprocess42.Popen(
+        [sys.executable, '-c', 'import time;time.sleep(60)'],
+        stdout=subprocess42.PIPE,
+        stderr=subprocess42.PIPE)
+    try:
+      start = time.time()
+      for _ in range(100):
+        self.assertEqual((None, None), proc.recv_any(timeout=0))
+      self.assertLess(time.time() - start, 0.1)
+    finally:
+      proc.kill()
+      proc.communicate()
+
   def _wait_for_hi(self, proc, err):
     actual = b''
     while True:
@@ -1066,5 +1135,63 @@ time.sleep(60)
         "%s != %s after %s seconds" % (got, want, time.time() - start))
 
 
+class Subprocess42Benchmark(unittest.TestCase):
+  # Benchmark, need to run in sequential_test_runner.py as an executable to get
+  # meaningful numbers.
+  no_run = 1
+
+  # Size written to each of stdout and stderr by the child process.
+  _SIZE = 256 * 1024 * 1024
+
+  def _proc(self):
+    script = textwrap.dedent("""
+        import os, sys
+        data = b'x' * 65536
+        for _ in range(%d):
+          os.write(1, data)
+          os.write(2, data)
+        """) % (self._SIZE // 65536)
+    return subprocess42.Popen([sys.executable, '-c', script],
+                              stdout=subprocess42.PIPE,
+                              stderr=subprocess42.PIPE)
+
+  def _benchmark(self, name, read):
+    proc = self._proc()
+    start = time.perf_counter()
+    cpu = time.process_time()
+    total = read(proc)
+    cpu = time.process_time() - cpu
+    duration = time.perf_counter() - start
+    proc.wait()
+    self.assertEqual(2 * self._SIZE, total)
+    mb = total / 1024. / 1024.
+    logging.warning('%s: %.1fMB/s; %.3fms CPU/MB', name, mb / duration,
+                    cpu * 1000. / mb)
+
+  def _read_all(self, proc):
+    return sum(len(d) for _, d in proc.yield_any(maxsize=self._maxsize))
+
+  def test_yield_any(self):
+    for self._maxsize in (None, 1024 * 1024):
+      self._benchmark('yield_any(maxsize=%s)' % self._maxsize, self._read_all)
+
+  @unittest.skipIf(sys.platform == 'win32', 'posix only')
+  def test_yield_any_recv_multi_impl(self):
+    # The previous implementation: one select() and two fcntl() per read, and
+    # only one pipe read per call.
+    def recv_multi(pipes, maxsize, timeout):
+      conns, names = zip(*pipes)
+      index, data, closed = subprocess42.recv_multi_impl(
+          conns, maxsize, timeout)
+      return (None if index is None else names[index]), data, closed
+
+    def read(proc):
+      proc._recv_multi = recv_multi
+      return self._read_all(proc)
+
+    for self._maxsize in (None, 1024 * 1024):
+      self._benchmark('recv_multi_impl(maxsize=%s)' % self._maxsize, read)
+
+
 if __name__ == '__main__':
   test_env.main()
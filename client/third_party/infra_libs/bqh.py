@@ -7,6 +7,11 @@ import os
 import threading
 import time
 
+try:
+  import queue
+except ImportError:  # Python 2
+  import Queue as queue
+
 from google.protobuf import duration_pb2
 from google.protobuf import json_format
 from google.protobuf import message as message_pb
@@ -18,6 +23,21 @@ from google.protobuf import timestamp_pb2
 _BATCH_DEFAULT = 500
 _BATCH_LIMIT = 10000
 
+# Default number of concurrent create_rows() requests in send_rows_streaming().
+_IN_FLIGHT_DEFAULT = 4
+# Default number of times a row that failed transiently is resent.
+_RETRIES_DEFAULT = 3
+# Seconds a table fetched with get_table() is reused by send_rows_streaming().
+_TABLE_CACHE_EXPIRATION = 600
+# insertAll error reasons for which a row was not inserted but can be resent
+# as-is. 'stopped' means another row in the same request was invalid.
+_RETRYABLE_REASONS = frozenset(
+    ('backendError', 'internalError', 'stopped', 'timeout'))
+
+# (project, dataset_id, table_id) -> (expiration, table).
+_table_cache = {}
+_table_cache_lock = threading.Lock()
+
 # OAuth 2.0 scope to insert rows.
 INSERT_ROWS_SCOPE = 'https://www.googleapis.com/auth/bigquery.insertdata'
 
@@ -108,20 +128,8 @@ def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT):
   Please use google.protobuf.message.Message instances moving forward.
   Tuples are deprecated.
   """
-  if batch_size > _BATCH_LIMIT:
-    batch_size = _BATCH_LIMIT
-  elif batch_size <= 0:
-    batch_size = _BATCH_DEFAULT
-
-  rows_to_send = []
-  for row in rows:
-    if isinstance(row, tuple):
-      rows_to_send.append(row)
-      continue
-    if isinstance(row, message_pb.Message):
-      rows_to_send.append(message_to_dict(row))
-    else:
-      raise UnsupportedTypeError(type(row).__name__)
+  batch_size = _clamp_batch_size(batch_size)
+  rows_to_send = [_to_row(row) for row in rows]
 
   table = bq_client.get_table(bq_client.dataset(dataset_id).table(table_id))
   for row_set in _batch(rows_to_send, batch_size):
@@ -131,11 +139,171 @@ def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT):
       raise BigQueryInsertError(insert_errors)
 
 
+def send_rows_streaming(bq_client, dataset_id, table_id, rows,
+                        batch_size=_BATCH_DEFAULT,
+                        max_in_flight=_IN_FLIGHT_DEFAULT,
+                        retries=_RETRIES_DEFAULT):
+  """Sends rows to BigQuery without materializing them all.
+
+  Unlike send_rows(), rows are converted lazily as batches are filled, up to
+  max_in_flight batches are sent concurrently, the table is fetched at most
+  once every _TABLE_CACHE_EXPIRATION seconds and a failed insert doesn't abort
+  the export: rows that failed transiently are resent on their own, up to
+  |retries| times, and rows that failed permanently are returned.
+
+  Args:
+    bq_client: an instance of google.cloud.bigquery.client.Client
+    dataset_id, table_id (str): identifiers for the table to which the rows will
+      be inserted
+    rows: an iterable of rows, as accepted by send_rows(). It is consumed
+      lazily.
+    batch_size (int): see send_rows().
+    max_in_flight (int): the max number of concurrent create_rows() requests.
+    retries (int): the max number of times a row is resent.
+
+  Returns:
+    tuple(number of rows inserted, insert errors). Insert errors are in the
+    form described in BigQueryInsertError, where "index" is the position of
+    the row in |rows|.
+  """
+  batch_size = _clamp_batch_size(batch_size)
+  max_in_flight = max(max_in_flight, 1)
+  table = _get_table(bq_client, dataset_id, table_id)
+  start = time.time()
+
+  # Bounds the number of converted batches waiting to be sent.
+  pending = queue.Queue(maxsize=max_in_flight)
+  lock = threading.Lock()
+  results = {'inserted': 0, 'errors': [], 'exception': None}
+
+  def worker():
+    while True:
+      item = pending.get()
+      if item is None:
+        return
+      offset, batch = item
+      try:
+        inserted, errors = _insert_batch(
+            bq_client, table, offset, batch, retries)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Failed to send rows to bigquery')
+        with lock:
+          results['exception'] = results['exception'] or e
+        continue
+      with lock:
+        results['inserted'] += inserted
+        results['errors'].extend(errors)
+
+  threads = [
+      threading.Thread(target=worker, name='bqh.send_rows_streaming')
+      for _ in range(max_in_flight)
+  ]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  try:
+    for item in _batch_lazy(rows, batch_size):
+      if results['exception']:
+        break
+      pending.put(item)
+  finally:
+    for _ in threads:
+      pending.put(None)
+    for t in threads:
+      t.join()
+  if results['exception']:
+    raise results['exception']
+
+  errors = sorted(results['errors'], key=lambda e: e['index'])
+  duration = time.time() - start
+  logging.info(
+      'Sent %d rows to %s.%s in %.1fs (%.1f rows/s); %d failed',
+      results['inserted'], dataset_id, table_id, duration,
+      results['inserted'] / max(duration, 0.001), len(errors))
+  if errors:
+    logging.error('Failed to send rows to bigquery: %s', errors)
+  return results['inserted'], errors
+
+
+def _clamp_batch_size(batch_size):
+  if batch_size > _BATCH_LIMIT:
+    return _BATCH_LIMIT
+  if batch_size <= 0:
+    return _BATCH_DEFAULT
+  return batch_size
+
+
+def _to_row(row):
+  """Converts a row accepted by send_rows() to what create_rows() accepts."""
+  if isinstance(row, tuple):
+    return row
+  if isinstance(row, message_pb.Message):
+    return message_to_dict(row)
+  raise UnsupportedTypeError(type(row).__name__)
+
+
+def _get_table(bq_client, dataset_id, table_id):
+  """Returns the table, reusing it for _TABLE_CACHE_EXPIRATION seconds."""
+  key = (getattr(bq_client, 'project', None), dataset_id, table_id)
+  now = time.time()
+  with _table_cache_lock:
+    entry = _table_cache.get(key)
+  if entry and entry[0] > now:
+    return entry[1]
+  table = bq_client.get_table(bq_client.dataset(dataset_id).table(table_id))
+  with _table_cache_lock:
+    _table_cache[key] = (now + _TABLE_CACHE_EXPIRATION, table)
+  return table
+
+
+def _insert_batch(bq_client, table, offset, batch, retries):
+  """Inserts a batch, resending the rows that failed transiently.
+
+  Returns:
+    tuple(number of rows inserted, insert errors for the rows that failed
+    permanently, indexed from |offset|).
+  """
+  # Indexes in |batch| of the rows to send.
+  indexes = list(range(len(batch)))
+  failed = []
+  for attempt in range(retries + 1):
+    if attempt:
+      time.sleep(0.1 * 2**(attempt - 1))
+    insert_errors = bq_client.create_rows(table, [batch[i] for i in indexes])
+    retry = []
+    for row_mapping in insert_errors or []:
+      i = indexes[row_mapping['index']]
+      errors = row_mapping.get('errors') or []
+      reasons = set(err.get('reason') for err in errors)
+      if attempt < retries and reasons and reasons <= _RETRYABLE_REASONS:
+        retry.append(i)
+      else:
+        failed.append({'index': offset + i, 'errors': errors})
+    indexes = retry
+    if not indexes:
+      break
+  return len(batch) - len(failed), failed
+
+
 def _batch(rows, batch_size):
   for i in range(0, len(rows), batch_size):
     yield rows[i:i + batch_size]
 
 
+def _batch_lazy(rows, batch_size):
+  """Yields (offset, batch) from an iterable, converting rows as needed."""
+  batch = []
+  offset = 0
+  for row in rows:
+    batch.append(_to_row(row))
+    if len(batch) == batch_size:
+      yield offset, batch
+      offset += batch_size
+      batch = []
+  if batch:
+    yield offset, batch
+
+
 class UnsupportedTypeError(Exception):
   """BigQueryHelper only supports row representations described by send_rows.
 
@@ -6,10 +6,35 @@
 
 import collections
 import json
+import os
+import struct
 import time
 
 CURRENT_VERSION = 3
 
+# The binary state file starts with this header: magic, format version, the
+# size of the keys in bytes and the number of records in the snapshot. It is
+# followed by fixed width records, one per operation, replayed in order on load.
+# The snapshot records are one add per item, oldest first. The journal records
+# appended after them by LRUDict.save() are add/touch and pop operations.
+_BINARY_MAGIC = b'LRUB'
+_BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('<4sBB2xQ')
+
+# Operations stored in the binary records.
+_OP_ADD = 1
+_OP_POP = 2
+
+# The binary state file is rewritten from scratch when it would contain more
+# than 2 * len(items) + _JOURNAL_SLACK records, otherwise only the operations
+# done since the last save are appended.
+_JOURNAL_SLACK = 1024
+
+
+def _binary_record(key_size):
+  """Returns the struct of one record: op, raw key, value, timestamp."""
+  return struct.Struct('<B%dsqq' % key_size)
+
 
 class LRUDict:
   """Dictionary that can evict least recently used items.
@@ -20,7 +45,12 @@ class LRUDict:
 
   That is, the first item in self._items is the oldest item.
 
-  Can also store its state as *.json file on disk.
+  If a size_fn is given, the sum of size_fn(value) over all items is kept up to
+  date on every mutation so total_size is O(1).
+
+  Can also store its state as *.json file on disk, or in a binary journaled
+  format when the keys are hex digests and the values and timestamps are
+  integers.
   """
   @staticmethod
   def time_fn():
@@ -30,12 +60,27 @@ class LRUDict:
     """
     return int(round(time.time()))
 
-  def __init__(self):
+  def __init__(self, size_fn=None, binary=False):
     # Ordered key -> (value, timestamp) mapping,
     # newest items at the bottom.
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Returns the size of a value, or None to not keep track of sizes.
+    self._size_fn = size_fn
+    # Sum of self._size_fn(value) of all the items.
+    self._total_size = 0
+    # True if save() should use the binary format when possible.
+    self._binary = binary
+    # Operations (op, key, value, timestamp) done since the state was last
+    # loaded or saved in the binary format. None if the file must be rewritten.
+    self._journal = [] if binary else None
+    # The binary state file self._journal can be appended to, its key size, its
+    # number of records and its size in bytes.
+    self._journal_file = None
+    self._key_size = 0
+    self._file_records = 0
+    self._file_size = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -57,78 +102,67 @@ class LRUDict:
     """Returns value for |key| or raises KeyError if not found."""
     return self._items[key][0]
 
+  @property
+  def total_size(self):
+    """Sum of size_fn(value) of all the items, 0 if there is no size_fn."""
+    return self._total_size
+
   @classmethod
-  def load(cls, state_file):
+  def load(cls, state_file, size_fn=None, binary=False):
     """Loads previously saved state and returns LRUDict in that state.
 
+    Both the json and the binary formats are supported, independently of
+    |binary| which only affects save().
+
     Raises ValueError if state file is corrupted.
     """
-
     try:
-      json_state = None
-      with open(state_file, 'r') as f:
-        json_state = f.read()
-        state = json.loads(json_state)
-    except (IOError, ValueError) as e:
-      raise ValueError(
-          'Broken state file %s with "%s": %s' % (state_file, json_state, e))
-    if not isinstance(state, dict):
-      raise ValueError(
-          'Broken state file %s, should be json object or list' % (state_file,))
-    state_ver = state.get('version')
-    if state_ver != CURRENT_VERSION:
-      raise ValueError(
-          'Unsupported state file %s, version is %s. '
-          'Latest supported is %d' % (state_file, state_ver, CURRENT_VERSION))
-    state_items = state.get('items')
-    if not isinstance(state_items, list):
-      raise ValueError(
-          'Broken state file %s, items should be json list' % (state_file,))
-    lru = cls()
-    # Items are stored oldest to newest. Put them back in the same order.
-    for item in state_items:
-      if not isinstance(item, list) or len(item) != 2:
-        raise ValueError(
-            'Broken state file %s, expecting pairs: %s' % (state_file, item))
-      if not isinstance(item[1], list) or len(item[1]) != 2:
-        raise ValueError(
-            'Broken state file %s, expecting second item to be a item: %s' % (
-              state_file, item))
-      if not isinstance(item[1][1], (int, float)):
-        raise ValueError(
-            'Broken state file %s, expecting second item of the second item '
-            'to be a number: %s' % (state_file, item))
+      with open(state_file, 'rb') as f:
+        raw_state = f.read()
+    except IOError as e:
+      raise ValueError('Broken state file %s: %s' % (state_file, e))
 
-    lru._items = collections.OrderedDict(state_items)
+    lru = cls(size_fn, binary)
+    if raw_state.startswith(_BINARY_MAGIC):
+      lru._load_binary(state_file, raw_state)
+    else:
+      lru._load_json(state_file, raw_state)
 
-    # Check for duplicate keys.
-    if len(lru) != len(state_items):
+    try:
+      lru._recalculate_total_size()
+    except (IndexError, TypeError, ValueError) as e:
       raise ValueError(
-          'Broken state file %s, found duplicate keys' % (state_file,))
+          'Broken state file %s, invalid size: %s' % (state_file, e))
 
     # Now state from the file corresponds to state in the memory.
     lru._dirty = False
     return lru
 
   def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+    """Saves cache state to a file if it was modified.
+
+    In the binary format, only the operations done since the last load() or
+    save() are appended to the file, unless the file accumulated too many stale
+    records in which case it is rewritten.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'w') as f:
-      contents = {
-          'version': CURRENT_VERSION,
-          'items': list(self._items.items()),
-      }
-      json.dump(contents, f, sort_keys=True, separators=(',', ':'))
-
+    if not self._append_journal(state_file):
+      self._write_snapshot(state_file)
     self._dirty = False
     return True
 
   def add(self, key, value):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
-    self._items[key] = (value, self.time_fn())
+    old = self._items.pop(key, None)
+    if self._size_fn:
+      if old is not None:
+        self._total_size -= self._size_fn(old[0])
+      self._total_size += self._size_fn(value)
+    item = (value, self.time_fn())
+    self._items[key] = item
+    self._record(_OP_ADD, key, item)
     self._dirty = True
 
   def get(self, key, default=None):
@@ -141,7 +175,9 @@ class LRUDict:
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = (self._items.pop(key)[0], self.time_fn())
+    item = (self._items.pop(key)[0], self.time_fn())
+    self._items[key] = item
+    self._record(_OP_ADD, key, item)
     self._dirty = True
 
   def pop(self, key):
@@ -150,6 +186,9 @@ class LRUDict:
     Raises KeyError if |key| is not in the dict.
     """
     item = self._items.pop(key)
+    if self._size_fn:
+      self._total_size -= self._size_fn(item[0])
+    self._record(_OP_POP, key, (0, 0))
     self._dirty = True
     return item[0]
 
@@ -170,6 +209,9 @@ class LRUDict:
     Raises KeyError if dict is empty.
     """
     item = self._items.popitem(last=False)
+    if self._size_fn:
+      self._total_size -= self._size_fn(item[1][0])
+    self._record(_OP_POP, item[0], (0, 0))
     self._dirty = True
     return item
 
@@ -192,4 +234,192 @@ class LRUDict:
     """Updates the data format and saves immediately."""
     for key, (val, timestamp) in self._items.items():
       self._items[key] = (mutator(key, val), timestamp)
+    self._recalculate_total_size()
+    self._journal = None
     self._dirty = True
+
+  def _recalculate_total_size(self):
+    """Recalculates self._total_size from scratch."""
+    if self._size_fn:
+      self._total_size = sum(
+          self._size_fn(val) for val, _ in self._items.values())
+
+  def _record(self, op, key, item):
+    """Adds an operation to the journal."""
+    if self._journal is None:
+      return
+    if len(self._journal) > len(self._items) + _JOURNAL_SLACK:
+      # The file is going to be rewritten anyway.
+      self._journal = None
+      return
+    self._journal.append((op, key, item[0], item[1]))
+
+  def _load_json(self, state_file, raw_state):
+    """Loads the items from a json state file."""
+    json_state = None
+    try:
+      json_state = raw_state.decode('utf-8')
+      state = json.loads(json_state)
+    except ValueError as e:
+      raise ValueError(
+          'Broken state file %s with "%s": %s' % (state_file, json_state, e))
+    if not isinstance(state, dict):
+      raise ValueError(
+          'Broken state file %s, should be json object or list' % (state_file,))
+    state_ver = state.get('version')
+    if state_ver != CURRENT_VERSION:
+      raise ValueError(
+          'Unsupported state file %s, version is %s. '
+          'Latest supported is %d' % (state_file, state_ver, CURRENT_VERSION))
+    state_items = state.get('items')
+    if not isinstance(state_items, list):
+      raise ValueError(
+          'Broken state file %s, items should be json list' % (state_file,))
+    # Items are stored oldest to newest. Put them back in the same order.
+    for item in state_items:
+      if not isinstance(item, list) or len(item) != 2:
+        raise ValueError(
+            'Broken state file %s, expecting pairs: %s' % (state_file, item))
+      if not isinstance(item[1], list) or len(item[1]) != 2:
+        raise ValueError(
+            'Broken state file %s, expecting second item to be a item: %s' % (
+              state_file, item))
+      if not isinstance(item[1][1], (int, float)):
+        raise ValueError(
+            'Broken state file %s, expecting second item of the second item '
+            'to be a number: %s' % (state_file, item))
+
+    self._items = collections.OrderedDict(state_items)
+
+    # Check for duplicate keys.
+    if len(self) != len(state_items):
+      raise ValueError(
+          'Broken state file %s, found duplicate keys' % (state_file,))
+
+  def _load_binary(self, state_file, raw_state):
+    """Loads the items by replaying the records of a binary state file."""
+    if len(raw_state) < _BINARY_HEADER.size:
+      raise ValueError('Broken state file %s, truncated header' % state_file)
+    _magic, version, key_size, snapshot = _BINARY_HEADER.unpack_from(raw_state)
+    if version != _BINARY_VERSION:
+      raise ValueError(
+          'Unsupported state file %s, binary version is %s. '
+          'Latest supported is %d' % (state_file, version, _BINARY_VERSION))
+    record = _binary_record(key_size)
+    body = memoryview(raw_state)[_BINARY_HEADER.size:]
+    split = snapshot * record.size
+    if split > len(body):
+      raise ValueError('Broken state file %s, truncated' % state_file)
+
+    # Fast path for the snapshot, which only contains unique additions.
+    if body[:split:record.size].tobytes().count(_OP_ADD) != snapshot:
+      raise ValueError(
+          'Broken state file %s, unexpected operation in snapshot' % state_file)
+    self._items = collections.OrderedDict(
+        (raw_key.hex(), (value, ts))
+        for _op, raw_key, value, ts in record.iter_unpack(body[:split]))
+    if len(self._items) != snapshot:
+      raise ValueError(
+          'Broken state file %s, found duplicate keys' % (state_file,))
+
+    # A record may have been partially appended if the process died while
+    # saving. Ignore it, the file will be rewritten on the next save.
+    journal = body[split:]
+    partial = len(journal) % record.size
+    if partial:
+      journal = journal[:-partial]
+    items = self._items
+    for op, raw_key, value, ts in record.iter_unpack(journal):
+      key = raw_key.hex()
+      if op == _OP_ADD:
+        items.pop(key, None)
+        items[key] = (value, ts)
+      elif op == _OP_POP:
+        if items.pop(key, None) is None:
+          raise ValueError(
+              'Broken state file %s, removing unknown key %s' %
+              (state_file, key))
+      else:
+        raise ValueError(
+            'Broken state file %s, unknown operation %d' % (state_file, op))
+
+    if not partial:
+      self._journal_file = state_file
+      self._key_size = key_size
+      self._file_records = snapshot + len(journal) // record.size
+      self._file_size = len(raw_state)
+
+  def _pack_records(self, records, key_size):
+    """Returns the binary records for (op, key, value, timestamp) tuples.
+
+    Raises ValueError if one of the item cannot be stored in binary.
+    """
+    record = _binary_record(key_size)
+    out = []
+    for op, key, value, ts in records:
+      if (not isinstance(key, str) or len(key) != 2 * key_size or
+          key != key.lower() or isinstance(value, bool)):
+        raise ValueError('Unsupported item %r: %r' % (key, value))
+      try:
+        out.append(record.pack(op, bytes.fromhex(key), value, ts))
+      except struct.error as e:
+        raise ValueError('Unsupported item %r: %s' % (key, e))
+    return b''.join(out)
+
+  def _append_journal(self, state_file):
+    """Appends the journal to the binary state file if possible.
+
+    Returns True on success.
+    """
+    if (not self._binary or self._journal is None or
+        state_file != self._journal_file):
+      return False
+    if (self._file_records + len(self._journal) >
+        2 * len(self._items) + _JOURNAL_SLACK):
+      return False
+    try:
+      if os.path.getsize(state_file) != self._file_size:
+        # The file was modified behind our back.
+        return False
+      records = self._pack_records(self._journal, self._key_size)
+    except (OSError, ValueError):
+      return False
+    with open(state_file, 'ab') as f:
+      f.write(records)
+    self._file_records += len(self._journal)
+    self._file_size += len(records)
+    self._journal = []
+    return True
+
+  def _write_snapshot(self, state_file):
+    """Rewrites the whole state file."""
+    content = None
+    if self._binary:
+      key_size = len(next(iter(self._items), '')) // 2
+      try:
+        content = _BINARY_HEADER.pack(
+            _BINARY_MAGIC, _BINARY_VERSION, key_size,
+            len(self._items)) + self._pack_records(
+                ((_OP_ADD, key, value, ts)
+                 for key, (value, ts) in self._items.items()), key_size)
+      except (ValueError, struct.error):
+        # Fallback to json.
+        content = None
+
+    if content is None:
+      with open(state_file, 'w') as f:
+        contents = {
+            'version': CURRENT_VERSION,
+            'items': list(self._items.items()),
+        }
+        json.dump(contents, f, sort_keys=True, separators=(',', ':'))
+      self._journal_file = None
+      return
+
+    with open(state_file, 'wb') as f:
+      f.write(content)
+    self._journal = []
+    self._journal_file = state_file
+    self._key_size = key_size
+    self._file_records = len(self._items)
+    self._file_size = len(content)
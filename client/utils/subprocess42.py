@@ -26,6 +26,7 @@ Example:
 TODO(maruel): Add VOID support like subprocess2.
 """
 
+import codecs
 import collections
 import contextlib
 import errno
@@ -302,6 +303,7 @@ if sys.platform == 'win32':
 else:
   import fcntl  # pylint: disable=F0401
   import select
+  import selectors
 
   # Signals that mean this process should exit quickly.
   STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
@@ -359,6 +361,141 @@ else:
       if not conn.closed:
         fcntl.fcntl(conn, fcntl.F_SETFL, flags)
 
+  class _PipeReader:
+    """Multiplexes reads over the pipes of a child process.
+
+    Unlike recv_multi_impl(), the pipes are made non-blocking once and stay
+    registered in persistent selectors (epoll on Linux) for the lifetime of
+    the process, one per set of pipe names read from. Every wakeup reads once
+    from each ready pipe into a preallocated buffer; data that doesn't fit in
+    the caller's maxsize is kept pending for the next call. Pipes that are not
+    read from are left alone, so the pending data stays bounded.
+    """
+    # Default pipe capacity on Linux, so a full pipe is drained in one read.
+    _BUFFER_SIZE = 65536
+
+    def __init__(self, pipes):
+      """Arguments:
+      - pipes: list of (file object, pipe name).
+      """
+      self._buf = bytearray(self._BUFFER_SIZE)
+      self._view = memoryview(self._buf)
+      # Chunks read but not yet returned, as (name, data, closed) in the order
+      # they were read.
+      self._pending = collections.deque()
+      # Pipes not closed yet, {name: fd}.
+      self._fds = {}
+      # {frozenset(names): selector over the pipes with these names}.
+      self._selectors = {}
+      for conn, name in pipes:
+        fd = conn.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._fds[name] = fd
+
+    def close(self):
+      for selector in self._selectors.values():
+        selector.close()
+      self._selectors.clear()
+
+    def recv(self, names, maxsize, timeout):
+      """Reads from the first available pipe in |names|.
+
+      It will immediately return on a closed connection, independent of
+      timeout.
+
+      Arguments:
+      - names: pipe names to read from. Data already read from other pipes is
+            kept pending.
+      - maxsize: Maximum number of bytes to return. Defaults to MAX_SIZE.
+      - timeout: If None, it is blocking. If 0 or above, will return None if no
+            data is available within |timeout| seconds.
+
+      Returns:
+        tuple(str(name), bytes(data), bool(closed)).
+      """
+      assert timeout is None or isinstance(timeout, (int, float)), timeout
+      maxsize = max(maxsize or MAX_SIZE, 1)
+      selector = self._get_selector(names)
+      end = None if timeout is None else time.time() + timeout
+      while True:
+        item = self._pop(names, maxsize)
+        if item:
+          return item
+        if not selector.get_map():
+          return None, None, False
+        remaining = None if end is None else max(end - time.time(), 0)
+        ready = selector.select(remaining)
+        if not ready and remaining is not None and time.time() >= end:
+          return None, None, False
+        for key, _ in ready:
+          self._read(key)
+
+    def _get_selector(self, names):
+      """Returns the selector over the open pipes in |names|."""
+      names = frozenset(names)
+      selector = self._selectors.get(names)
+      if not selector:
+        selector = selectors.DefaultSelector()
+        for name in names:
+          if name in self._fds:
+            selector.register(self._fds[name], selectors.EVENT_READ, name)
+        self._selectors[names] = selector
+      return selector
+
+    def _read(self, key):
+      """Reads once from a ready pipe.
+
+      A pipe that keeps being filled by the child is read again on the next
+      wakeup, after the data read so far was returned.
+      """
+      while True:
+        try:
+          n = os.readv(key.fd, [self._view])
+          break
+        except BlockingIOError:
+          return
+        except InterruptedError:
+          continue
+      if not n:
+        # On posix, this means the channel closed.
+        del self._fds[key.data]
+        for selector in self._selectors.values():
+          if key.fd in selector.get_map():
+            selector.unregister(key.fd)
+        self._pending.append((key.data, None, True))
+        return
+      self._pending.append((key.data, bytes(self._view[:n]), False))
+
+    def _pop(self, names, maxsize):
+      """Returns the oldest pending chunk for one of |names|, if any."""
+      for i, (name, data, closed) in enumerate(self._pending):
+        if name not in names:
+          continue
+        del self._pending[i]
+        if not data:
+          return name, data, closed
+        # Coalesce the following chunks of the same pipe up to maxsize. The
+        # remainder of a split chunk is kept pending without copying it.
+        chunks = []
+        size = 0
+        while True:
+          if size + len(data) > maxsize:
+            view = memoryview(data)
+            self._pending.insert(i, (name, view[maxsize - size:], False))
+            data = view[:maxsize - size]
+          chunks.append(data)
+          size += len(data)
+          if (size >= maxsize or i >= len(self._pending) or
+              self._pending[i][0] != name or not self._pending[i][1]):
+            break
+          data = self._pending[i][1]
+          del self._pending[i]
+        if len(chunks) == 1 and isinstance(chunks[0], bytes):
+          return name, chunks[0], False
+        return name, b''.join(chunks), False
+      return None
+
 
 TimeoutExpired = subprocess.TimeoutExpired
 
@@ -462,6 +599,10 @@ class Popen(subprocess.Popen):
     # _cleanup().
     self._handle = None
     self._job = None
+    # _PipeReader, created on first use of recv_any() on posix.
+    self._reader = None
+    # Incremental decoders for universal_newlines, one per pipe.
+    self._decoders = {}
 
     self.detached = kwargs.pop('detached', False)
     if self.detached:
@@ -580,16 +721,20 @@ class Popen(subprocess.Popen):
     - TimeoutExpired when more than timeout seconds were spent waiting for the
       process.
     """
-    if not timeout:
-      return super(Popen, self).communicate(input=input)
+    # Once recv_any() was used on posix, the pipes are non-blocking and may
+    # have data pending in self._reader so the stdlib implementation can't be
+    # used.
+    if self._reader is None:
+      if not timeout:
+        return super(Popen, self).communicate(input=input)
+
+      if sys.platform != 'win32':
+        return super(Popen, self).communicate(
+            input=input,
+            timeout=timeout,
+        )
 
-    if sys.platform != 'win32':
-      return super(Popen, self).communicate(
-          input=input,
-          timeout=timeout,
-      )
-
-    assert isinstance(timeout, (int, float)), timeout
+    assert timeout is None or isinstance(timeout, (int, float)), timeout
     if self.stdin or self.stdout or self.stderr:
       stdout = None
       if self.stdout:
@@ -617,11 +762,12 @@ class Popen(subprocess.Popen):
 
       try:
         if self.stdout or self.stderr:
-          start = time.time()
-          end = start + timeout
+          remaining = None
+          if timeout:
+            end = time.time() + timeout
 
-          def remaining():
-            return max(end - time.time(), 0)
+            def remaining():
+              return max(end - time.time(), 0)
 
           for pipe, data in self.yield_any(timeout=remaining):
             if pipe is None:
@@ -802,24 +948,15 @@ class Popen(subprocess.Popen):
     # recv_multi_impl will early exit on a closed connection. Loop accordingly
     # to simplify call sites.
     while True:
-      pipes = [
-          x for x in ((self.stderr, 'stderr'), (self.stdout, 'stdout')) if x[0]
-      ]
-      # If both stdout and stderr have the exact file handle, they are
-      # effectively the same pipe. Deduplicate it since otherwise it confuses
-      # recv_multi_impl().
-      if len(pipes) == 2 and self.stderr.fileno() == self.stdout.fileno():
-        pipes.pop(0)
-
+      pipes = self._pipes()
       if not pipes:
         return None, None
       start = time.time()
-      conns, names = zip(*pipes)
-      index, data, closed = recv_multi_impl(conns, maxsize, timeout)
-      if index is None:
+      name, data, closed = self._recv_multi(pipes, maxsize, timeout)
+      if name is None:
         return None, None
       if closed:
-        self._close(names[index])
+        self._close(name)
         if not data:
           # Loop again. The other pipe may still be open.
           if timeout:
@@ -829,10 +966,8 @@ class Popen(subprocess.Popen):
           continue
 
       if self.universal_newlines and data:
-        if isinstance(data, str):
-          data = data.encode()
-        data = self._translate_newlines(data, encoding='utf-8', errors='strict')
-      return names[index], data
+        data = self._decode(name, data)
+      return name, data
 
   def recv_out(self, maxsize=None, timeout=None):
     """Reads from stdout synchronously with timeout."""
@@ -911,6 +1046,8 @@ class Popen(subprocess.Popen):
     """Closes either stdout or stderr."""
     getattr(self, which).close()
     setattr(self, which, None)
+    if self._reader and not self.stdout and not self.stderr:
+      self._reader.close()
 
   def _cleanup(self):
     """Makes sure resources are not leaked."""
@@ -932,13 +1069,53 @@ class Popen(subprocess.Popen):
     conn = getattr(self, which)
     if conn is None:
       return None
-    _, data, closed = recv_multi_impl([conn], maxsize, timeout)
+    _, data, closed = self._recv_multi([(conn, which)], maxsize, timeout)
     if closed:
       self._close(which)
     if self.universal_newlines and data:
-      data = self._translate_newlines(data)
+      data = self._decode(which, data)
     return data
 
+  def _pipes(self):
+    """Returns the open output pipes as a list of (file object, name)."""
+    pipes = [
+        x for x in ((self.stderr, 'stderr'), (self.stdout, 'stdout')) if x[0]
+    ]
+    # If both stdout and stderr have the exact file handle, they are
+    # effectively the same pipe. Deduplicate it since otherwise it confuses
+    # recv_multi_impl().
+    if len(pipes) == 2 and self.stderr.fileno() == self.stdout.fileno():
+      pipes.pop(0)
+    return pipes
+
+  def _recv_multi(self, pipes, maxsize, timeout):
+    """Reads from the first available pipe in |pipes|.
+
+    Returns:
+      tuple(pipename or None, bytes(data), bool(closed)).
+    """
+    if sys.platform == 'win32':
+      conns, names = zip(*pipes)
+      index, data, closed = recv_multi_impl(conns, maxsize, timeout)
+      return (None if index is None else names[index]), data, closed
+    if not self._reader:
+      # Register every pipe once, even if only one is read from now.
+      self._reader = _PipeReader(self._pipes())
+    return self._reader.recv([name for _, name in pipes], maxsize, timeout)
+
+  def _decode(self, which, data):
+    """Decodes the output of one pipe and translates its newlines.
+
+    An incremental decoder is used since a read may split a multibyte
+    character.
+    """
+    decoder = self._decoders.get(which)
+    if not decoder:
+      decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
+      self._decoders[which] = decoder
+    data = decoder.decode(data)
+    return data.replace('\r\n', '\n').replace('\r', '\n')
+
 
 @contextlib.contextmanager
 def set_signal_handler(signals, handler):